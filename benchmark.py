@@ -0,0 +1,223 @@
+#
+# Copyright (c) 2007-2013. The YARA Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Scanning benchmark for yara-python.
+
+The workload compiles a rule set that uses the most common kinds of strings
+(text, hex patterns with wildcards and jumps, regular expressions, and the
+nocase, wide and xor modifiers) and scans a generated corpus with it. It's
+also the training run used by "setup.py build --enable-pgo".
+
+Run it with the yara module that can be imported:
+
+  $ python benchmark.py
+
+Or compare several builds, each of them in a directory containing the
+compiled module. Speedups are relative to the first directory:
+
+  $ python benchmark.py build/default build/optimized
+
+With --metrics the corpus is scanned with yara.metrics disabled and enabled,
+and the benchmark fails if the metrics slow down scanning more than allowed
+by --max-overhead:
+
+  $ python benchmark.py --metrics --max-overhead 5
+"""
+
+import hashlib
+import optparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+
+WORDS = [
+    b'kernel32.dll', b'GetProcAddress', b'LoadLibraryA', b'VirtualAlloc',
+    b'http://', b'https://', b'User-Agent', b'Mozilla/5.0', b'powershell',
+    b'cmd.exe', b'This program cannot be run in DOS mode', b'password',
+    b'HKEY_LOCAL_MACHINE', b'CreateRemoteThread', b'WriteProcessMemory']
+
+
+def generate_rules(num_rules):
+  """Returns the source for a rule set with "num_rules" rules."""
+  rules = []
+  for i in range(num_rules):
+    word = WORDS[i % len(WORDS)].decode('ascii')
+    rules.append('''
+rule text_%(i)d {
+  strings:
+    $a = "%(word)s%(i)d"
+    $b = "%(word)s" nocase wide
+    $c = { 4D 5A [4-32] 50 45 ?? ?? %(byte)02X }
+  condition:
+    $a or (#b > 2 and $c)
+}
+
+rule regexp_%(i)d {
+  strings:
+    $a = /%(prefix)s[a-z0-9]{4,16}\\.(exe|dll|sys)%(i)d/
+    $b = "xor%(i)d_key" xor(1-16)
+  condition:
+    any of them and filesize > 1KB
+}
+''' % {
+        'i': i,
+        'word': word,
+        'byte': i % 256,
+        'prefix': re.escape(word[:4]).replace('/', '\\/')})
+  return ''.join(rules)
+
+
+def generate_corpus(num_files, file_size):
+  """Returns a list of buffers mixing pseudo-random bytes and text.
+
+  The corpus is always the same, so that different builds can be compared.
+  """
+  corpus = []
+  for i in range(num_files):
+    blocks = []
+    length = 0
+    counter = 0
+    while length < file_size:
+      block = hashlib.sha256(b'%d:%d' % (i, counter)).digest()
+      if counter % 7 == 0:
+        block += WORDS[counter % len(WORDS)]
+      if counter % 11 == 0:
+        block += b'MZ\x90\x00\x03\x00\x00\x00PE\x00\x00\x4c'
+      blocks.append(block)
+      length += len(block)
+      counter += 1
+    corpus.append(b''.join(blocks)[:file_size])
+  return corpus
+
+
+def run(module_dir=None, rounds=3, num_rules=100, num_files=32, file_size=256 << 10):
+  """Runs the workload and returns a dictionary with its timings."""
+  if module_dir:
+    sys.path.insert(0, os.path.abspath(module_dir))
+
+  import yara
+
+  source = generate_rules(num_rules)
+  corpus = generate_corpus(num_files, file_size)
+
+  start = time.time()
+  rules = yara.compile(source=source)
+  compile_time = time.time() - start
+
+  scan_time = scan(rules, corpus, rounds)
+
+  return {
+      'yara': yara.__file__,
+      'compile': compile_time,
+      'scan': scan_time,
+      'throughput': rounds * num_files * file_size / scan_time / (1 << 20)}
+
+
+def scan(rules, corpus, rounds):
+  """Returns the time taken by scanning "corpus" "rounds" times."""
+  start = time.time()
+  for _ in range(rounds):
+    for data in corpus:
+      rules.match(data=data)
+  return time.time() - start
+
+
+def measure_metrics(module_dir=None, rounds=3, num_rules=100, num_files=256,
+                    file_size=4 << 10):
+  """Returns the time taken by the workload with yara.metrics disabled and
+  enabled. Small files are used so that the cost per scan dominates. Runs
+  alternate between both modes and the fastest of each is kept, which makes
+  the comparison less sensitive to noise."""
+  if module_dir:
+    sys.path.insert(0, os.path.abspath(module_dir))
+
+  import yara
+
+  rules = yara.compile(source=generate_rules(num_rules))
+  corpus = generate_corpus(num_files, file_size)
+  enabled = yara.metrics.enabled
+  disabled_time = enabled_time = None
+
+  try:
+    for _ in range(rounds):
+      yara.metrics.disable()
+      elapsed = scan(rules, corpus, 1)
+      disabled_time = min(disabled_time or elapsed, elapsed)
+      yara.metrics.enable()
+      elapsed = scan(rules, corpus, 1)
+      enabled_time = min(enabled_time or elapsed, elapsed)
+  finally:
+    if not enabled:
+      yara.metrics.disable()
+
+  return disabled_time, enabled_time
+
+
+def compare(module_dirs, rounds):
+  """Runs the workload with each module in a separate process."""
+  results = []
+  for module_dir in module_dirs:
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__),
+        '--module-dir', module_dir,
+        '--rounds', str(rounds)])
+    match = re.search(br'scan: ([0-9.]+) MB/s', output)
+    if not match:
+      raise RuntimeError('unexpected output: %r' % output)
+    results.append((module_dir, float(match.group(1))))
+
+  baseline = results[0][1]
+  for module_dir, throughput in results:
+    print('%-40s %8.1f MB/s %6.2fx' % (
+        module_dir, throughput, throughput / baseline))
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options] [module_dir ...]')
+  parser.add_option(
+      '--module-dir', help='directory containing the yara module to use')
+  parser.add_option(
+      '--rounds', type='int', default=3, help='times the corpus is scanned')
+  parser.add_option(
+      '--metrics', action='store_true',
+      help='measure the overhead of yara.metrics')
+  parser.add_option(
+      '--max-overhead', type='float', default=5.0,
+      help='maximum overhead of yara.metrics allowed, in percent')
+  options, args = parser.parse_args()
+
+  if options.metrics:
+    disabled, enabled = measure_metrics(options.module_dir, options.rounds)
+    overhead = (enabled - disabled) * 100 / disabled
+    print('metrics disabled: %.3f s' % disabled)
+    print('metrics enabled: %.3f s' % enabled)
+    print('overhead: %.1f%%' % overhead)
+    if overhead > options.max_overhead:
+      sys.exit(1)
+  elif args:
+    compare(args, options.rounds)
+  else:
+    result = run(options.module_dir, options.rounds)
+    print('module: %s' % result['yara'])
+    print('compile: %.3f s' % result['compile'])
+    print('scan: %.1f MB/s' % result['throughput'])
+
+
+if __name__ == '__main__':
+  main()
@@ -37,7 +37,10 @@ OPTIONS = [
    ('enable-dotnet', None, 'enable "dotnet" module'),
    ('enable-dex', None, 'enable "dex" module'),
    ('enable-macho', None, 'enable "macho" module'),
-   ('enable-profiling', None, 'enable profiling features')]
+   ('enable-profiling', None, 'enable profiling features'),
+   ('enable-lto', None, 'enable link-time optimization'),
+   ('enable-pgo', None, 'enable profile-guided optimization'),
+   ('march=', None, 'target CPU architecture passed to -march (e.g. "native")')]
 
 
 BOOLEAN_OPTIONS = [
@@ -47,7 +50,9 @@ BOOLEAN_OPTIONS = [
     'enable-dotnet',
     'enable-dex',
     'enable-macho',
-    'enable-profiling']
+    'enable-profiling',
+    'enable-lto',
+    'enable-pgo']
 
 
 @contextlib.contextmanager
@@ -122,6 +127,9 @@ class BuildCommand(build):
     self.enable_dex = None
     self.enable_macho = None
     self.enable_profiling = None
+    self.enable_lto = None
+    self.enable_pgo = None
+    self.march = None
 
   def finalize_options(self):
 
@@ -144,6 +152,9 @@ class BuildExtCommand(build_ext):
     self.enable_dex = None
     self.enable_macho = None
     self.enable_profiling = None
+    self.enable_lto = None
+    self.enable_pgo = None
+    self.march = None
 
   def finalize_options(self):
 
@@ -159,7 +170,10 @@ class BuildExtCommand(build_ext):
         ('enable_dotnet', 'enable_dotnet'),
         ('enable_dex', 'enable_dex'),
         ('enable_macho', 'enable_macho'),
-        ('enable_profiling', 'enable_profiling'))
+        ('enable_profiling', 'enable_profiling'),
+        ('enable_lto', 'enable_lto'),
+        ('enable_pgo', 'enable_pgo'),
+        ('march', 'march'))
 
     if self.enable_magic and self.dynamic_linking:
       raise distutils.errors.DistutilsOptionError(
@@ -176,6 +190,12 @@ class BuildExtCommand(build_ext):
     if self.enable_macho and self.dynamic_linking:
       raise distutils.errors.DistutilsOptionError(
           '--enable-macho can''t be used with --dynamic-linking')
+    if self.enable_pgo and self.plat_name in ('win32','win-amd64'):
+      raise distutils.errors.DistutilsOptionError(
+          '--enable-pgo is not supported on Windows')
+    if self.march and self.plat_name in ('win32','win-amd64'):
+      raise distutils.errors.DistutilsOptionError(
+          '--march is not supported on Windows')
 
   def run(self):
     """Execute the build command."""
@@ -255,6 +275,17 @@ class BuildExtCommand(build_ext):
     if self.enable_profiling:
       module.define_macros.append(('YR_PROFILING_ENABLED', '1'))
 
+    if self.enable_lto:
+      if building_for_windows:
+        module.extra_compile_args.append('/GL')
+        module.extra_link_args.append('/LTCG')
+      else:
+        module.extra_compile_args.append('-flto')
+        module.extra_link_args.append('-flto')
+
+    if self.march:
+      module.extra_compile_args.append('-march=%s' % self.march)
+
     if self.dynamic_linking:
       module.libraries.append('yara')
     else:
@@ -309,6 +340,58 @@ class BuildExtCommand(build_ext):
           if x.endswith('.c') and x not in exclusions:
             module.sources.append(x)
 
+    if self.enable_pgo:
+      self.run_pgo(module)
+    else:
+      build_ext.run(self)
+
+  def run_pgo(self, module):
+    """Builds the extension with profile-guided optimization.
+
+    The extension is built with instrumentation first, then benchmark.py
+    runs its workload with it for collecting a profile, and finally the
+    extension is built again using the profile.
+    """
+    compiler = distutils.ccompiler.new_compiler()
+    distutils.sysconfig.customize_compiler(compiler)
+    version = subprocess.check_output(compiler.compiler_so[:1] + ['--version'])
+    using_clang = b'clang' in version
+
+    profile_dir = os.path.abspath(os.path.join(self.build_temp, 'pgo'))
+    if os.path.exists(profile_dir):
+      shutil.rmtree(profile_dir)
+    os.makedirs(profile_dir)
+
+    compile_args = list(module.extra_compile_args)
+    link_args = list(module.extra_link_args)
+
+    module.extra_compile_args = compile_args + ['-fprofile-generate=%s' % profile_dir]
+    module.extra_link_args = link_args + ['-fprofile-generate=%s' % profile_dir]
+
+    # build_ext.run replaces self.compiler with the compiler instance, and
+    # expects it to be the compiler name when invoked again.
+    compiler_name = self.compiler
+    self.force = True
+    build_ext.run(self)
+    self.compiler = compiler_name
+
+    subprocess.check_call([
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark.py'),
+        '--module-dir', os.path.dirname(os.path.abspath(self.get_ext_fullpath(module.name)))])
+
+    if using_clang:
+      profile = os.path.join(profile_dir, 'default.profdata')
+      subprocess.check_call(
+          ['llvm-profdata', 'merge', '-output=%s' % profile] +
+          [os.path.join(profile_dir, x) for x in os.listdir(profile_dir) if x.endswith('.profraw')])
+    else:
+      profile = profile_dir
+
+    module.extra_compile_args = compile_args + [
+        '-fprofile-use=%s' % profile, '-fprofile-correction']
+    module.extra_link_args = link_args + ['-fprofile-use=%s' % profile]
+
     build_ext.run(self)
 
 
@@ -368,6 +451,9 @@ setup(
         'build': BuildCommand,
         'build_ext': BuildExtCommand,
         'update': UpdateCommand},
+    py_modules=[
+        'yara_archive', 'yara_follow', 'yara_pool', 'yara_router',
+        'yara_scan', 'yara_server'],
     ext_modules=[Extension(
         name='yara',
         include_dirs=['yara/libyara/include', 'yara/libyara/', '.'],
@@ -28,6 +28,10 @@ try:
 except:
     import io
 
+# True in the subinterpreter where testSubinterpreters runs the suite. Forking
+# and tracemalloc are not supported there.
+SUBINTERPRETER = False
+
 PE32_FILE = binascii.unhexlify('\
 4d5a000000000000000000000000000000000000000000000000000000000000\
 0000000000000000000000000000000000000000000000000000000040000000\
@@ -908,6 +912,1682 @@ class TestYara(unittest.TestCase):
                 source="rule test { condition: true}",
                 externals={'foo': u'\u6765\u6613\u7f51\u7edc\u79d1'})
 
+    def testExternalsBinding(self):
+
+        r = yara.compile(
+            source='rule test { condition: ext_int == 15 and ext_str == "foo" }',
+            externals={'ext_int': 0, 'ext_str': ''})
+
+        ext = yara.Externals(r, ext_int=15, ext_str='foo')
+        self.assertTrue(ext.rules is r)
+        self.assertTrue(r.match(data='dummy', externals=ext))
+
+        ext.update(ext_str='bar')
+        self.assertFalse(r.match(data='dummy', externals=ext))
+
+        ext.update({'ext_str': 'foo'}, ext_int=15)
+        self.assertTrue(r.match(data='dummy', externals=ext))
+
+        self.assertRaises(yara.Error, yara.Externals, r, ext_unknown=1)
+        self.assertRaises(yara.Error, ext.update, ext_int='foo')
+        self.assertRaises(TypeError, ext.update, ext_int=[])
+
+        other = yara.compile(source='rule test { condition: true }')
+        self.assertRaises(TypeError, other.match, data='dummy', externals=ext)
+
+        # Updates are validated completely before applying any value.
+        self.assertRaises(yara.Error, ext.update, ext_str='bar', ext_int='foo')
+        self.assertRaises(yara.Error, ext.update, {'ext_str': 'bar'}, ext_unknown=1)
+        self.assertTrue(r.match(data='dummy', externals=ext))
+
+        r = yara.compile(
+            source='rule test { condition: ext_float > 1.5 and ext_bool and ext_int == 3 }',
+            externals={'ext_float': 0.0, 'ext_bool': False, 'ext_int': 0})
+
+        # Values that change between scans are defined again, the others
+        # keep what the scanner had.
+        ext = yara.Externals(r, ext_float=2.0, ext_bool=True, ext_int=3)
+        self.assertTrue(r.match(data='dummy', externals=ext))
+        ext.update(ext_bool=False)
+        ext.update(ext_float=1.0, ext_bool=True)
+        self.assertFalse(r.match(data='dummy', externals=ext))
+        ext.update(ext_float=2.0, ext_int=3)
+        self.assertTrue(r.match(data='dummy', externals=ext))
+
+    def testExternalsBindingThreads(self):
+
+        import threading
+
+        r = yara.compile(
+            source='rule test { condition: ext_int == 15 }',
+            externals={'ext_int': 0})
+
+        ext = yara.Externals(r, ext_int=15)
+        entered = threading.Event()
+        leave = threading.Event()
+        results = []
+
+        def callback(data):
+            entered.set()
+            leave.wait(10)
+            return yara.CALLBACK_CONTINUE
+
+        def blocked_scan():
+            results.append(r.match(data='dummy', externals=ext, callback=callback))
+
+        # A scan using the binding doesn't keep other threads from using it,
+        # and an update doesn't affect the scans already in progress.
+        t = threading.Thread(target=blocked_scan)
+        t.start()
+        try:
+            self.assertTrue(entered.wait(10))
+            self.assertTrue(r.match(data='dummy', externals=ext))
+            self.assertTrue(t.is_alive())
+            ext.update(ext_int=0)
+            self.assertFalse(r.match(data='dummy', externals=ext))
+        finally:
+            leave.set()
+            t.join()
+
+        self.assertEqual([m.rule for m in results[0]], ['test'])
+        self.assertFalse(r.match(data='dummy', externals=ext))
+        ext.update(ext_int=15)
+        self.assertTrue(r.match(data='dummy', externals=ext))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'requires /proc')
+    def testMatchProcesses(self):
+
+        import subprocess
+
+        child = subprocess.Popen(
+            [sys.executable, '-c',
+             'import sys, time\n'
+             'marker = "yara-python-" + "process-marker"\n'
+             'sys.stdout.write("ready\\n")\n'
+             'sys.stdout.flush()\n'
+             'time.sleep(60)\n'],
+            stdout=subprocess.PIPE)
+
+        try:
+            child.stdout.readline()
+
+            r = yara.compile(source='rule test { strings: $a = "yara-python-process-marker" condition: $a }')
+
+            # Skip file-backed mappings, the marker lives in the heap.
+            results = r.match_processes(
+                [child.pid, 0x7fffffff], workers=2,
+                region_filter=lambda region: not region['path'].startswith('/'))
+
+            self.assertEqual(len(results), 2)
+            self.assertEqual(results[0]['pid'], child.pid)
+            self.assertTrue(results[0]['error'] is None)
+            self.assertEqual([m.rule for m in results[0]['matches']], ['test'])
+            self.assertTrue(len(results[0]['regions']) > 0)
+
+            region = results[0]['regions'][0]
+            offset, rule, string = region['strings'][0]
+            self.assertTrue(region['base'] <= offset < region['base'] + region['size'])
+            self.assertEqual((rule, string), ('test', '$a'))
+
+            self.assertTrue(isinstance(results[1]['error'], yara.Error))
+
+            results = r.match_processes([child.pid], region_filter=lambda region: False)
+            self.assertEqual(results[0]['matches'], [])
+        finally:
+            child.kill()
+            child.wait()
+
+    def testStopConditions(self):
+
+        r = yara.compile(source="""
+            rule a { condition: true }
+            rule b : critical { condition: true }
+            rule c { condition: true }
+            """)
+
+        self.assertEqual([m.rule for m in r.match(data='dummy')], ['a', 'b', 'c'])
+        self.assertEqual([m.rule for m in r.match(data='dummy', stop_after=1)], ['a'])
+        self.assertEqual([m.rule for m in r.match(data='dummy', stop_after=2)], ['a', 'b'])
+        self.assertEqual([m.rule for m in r.match(data='dummy', stop_on_tags={'critical'})], ['a', 'b'])
+        self.assertEqual([m.rule for m in r.match(data='dummy', stop_on_rules=['default:a'])], ['a'])
+        self.assertEqual([m.rule for m in r.match(data='dummy', stop_on_rules=['c'])], ['a', 'b', 'c'])
+        self.assertEqual([m.rule for m in r.match(data='dummy', stop_on_rules=['unknown'])], ['a', 'b', 'c'])
+
+        self.assertRaises(ValueError, r.match, data='dummy', stop_after=-1)
+        self.assertRaises(TypeError, r.match, data='dummy', stop_on_tags=[1])
+
+    @unittest.skipIf(sys.version_info < (3, 4), 'requires tracemalloc')
+    def testStopConditionsMemory(self):
+
+        if SUBINTERPRETER:
+            self.skipTest('tracemalloc is not supported in subinterpreters')
+
+        import tracemalloc
+
+        # The table built for stop_on_tags and stop_on_rules has an entry per
+        # rule, so a table leaked by each scan is easy to notice.
+        r = yara.compile(source='\n'.join(
+            'rule r%d : t%d { condition: true }' % (i, i) for i in range(1000)))
+
+        def scan():
+            r.match(data='dummy', stop_on_tags=['t1'], stop_on_rules=['r2'])
+            r.match(data='dummy', stop_on_rules=['r2'], batch_callback=lambda batch: None)
+            self.assertRaises(TypeError, r.match, data='dummy', stop_on_tags=['t1'], externals=1)
+
+        scan()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for i in range(100):
+                scan()
+            self.assertLess(tracemalloc.get_traced_memory()[0] - before, 100 * 1000)
+        finally:
+            tracemalloc.stop()
+
+    def testSelect(self):
+
+        r = yara.compile(sources={
+            'ns1': """
+                private rule helper { condition: true }
+                rule a : pe { condition: helper }
+                rule b : elf { condition: true }
+                """,
+            'ns2': """
+                global rule g { condition: filesize > 0 }
+                rule c : pe { condition: true }
+                """})
+
+        def rule_names(matches):
+            return sorted(m.namespace + ':' + m.rule for m in matches)
+
+        self.assertEqual(
+            rule_names(r.match(data='dummy')),
+            ['ns1:a', 'ns1:b', 'ns2:c', 'ns2:g'])
+
+        pe = r.select(tags=['pe'])
+        self.assertEqual(rule_names(pe.match(data='dummy')), ['ns1:a', 'ns2:c', 'ns2:g'])
+        self.assertEqual(rule_names(pe.match(data='')), ['ns1:a'])
+        self.assertEqual([rule.identifier for rule in pe], ['helper', 'a', 'g', 'c'])
+
+        ns1 = r.select(namespaces=['ns1'])
+        self.assertEqual(rule_names(ns1.match(data='dummy')), ['ns1:a', 'ns1:b'])
+
+        self.assertEqual(
+            rule_names(r.select(identifiers=['b', 'ns2:c']).match(data='dummy')),
+            ['ns1:b', 'ns2:c', 'ns2:g'])
+
+        self.assertEqual(rule_names(r.select(tags=['pe'], namespaces=['ns2']).match(data='dummy')), ['ns2:c', 'ns2:g'])
+        self.assertEqual(r.select(tags=['unknown']).match(data='dummy'), [])
+
+        # Views are independent from each other and from the original rules.
+        self.assertEqual(rule_names(pe.match(data='dummy')), ['ns1:a', 'ns2:c', 'ns2:g'])
+        self.assertEqual(len(r.match(data='dummy')), 4)
+
+        del r
+        self.assertEqual(rule_names(ns1.match(data='dummy')), ['ns1:a', 'ns1:b'])
+        self.assertRaises(yara.Error, ns1.save, os.devnull)
+        self.assertRaises(TypeError, ns1.select, tags=[1])
+
+    def testSelectDependencies(self):
+
+        r = yara.compile(source="""
+            rule a { condition: true }
+            rule b : x { condition: a }
+            rule c { condition: b and filesize > 0 }
+            rule d : y { condition: c }
+            """)
+
+        def rule_names(matches):
+            return [m.rule for m in matches]
+
+        self.assertEqual(rule_names(r.match(data='dummy')), ['a', 'b', 'c', 'd'])
+
+        # Rules referenced from selected rules are evaluated but not reported.
+        x = r.select(tags=['x'])
+        self.assertEqual(rule_names(x.match(data='dummy')), ['b'])
+        self.assertEqual([rule.identifier for rule in x], ['b'])
+
+        y = r.select(tags=['y'])
+        self.assertEqual(rule_names(y.match(data='dummy')), ['d'])
+        self.assertEqual(y.match(data=''), [])
+
+        # Dependencies kept by a view don't become part of a nested selection.
+        self.assertEqual(rule_names(y.select(identifiers=['d', 'a']).match(data='dummy')), ['d'])
+        self.assertEqual(y.select(identifiers=['a']).match(data='dummy'), [])
+
+        # Excluded rules that no selected rule references are not evaluated.
+        r = yara.compile(source="""
+            import "console"
+            rule a { condition: console.log("a") }
+            rule b { condition: console.log("b") }
+            rule c { condition: a }
+            """)
+
+        logged = []
+        r.select(identifiers=['c']).match(data='dummy', console_callback=logged.append)
+        self.assertEqual(logged, ['a'])
+
+    def testSelectCallback(self):
+
+        r = yara.compile(source="""
+            rule a { condition: true }
+            rule b : x { condition: false }
+            rule c : x { condition: a }
+            rule d { condition: false }
+            """)
+
+        for which in (yara.CALLBACK_ALL, yara.CALLBACK_NON_MATCHES):
+            reported = []
+
+            def callback(data):
+                reported.append((data['rule'], data['matches']))
+                return yara.CALLBACK_CONTINUE
+
+            r.select(tags=['x']).match(data='dummy', callback=callback, which_callbacks=which)
+
+            if which == yara.CALLBACK_ALL:
+                self.assertEqual(reported, [('b', False), ('c', True)])
+            else:
+                self.assertEqual(reported, [('b', False)])
+
+        batches = []
+        r.select(tags=['x']).match(
+            data='dummy',
+            batch_callback=lambda batch: batches.extend((d['rule'], d['matches']) for d in batch),
+            which_callbacks=yara.CALLBACK_ALL)
+
+        self.assertEqual(batches, [('b', False), ('c', True)])
+
+    def testBatchCallback(self):
+
+        r = yara.compile(source="""
+            rule a { strings: $a = "dummy" condition: $a }
+            rule b { condition: false }
+            rule c { condition: true }
+            rule d { condition: true }
+            """)
+
+        batches = []
+
+        def callback(batch):
+            batches.append(batch)
+            return yara.CALLBACK_CONTINUE
+
+        matches = r.match(data='dummy', batch_callback=callback)
+        self.assertEqual([m.rule for m in matches], ['a', 'c', 'd'])
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([d['rule'] for d in batches[0]], ['a', 'b', 'c', 'd'])
+        self.assertEqual([d['matches'] for d in batches[0]], [True, False, True, True])
+        self.assertEqual(batches[0][0]['strings'], [(0, '$a', b'dummy')])
+
+        batches = []
+        r.match(data='dummy', batch_callback=callback, batch_size=3,
+                which_callbacks=yara.CALLBACK_MATCHES)
+        self.assertEqual([[d['rule'] for d in b] for b in batches], [['a', 'c', 'd']])
+
+        batches = []
+        r.match(data='dummy', batch_callback=callback, batch_size=2)
+        self.assertEqual([[d['rule'] for d in b] for b in batches], [['a', 'b'], ['c', 'd']])
+
+        def abort(batch):
+            batches.append(batch)
+            return yara.CALLBACK_ABORT
+
+        batches = []
+        matches = r.match(data='dummy', batch_callback=abort, batch_size=2)
+        self.assertEqual([m.rule for m in matches], ['a'])
+        self.assertEqual(len(batches), 1)
+
+        def error(batch):
+            raise KeyError()
+
+        self.assertRaises(KeyError, r.match, data='dummy', batch_callback=error)
+        self.assertRaises(TypeError, r.match, data='dummy', batch_callback=1)
+        self.assertRaises(TypeError, r.match, data='dummy', batch_callback=callback, callback=callback)
+        self.assertRaises(ValueError, r.match, data='dummy', batch_callback=callback, batch_size=-1)
+
+    def testMatchesCollectedWithoutCallback(self):
+
+        r = yara.compile(source="""
+            rule a : t1 t2 { meta: m = 1 strings: $a = "ab" $b = { 63 64 } condition: all of them }
+            rule b { strings: $a = "zz" condition: $a }
+            rule c { strings: $a = /b.d/ condition: #a > 1 }
+            """)
+
+        data = 'abcdabcdzzz' * 10
+
+        def callback(d):
+            return yara.CALLBACK_CONTINUE
+
+        def as_tuples(matches):
+            return [(m.rule, m.namespace, m.tags, m.meta, m.strings) for m in matches]
+
+        collected = r.match(data=data)
+        self.assertEqual([m.rule for m in collected], ['a', 'b', 'c'])
+        self.assertEqual(len(collected[1].strings), 20)
+        self.assertEqual(as_tuples(collected), as_tuples(r.match(data=data, callback=callback)))
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'columnar results require Python 3')
+    def testColumnarResult(self):
+
+        r = yara.compile(source="""
+            rule a { strings: $a = "ab" $b = "cd" condition: any of them }
+            rule b { condition: true }
+            rule c { strings: $a = "zz" condition: $a }
+            """)
+
+        result = r.match(data='abcdab', result='columnar')
+
+        self.assertEqual(result['rules'].format, 'q')
+        self.assertEqual(result['length'].format, 'i')
+        self.assertEqual(result['rules'].tolist(), [0, 1])
+        self.assertEqual(result['rule_index'].tolist(), [0, 0, 0])
+        self.assertEqual(result['offset'].tolist(), [0, 4, 2])
+        self.assertEqual(result['length'].tolist(), [2, 2, 2])
+        self.assertEqual(result['data'].tobytes(), b'ababcd')
+        self.assertEqual(result['data_offset'].tolist(), [0, 2, 4, 6])
+        self.assertEqual(
+            [result['rule_names'][i] for i in result['rules']],
+            ['default:a', 'default:b'])
+        self.assertEqual(
+            [result['string_names'][i] for i in result['string_index']],
+            ['$a', '$a', '$b'])
+
+        result = r.match(data='dummy', result='columnar')
+        self.assertEqual(result['rules'].tolist(), [1])
+        self.assertEqual(len(result['offset']), 0)
+        self.assertEqual(result['data_offset'].tolist(), [0])
+
+        self.assertEqual(len(r.match(data='abcdab', result='matches')), 2)
+        self.assertRaises(ValueError, r.match, data='dummy', result='unknown')
+        self.assertRaises(TypeError, r.match, data='dummy', result='columnar', callback=lambda d: 0)
+
+    def _subinterpreters(self):
+        try:
+            import _interpreters as interpreters
+        except ImportError:
+            try:
+                import _xxsubinterpreters as interpreters
+            except ImportError:
+                self.skipTest('subinterpreters not available')
+        return interpreters
+
+    def _run_in_subinterpreter(self, interpreters, interp, code):
+        code = 'import sys\nsys.path[:] = %r\n%s' % (sys.path, code)
+        error = interpreters.run_string(interp, code)
+        if error is not None:
+            self.fail(error.formatted)
+
+    @unittest.skipIf(sys.version_info < (3, 12), 'requires Python 3.12')
+    def testSubinterpreters(self):
+
+        interpreters = self._subinterpreters()
+        interp = interpreters.create()
+
+        try:
+            self._run_in_subinterpreter(interpreters, interp, '\n'.join([
+                'import io, unittest, tests',
+                'tests.SUBINTERPRETER = True',
+                'loader = unittest.TestLoader()',
+                'suite = unittest.TestSuite(',
+                '    t for t in loader.loadTestsFromTestCase(tests.TestYara)',
+                '    if "Subinterpreter" not in t.id())',
+                'stream = io.StringIO()',
+                'result = unittest.TextTestRunner(stream=stream).run(suite)',
+                'assert result.wasSuccessful(), stream.getvalue()',
+            ]))
+        finally:
+            interpreters.destroy(interp)
+
+    @unittest.skipIf(sys.version_info < (3, 12), 'requires Python 3.12')
+    def testSubinterpreterThreads(self):
+
+        import threading
+
+        interpreters = self._subinterpreters()
+        interps = [interpreters.create() for i in range(4)]
+        errors = []
+
+        code = '\n'.join([
+            'import yara',
+            'r = yara.compile(source="rule test { strings: $a = \\"foo\\" condition: #a == 1000 }")',
+            'data = b"foo" * 1000',
+            'for i in range(50):',
+            '    assert [m.rule for m in r.match(data=data)] == ["test"]',
+        ])
+
+        def worker(interp):
+            try:
+                self._run_in_subinterpreter(interpreters, interp, code)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in interps]
+
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            for interp in interps:
+                interpreters.destroy(interp)
+
+        self.assertEqual(errors, [])
+
+    def testGilNotUsed(self):
+
+        import sysconfig
+
+        if not sysconfig.get_config_var('Py_GIL_DISABLED'):
+            self.skipTest('requires a free-threaded build')
+
+        # Importing yara must not re-enable the GIL.
+        self.assertFalse(sys._is_gil_enabled())
+
+    def testConcurrentRules(self):
+
+        # Runs a mix of match(), iteration, save() and profiling_info() on the
+        # same Rules object from a growing number of threads. Set the
+        # YARA_STRESS_REPORT environment variable for printing the throughput
+        # obtained with each number of threads.
+
+        import threading
+        import time
+
+        r = yara.compile(sources=dict(
+            ('ns%d' % i, 'rule test%d : tag%d { meta: m = %d strings: $a = "foo" condition: $a }' % (i, i, i))
+            for i in range(20)))
+
+        identifiers = [rule.identifier for rule in r]
+        data = b'foo' * 1000
+        rounds = 3
+        errors = []
+        report = []
+
+        self.assertEqual(len(identifiers), 20)
+
+        def match():
+            matches = []
+            def callback(data):
+                matches.append(data['rule'])
+                return yara.CALLBACK_CONTINUE
+            r.match(data=data, callback=callback, which_callbacks=yara.CALLBACK_MATCHES)
+            if sorted(matches) != sorted(identifiers):
+                raise AssertionError(matches)
+            if sorted(m.rule for m in r.match(data=data)) != sorted(identifiers):
+                raise AssertionError('unexpected matches')
+            if sys.version_info[0] >= 3:
+                r.match(data=data, result='columnar')
+
+        def iterate():
+            # Every iteration must see all the rules, in order, no matter
+            # what other threads are doing.
+            seen = [rule.identifier for rule in r]
+            if seen != identifiers:
+                raise AssertionError(seen)
+
+        def save():
+            try:
+                stream = StringIO.StringIO()
+            except:
+                stream = io.BytesIO()
+            r.save(file=stream)
+            stream.seek(0)
+            if len(list(yara.load(file=stream))) != len(identifiers):
+                raise AssertionError('unexpected rules')
+
+        def profile():
+            try:
+                r.profiling_info()
+            except yara.Error:
+                pass
+
+        def worker(operations):
+            try:
+                for i in range(rounds):
+                    for operation in operations:
+                        operation()
+            except Exception as e:
+                errors.append(e)
+
+        for num_threads in (1, 2, 4, 8):
+            threads = [
+                threading.Thread(
+                    target=worker, args=([match, iterate, save, profile][i % 4:] +
+                                         [match, iterate, save, profile][:i % 4],))
+                for i in range(num_threads)]
+
+            start = time.time()
+
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            elapsed = time.time() - start
+            report.append((num_threads, num_threads * rounds * 4 / max(elapsed, 1e-6)))
+
+        self.assertEqual(errors, [])
+
+        if os.environ.get('YARA_STRESS_REPORT'):
+            for num_threads, throughput in report:
+                sys.stderr.write(
+                    '\n%d threads: %.0f operations/s (%.2fx)' % (
+                        num_threads, throughput, throughput / report[0][1]))
+
+    def testFileRanges(self):
+
+        size = 3 << 20
+        content = bytearray(size)
+        content[0:4] = b'HEAD'
+        content[(3 << 19) + 7:(3 << 19) + 13] = b'MIDDLE'
+        content[-8:-4] = b'TAIL'
+        content[-4:] = b'\x01\x02\x03\x04'
+
+        r = yara.compile(source='''
+            rule head { strings: $a = "HEAD" condition: $a at 0 }
+            rule middle { strings: $a = "MIDDLE" condition: $a }
+            rule tail { strings: $a = "TAIL" condition: $a at filesize - 8 }
+            rule trailer { condition: uint32(filesize - 4) == 0x04030201 }
+            rule size { condition: filesize == %d }
+        ''' % size)
+
+        f = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            f.write(content)
+            f.close()
+
+            def rules(**kwargs):
+                return sorted(m.rule for m in r.match(f.name, **kwargs))
+
+            self.assertEqual(
+                rules(), ['head', 'middle', 'size', 'tail', 'trailer'])
+            self.assertEqual(
+                rules(ranges=[(0, 1024), (-1024, None)]),
+                ['head', 'size', 'tail', 'trailer'])
+            self.assertEqual(
+                rules(ranges=[((3 << 19) - 100, (3 << 19) + 100)]),
+                ['middle', 'size'])
+            self.assertEqual(
+                rules(ranges=[[0, 100], [50, 1 << 30]]),
+                ['head', 'middle', 'size', 'tail', 'trailer'])
+            self.assertEqual(rules(max_bytes=1024), ['head', 'size'])
+            self.assertEqual(
+                rules(ranges=[(-1024, None), (0, 1024)], max_bytes=1024),
+                ['head', 'size'])
+            self.assertEqual(rules(ranges=[]), ['size'])
+
+            m = r.match(f.name, ranges=[(-1024, None)])
+            tail = [x for x in m if x.rule == 'tail'][0]
+            self.assertEqual(tail.strings, [(size - 8, '$a', b'TAIL')])
+
+            self.assertRaises(TypeError, r.match, f.name, ranges=[(0,)])
+            self.assertRaises(TypeError, r.match, f.name, ranges=[('a', 1)])
+            self.assertRaises(TypeError, r.match, data=b'x', max_bytes=1)
+            self.assertRaises(ValueError, r.match, f.name, max_bytes=-2)
+        finally:
+            os.unlink(f.name)
+
+        self.assertRaises(yara.Error, r.match, f.name, max_bytes=1)
+
+    def testResultCache(self):
+
+        try:
+            from threading import get_ident
+        except ImportError:
+            from thread import get_ident
+
+        source = '''
+            rule a : tag { meta: m = 1 strings: $a = "foo" condition: $a }
+            rule b { condition: ext }
+        '''
+
+        r = yara.compile(source=source, externals={'ext': False})
+        cache = yara.ResultCache(max_entries=2)
+
+        m1 = r.match(data=b'foo', cache=cache)
+        m2 = r.match(data=b'foo', cache=cache)
+
+        self.assertEqual(m1, m2)
+        self.assertEqual(m2[0].tags, ['tag'])
+        self.assertEqual(m2[0].meta, {'m': 1})
+        self.assertEqual(m2[0].strings, [(0, '$a', b'foo')])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate, 0.5)
+
+        # Externals are part of the key.
+        m = r.match(data=b'foo', externals={'ext': True}, cache=cache)
+        self.assertEqual([x.rule for x in m], ['a', 'b'])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        # Scans with callbacks don't use the cache.
+        r.match(data=b'foo', cache=cache, callback=lambda data: 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        # Least recently used entries are evicted.
+        r.match(data=b'bar', cache=cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+
+        # Rules with other rules enabled have a different fingerprint.
+        r.select(identifiers=['b']).match(data=b'foo', cache=cache)
+        self.assertEqual(cache.misses, 4)
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+        self.assertRaises(TypeError, r.match, data=b'foo', cache=1)
+        self.assertRaises(ValueError, yara.ResultCache, max_entries=-1)
+
+        directory = tempfile.mkdtemp()
+        f = tempfile.NamedTemporaryFile(delete=False)
+
+        try:
+            f.write(b'foo')
+            f.close()
+
+            # Results persisted in the directory are found by other caches
+            # and by rules compiled again from the same source.
+            cache = yara.ResultCache(directory=directory)
+            r.match(f.name, cache=cache)
+
+            cache = yara.ResultCache(directory=directory)
+            r = yara.compile(source=source, externals={'ext': False})
+            m = r.match(f.name, cache=cache)
+
+            self.assertEqual([x.rule for x in m], ['a'])
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+            # Temporary files are named after the process and thread writing
+            # them, and a writer never replaces a file it didn't create.
+            entries = os.listdir(directory)
+            self.assertEqual(len(entries), 1)
+            entry = os.path.join(directory, entries[0])
+            temp = '%s.%d.%d.tmp' % (entry, os.getpid(), get_ident())
+            os.unlink(entry)
+
+            with open(temp, 'wb') as fh:
+                fh.write(b'other')
+
+            r.match(f.name, cache=yara.ResultCache(directory=directory))
+
+            self.assertEqual(os.listdir(directory), [os.path.basename(temp)])
+            with open(temp, 'rb') as fh:
+                self.assertEqual(fh.read(), b'other')
+            os.unlink(temp)
+
+            # Corrupt entries are reported, not taken as misses.
+            r.match(f.name, cache=yara.ResultCache(directory=directory))
+            with open(entry, 'wb') as fh:
+                fh.write(b'corrupt')
+            self.assertRaises(
+                (ValueError, EOFError, TypeError),
+                r.match, f.name, cache=yara.ResultCache(directory=directory))
+
+            # With ranges only the data in them is part of the key.
+            cache = yara.ResultCache()
+            for data, hits, rules in [(b'foo bar', 0, ['a']),
+                                      (b'foo baz', 1, ['a']),
+                                      (b'fox baz', 1, [])]:
+                with open(f.name, 'wb') as fh:
+                    fh.write(data)
+                m = r.match(f.name, ranges=[(0, 3)], cache=cache)
+                self.assertEqual([x.rule for x in m], rules)
+                self.assertEqual(cache.hits, hits)
+        finally:
+            os.unlink(f.name)
+            for name in os.listdir(directory):
+                os.unlink(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def testAnalyze(self):
+
+        r = yara.compile(source='''
+            rule fast { strings: $a = "abcdefgh" condition: $a }
+            rule slow { strings: $a = { 00 00 } $b = "xyz1" condition: any of them }
+            rule chained { strings: $a = { 41 42 43 44 [-] 45 46 47 48 } condition: $a }
+            rule nostrings { condition: true }
+            ''')
+
+        report = dict((rule['identifier'], rule) for rule in r.analyze())
+
+        self.assertEqual(len(report), 4)
+        self.assertFalse(report['fast']['slow'])
+        self.assertEqual(report['fast']['namespace'], 'default')
+        self.assertEqual(len(report['fast']['strings']), 1)
+        self.assertEqual(report['fast']['strings'][0]['identifier'], '$a')
+        self.assertEqual(len(report['fast']['strings'][0]['atoms']), 1)
+        atom, mask, quality = report['fast']['strings'][0]['atoms'][0]
+        self.assertEqual(len(atom), 4)
+        self.assertEqual(mask, b'\xff' * 4)
+        self.assertTrue(atom in b'abcdefgh')
+        self.assertEqual(report['fast']['min_atom_quality'], quality)
+
+        self.assertTrue(report['slow']['slow'])
+        strings = dict((s['identifier'], s) for s in report['slow']['strings'])
+        self.assertEqual(strings['$a']['atoms'][0][0], b'\x00\x00')
+        self.assertTrue(strings['$a']['slow'])
+        self.assertFalse(strings['$b']['slow'])
+        self.assertTrue(
+            strings['$a']['min_atom_quality'] < yara.ATOM_QUALITY_WARNING_THRESHOLD)
+
+        self.assertEqual(len(report['chained']['strings']), 1)
+        self.assertEqual(len(report['chained']['strings'][0]['atoms']), 2)
+        self.assertFalse(report['nostrings']['slow'])
+        self.assertEqual(report['nostrings']['min_atom_quality'], None)
+
+        # Wildcards expanded by the compiler are reported as a single atom,
+        # and get the same quality the compiler gives them.
+        r = yara.compile(source='''
+            rule wildcards {
+              strings:
+                $a = { 01 ?? 03 04 }
+                $b = { 01 ?2 ?? 04 }
+                $c = /a.c/
+              condition:
+                any of them
+            }''')
+
+        strings = dict((s['identifier'], s) for s in r.analyze()[0]['strings'])
+        self.assertEqual(
+            [atom[:2] for atom in strings['$a']['atoms']],
+            [(b'\x01\x00\x03\x04', b'\xff\x00\xff\xff')])
+        self.assertEqual(
+            [atom[:2] for atom in strings['$b']['atoms']],
+            [(b'\x01\x02\x00\x04', b'\xff\x0f\x00\xff')])
+        self.assertTrue(strings['$c']['slow'])
+        self.assertEqual(r.warnings, ['line 6: string "$c" may slow down scanning'])
+
+        # A lower threshold makes every string acceptable.
+        r = yara.compile(source='rule slow { strings: $a = { 00 00 } condition: $a }')
+        self.assertFalse(any(rule['slow'] for rule in r.analyze(threshold=0)))
+
+        self.assertRaises(yara.WarningError, yara.compile,
+            source='rule slow { strings: $a = { 00 00 } condition: $a }',
+            min_atom_quality=yara.ATOM_QUALITY_WARNING_THRESHOLD)
+
+        try:
+            yara.compile(
+                source='rule test { strings: $a = "abcd" condition: $a }',
+                min_atom_quality=255)
+            self.fail('expected yara.WarningError')
+        except yara.WarningError as e:
+            self.assertEqual(len(e.warnings), 1)
+            self.assertTrue('"default:test"' in e.warnings[0])
+
+        r = yara.compile(
+            source='rule test { strings: $a = "abcd" condition: $a }',
+            min_atom_quality=yara.ATOM_QUALITY_WARNING_THRESHOLD)
+        self.assertEqual(len(r.analyze()), 1)
+
+        self.assertEqual(len(
+            yara.compile(source='rule a { condition: true } rule b { condition: true }'
+                ).select(identifiers=["a"]).analyze()), 1)
+    def testMemoryUsage(self):
+
+        source = '''
+            rule small { condition: true }
+            rule large : tag {
+              meta:
+                author = "someone"
+              strings:
+                $a = "abcdefghijklmnopqrstuvwxyz"
+                $b = "ABCD" nocase
+                $c = { 01 02 03 04 05 06 }
+              condition:
+                any of them
+            }'''
+
+        r = yara.compile(source=source)
+        usage = r.memory_usage()
+
+        self.assertEqual(usage['num_rules'], 2)
+        self.assertEqual(usage['num_strings'], 3)
+        self.assertTrue(usage['num_atoms'] >= 18)
+        self.assertTrue(usage['arena_size'] >= usage['arena_used'] > 0)
+        self.assertEqual(usage['arena_used'], sum(usage['sections'].values()))
+        self.assertEqual(
+            usage['ac_transition_table'], usage['sections']['ac_transition_table'])
+        self.assertEqual(usage['ac_match_table'], usage['sections']['ac_match_table'])
+
+        largest = usage['largest_rules']
+        self.assertEqual([rule['identifier'] for rule in largest], ['large', 'small'])
+        self.assertEqual(largest[0]['namespace'], 'default')
+        self.assertEqual(largest[0]['atoms'], usage['num_atoms'])
+        self.assertTrue(largest[0]['size'] > largest[1]['size'])
+        self.assertEqual(len(r.memory_usage(top=1)['largest_rules']), 1)
+        self.assertRaises(ValueError, r.memory_usage, top=-1)
+
+        # Loaded rules report the same numbers, except for the relocation
+        # entries, which are only kept by loaded rules.
+        try:
+            stream = StringIO.StringIO()
+        except:
+            stream = io.BytesIO()
+
+        r.save(file=stream)
+        stream.seek(0)
+        loaded = yara.load(file=stream).memory_usage()
+
+        for key in ('num_rules', 'num_strings', 'num_atoms', 'arena_used',
+                    'sections', 'largest_rules'):
+            self.assertEqual(loaded[key], usage[key])
+
+    @unittest.skipIf(sys.platform == 'win32', 'requires fork()')
+    def testScanPool(self):
+
+        if SUBINTERPRETER:
+            self.skipTest('requires fork()')
+
+        import shutil
+        import signal
+        import time
+
+        r = yara.compile(source='''
+            rule a : tag { meta: m = 1 strings: $a = "foo" condition: $a }
+            rule b { strings: $b = "bar" condition: $b and ext }
+        ''', externals={'ext': False})
+
+        tmpdir = tempfile.mkdtemp()
+        paths = []
+
+        # Python 2 can't pass file descriptors to the workers, the data is
+        # scanned from files there.
+        def sample(data):
+            if sys.version_info[0] >= 3:
+                return bytearray(data)
+            paths.append(os.path.join(tmpdir, str(len(paths))))
+            with open(paths[-1], 'wb') as f:
+                f.write(data)
+            return paths[-1]
+
+        f = tempfile.NamedTemporaryFile(delete=False)
+
+        try:
+            f.write(b'xx foo bar')
+            f.close()
+
+            fd = os.open(f.name, os.O_RDONLY)
+            foo = sample(b'foo')
+
+            samples = [sample(b'foo bar'), f.name, fd, sample(b'baz')]
+            expected = [
+                r.match(data=b'foo bar'),
+                r.match(f.name),
+                r.match(f.name),
+                r.match(data=b'baz')]
+
+            if sys.version_info[0] < 3:
+                del samples[2], expected[2]
+
+            # Workers are forked with os.fork(), which runs the fork hooks.
+            forks = []
+            if hasattr(os, 'register_at_fork'):
+                os.register_at_fork(after_in_parent=lambda: forks.append(1))
+
+            with yara.ScanPool(r, processes=2) as pool:
+                self.assertTrue(isinstance(pool, yara.ScanPool))
+                self.assertEqual(pool.processes, 2)
+                self.assertEqual(len(pool.pids), 2)
+                if hasattr(os, 'register_at_fork'):
+                    self.assertEqual(len(forks), 2)
+                self.assertEqual(pool.map(samples), expected)
+
+                results = sorted(
+                    (repr(s), m) for s, m in pool.imap_unordered(samples))
+                self.assertEqual(
+                    results,
+                    sorted((repr(s), m) for s, m in zip(samples, expected)))
+
+                # Workers that die are replaced.
+                os.kill(pool.pids[0], signal.SIGKILL)
+                time.sleep(0.1)
+
+                results = pool.map([foo] * 10)
+                self.assertEqual(
+                    [[(m.rule, m.strings) for m in x] for x in results],
+                    [[('a', [(0, '$a', b'foo')])]] * 10)
+                self.assertEqual(pool.replaced, 1)
+                self.assertEqual(len(pool.pids), 2)
+
+                self.assertRaises(TypeError, pool.map, [1.5])
+                self.assertRaises(yara.Error, pool.map, ['/nonexistent'])
+
+                it = pool.imap_unordered([foo] * 4)
+                next(it)
+                self.assertRaises(RuntimeError, pool.map, [])
+                del it
+
+            self.assertEqual(pool.pids, [])
+            self.assertRaises(ValueError, pool.map, [])
+
+            # External variables are defined for all the workers.
+            pool = yara.ScanPool(r, processes=1, externals={'ext': True})
+            self.assertEqual(
+                [m.rule for m in pool.map([samples[0]])[0]], ['a', 'b'])
+            pool.close()
+
+            # Workers that don't answer in time are killed and replaced.
+            with yara.ScanPool(r, processes=1, timeout=1) as pool:
+                os.kill(pool.pids[0], signal.SIGSTOP)
+                self.assertRaises(yara.TimeoutError, pool.map, [foo])
+                self.assertEqual(pool.replaced, 1)
+                self.assertEqual([m.rule for m in pool.map([foo])[0]], ['a'])
+
+            os.close(fd)
+        finally:
+            os.unlink(f.name)
+            shutil.rmtree(tmpdir)
+
+        self.assertRaises(TypeError, yara.ScanPool, 'foo')
+        self.assertRaises(ValueError, yara.ScanPool, r, processes=0)
+
+    def testPickleMatch(self):
+
+        import pickle
+
+        r = yara.compile(
+            source='rule a : t { meta: m = 1 strings: $a = "foo" condition: $a }')
+
+        match = r.match(data=b'foo foo', max_string_matches=1)[0]
+        copy = pickle.loads(pickle.dumps(match))
+
+        self.assertTrue(isinstance(copy, yara.Match))
+        self.assertEqual(copy, match)
+        self.assertEqual(
+            (copy.rule, copy.namespace, copy.tags, copy.meta, copy.strings,
+             copy.truncated),
+            ('a', 'default', ['t'], {'m': 1}, [(0, '$a', b'foo')], True))
+
+    @unittest.skipIf(sys.platform == 'win32', 'requires UNIX sockets')
+    @unittest.skipIf(
+        sys.version_info[0] < 3, 'passing buffers to workers requires Python 3')
+    def testServer(self):
+
+        if SUBINTERPRETER:
+            self.skipTest('requires fork()')
+
+        import shutil
+        import threading
+        import yara_server
+
+        r = yara.compile(source='''
+            rule a : tag { meta: m = 1 strings: $a = "foo" condition: $a }
+            rule b { strings: $b = "bar" condition: $b }
+        ''')
+
+        tmpdir = tempfile.mkdtemp()
+        address = os.path.join(tmpdir, 'yara.sock')
+        path = os.path.join(tmpdir, 'sample')
+
+        with open(path, 'wb') as f:
+            f.write(b'xx foo bar')
+
+        server = yara_server.Server(r, address, workers=4)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            with yara_server.Client(address) as client:
+                matches = client.scan(bytearray(b'foo'))
+                self.assertEqual(matches, [{
+                    'rule': 'a',
+                    'namespace': 'default',
+                    'tags': ['tag'],
+                    'meta': {'m': 1},
+                    'strings': [[0, '$a', 'Zm9v']]}])
+                self.assertEqual(
+                    [m['rule'] for m in client.scan(path)], ['a', 'b'])
+                self.assertRaises(
+                    yara.Error, client.scan, os.path.join(tmpdir, 'none'))
+                if hasattr(client._socket, 'sendmsg'):
+                    fd = os.open(path, os.O_RDONLY)
+                    self.assertEqual(
+                        [m['rule'] for m in client.scan(fd)], ['a', 'b'])
+                    os.close(fd)
+
+                # Responses to other requests are kept while scan() waits.
+                first = client.send(bytearray(b'foo'))
+                second = client.send(path)
+                self.assertEqual(
+                    [m['rule'] for m in client.scan(bytearray(b'bar'))], ['b'])
+                responses = dict(
+                    (response['id'], [m['rule'] for m in response['matches']])
+                    for response in [client.receive(), client.receive()])
+                self.assertEqual(responses, {first: ['a'], second: ['a', 'b']})
+
+            # Load test: several clients streaming requests at once.
+            samples = [path, bytearray(b'bar'), bytearray(b'baz')] * 50
+            expected = sorted(zip(
+                [repr(s) for s in samples], [['a', 'b'], ['b'], []] * 50))
+            results = []
+            errors = []
+
+            def run_client():
+                try:
+                    with yara_server.Client(address) as client:
+                        results.append(sorted(
+                            (repr(s), [m['rule'] for m in response['matches']])
+                            for s, response in client.scan_many(samples)))
+                except Exception as e:
+                    errors.append(e)
+
+            clients = [threading.Thread(target=run_client) for _ in range(8)]
+            for t in clients:
+                t.start()
+            for t in clients:
+                t.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(results, [expected] * 8)
+        finally:
+            server.shutdown()
+            thread.join()
+            shutil.rmtree(tmpdir)
+
+        self.assertFalse(os.path.exists(address))
+
+    def testRuleStore(self):
+
+        import threading
+
+        r = yara.compile(source='rule a { strings: $a = "foo" condition: $a }')
+        store = yara.RuleStore(r)
+
+        self.assertTrue(store.rules is r)
+        self.assertEqual(store.version, 1)
+        self.assertEqual(len(store.fingerprint), 64)
+        self.assertEqual(store.reload_latency, None)
+        self.assertEqual([m.rule for m in store.match(data=b'foo')], ['a'])
+
+        fingerprint = store.fingerprint
+
+        store.reload(source='rule b { strings: $a = "foo" condition: $a }')
+        store.wait()
+
+        self.assertFalse(store.reloading)
+        self.assertEqual(store.version, 2)
+        self.assertNotEqual(store.fingerprint, fingerprint)
+        self.assertTrue(store.reload_latency >= 0)
+        self.assertEqual([m.rule for m in store.match(data=b'foo')], ['b'])
+        self.assertEqual(store.scans, {1: 1, 2: 1})
+
+        # The store doesn't keep previous versions alive.
+        self.assertEqual(sys.getrefcount(r), 2)
+
+        # A failed reload keeps the current version.
+        store.reload(source='rule c { condition: x }')
+        self.assertRaises(yara.SyntaxError, store.wait)
+        store.wait()
+        self.assertEqual(store.version, 2)
+
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.close()
+
+        try:
+            yara.compile(source='rule d { condition: true }').save(f.name)
+            store.reload(f.name, compiled=True)
+            self.assertRaises(RuntimeError, store.reload, f.name, compiled=True)
+            store.wait()
+            self.assertEqual([m.rule for m in store.match(data=b'')], ['d'])
+        finally:
+            os.unlink(f.name)
+
+        # Reloading while other threads scan.
+        stop = threading.Event()
+        errors = []
+
+        def scan():
+            while not stop.is_set():
+                try:
+                    matches = store.match(data=b'foo')
+                    if len(matches) != 1:
+                        errors.append(matches)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=scan) for i in range(4)]
+
+        for t in threads:
+            t.start()
+
+        for i in range(10):
+            store.reload(source='rule r%d { condition: true }' % i)
+            store.wait()
+
+        stop.set()
+
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(store.version, 13)
+        self.assertEqual(sorted(store.scans), list(range(1, 14)))
+
+        self.assertRaises(TypeError, yara.RuleStore, 'foo')
+
+    def testScanCommand(self):
+
+        import json
+        import shutil
+        import yara_scan
+
+        rules_dir = tempfile.mkdtemp()
+        rules_path = os.path.join(rules_dir, 'rules.yar')
+
+        with open(rules_path, 'w') as f:
+            f.write('rule a { strings: $a = "foo" condition: $a }')
+
+        tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(tmpdir, 'sub'))
+
+        for name, data in [
+                ('one', b'foo'),
+                ('two', b'bar'),
+                ('big', b'foo' * 1000),
+                (os.path.join('sub', 'three'), b'xfoo')]:
+            with open(os.path.join(tmpdir, name), 'wb') as f:
+                f.write(data)
+
+        class Output(object):
+            def __init__(self):
+                self.lines = []
+            def write(self, line):
+                self.lines.append(line)
+
+        def run(*args):
+            output = Output()
+            stdout = sys.stdout
+            sys.stdout = output
+            try:
+                status = yara_scan.main(list(args) + [rules_path, tmpdir])
+            finally:
+                sys.stdout = stdout
+            results = [json.loads(line) for line in output.lines]
+            return status, sorted(
+                os.path.relpath(r['path'], tmpdir) for r in results)
+
+        try:
+            self.assertEqual(
+                run('--no-summary'), (0, ['big', 'one']))
+            self.assertEqual(
+                run('--no-summary', '-r', '--workers', '3'),
+                (0, ['big', 'one', os.path.join('sub', 'three')]))
+            self.assertEqual(
+                run('--no-summary', '-r', '--max-size', '1KB'),
+                (0, ['one', os.path.join('sub', 'three')]))
+            self.assertEqual(
+                run('--no-summary', '-r', '--min-size', '4'),
+                (0, ['big', os.path.join('sub', 'three')]))
+
+            r = yara.compile(rules_path)
+            output = Output()
+            scanner = yara_scan.Scanner(r, output, workers=2, slowest=2)
+            scanner.scan(yara_scan.iter_files([tmpdir], recursive=True))
+            scanner.scan([(os.path.join(tmpdir, 'none'), 0)])
+
+            summary = scanner.summary()
+            self.assertEqual(summary['files'], 5)
+            self.assertEqual(summary['bytes'], 3010)
+            self.assertEqual(summary['matching'], 3)
+            self.assertEqual(summary['errors'], 1)
+            self.assertEqual(len(summary['slowest']), 2)
+            self.assertTrue('files/s' in yara_scan.format_summary(summary))
+            self.assertEqual(json.loads(output.lines[-1])['path'],
+                             os.path.join(tmpdir, 'none'))
+        finally:
+            shutil.rmtree(tmpdir)
+            shutil.rmtree(rules_dir)
+
+        self.assertEqual(yara_scan.parse_size('2MB'), 2 << 20)
+
+    def testEncodedOutput(self):
+
+        import base64
+        import json
+
+        r = yara.compile(source=r'''
+            rule a : t1 t2 {
+              meta: m = 1 s = "q\"x\\y" b = true n = -5 d = 1 d = 2
+              strings: $a = "foo" $b = { 00 01 FF }
+              condition: any of them }
+            rule b { strings: $a = "bar" condition: $a }
+            rule c { condition: false }
+        ''')
+
+        data = b'foo \x00\x01\xff bar foo'
+        matches = r.match(data=data)
+
+        def expected(encode):
+            return [{
+                'rule': m.rule,
+                'namespace': m.namespace,
+                'tags': m.tags,
+                'meta': m.meta,
+                'strings': [
+                    [o, i, encode(d)] if encode else [o, i]
+                    for o, i, d in m.strings]}
+                for m in matches]
+
+        for output_data, encode in [
+                ('base64', lambda d: base64.b64encode(d).decode('ascii')),
+                ('hex', lambda d: binascii.hexlify(d).decode('ascii')),
+                (None, None)]:
+            output = r.match(data=data, output='json', output_data=output_data)
+            self.assertEqual(json.loads(output.decode('utf-8')), expected(encode))
+            self.assertEqual(
+                json.loads(
+                    yara.dumps_matches(matches, data=output_data).decode('utf-8')),
+                expected(encode))
+
+        self.assertEqual(
+            json.loads(r.match(data=data, output='json').decode('utf-8'))[0]['meta'],
+            {'m': 1, 's': 'q"x\\y', 'b': True, 'n': -5, 'd': 2})
+        self.assertEqual(
+            json.loads(r.match(
+                data=data,
+                output='json',
+                allow_duplicate_metadata=True).decode('utf-8'))[0]['meta']['d'],
+            [1, 2])
+
+        data = b'bar\xffbar'
+        for output_data in ('base64', 'raw', None):
+            self.assertEqual(
+                r.match(data=data, output='msgpack', output_data=output_data),
+                yara.dumps_matches(
+                    r.match(data=data), format='msgpack', data=output_data))
+
+        self.assertEqual(r.match(data=b'', output='json'), b'[]')
+        self.assertEqual(r.match(data=b'', output='msgpack'), b'\x90')
+        self.assertEqual(
+            r.match(data=b'bar', output='msgpack', output_data=None),
+            b'\x91\x85\xa4rule\xa1b\xa9namespace\xa7default\xa4tags\x90'
+            b'\xa4meta\x80\xa7strings\x91\x92\x00\xa2$a')
+
+        self.assertRaises(ValueError, r.match, data=data, output='xml')
+        self.assertRaises(
+            ValueError, r.match, data=data, output='json', output_data='raw')
+        self.assertRaises(
+            TypeError, r.match, data=data, output='json', callback=lambda x: 0)
+        self.assertRaises(TypeError, yara.dumps_matches, [1])
+
+    def testScanLimits(self):
+
+        r = yara.compile(source='''
+            rule a { strings: $a = "ab" $b = "cd" condition: any of them }
+            rule b { strings: $a = "abcd" condition: $a }
+            rule c { condition: true }
+        ''')
+
+        data = b'abcd' * 10
+
+        def summary(matches):
+            return [
+                (m.rule, m.truncated, len(m.strings),
+                 sum(len(s[2]) for s in m.strings))
+                for m in matches]
+
+        self.assertEqual(
+            summary(r.match(data=data)),
+            [('a', False, 20, 40), ('b', False, 10, 40), ('c', False, 0, 0)])
+        self.assertEqual(
+            summary(r.match(data=data, max_string_matches=2)),
+            [('a', True, 4, 8), ('b', True, 2, 8), ('c', False, 0, 0)])
+        self.assertEqual(
+            summary(r.match(data=data, max_matches=3)),
+            [('a', True, 3, 6), ('b', True, 0, 0), ('c', False, 0, 0)])
+        self.assertEqual(
+            summary(r.match(data=data, max_match_data=7)),
+            [('a', True, 20, 7), ('b', True, 10, 0), ('c', False, 0, 0)])
+        self.assertEqual(
+            summary(r.match(data=data, max_matches=0)),
+            [('a', True, 0, 0), ('b', True, 0, 0), ('c', False, 0, 0)])
+
+        # The same data is always truncated in the same way.
+        matches = r.match(data=data, max_result_size=300)
+        self.assertTrue(matches[0].truncated)
+        self.assertEqual(
+            [m.strings for m in r.match(data=data, max_result_size=300)],
+            [m.strings for m in matches])
+        self.assertLess(
+            sum(len(m.strings) for m in matches),
+            sum(len(m.strings) for m in r.match(data=data)))
+
+        output = r.match(data=data, max_matches=3, output='json', output_data=None)
+        self.assertIn(b'"strings":[],"truncated":true}', output)
+        self.assertEqual(
+            yara.dumps_matches(r.match(data=data, max_matches=3), data=None),
+            output)
+
+        cache = yara.ResultCache()
+        self.assertTrue(r.match(data=data, max_matches=1, cache=cache)[0].truncated)
+        self.assertTrue(r.match(data=data, max_matches=1, cache=cache)[0].truncated)
+        self.assertFalse(r.match(data=data, cache=cache)[0].truncated)
+
+        # Python 2 can't pass buffers to the workers.
+        if (sys.platform != 'win32' and sys.version_info[0] >= 3 and
+                not SUBINTERPRETER):
+            with yara.ScanPool(r, processes=1, max_string_matches=1) as pool:
+                self.assertEqual(
+                    summary(pool.map([bytearray(data)])[0]),
+                    [('a', True, 2, 4), ('b', True, 1, 4), ('c', False, 0, 0)])
+            self.assertRaises(ValueError, yara.ScanPool, r, max_match_data=-2)
+
+        self.assertRaises(ValueError, r.match, data=data, max_matches=-2)
+        self.assertRaises(
+            TypeError, r.match, data=data, max_matches=1, callback=lambda x: 0)
+
+    def testMatchArchive(self):
+
+        import gzip
+        import io
+        import tarfile
+        import zipfile
+
+        r = yara.compile(source='rule a { strings: $a = "foo" condition: $a }')
+
+        tar = io.BytesIO()
+        archive = tarfile.open(fileobj=tar, mode='w:gz')
+        for name, data in [('x/foo.txt', b'a foo b'), ('bar.txt', b'bar')]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+        archive.close()
+
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+            f.write(b'zzz foo')
+
+        outer = io.BytesIO()
+        with zipfile.ZipFile(outer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('one.txt', b'foo')
+            archive.writestr('dir/', b'')
+            archive.writestr('inner.tar.gz', tar.getvalue())
+            archive.writestr('single.gz', compressed.getvalue())
+            archive.writestr('bomb.bin', b'\x00' * (4 << 20))
+            archive.writestr('two.txt', b'foo bar')
+
+        def summary(members):
+            return [
+                (m.path, m.depth, m.matches and [x.rule for x in m.matches],
+                 m.error and str(m.error))
+                for m in members]
+
+        expected = [
+            ('one.txt', 0, ['a'], None),
+            ('inner.tar.gz', 0, [], None),
+            ('inner.tar.gz/x/foo.txt', 1, ['a'], None),
+            ('inner.tar.gz/bar.txt', 1, [], None),
+            ('single.gz', 0, [], None),
+            ('single.gz/single', 1, ['a'], None),
+            ('bomb.bin', 0, None, 'member exceeds max_ratio'),
+            ('two.txt', 0, ['a'], None)]
+
+        for workers in (1, 4):
+            outer.seek(0)
+            self.assertEqual(
+                summary(r.match_archive(outer, workers=workers, max_depth=1)),
+                expected)
+
+        outer.seek(0)
+        self.assertEqual(
+            summary(r.match_archive(outer)),
+            [m for m in expected if m[1] == 0])
+
+        outer.seek(0)
+        self.assertEqual(
+            summary(r.match_archive(outer, max_member_size=100)),
+            [('one.txt', 0, ['a'], None),
+             ('inner.tar.gz', 0, None, 'member exceeds max_member_size'),
+             ('single.gz', 0, [], None),
+             ('bomb.bin', 0, None, 'member exceeds max_member_size'),
+             ('two.txt', 0, ['a'], None)])
+
+        # The scan stops when the total size is exceeded.
+        outer.seek(0)
+        self.assertEqual(
+            summary(r.match_archive(outer, max_total_size=100, max_depth=1)),
+            [('one.txt', 0, ['a'], None),
+             ('inner.tar.gz', 0, None, 'archive exceeds max_total_size')])
+
+        # Members are also scanned with the keyword arguments of match().
+        outer.seek(0)
+        members = list(r.match_archive(outer, max_matches=0))
+        self.assertTrue(members[0].matches[0].truncated)
+        self.assertEqual(members[0].size, 3)
+
+        # The members of a compressed tar file have no compressed size, the
+        # ratio applies to their total and the size of the whole file.
+        bomb = io.BytesIO()
+        archive = tarfile.open(fileobj=bomb, mode='w:gz')
+        for name, data in [('a.bin', b'\x00' * (768 << 10)),
+                           ('b.bin', b'\x00' * (768 << 10)),
+                           ('c.txt', b'foo')]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+        archive.close()
+
+        bomb.seek(0)
+        self.assertEqual(
+            summary(r.match_archive(bomb)),
+            [('a.bin', 0, [], None),
+             ('b.bin', 0, None, 'member exceeds max_ratio')])
+
+        bomb.seek(0)
+        self.assertEqual(
+            summary(r.match_archive(bomb, max_ratio=1 << 20)),
+            [('a.bin', 0, [], None),
+             ('b.bin', 0, [], None),
+             ('c.txt', 0, ['a'], None)])
+
+        f = tempfile.NamedTemporaryFile(suffix='.tar.gz', delete=False)
+
+        try:
+            f.write(tar.getvalue())
+            f.close()
+            self.assertEqual(
+                summary(r.match_archive(f.name)),
+                [('x/foo.txt', 0, ['a'], None), ('bar.txt', 0, [], None)])
+        finally:
+            os.unlink(f.name)
+
+        self.assertRaises(
+            yara.Error, list, r.match_archive(io.BytesIO(b'not an archive')))
+        self.assertRaises(
+            TypeError, list, r.match_archive(io.BytesIO(outer.getvalue()), foo=1))
+
+    def testMetrics(self):
+
+        r = yara.compile(source='''
+            rule a { strings: $a = "foo" condition: $a }
+            rule b { condition: true }
+            ''')
+
+        self.assertFalse(yara.metrics.enabled)
+        yara.metrics.reset()
+        r.match(data=b'foo')
+        self.assertEqual(yara.metrics.as_dict()['scans'], 0)
+
+        yara.metrics.enable()
+
+        try:
+            self.assertTrue(yara.metrics.enabled)
+            r.match(data=b'foobar')
+            r.match(data=b'bar')
+            self.assertRaises(yara.Error, r.match, '/non/existent/file')
+
+            metrics = yara.metrics.as_dict()
+            self.assertEqual(metrics['scans'], 3)
+            self.assertEqual(metrics['scanned_bytes'], 9)
+            self.assertEqual(metrics['errors'], {3: 1})
+            self.assertEqual(
+                metrics['rule_hits'],
+                {('default', 'a'): 1, ('default', 'b'): 2})
+            self.assertEqual(metrics['scan_latency']['count'], 3)
+            self.assertEqual(metrics['scan_latency']['buckets'][-1][1], 3)
+
+            text = yara.metrics.openmetrics()
+            self.assertTrue('yara_scans_total 3\n' in text)
+            self.assertTrue('yara_errors_total{code="3"} 1\n' in text)
+            self.assertTrue(
+                'yara_rule_hits_total{namespace="default",rule="b"} 2\n' in text)
+            self.assertTrue(
+                'yara_scan_duration_seconds_bucket{le="+Inf"} 3\n' in text)
+            self.assertTrue(text.endswith('# EOF\n'))
+
+            yara.metrics.reset()
+            metrics = yara.metrics.as_dict()
+            self.assertEqual(metrics['scans'], 0)
+            self.assertEqual(metrics['rule_hits'], {})
+        finally:
+            yara.metrics.disable()
+
+        self.assertFalse(yara.metrics.enabled)
+        self.assertRaises(TypeError, type(yara.metrics))
+
+    def testRouter(self):
+
+        import yara_router
+
+        source = '''
+            import "pe"
+            rule tagged : pe {
+              strings: $a = "foo"
+              condition: $a and uint16(0) == 0x5a4d
+            }
+            rule declared {
+              meta: filetype = "elf, macho"
+              strings: $a = "foo"
+              condition: $a and (uint8(0) == 0x7f or uint8(0) == 0xcf)
+            }
+            rule uses_pe {
+              strings: $a = "pe.rule()"  // not a module reference: elf.type
+              condition: pe.number_of_sections == 1 or $a or true
+            }
+            rule unknown { meta: filetype = "script" strings: $a = "foo" condition: $a }
+            rule generic { strings: $a = "foo" condition: $a }
+            '''
+
+        router = yara_router.compile(sources={'ns': source})
+
+        self.assertEqual(router.types[('ns', 'tagged')], frozenset(['pe']))
+        self.assertEqual(
+            router.types[('ns', 'declared')], frozenset(['elf', 'macho']))
+        self.assertEqual(router.types[('ns', 'uses_pe')], frozenset(['pe']))
+        self.assertEqual(router.types[('ns', 'unknown')], frozenset())
+        self.assertEqual(router.types[('ns', 'generic')], frozenset())
+
+        self.assertEqual(yara_router.sniff(b'MZ\x90\x00'), 'pe')
+        self.assertEqual(yara_router.sniff(b'\x7fELF\x02'), 'elf')
+        self.assertEqual(yara_router.sniff(b'\xca\xfe\xba\xbe\x00\x00\x00\x02'), 'macho')
+        self.assertEqual(yara_router.sniff(b'\xca\xfe\xba\xbe\x00\x00\x00\x34'), None)
+        self.assertEqual(yara_router.sniff(b'foo'), None)
+
+        def rules(matches):
+            return sorted(m.rule for m in matches)
+
+        self.assertEqual(
+            rules(router.match(data=b'MZ foo')),
+            ['generic', 'tagged', 'unknown', 'uses_pe'])
+        self.assertEqual(
+            rules(router.match(data=b'\x7fELF foo')),
+            ['declared', 'generic', 'unknown'])
+        self.assertEqual(
+            rules(router.match(data=b'foo')), ['generic', 'unknown'])
+
+        f = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            f.write(b'\xcf\xfa\xed\xfe foo')
+            f.close()
+            self.assertEqual(
+                rules(router.match(f.name)), ['declared', 'generic', 'unknown'])
+        finally:
+            os.unlink(f.name)
+
+        # "uses_pe" matches any file, which is detected when verifying.
+        router.verify = True
+        router.match(data=b'MZ foo')
+
+        try:
+            router.match(data=b'\x7fELF foo')
+            self.fail('RoutingError not raised')
+        except yara_router.RoutingError as e:
+            self.assertEqual(e.file_type, 'elf')
+            self.assertEqual(e.missing, [('ns', 'uses_pe')])
+            self.assertEqual(e.unexpected, [])
+            self.assertTrue('uses_pe' in rules(e.matches))
+
+        # Rules referenced from another type's rules are evaluated for that
+        # type too, but only reported for their own.
+        router = yara_router.compile(source='''
+            rule upx : elf { strings: $a = "UPX!" condition: $a }
+            rule packed_pe : pe { condition: upx and uint16(0) == 0x5a4d }
+            rule packed { condition: upx }
+            ''')
+
+        self.assertEqual(rules(router.match(data=b'MZ UPX!')), ['packed', 'packed_pe'])
+        self.assertEqual(rules(router.match(data=b'\x7fELF UPX!')), ['packed', 'upx'])
+        self.assertEqual(rules(router.match(data=b'UPX!')), ['packed'])
+        self.assertEqual(
+            [rule.identifier for rule in router.rules_for('pe')], ['packed_pe', 'packed'])
+
+    def testFollow(self):
+
+        import threading
+
+        r = yara.compile(source='''
+            rule a { strings: $a = "foo" condition: $a }
+            rule b { condition: filesize > 0 }
+            ''')
+
+        self.assertRaises(ValueError, r.follow, 'x', overlap=-1)
+        self.assertRaises(TypeError, r.follow, 'x', data=b'x')
+
+        f = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            f.close()
+            follower = r.follow(f.name, overlap=16)
+
+            def append(data):
+                with open(f.name, 'ab') as out:
+                    out.write(data)
+
+            def scan():
+                return sorted((m.rule, m.strings) for m in follower.scan())
+
+            self.assertEqual(scan(), [])
+            append(b'foo bar')
+            self.assertEqual(
+                scan(), [('a', [(0, '$a', b'foo')]), ('b', [])])
+            self.assertEqual(scan(), [])
+
+            # Matches in the overlap are not reported again, and matches
+            # crossing the boundary between two scans are found.
+            append(b' baz fo')
+            self.assertEqual(scan(), [])
+            append(b'o ' + b'x' * 100 + b'foo')
+            self.assertEqual(
+                scan(), [('a', [(12, '$a', b'foo'), (116, '$a', b'foo')])])
+            self.assertEqual(follower.offset, 119)
+
+            # A truncated file is scanned again from the beginning.
+            with open(f.name, 'wb') as out:
+                out.write(b'foo')
+            self.assertEqual(
+                scan(), [('a', [(0, '$a', b'foo')]), ('b', [])])
+
+            stop = threading.Event()
+            matches = follower.follow(interval=0.01, stop=stop)
+            append(b' foo')
+            match = next(matches)
+            self.assertEqual(match.strings, [(4, '$a', b'foo')])
+            stop.set()
+            self.assertEqual(list(matches), [])
+        finally:
+            os.unlink(f.name)
+
     def testCallbackAll(self):
         global rule_data
         rule_data = []
@@ -1106,6 +2786,20 @@ class TestYara(unittest.TestCase):
         self.assertTrue(r.identifier == 'test2')
         r = next(it)
         self.assertTrue(r.identifier == 'test3')
+        self.assertRaises(StopIteration, next, it)
+
+        # Every iter() call gets its own position.
+        it1 = iter(rules)
+        it2 = iter(rules)
+        self.assertTrue(it1 is not it2)
+        self.assertEqual(next(it1).identifier, 'test1')
+        self.assertEqual(next(it1).identifier, 'test2')
+        self.assertEqual(next(it2).identifier, 'test1')
+        self.assertEqual(next(it1).identifier, 'test3')
+        self.assertEqual(next(it2).identifier, 'test2')
+
+        pairs = [(a.identifier, b.identifier) for a in rules for b in rules]
+        self.assertEqual(len(pairs), 9)
 
     def testSetConfig(self):
 
@@ -1128,6 +2822,7 @@ class TestYara(unittest.TestCase):
         r = list(yara.compile(source=rules))
         self.assertTrue(r[0].is_global == True)
         self.assertTrue(r[1].is_private == True)
+        self.assertEqual(r[0].namespace, 'default')
 
     def testMatchMemoryview(self):
 
@@ -19,6 +19,8 @@ limitations under the License.
 
 #include <Python.h>
 #include "structmember.h"
+#include "pythread.h"
+#include "marshal.h"
 
 #if PY_VERSION_HEX >= 0x02060000
 #include "bytesobject.h"
@@ -29,8 +31,23 @@ limitations under the License.
 #define PyBytes_FromStringAndSize PyString_FromStringAndSize
 #endif
 
+#include <sys/stat.h>
+#include <stdarg.h>
 #include <time.h>
+
+#if defined(_WIN32)
+#include <process.h>
+#endif
+
+#if !defined(_WIN32)
+#include <fcntl.h>
+#include <unistd.h>
+#endif
+
 #include <yara.h>
+#include <yara/proc.h>
+#include <yara/ahocorasick.h>
+#include <yara/exec.h>
 
 #if PY_VERSION_HEX < 0x02050000 && !defined(PY_SSIZE_T_MIN)
 typedef int Py_ssize_t;
@@ -62,12 +79,85 @@ typedef long Py_hash_t;
 #define PyDescr_NAME(x) (((PyDescrObject*)x)->d_name)
 #endif
 
-/* Module globals */
+#ifndef PYTHREAD_INVALID_THREAD_ID
+#define PYTHREAD_INVALID_THREAD_ID ((unsigned long) -1)
+#endif
+
+/* Module state */
+
+// Starting with Python 3.11 the module uses multi-phase initialization, and
+// exceptions and types are created for each module object, which allows
+// loading it in multiple interpreters. Older versions use static types and
+// a single global state.
+
+#if PY_VERSION_HEX >= 0x030B0000
+#define USE_MODULE_STATE
+#endif
+
+typedef struct
+{
+  PyObject* YaraError;
+  PyObject* YaraSyntaxError;
+  PyObject* YaraTimeoutError;
+  PyObject* YaraWarningError;
+  PyTypeObject* Rule_Type;
+  PyTypeObject* Rules_Type;
+  PyTypeObject* RulesIterator_Type;
+  PyTypeObject* Match_Type;
+  PyTypeObject* Externals_Type;
+  PyTypeObject* ScanPool_Type;
+  PyTypeObject* ResultCache_Type;
+  PyTypeObject* RuleStore_Type;
+  PyTypeObject* Metrics_Type;
+  PyTypeObject* RuleString_Type;
+  bool initialized;
+
+} YARA_STATE;
+
+#if defined(USE_MODULE_STATE)
+
+static struct PyModuleDef yara_module;
+
+static YARA_STATE* get_module_state(
+    PyObject* module)
+{
+  return (YARA_STATE*) PyModule_GetState(module);
+}
+
+static YARA_STATE* get_type_state(
+    PyTypeObject* type)
+{
+  return get_module_state(PyType_GetModuleByDef(type, &yara_module));
+}
+
+#else
+
+static YARA_STATE yara_state;
+
+static YARA_STATE* get_module_state(
+    PyObject* module)
+{
+  return &yara_state;
+}
+
+static YARA_STATE* get_type_state(
+    PyTypeObject* type)
+{
+  return &yara_state;
+}
+
+#endif
+
+// Instances of heap types own a reference to their type, which must be
+// released when they are deallocated.
 
-static PyObject* YaraError = NULL;
-static PyObject* YaraSyntaxError = NULL;
-static PyObject* YaraTimeoutError = NULL;
-static PyObject* YaraWarningError = NULL;
+static void release_type(
+    PyTypeObject* type)
+{
+  #if defined(USE_MODULE_STATE)
+  Py_DECREF(type);
+  #endif
+}
 
 
 #define YARA_DOC "\
@@ -91,6 +181,7 @@ typedef struct
   PyObject* tags;
   PyObject* meta;
   PyObject* strings;
+  char truncated;
 
 } Match;
 
@@ -130,10 +221,18 @@ static PyMemberDef Match_members[] = {
     READONLY,
     "Tuple with offsets and strings that matched the file"
   },
+  {
+    "truncated",
+    T_BOOL,
+    offsetof(Match, truncated),
+    READONLY,
+    "True if some matches or match data were dropped by the scan limits"
+  },
   { NULL } // End marker
 };
 
 static PyObject* Match_NEW(
+    YARA_STATE* state,
     const char* rule,
     const char* ns,
     PyObject* tags,
@@ -158,12 +257,24 @@ static PyObject* Match_richcompare(
 static Py_hash_t Match_hash(
     PyObject* self);
 
+static PyObject* Match_reduce(
+    PyObject* self,
+    PyObject* args);
+
 
 static PyMethodDef Match_methods[] =
 {
+  {
+    "__reduce__",
+    (PyCFunction) Match_reduce,
+    METH_NOARGS,
+    "Returns the values needed to pickle the match"
+  },
   { NULL },
 };
 
+#if !defined(USE_MODULE_STATE)
+
 static PyTypeObject Match_Type = {
   PyVarObject_HEAD_INIT(NULL, 0)
   "yara.Match",               /*tp_name*/
@@ -205,12 +316,37 @@ static PyTypeObject Match_Type = {
   0,                          /* tp_new */
 };
 
+#else
+
+static PyType_Slot Match_Type_slots[] = {
+  {Py_tp_dealloc, Match_dealloc},
+  {Py_tp_repr, Match_repr},
+  {Py_tp_hash, Match_hash},
+  {Py_tp_getattro, Match_getattro},
+  {Py_tp_doc, (void*) "Match class"},
+  {Py_tp_richcompare, Match_richcompare},
+  {Py_tp_methods, Match_methods},
+  {Py_tp_members, Match_members},
+  {0, NULL}
+};
+
+static PyType_Spec Match_Type_spec = {
+  "yara.Match",
+  sizeof(Match),
+  0,
+  Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_DISALLOW_INSTANTIATION,
+  Match_Type_slots
+};
+
+#endif
+
 // Rule object
 
 typedef struct
 {
   PyObject_HEAD
   PyObject* identifier;
+  PyObject* ns;
   PyObject* tags;
   PyObject* meta;
   PyObject* global;
@@ -246,6 +382,13 @@ static PyMemberDef Rule_members[] = {
     READONLY,
     "Name of the rule"
   },
+  {
+    "namespace",
+    T_OBJECT_EX,
+    offsetof(Rule, ns),
+    READONLY,
+    "Namespace of the rule"
+  },
   {
     "tags",
     T_OBJECT_EX,
@@ -268,6 +411,8 @@ static PyMethodDef Rule_methods[] =
   { NULL, NULL }
 };
 
+#if !defined(USE_MODULE_STATE)
+
 static PyTypeObject Rule_Type = {
   PyVarObject_HEAD_INIT(NULL, 0)
   "yara.Rule",                /*tp_name*/
@@ -309,6 +454,27 @@ static PyTypeObject Rule_Type = {
   0,                          /* tp_new */
 };
 
+#else
+
+static PyType_Slot Rule_Type_slots[] = {
+  {Py_tp_dealloc, Rule_dealloc},
+  {Py_tp_getattro, Rule_getattro},
+  {Py_tp_doc, (void*) "Rule class"},
+  {Py_tp_methods, Rule_methods},
+  {Py_tp_members, Rule_members},
+  {0, NULL}
+};
+
+static PyType_Spec Rule_Type_spec = {
+  "yara.Rule",
+  sizeof(Rule),
+  0,
+  Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_DISALLOW_INSTANTIATION,
+  Rule_Type_slots
+};
+
+#endif
+
 
 // Rules object
 
@@ -317,12 +483,26 @@ typedef struct
   PyObject_HEAD
   PyObject* externals;
   PyObject* warnings;
+  PyObject* parent;
+  PyObject* rule_names;
+  PyObject* string_names;
+  PyObject* fingerprint;
   YR_RULES* rules;
-  YR_RULE* iter_current_rule;
+  PyThread_type_lock lock;
 } Rules;
 
+// Flag set by select() in its private copy of the rules table for rules that
+// are only kept because the condition of a selected rule references them.
+// Those rules are also flagged as private, so the scanner evaluates them but
+// doesn't report them. libyara doesn't use this bit.
+
+#define RULE_FLAGS_DEPENDENCY 0x80
+
+#define RULE_IS_DEPENDENCY(x) (((x)->flags) & RULE_FLAGS_DEPENDENCY)
+
 
-static Rules* Rules_NEW(void);
+static Rules* Rules_NEW(
+    YARA_STATE* state);
 
 static void Rules_dealloc(
     PyObject* self);
@@ -337,15 +517,45 @@ static PyObject* Rules_save(
     PyObject* args,
     PyObject* keywords);
 
+static PyObject* Rules_match_processes(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords);
+
+static PyObject* Rules_match_archive(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords);
+
+static PyObject* Rules_follow(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords);
+
+static PyObject* Rules_select(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords);
+
 static PyObject* Rules_profiling_info(
     PyObject* self,
     PyObject* args);
 
+static PyObject* Rules_analyze(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords);
+
+static PyObject* Rules_memory_usage(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords);
+
 static PyObject* Rules_getattro(
     PyObject* self,
     PyObject* name);
 
-static PyObject* Rules_next(
+static PyObject* Rules_iter(
     PyObject* self);
 
 static PyMemberDef Rules_members[] = {
@@ -366,22 +576,54 @@ static PyMethodDef Rules_methods[] =
     (PyCFunction) Rules_match,
     METH_VARARGS | METH_KEYWORDS
   },
+  {
+    "match_processes",
+    (PyCFunction) Rules_match_processes,
+    METH_VARARGS | METH_KEYWORDS
+  },
+  {
+    "match_archive",
+    (PyCFunction) Rules_match_archive,
+    METH_VARARGS | METH_KEYWORDS
+  },
+  {
+    "follow",
+    (PyCFunction) Rules_follow,
+    METH_VARARGS | METH_KEYWORDS
+  },
   {
     "save",
     (PyCFunction) Rules_save,
     METH_VARARGS | METH_KEYWORDS
   },
+  {
+    "select",
+    (PyCFunction) Rules_select,
+    METH_VARARGS | METH_KEYWORDS
+  },
   {
     "profiling_info",
     (PyCFunction) Rules_profiling_info,
     METH_NOARGS
   },
+  {
+    "analyze",
+    (PyCFunction) Rules_analyze,
+    METH_VARARGS | METH_KEYWORDS
+  },
+  {
+    "memory_usage",
+    (PyCFunction) Rules_memory_usage,
+    METH_VARARGS | METH_KEYWORDS
+  },
   {
     NULL,
     NULL
   }
 };
 
+#if !defined(USE_MODULE_STATE)
+
 static PyTypeObject Rules_Type = {
   PyVarObject_HEAD_INIT(NULL, 0)
   "yara.Rules",               /*tp_name*/
@@ -408,8 +650,8 @@ static PyTypeObject Rules_Type = {
   0,                          /* tp_clear */
   0,                          /* tp_richcompare */
   0,                          /* tp_weaklistoffset */
-  PyObject_SelfIter,          /* tp_iter */
-  (iternextfunc) Rules_next,  /* tp_iternext */
+  Rules_iter,                 /* tp_iter */
+  0,                          /* tp_iternext */
   Rules_methods,              /* tp_methods */
   Rules_members,              /* tp_members */
   0,                          /* tp_getset */
@@ -423,2022 +665,9443 @@ static PyTypeObject Rules_Type = {
   0,                          /* tp_new */
 };
 
-typedef struct _CALLBACK_DATA
-{
-  PyObject* matches;
-  PyObject* callback;
-  PyObject* modules_data;
-  PyObject* modules_callback;
-  PyObject* warnings_callback;
-  PyObject* console_callback;
-  int which;
-  bool allow_duplicate_metadata;
-
-} CALLBACK_DATA;
+#else
 
-static PyStructSequence_Field RuleString_Fields[] = {
-  {"namespace", "Namespace of the rule"},
-  {"rule", "Identifier of the rule"},
-  {"string", "Identifier of the string"},
-  {NULL}
+static PyType_Slot Rules_Type_slots[] = {
+  {Py_tp_dealloc, Rules_dealloc},
+  {Py_tp_getattro, Rules_getattro},
+  {Py_tp_doc, (void*) "Rules class"},
+  {Py_tp_iter, Rules_iter},
+  {Py_tp_methods, Rules_methods},
+  {Py_tp_members, Rules_members},
+  {0, NULL}
 };
 
-static PyStructSequence_Desc RuleString_Desc = {
-  "RuleString",
-  "Named tuple tying together rule identifier and string identifier",
-  RuleString_Fields,
-  (sizeof(RuleString_Fields) / sizeof(RuleString_Fields[0])) - 1
+static PyType_Spec Rules_Type_spec = {
+  "yara.Rules",
+  sizeof(Rules),
+  0,
+  Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_DISALLOW_INSTANTIATION,
+  Rules_Type_slots
 };
 
-static PyTypeObject RuleString_Type = {0};
+#endif
 
-// Forward declarations for handling module data.
-PyObject* convert_structure_to_python(
-    YR_OBJECT_STRUCTURE* structure);
+// RulesIterator object, returned by iter(rules). Each iterator has its own
+// position, so the same Rules object can be iterated from several threads
+// at once.
 
+typedef struct
+{
+  PyObject_HEAD
+  PyObject* rules;
+  YR_RULE* current_rule;
+} RulesIterator;
 
-PyObject* convert_array_to_python(
-    YR_OBJECT_ARRAY* array);
 
+static void RulesIterator_dealloc(
+    PyObject* self);
 
-PyObject* convert_dictionary_to_python(
-    YR_OBJECT_DICTIONARY* dictionary);
+static PyObject* RulesIterator_next(
+    PyObject* self);
 
+#if !defined(USE_MODULE_STATE)
 
-PyObject* convert_object_to_python(
-    YR_OBJECT* object)
-{
-  PyObject* result = NULL;
+static PyTypeObject RulesIterator_Type = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  "yara.RulesIterator",       /*tp_name*/
+  sizeof(RulesIterator),      /*tp_basicsize*/
+  0,                          /*tp_itemsize*/
+  (destructor) RulesIterator_dealloc, /*tp_dealloc*/
+  0,                          /*tp_print*/
+  0,                          /*tp_getattr*/
+  0,                          /*tp_setattr*/
+  0,                          /*tp_compare*/
+  0,                          /*tp_repr*/
+  0,                          /*tp_as_number*/
+  0,                          /*tp_as_sequence*/
+  0,                          /*tp_as_mapping*/
+  0,                          /*tp_hash */
+  0,                          /*tp_call*/
+  0,                          /*tp_str*/
+  0,                          /*tp_getattro*/
+  0,                          /*tp_setattro*/
+  0,                          /*tp_as_buffer*/
+  Py_TPFLAGS_DEFAULT,         /*tp_flags*/
+  "RulesIterator class",      /* tp_doc */
+  0,                          /* tp_traverse */
+  0,                          /* tp_clear */
+  0,                          /* tp_richcompare */
+  0,                          /* tp_weaklistoffset */
+  PyObject_SelfIter,          /* tp_iter */
+  (iternextfunc) RulesIterator_next, /* tp_iternext */
+  0,                          /* tp_methods */
+  0,                          /* tp_members */
+  0,                          /* tp_getset */
+  0,                          /* tp_base */
+  0,                          /* tp_dict */
+  0,                          /* tp_descr_get */
+  0,                          /* tp_descr_set */
+  0,                          /* tp_dictoffset */
+  0,                          /* tp_init */
+  0,                          /* tp_alloc */
+  0,                          /* tp_new */
+};
 
-  if (object == NULL)
-    return NULL;
+#else
 
-  switch(object->type)
-  {
-    case OBJECT_TYPE_INTEGER:
-      if (object->value.i != YR_UNDEFINED)
-        result = Py_BuildValue("l", object->value.i);
-      break;
+static PyType_Slot RulesIterator_Type_slots[] = {
+  {Py_tp_dealloc, RulesIterator_dealloc},
+  {Py_tp_doc, (void*) "RulesIterator class"},
+  {Py_tp_iter, PyObject_SelfIter},
+  {Py_tp_iternext, RulesIterator_next},
+  {0, NULL}
+};
 
-    case OBJECT_TYPE_STRING:
-      if (object->value.ss != NULL)
-        result = PyBytes_FromStringAndSize(
-            object->value.ss->c_string,
-            object->value.ss->length);
-      break;
+static PyType_Spec RulesIterator_Type_spec = {
+  "yara.RulesIterator",
+  sizeof(RulesIterator),
+  0,
+  Py_TPFLAGS_DEFAULT | Py_TPFLAGS_DISALLOW_INSTANTIATION,
+  RulesIterator_Type_slots
+};
 
-    case OBJECT_TYPE_STRUCTURE:
-      result = convert_structure_to_python(object_as_structure(object));
-      break;
+#endif
 
-    case OBJECT_TYPE_ARRAY:
-      result = convert_array_to_python(object_as_array(object));
-      break;
+// Externals object
 
-    case OBJECT_TYPE_FUNCTION:
-      // Do nothing with functions...
-      break;
+// External variable of the rules bound to an Externals object. "value" is
+// NULL until the binding sets it, "generation" is the version of the values
+// in which it last changed.
 
-    case OBJECT_TYPE_DICTIONARY:
-      result = convert_dictionary_to_python(object_as_dictionary(object));
-      break;
+typedef struct _EXTERNALS_VARIABLE
+{
+  YR_EXTERNAL_VARIABLE* external;
+  PyObject* value;
+  uint64_t generation;
 
-    case OBJECT_TYPE_FLOAT:
-      if (!isnan(object->value.d))
-        result = Py_BuildValue("d", object->value.d);
-      break;
+} EXTERNALS_VARIABLE;
 
-    default:
-      break;
-  }
+// Scanner kept by an Externals object between scans. "generation" tells
+// which version of the values the scanner has defined, "objects" holds the
+// scanner's object for each variable, so that values are set without
+// looking up their names.
 
-  return result;
-}
+typedef struct _EXTERNALS_SCANNER
+{
+  YR_SCANNER* scanner;
+  YR_OBJECT** objects;
+  uint64_t generation;
 
+} EXTERNALS_SCANNER;
 
-PyObject* convert_structure_to_python(
-    YR_OBJECT_STRUCTURE* structure)
+typedef struct
 {
-  YR_STRUCTURE_MEMBER* member;
+  PyObject_HEAD
+  PyObject* rules;
+  PyObject* values;
+  PyObject* indexes;
+  EXTERNALS_VARIABLE* variables;
+  Py_ssize_t num_variables;
+  uint64_t generation;
+  EXTERNALS_SCANNER* idle;
+  size_t num_idle;
+  size_t idle_capacity;
+  PyThread_type_lock lock;
+} Externals;
+
+static PyObject* Externals_new(
+    PyTypeObject* type,
+    PyObject* args,
+    PyObject* keywords);
 
-  PyObject* py_object;
-  PyObject* py_dict = PyDict_New();
+static void Externals_dealloc(
+    PyObject* self);
 
-  if (py_dict == NULL)
-    return py_dict;
+static PyObject* Externals_update(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords);
 
-  member = structure->members;
+static YR_SCANNER* Externals_acquire_scanner(
+    Externals* externals,
+    EXTERNALS_SCANNER* acquired,
+    PyObject** values);
 
-  while (member != NULL)
+static void Externals_release_scanner(
+    Externals* externals,
+    EXTERNALS_SCANNER* acquired);
+
+static PyMemberDef Externals_members[] = {
   {
-    py_object = convert_object_to_python(member->object);
+    "rules",
+    T_OBJECT_EX,
+    offsetof(Externals, rules),
+    READONLY,
+    "Rules object the external variables are bound to"
+  },
+  { NULL } // End marker
+};
 
-    if (py_object != NULL)
-    {
-      PyDict_SetItemString(py_dict, member->object->identifier, py_object);
-      Py_DECREF(py_object);
-    }
-
-    member =member->next;
+static PyMethodDef Externals_methods[] =
+{
+  {
+    "update",
+    (PyCFunction) Externals_update,
+    METH_VARARGS | METH_KEYWORDS
+  },
+  {
+    NULL,
+    NULL
   }
+};
 
-  return py_dict;
-}
+#if !defined(USE_MODULE_STATE)
 
+static PyTypeObject Externals_Type = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  "yara.Externals",           /*tp_name*/
+  sizeof(Externals),          /*tp_basicsize*/
+  0,                          /*tp_itemsize*/
+  (destructor) Externals_dealloc, /*tp_dealloc*/
+  0,                          /*tp_print*/
+  0,                          /*tp_getattr*/
+  0,                          /*tp_setattr*/
+  0,                          /*tp_compare*/
+  0,                          /*tp_repr*/
+  0,                          /*tp_as_number*/
+  0,                          /*tp_as_sequence*/
+  0,                          /*tp_as_mapping*/
+  0,                          /*tp_hash */
+  0,                          /*tp_call*/
+  0,                          /*tp_str*/
+  0,                          /*tp_getattro*/
+  0,                          /*tp_setattro*/
+  0,                          /*tp_as_buffer*/
+  Py_TPFLAGS_DEFAULT,         /*tp_flags*/
+  "External variables bound to a Rules object",  /* tp_doc */
+  0,                          /* tp_traverse */
+  0,                          /* tp_clear */
+  0,                          /* tp_richcompare */
+  0,                          /* tp_weaklistoffset */
+  0,                          /* tp_iter */
+  0,                          /* tp_iternext */
+  Externals_methods,          /* tp_methods */
+  Externals_members,          /* tp_members */
+  0,                          /* tp_getset */
+  0,                          /* tp_base */
+  0,                          /* tp_dict */
+  0,                          /* tp_descr_get */
+  0,                          /* tp_descr_set */
+  0,                          /* tp_dictoffset */
+  0,                          /* tp_init */
+  0,                          /* tp_alloc */
+  Externals_new,              /* tp_new */
+};
 
-PyObject* convert_array_to_python(
-    YR_OBJECT_ARRAY* array)
-{
-  PyObject* py_object;
-  PyObject* py_list = PyList_New(0);
+#else
 
-  if (py_list == NULL)
-    return py_list;
+static PyType_Slot Externals_Type_slots[] = {
+  {Py_tp_dealloc, Externals_dealloc},
+  {Py_tp_doc, (void*) "External variables bound to a Rules object"},
+  {Py_tp_methods, Externals_methods},
+  {Py_tp_members, Externals_members},
+  {Py_tp_new, Externals_new},
+  {0, NULL}
+};
 
-  // If there is nothing in the list, return an empty Python list
-  if (array->items == NULL)
-    return py_list;
+static PyType_Spec Externals_Type_spec = {
+  "yara.Externals",
+  sizeof(Externals),
+  0,
+  Py_TPFLAGS_DEFAULT,
+  Externals_Type_slots
+};
 
-  for (int i = 0; i < array->items->length; i++)
-  {
-    py_object = convert_object_to_python(array->items->objects[i]);
+#endif
 
-    if (py_object != NULL)
-    {
-      PyList_Append(py_list, py_object);
-      Py_DECREF(py_object);
-    }
-  }
+// ScanPool object. The pool is implemented in Python by yara_pool.ScanPool,
+// which derives from this type. Instantiating yara.ScanPool creates an
+// instance of that subclass, so that yara.ScanPool can be used with
+// isinstance() and subclassed like any other type of the module.
 
-  return py_list;
-}
+static PyObject* ScanPool_new(
+    PyTypeObject* type,
+    PyObject* args,
+    PyObject* keywords);
 
+#if !defined(USE_MODULE_STATE)
 
-PyObject* convert_dictionary_to_python(
-    YR_OBJECT_DICTIONARY* dictionary)
-{
-  PyObject* py_object;
-  PyObject* py_dict = PyDict_New();
+static PyTypeObject ScanPool_Type = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  "yara.ScanPool",            /*tp_name*/
+  sizeof(PyObject),           /*tp_basicsize*/
+  0,                          /*tp_itemsize*/
+  0,                          /*tp_dealloc*/
+  0,                          /*tp_print*/
+  0,                          /*tp_getattr*/
+  0,                          /*tp_setattr*/
+  0,                          /*tp_compare*/
+  0,                          /*tp_repr*/
+  0,                          /*tp_as_number*/
+  0,                          /*tp_as_sequence*/
+  0,                          /*tp_as_mapping*/
+  0,                          /*tp_hash */
+  0,                          /*tp_call*/
+  0,                          /*tp_str*/
+  0,                          /*tp_getattro*/
+  0,                          /*tp_setattro*/
+  0,                          /*tp_as_buffer*/
+  Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /*tp_flags*/
+  "Pool of worker processes scanning with the same rules", /* tp_doc */
+  0,                          /* tp_traverse */
+  0,                          /* tp_clear */
+  0,                          /* tp_richcompare */
+  0,                          /* tp_weaklistoffset */
+  0,                          /* tp_iter */
+  0,                          /* tp_iternext */
+  0,                          /* tp_methods */
+  0,                          /* tp_members */
+  0,                          /* tp_getset */
+  0,                          /* tp_base */
+  0,                          /* tp_dict */
+  0,                          /* tp_descr_get */
+  0,                          /* tp_descr_set */
+  0,                          /* tp_dictoffset */
+  0,                          /* tp_init */
+  0,                          /* tp_alloc */
+  ScanPool_new,               /* tp_new */
+};
 
-  if (py_dict == NULL)
-    return py_dict;
+#else
 
-  // If there is nothing in the YARA dictionary, return an empty Python dict
-  if (dictionary->items == NULL)
-    return py_dict;
+static PyType_Slot ScanPool_Type_slots[] = {
+  {Py_tp_doc, (void*) "Pool of worker processes scanning with the same rules"},
+  {Py_tp_new, ScanPool_new},
+  {0, NULL}
+};
 
-  for (int i = 0; i < dictionary->items->used; i++)
-  {
-    py_object = convert_object_to_python(dictionary->items->objects[i].obj);
+static PyType_Spec ScanPool_Type_spec = {
+  "yara.ScanPool",
+  sizeof(PyObject),
+  0,
+  Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
+  ScanPool_Type_slots
+};
 
-    if (py_object != NULL)
-    {
-      PyDict_SetItemString(
-          py_dict,
-          dictionary->items->objects[i].key->c_string,
-          py_object);
+#endif
 
-      Py_DECREF(py_object);
-    }
-  }
+// ResultCache object
 
-  return py_dict;
-}
+typedef struct
+{
+  PyObject_HEAD
+  PyObject* entries;
+  PyObject* directory;
+  Py_ssize_t max_entries;
+  Py_ssize_t max_bytes;
+  Py_ssize_t size;
+  unsigned long long hits;
+  unsigned long long misses;
+  unsigned long long evictions;
+  PyThread_type_lock lock;
+} ResultCache;
+
+static PyObject* ResultCache_new(
+    PyTypeObject* type,
+    PyObject* args,
+    PyObject* keywords);
 
+static void ResultCache_dealloc(
+    PyObject* self);
 
-static int handle_import_module(
-    YR_MODULE_IMPORT* module_import,
-    CALLBACK_DATA* data)
-{
-  if (data->modules_data == NULL)
-    return CALLBACK_CONTINUE;
+static PyObject* ResultCache_clear(
+    PyObject* self,
+    PyObject* args);
 
-  PyGILState_STATE gil_state = PyGILState_Ensure();
+static Py_ssize_t ResultCache_length(
+    PyObject* self);
 
-  PyObject* module_data = PyDict_GetItemString(
-      data->modules_data,
-      module_import->module_name);
+static PyObject* ResultCache_hit_rate(
+    PyObject* self,
+    void* closure);
 
-  #if PY_MAJOR_VERSION >= 3
-  if (module_data != NULL && PyBytes_Check(module_data))
-  #else
-  if (module_data != NULL && PyString_Check(module_data))
-  #endif
+static PyObject* ResultCache_lookup(
+    ResultCache* cache,
+    PyObject* key);
+
+static void ResultCache_store(
+    ResultCache* cache,
+    PyObject* key,
+    PyObject* blob);
+
+static PyMemberDef ResultCache_members[] = {
   {
-    Py_ssize_t data_size;
+    "directory",
+    T_OBJECT,
+    offsetof(ResultCache, directory),
+    READONLY,
+    "Directory where results are persisted, or None. It is never pruned"
+  },
+  {
+    "max_entries",
+    T_PYSSIZET,
+    offsetof(ResultCache, max_entries),
+    READONLY,
+    "Maximum number of results kept in memory"
+  },
+  {
+    "max_bytes",
+    T_PYSSIZET,
+    offsetof(ResultCache, max_bytes),
+    READONLY,
+    "Maximum size in bytes of the results kept in memory"
+  },
+  {
+    "size",
+    T_PYSSIZET,
+    offsetof(ResultCache, size),
+    READONLY,
+    "Size in bytes of the results kept in memory"
+  },
+  {
+    "hits",
+    T_ULONGLONG,
+    offsetof(ResultCache, hits),
+    READONLY,
+    "Number of scans served from the cache"
+  },
+  {
+    "misses",
+    T_ULONGLONG,
+    offsetof(ResultCache, misses),
+    READONLY,
+    "Number of scans not found in the cache"
+  },
+  {
+    "evictions",
+    T_ULONGLONG,
+    offsetof(ResultCache, evictions),
+    READONLY,
+    "Number of results evicted from memory"
+  },
+  { NULL } // End marker
+};
 
-    #if PY_MAJOR_VERSION >= 3
-    PyBytes_AsStringAndSize(
-        module_data,
-        (char**) &module_import->module_data,
-        &data_size);
-    #else
-    PyString_AsStringAndSize(
-        module_data,
-        (char**) &module_import->module_data,
-        &data_size);
-    #endif
+static PyGetSetDef ResultCache_getsetters[] = {
+  {
+    "hit_rate",
+    ResultCache_hit_rate,
+    NULL,
+    "Fraction of cacheable scans served from the cache",
+    NULL
+  },
+  { NULL } // End marker
+};
 
-    module_import->module_data_size = data_size;
+static PyMethodDef ResultCache_methods[] =
+{
+  {
+    "clear",
+    (PyCFunction) ResultCache_clear,
+    METH_NOARGS
+  },
+  {
+    NULL,
+    NULL
   }
+};
 
-  PyGILState_Release(gil_state);
+#if !defined(USE_MODULE_STATE)
 
-  return CALLBACK_CONTINUE;
-}
+static PyMappingMethods ResultCache_as_mapping = {
+  ResultCache_length,         /*mp_length*/
+  0,                          /*mp_subscript*/
+  0,                          /*mp_ass_subscript*/
+};
 
+static PyTypeObject ResultCache_Type = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  "yara.ResultCache",         /*tp_name*/
+  sizeof(ResultCache),        /*tp_basicsize*/
+  0,                          /*tp_itemsize*/
+  (destructor) ResultCache_dealloc, /*tp_dealloc*/
+  0,                          /*tp_print*/
+  0,                          /*tp_getattr*/
+  0,                          /*tp_setattr*/
+  0,                          /*tp_compare*/
+  0,                          /*tp_repr*/
+  0,                          /*tp_as_number*/
+  0,                          /*tp_as_sequence*/
+  &ResultCache_as_mapping,    /*tp_as_mapping*/
+  0,                          /*tp_hash */
+  0,                          /*tp_call*/
+  0,                          /*tp_str*/
+  0,                          /*tp_getattro*/
+  0,                          /*tp_setattro*/
+  0,                          /*tp_as_buffer*/
+  Py_TPFLAGS_DEFAULT,         /*tp_flags*/
+  "Cache of scan results keyed by content and rules\n\n"
+  "max_entries and max_bytes only limit the results kept in memory. Files "
+  "written to directory are never removed, the directory must be pruned by "
+  "other means.",  /* tp_doc */
+  0,                          /* tp_traverse */
+  0,                          /* tp_clear */
+  0,                          /* tp_richcompare */
+  0,                          /* tp_weaklistoffset */
+  0,                          /* tp_iter */
+  0,                          /* tp_iternext */
+  ResultCache_methods,        /* tp_methods */
+  ResultCache_members,        /* tp_members */
+  ResultCache_getsetters,     /* tp_getset */
+  0,                          /* tp_base */
+  0,                          /* tp_dict */
+  0,                          /* tp_descr_get */
+  0,                          /* tp_descr_set */
+  0,                          /* tp_dictoffset */
+  0,                          /* tp_init */
+  0,                          /* tp_alloc */
+  ResultCache_new,            /* tp_new */
+};
 
-static int handle_module_imported(
-    void* message_data,
-    CALLBACK_DATA* data)
-{
-  if (data->modules_callback == NULL)
-    return CALLBACK_CONTINUE;
+#else
 
-  PyGILState_STATE gil_state = PyGILState_Ensure();
+static PyType_Slot ResultCache_Type_slots[] = {
+  {Py_tp_dealloc, ResultCache_dealloc},
+  {Py_tp_doc, (void*) (
+      "Cache of scan results keyed by content and rules\n\n"
+      "max_entries and max_bytes only limit the results kept in memory. Files "
+      "written to directory are never removed, the directory must be pruned by "
+      "other means.")},
+  {Py_tp_methods, ResultCache_methods},
+  {Py_tp_members, ResultCache_members},
+  {Py_tp_getset, ResultCache_getsetters},
+  {Py_mp_length, ResultCache_length},
+  {Py_tp_new, ResultCache_new},
+  {0, NULL}
+};
 
-  PyObject* module_info_dict = convert_structure_to_python(
-      object_as_structure(message_data));
+static PyType_Spec ResultCache_Type_spec = {
+  "yara.ResultCache",
+  sizeof(ResultCache),
+  0,
+  Py_TPFLAGS_DEFAULT,
+  ResultCache_Type_slots
+};
 
-  if (module_info_dict == NULL)
-  {
-    PyGILState_Release(gil_state);
-    return CALLBACK_CONTINUE;
-  }
+#endif
 
-  PyObject* object = PY_STRING(object_as_structure(message_data)->identifier);
-  PyDict_SetItemString(module_info_dict, "module", object);
-  Py_DECREF(object);
+// Limits on the matches kept by a scan, -1 means unlimited. The result size
+// is the memory taken by the records and match data.
 
-  Py_INCREF(data->modules_callback);
+typedef struct _SCAN_LIMITS
+{
+  long long max_string_matches;
+  long long max_matches;
+  long long max_match_data;
+  long long max_result_size;
 
-  PyObject* callback_result = PyObject_CallFunctionObjArgs(
-      data->modules_callback,
-      module_info_dict,
-      NULL);
+} SCAN_LIMITS;
 
-  int result = CALLBACK_CONTINUE;
 
-  if (callback_result != NULL)
-  {
-    #if PY_MAJOR_VERSION >= 3
-    if (PyLong_Check(callback_result))
-    #else
-    if (PyLong_Check(callback_result) || PyInt_Check(callback_result))
-    #endif
-    {
-      result = (int) PyLong_AsLong(callback_result);
-    }
-  }
-  else
-  {
-    result = CALLBACK_ERROR;
-  }
+// RuleStore object. It holds the current version of a rule set, which can be
+// replaced by a new version compiled or loaded in a background thread. Each
+// scan holds a reference to the version it started with, so the previous
+// version is destroyed as soon as the last scan using it finishes.
 
-  Py_XDECREF(callback_result);
-  Py_DECREF(module_info_dict);
-  Py_DECREF(data->modules_callback);
+typedef struct
+{
+  PyObject_HEAD
+  PyObject* rules;
+  PyObject* history;
+  PyCFunctionWithKeywords loader;
+  PyObject* loader_args;
+  PyObject* loader_keywords;
+  PyObject* reload_error;
+  unsigned long long version;
+  unsigned long long scans;
+  double reload_started;
+  double reload_latency;
+  bool reloading;
+  PyInterpreterState* interpreter;
+  PyThread_type_lock lock;
+  PyThread_type_lock done;
+} RuleStore;
+
+static PyObject* RuleStore_new(
+    PyTypeObject* type,
+    PyObject* args,
+    PyObject* keywords);
 
-  PyGILState_Release(gil_state);
+static void RuleStore_dealloc(
+    PyObject* self);
 
-  return result;
-}
+static PyObject* RuleStore_match(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords);
 
+static PyObject* RuleStore_reload(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords);
 
-static int handle_console_log(
-    void* message_data,
-    CALLBACK_DATA* data)
-{
-  PyGILState_STATE gil_state = PyGILState_Ensure();
-  int result = CALLBACK_CONTINUE;
+static PyObject* RuleStore_wait(
+    PyObject* self,
+    PyObject* args);
 
-  if (data->console_callback == NULL)
-  {
-    // If the user does not specify a console callback we dump to stdout.
-    // If we want to support 3.2 and newer only we can use
-    // https://docs.python.org/3/c-api/sys.html?highlight=stdout#c.PySys_FormatStdout
-    // instead of this call with the limit.
-    PySys_WriteStdout("%.1000s\n", (char*) message_data);
-  }
-  else
-  {
-    PyObject* log_string = PY_STRING((char*) message_data);
-    Py_INCREF(data->console_callback);
+static PyObject* RuleStore_rules(
+    PyObject* self,
+    void* closure);
 
-    PyObject* callback_result = PyObject_CallFunctionObjArgs(
-        data->console_callback,
-        log_string,
-        NULL);
+static PyObject* RuleStore_fingerprint(
+    PyObject* self,
+    void* closure);
 
-    if (callback_result != NULL)
-    {
-      #if PY_MAJOR_VERSION >= 3
-      if (PyLong_Check(callback_result))
-      #else
-      if (PyLong_Check(callback_result) || PyInt_Check(callback_result))
-      #endif
-      {
-        result = (int) PyLong_AsLong(callback_result);
-      }
-    }
-    else
-    {
-      result = CALLBACK_ERROR;
-    }
+static PyObject* RuleStore_reload_latency(
+    PyObject* self,
+    void* closure);
 
-    Py_DECREF(log_string);
-    Py_XDECREF(callback_result);
-    Py_DECREF(data->console_callback);
-  }
+static PyObject* RuleStore_scans(
+    PyObject* self,
+    void* closure);
 
-  PyGILState_Release(gil_state);
+static PyObject* RuleStore_reloading(
+    PyObject* self,
+    void* closure);
 
-  return result;
-}
+static PyMemberDef RuleStore_members[] = {
+  {
+    "version",
+    T_ULONGLONG,
+    offsetof(RuleStore, version),
+    READONLY,
+    "Number of the current version, starting at 1"
+  },
+  { NULL } // End marker
+};
 
+static PyGetSetDef RuleStore_getsetters[] = {
+  {
+    "rules",
+    RuleStore_rules,
+    NULL,
+    "Rules object of the current version",
+    NULL
+  },
+  {
+    "fingerprint",
+    RuleStore_fingerprint,
+    NULL,
+    "Hexadecimal SHA-256 fingerprint of the current version",
+    NULL
+  },
+  {
+    "reload_latency",
+    RuleStore_reload_latency,
+    NULL,
+    "Seconds taken by the last successful reload, or None",
+    NULL
+  },
+  {
+    "scans",
+    RuleStore_scans,
+    NULL,
+    "Dictionary with the number of scans started with each version",
+    NULL
+  },
+  {
+    "reloading",
+    RuleStore_reloading,
+    NULL,
+    "True while a new version is being compiled or loaded",
+    NULL
+  },
+  { NULL } // End marker
+};
 
-static int handle_too_many_matches(
-    YR_SCAN_CONTEXT* context,
-    YR_STRING* string,
-    CALLBACK_DATA* data)
+static PyMethodDef RuleStore_methods[] =
 {
-  PyGILState_STATE gil_state = PyGILState_Ensure();
-
-  PyObject* warning_type = NULL;
-  PyObject* string_identifier = NULL;
-  PyObject* rule_identifier = NULL;
-  PyObject* namespace_identifier = NULL;
-  PyObject* rule_string = NULL;
-  YR_RULE* rule = NULL;
-
-  int result = CALLBACK_CONTINUE;
-
-  if (data->warnings_callback == NULL)
   {
-    char message[200];
+    "match",
+    (PyCFunction) RuleStore_match,
+    METH_VARARGS | METH_KEYWORDS
+  },
+  {
+    "reload",
+    (PyCFunction) RuleStore_reload,
+    METH_VARARGS | METH_KEYWORDS
+  },
+  {
+    "wait",
+    (PyCFunction) RuleStore_wait,
+    METH_NOARGS
+  },
+  {
+    NULL,
+    NULL
+  }
+};
 
-    snprintf(
-        message,
-        sizeof(message),
-        "too many matches for string %s in rule \"%s\"",
-        string->identifier,
-        context->rules->rules_table[string->rule_idx].identifier);
+#if !defined(USE_MODULE_STATE)
 
-    if (PyErr_WarnEx(PyExc_RuntimeWarning, message, 1) == -1)
-      result = CALLBACK_ERROR;
-  }
-  else
-  {
-    Py_INCREF(data->warnings_callback);
+static PyTypeObject RuleStore_Type = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  "yara.RuleStore",           /*tp_name*/
+  sizeof(RuleStore),          /*tp_basicsize*/
+  0,                          /*tp_itemsize*/
+  (destructor) RuleStore_dealloc, /*tp_dealloc*/
+  0,                          /*tp_print*/
+  0,                          /*tp_getattr*/
+  0,                          /*tp_setattr*/
+  0,                          /*tp_compare*/
+  0,                          /*tp_repr*/
+  0,                          /*tp_as_number*/
+  0,                          /*tp_as_sequence*/
+  0,                          /*tp_as_mapping*/
+  0,                          /*tp_hash */
+  0,                          /*tp_call*/
+  0,                          /*tp_str*/
+  0,                          /*tp_getattro*/
+  0,                          /*tp_setattro*/
+  0,                          /*tp_as_buffer*/
+  Py_TPFLAGS_DEFAULT,         /*tp_flags*/
+  "Versioned rules that can be reloaded while scanning",  /* tp_doc */
+  0,                          /* tp_traverse */
+  0,                          /* tp_clear */
+  0,                          /* tp_richcompare */
+  0,                          /* tp_weaklistoffset */
+  0,                          /* tp_iter */
+  0,                          /* tp_iternext */
+  RuleStore_methods,          /* tp_methods */
+  RuleStore_members,          /* tp_members */
+  RuleStore_getsetters,       /* tp_getset */
+  0,                          /* tp_base */
+  0,                          /* tp_dict */
+  0,                          /* tp_descr_get */
+  0,                          /* tp_descr_set */
+  0,                          /* tp_dictoffset */
+  0,                          /* tp_init */
+  0,                          /* tp_alloc */
+  RuleStore_new,              /* tp_new */
+};
 
-    string_identifier = PY_STRING(string->identifier);
+#else
 
-    if (string_identifier == NULL)
-    {
-      result = CALLBACK_ERROR;
-      goto _exit;
-    }
+static PyType_Slot RuleStore_Type_slots[] = {
+  {Py_tp_dealloc, RuleStore_dealloc},
+  {Py_tp_doc, (void*) "Versioned rules that can be reloaded while scanning"},
+  {Py_tp_methods, RuleStore_methods},
+  {Py_tp_members, RuleStore_members},
+  {Py_tp_getset, RuleStore_getsetters},
+  {Py_tp_new, RuleStore_new},
+  {0, NULL}
+};
 
-    rule = &context->rules->rules_table[string->rule_idx];
-    rule_identifier = PY_STRING(rule->identifier);
+static PyType_Spec RuleStore_Type_spec = {
+  "yara.RuleStore",
+  sizeof(RuleStore),
+  0,
+  Py_TPFLAGS_DEFAULT,
+  RuleStore_Type_slots
+};
 
-    if (rule_identifier == NULL)
-    {
-      result = CALLBACK_ERROR;
-      goto _exit;
-    }
+#endif
 
-    namespace_identifier = PY_STRING(rule->ns->name);
+// Metrics object. There's a single instance, yara.metrics, and the counters
+// it exposes are process-wide, shared by all interpreters and threads.
 
-    if (namespace_identifier == NULL)
-    {
-      result = CALLBACK_ERROR;
-      goto _exit;
-    }
+typedef struct
+{
+  PyObject_HEAD
+} Metrics;
 
-    rule_string = PyStructSequence_New(&RuleString_Type);
+static PyObject* Metrics_enable(
+    PyObject* self,
+    PyObject* args);
 
-    if (rule_string == NULL)
-    {
-      result = CALLBACK_ERROR;
-      goto _exit;
-    }
+static PyObject* Metrics_disable(
+    PyObject* self,
+    PyObject* args);
 
-    PyStructSequence_SET_ITEM(rule_string, 0, namespace_identifier);
-    PyStructSequence_SET_ITEM(rule_string, 1, rule_identifier);
-    PyStructSequence_SET_ITEM(rule_string, 2, string_identifier);
+static PyObject* Metrics_reset(
+    PyObject* self,
+    PyObject* args);
 
-    // PyStructSequenece steals the reference so we NULL these
-    // so that Py_XDECREF() can be used in _exit label
-    namespace_identifier = NULL;
-    rule_identifier = NULL;
-    string_identifier = NULL;
+static PyObject* Metrics_as_dict(
+    PyObject* self,
+    PyObject* args);
 
-    warning_type = PyLong_FromLong(CALLBACK_MSG_TOO_MANY_MATCHES);
+static PyObject* Metrics_openmetrics(
+    PyObject* self,
+    PyObject* args);
 
-    if (warning_type == NULL)
-    {
-      result = CALLBACK_ERROR;
-      goto _exit;
-    }
+static PyObject* Metrics_enabled(
+    PyObject* self,
+    void* closure);
 
-    PyObject* callback_result = PyObject_CallFunctionObjArgs(
-        data->warnings_callback,
-        warning_type,
-        rule_string,
-        NULL);
+static void Metrics_dealloc(
+    PyObject* self);
 
-    if (callback_result != NULL)
-    {
-      #if PY_MAJOR_VERSION >= 3
-      if (PyLong_Check(callback_result))
-      #else
-      if (PyLong_Check(callback_result) || PyInt_Check(callback_result))
-      #endif
-      {
-        result = (int) PyLong_AsLong(callback_result);
-      }
-    }
-    else
-    {
-      result = CALLBACK_ERROR;
-    }
+static PyGetSetDef Metrics_getsetters[] = {
+  {
+    "enabled",
+    Metrics_enabled,
+    NULL,
+    "True if metrics are being collected",
+    NULL
+  },
+  { NULL } // End marker
+};
 
-    Py_XDECREF(callback_result);
+static PyMethodDef Metrics_methods[] =
+{
+  {
+    "enable",
+    (PyCFunction) Metrics_enable,
+    METH_NOARGS
+  },
+  {
+    "disable",
+    (PyCFunction) Metrics_disable,
+    METH_NOARGS
+  },
+  {
+    "reset",
+    (PyCFunction) Metrics_reset,
+    METH_NOARGS
+  },
+  {
+    "as_dict",
+    (PyCFunction) Metrics_as_dict,
+    METH_NOARGS
+  },
+  {
+    "openmetrics",
+    (PyCFunction) Metrics_openmetrics,
+    METH_NOARGS
+  },
+  {
+    NULL,
+    NULL
   }
+};
 
-_exit:
-
-  Py_XDECREF(namespace_identifier);
-  Py_XDECREF(rule_identifier);
-  Py_XDECREF(string_identifier);
-  Py_XDECREF(rule_string);
-  Py_XDECREF(warning_type);
-  Py_XDECREF(data->warnings_callback);
-
-  PyGILState_Release(gil_state);
-
-  return result;
-}
+#if !defined(USE_MODULE_STATE)
 
+static PyTypeObject Metrics_Type = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  "yara.Metrics",             /*tp_name*/
+  sizeof(Metrics),            /*tp_basicsize*/
+  0,                          /*tp_itemsize*/
+  (destructor) Metrics_dealloc, /*tp_dealloc*/
+  0,                          /*tp_print*/
+  0,                          /*tp_getattr*/
+  0,                          /*tp_setattr*/
+  0,                          /*tp_compare*/
+  0,                          /*tp_repr*/
+  0,                          /*tp_as_number*/
+  0,                          /*tp_as_sequence*/
+  0,                          /*tp_as_mapping*/
+  0,                          /*tp_hash */
+  0,                          /*tp_call*/
+  0,                          /*tp_str*/
+  0,                          /*tp_getattro*/
+  0,                          /*tp_setattro*/
+  0,                          /*tp_as_buffer*/
+  Py_TPFLAGS_DEFAULT,         /*tp_flags*/
+  "Process-wide scanning metrics",  /* tp_doc */
+  0,                          /* tp_traverse */
+  0,                          /* tp_clear */
+  0,                          /* tp_richcompare */
+  0,                          /* tp_weaklistoffset */
+  0,                          /* tp_iter */
+  0,                          /* tp_iternext */
+  Metrics_methods,            /* tp_methods */
+  0,                          /* tp_members */
+  Metrics_getsetters,         /* tp_getset */
+  0,                          /* tp_base */
+  0,                          /* tp_dict */
+  0,                          /* tp_descr_get */
+  0,                          /* tp_descr_set */
+  0,                          /* tp_dictoffset */
+  0,                          /* tp_init */
+  0,                          /* tp_alloc */
+  0,                          /* tp_new */
+};
 
-#define CALLBACK_MATCHES 0x01
-#define CALLBACK_NON_MATCHES 0x02
-#define CALLBACK_ALL CALLBACK_MATCHES | CALLBACK_NON_MATCHES
+#else
 
-int yara_callback(
-    YR_SCAN_CONTEXT* context,
-    int message,
-    void* message_data,
-    void* user_data)
-{
-  YR_STRING* string;
-  YR_MATCH* m;
-  YR_META* meta;
-  YR_RULE* rule;
+static PyType_Slot Metrics_Type_slots[] = {
+  {Py_tp_dealloc, Metrics_dealloc},
+  {Py_tp_doc, (void*) "Process-wide scanning metrics"},
+  {Py_tp_methods, Metrics_methods},
+  {Py_tp_getset, Metrics_getsetters},
+  {0, NULL}
+};
 
-  const char* tag;
+static PyType_Spec Metrics_Type_spec = {
+  "yara.Metrics",
+  sizeof(Metrics),
+  0,
+  Py_TPFLAGS_DEFAULT | Py_TPFLAGS_DISALLOW_INSTANTIATION,
+  Metrics_Type_slots
+};
 
-  PyObject* tag_list = NULL;
-  PyObject* string_list = NULL;
-  PyObject* meta_list = NULL;
-  PyObject* match;
-  PyObject* callback_dict;
-  PyObject* object;
-  PyObject* tuple;
-  PyObject* matches = ((CALLBACK_DATA*) user_data)->matches;
-  PyObject* callback = ((CALLBACK_DATA*) user_data)->callback;
-  PyObject* callback_result;
+#endif
 
-  int which = ((CALLBACK_DATA*) user_data)->which;
+// Counters behind yara.metrics. They are updated with atomic operations, so
+// scans update them without holding the GIL or any lock, and only when
+// metrics are enabled. Rule hits are kept in a fixed-size hash table keyed by
+// namespace and identifier, protected by a spin lock.
 
-  switch(message)
-  {
-  case CALLBACK_MSG_IMPORT_MODULE:
-    return handle_import_module(message_data, user_data);
+#define METRICS_MAX_ERROR 128
+#define METRICS_MAX_RULES 4096
+#define METRICS_LATENCY_BUCKETS 9
 
-  case CALLBACK_MSG_MODULE_IMPORTED:
-    return handle_module_imported(message_data, user_data);
+static const double metrics_latency_bounds[METRICS_LATENCY_BUCKETS] = {
+    0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10};
 
-  case CALLBACK_MSG_TOO_MANY_MATCHES:
-    return handle_too_many_matches(context, message_data, user_data);
+static const char* metrics_latency_labels[METRICS_LATENCY_BUCKETS] = {
+    "0.001", "0.005", "0.01", "0.05", "0.1", "0.5", "1.0", "5.0", "10.0"};
 
-  case CALLBACK_MSG_SCAN_FINISHED:
-    return CALLBACK_CONTINUE;
+typedef struct _METRICS
+{
+  volatile uint64_t scans;
+  volatile uint64_t scanned_bytes;
+  volatile uint64_t timeouts;
+  volatile uint64_t too_many_matches;
+  volatile uint64_t dropped_rule_hits;
+  volatile uint64_t errors[METRICS_MAX_ERROR];
 
-  case CALLBACK_MSG_RULE_NOT_MATCHING:
-    // In cases where the rule doesn't match and the user didn't provided a
-    // callback function or is not interested in getting notified about
-    // non-matches, there's nothing more do to here, keep executing the function
-    // if otherwise.
+  // Scans in each latency bucket, the last one for scans slower than all the
+  // bounds. The sum is in microseconds.
+  volatile uint64_t latency[METRICS_LATENCY_BUCKETS + 1];
+  volatile uint64_t latency_sum;
 
-    if (callback == NULL ||
-        (which & CALLBACK_NON_MATCHES) != CALLBACK_NON_MATCHES)
-      return CALLBACK_CONTINUE;
-    break;
+} METRICS;
 
-  case CALLBACK_MSG_CONSOLE_LOG:
-    return handle_console_log(message_data, user_data);
-  }
 
-  // At this point we have handled all the other cases of when this callback
-  // can be called. The only things left are:
-  //
-  // 1. A matching rule.
-  //
-  // 2 A non-matching rule and the user has requested to see non-matching rules.
-  //
-  // In both cases, we need to create the data that will be either passed back
-  // to the python callback or stored in the matches list.
+typedef struct _METRICS_RULE
+{
+  char* ns;
+  char* identifier;
+  uint64_t hits;
 
-  int result = CALLBACK_CONTINUE;
+} METRICS_RULE;
 
-  rule = (YR_RULE*) message_data;
 
-  PyGILState_STATE gil_state = PyGILState_Ensure();
+static METRICS metrics;
+static METRICS_RULE metrics_rules[METRICS_MAX_RULES];
 
-  tag_list = PyList_New(0);
-  string_list = PyList_New(0);
-  meta_list = PyDict_New();
+static volatile long metrics_enabled = 0;
+static volatile long metrics_rules_lock = 0;
 
-  if (tag_list == NULL || string_list == NULL || meta_list == NULL)
-  {
-    Py_XDECREF(tag_list);
-    Py_XDECREF(string_list);
-    Py_XDECREF(meta_list);
-    PyGILState_Release(gil_state);
 
-    return CALLBACK_ERROR;
-  }
+static void spin_lock(
+    volatile long* lock)
+{
+  #if defined(_WIN32)
+  while (InterlockedCompareExchange(lock, 1, 0) != 0) {}
+  #else
+  while (__sync_lock_test_and_set(lock, 1)) {}
+  #endif
+}
 
-  yr_rule_tags_foreach(rule, tag)
-  {
-    object = PY_STRING(tag);
-    PyList_Append(tag_list, object);
-    Py_DECREF(object);
-  }
 
-  yr_rule_metas_foreach(rule, meta)
-  {
-    if (meta->type == META_TYPE_INTEGER)
-      object = Py_BuildValue("i", meta->integer);
-    else if (meta->type == META_TYPE_BOOLEAN)
-      object = PyBool_FromLong((long) meta->integer);
-    else
-      object = PY_STRING(meta->string);
+static void spin_unlock(
+    volatile long* lock)
+{
+  #if defined(_WIN32)
+  InterlockedExchange(lock, 0);
+  #else
+  __sync_lock_release(lock);
+  #endif
+}
 
-    if (((CALLBACK_DATA*) user_data)->allow_duplicate_metadata){
-      // Check if we already have an array under this key
-      PyObject* existing_item = PyDict_GetItemString(meta_list, meta->identifier);
-      // Append object to existing list
-      if (existing_item)
-        PyList_Append(existing_item, object);
-      else{
-        //Otherwise, instantiate array and append object as first item
-        PyObject* new_list = PyList_New(0);
-        PyList_Append(new_list, object);
-        PyDict_SetItemString(meta_list, meta->identifier, new_list);
-        Py_DECREF(new_list);
-      }
-    }
-    else{
-      PyDict_SetItemString(meta_list, meta->identifier, object);
-      Py_DECREF(object);
-    }
-  }
 
-  yr_rule_strings_foreach(rule, string)
-  {
-    yr_string_matches_foreach(context, string, m)
-    {
-      object = PyBytes_FromStringAndSize((char*) m->data, m->data_length);
+// Adds "value" to a counter and returns its previous value. Adding 0 reads
+// the counter atomically.
 
-      tuple = Py_BuildValue(
-          "(L,s,O)",
-          m->base + m->offset,
-          string->identifier,
-          object);
+static uint64_t metrics_add(
+    volatile uint64_t* counter,
+    uint64_t value)
+{
+  #if defined(_WIN32)
+  return (uint64_t) InterlockedExchangeAdd64(
+      (volatile LONG64*) counter, (LONG64) value);
+  #else
+  return __sync_fetch_and_add(counter, value);
+  #endif
+}
 
-      PyList_Append(string_list, tuple);
 
-      Py_DECREF(object);
-      Py_DECREF(tuple);
-    }
-  }
+static uint64_t metrics_clear(
+    volatile uint64_t* counter)
+{
+  #if defined(_WIN32)
+  return (uint64_t) InterlockedExchange64((volatile LONG64*) counter, 0);
+  #else
+  return __sync_lock_test_and_set(counter, 0);
+  #endif
+}
 
-  if (message == CALLBACK_MSG_RULE_MATCHING)
-  {
-    match = Match_NEW(
-        rule->identifier,
-        rule->ns->name,
-        tag_list,
-        meta_list,
-        string_list);
 
-    if (match != NULL)
-    {
-      PyList_Append(matches, match);
-      Py_DECREF(match);
-    }
-    else
-    {
-      Py_DECREF(tag_list);
-      Py_DECREF(string_list);
-      Py_DECREF(meta_list);
-      PyGILState_Release(gil_state);
+static double monotonic_time(void);
 
-      return CALLBACK_ERROR;
-    }
-  }
 
-  if (callback != NULL &&
-      ((message == CALLBACK_MSG_RULE_MATCHING && (which & CALLBACK_MATCHES)) ||
-       (message == CALLBACK_MSG_RULE_NOT_MATCHING && (which & CALLBACK_NON_MATCHES))))
-  {
-    Py_INCREF(callback);
+// Counts a match of "rule". Called without the GIL.
 
-    callback_dict = PyDict_New();
+static void metrics_count_rule(
+    YR_RULE* rule)
+{
+  const char* c;
+  uint32_t hash = 2166136261u;
+  size_t i, n;
 
-    object = PyBool_FromLong(message == CALLBACK_MSG_RULE_MATCHING);
-    PyDict_SetItemString(callback_dict, "matches", object);
-    Py_DECREF(object);
+  for (c = rule->ns->name; *c != '\0'; c++)
+    hash = (hash ^ (uint8_t) *c) * 16777619u;
 
-    object = PY_STRING(rule->identifier);
-    PyDict_SetItemString(callback_dict, "rule", object);
-    Py_DECREF(object);
+  hash = (hash ^ ':') * 16777619u;
 
-    object = PY_STRING(rule->ns->name);
-    PyDict_SetItemString(callback_dict, "namespace", object);
-    Py_DECREF(object);
+  for (c = rule->identifier; *c != '\0'; c++)
+    hash = (hash ^ (uint8_t) *c) * 16777619u;
 
-    PyDict_SetItemString(callback_dict, "tags", tag_list);
-    PyDict_SetItemString(callback_dict, "meta", meta_list);
-    PyDict_SetItemString(callback_dict, "strings", string_list);
+  spin_lock(&metrics_rules_lock);
 
-    callback_result = PyObject_CallFunctionObjArgs(
-        callback,
-        callback_dict,
-        NULL);
+  for (n = 0, i = hash % METRICS_MAX_RULES;
+       n < METRICS_MAX_RULES;
+       n++, i = (i + 1) % METRICS_MAX_RULES)
+  {
+    METRICS_RULE* entry = &metrics_rules[i];
 
-    if (callback_result != NULL)
+    if (entry->identifier == NULL)
     {
-      #if PY_MAJOR_VERSION >= 3
-      if (PyLong_Check(callback_result))
-      #else
-      if (PyLong_Check(callback_result) || PyInt_Check(callback_result))
-      #endif
+      entry->ns = strdup(rule->ns->name);
+      entry->identifier = strdup(rule->identifier);
+
+      if (entry->ns == NULL || entry->identifier == NULL)
       {
-        result = (int) PyLong_AsLong(callback_result);
+        free(entry->ns);
+        free(entry->identifier);
+        entry->ns = NULL;
+        entry->identifier = NULL;
+        break;
       }
-
-      Py_DECREF(callback_result);
     }
-    else
+
+    if (strcmp(entry->identifier, rule->identifier) == 0 &&
+        strcmp(entry->ns, rule->ns->name) == 0)
     {
-      result = CALLBACK_ERROR;
+      entry->hits++;
+      spin_unlock(&metrics_rules_lock);
+      return;
     }
-
-    Py_DECREF(callback_dict);
-    Py_DECREF(callback);
   }
 
-  Py_DECREF(tag_list);
-  Py_DECREF(string_list);
-  Py_DECREF(meta_list);
-  PyGILState_Release(gil_state);
+  spin_unlock(&metrics_rules_lock);
 
-  return result;
+  // The table is full, or there's no memory for a new entry.
+  metrics_add(&metrics.dropped_rule_hits, 1);
 }
 
 
-/* YR_STREAM read method for "file-like objects" */
+// Records a scan that took "seconds" and finished with "error". Called with
+// or without the GIL.
 
-static size_t flo_read(
-    void* ptr,
-    size_t size,
-    size_t count,
-    void* user_data)
+static void metrics_record_scan(
+    uint64_t scanned_bytes,
+    double seconds,
+    int error)
 {
-  size_t i;
-
-  for (i = 0; i < count; i++)
-  {
-    PyGILState_STATE gil_state = PyGILState_Ensure();
-
-    PyObject* bytes = PyObject_CallMethod(
-        (PyObject*) user_data, "read", "n", (Py_ssize_t) size);
-
-    PyGILState_Release(gil_state);
-
-    if (bytes != NULL)
-    {
-      Py_ssize_t len;
-      char* buffer;
+  int i;
 
-      int result = PyBytes_AsStringAndSize(bytes, &buffer, &len);
+  metrics_add(&metrics.scans, 1);
 
-      if (result == -1 || (size_t) len < size)
-      {
-        Py_DECREF(bytes);
-        return i;
-      }
-
-      memcpy((char*) ptr + i * size, buffer, size);
+  if (error == ERROR_SUCCESS)
+    metrics_add(&metrics.scanned_bytes, scanned_bytes);
+  else if (error == ERROR_SCAN_TIMEOUT)
+    metrics_add(&metrics.timeouts, 1);
 
-      Py_DECREF(bytes);
-    }
-    else
-    {
-      return i;
-    }
+  for (i = 0; i < METRICS_LATENCY_BUCKETS; i++)
+  {
+    if (seconds <= metrics_latency_bounds[i])
+      break;
   }
 
-  return count;
+  metrics_add(&metrics.latency[i], 1);
+  metrics_add(&metrics.latency_sum, (uint64_t) (seconds * 1e6));
 }
 
 
-/* YR_STREAM write method for "file-like objects" */
+// Rule reported by the scanner but not yet delivered to the batch callback.
 
-static size_t flo_write(
-    const void* ptr,
-    size_t size,
-    size_t count,
-    void* user_data)
+typedef struct _PENDING_RULE
 {
-  size_t i;
-
-  for (i = 0; i < count; i++)
-  {
-    PyGILState_STATE gil_state = PyGILState_Ensure();
+  YR_RULE* rule;
+  bool matching;
 
-    PyObject* result = PyObject_CallMethod(
-    #if PY_MAJOR_VERSION >= 3
-        (PyObject*) user_data, "write", "y#", (char*) ptr + i * size, size);
-    #else
-        (PyObject*) user_data, "write", "s#", (char*) ptr + i * size, size);
-    #endif
+} PENDING_RULE;
 
-    PyGILState_Release(gil_state);
 
-    if (result == NULL)
-      return i;
+// Matches found during a scan, recorded in plain C storage so that they can
+// be collected without holding the GIL. Each RULE_RECORD refers to a range of
+// MATCH_RECORDs, and each MATCH_RECORD to a range of bytes in "data".
 
-    Py_DECREF(result);
-  }
+typedef struct _MATCH_RECORD
+{
+  YR_STRING* string;
+  int64_t offset;
+  int32_t length;
+  int32_t data_length;
+  size_t data_offset;
 
-  return count;
-}
+} MATCH_RECORD;
 
 
-PyObject* handle_error(
-    int error,
-    char* extra)
+typedef struct _RULE_RECORD
 {
-  switch(error)
-  {
-    case ERROR_COULD_NOT_ATTACH_TO_PROCESS:
-      return PyErr_Format(
-          YaraError,
-          "access denied");
-    case ERROR_INSUFFICIENT_MEMORY:
-      return PyErr_NoMemory();
-    case ERROR_COULD_NOT_OPEN_FILE:
-      return PyErr_Format(
-          YaraError,
-          "could not open file \"%s\"",
-          extra);
-    case ERROR_COULD_NOT_MAP_FILE:
-      return PyErr_Format(
-          YaraError,
-          "could not map file \"%s\" into memory",
-          extra);
-    case ERROR_INVALID_FILE:
-      return PyErr_Format(
-          YaraError,
-          "invalid rules file \"%s\"",
-          extra);
-    case ERROR_CORRUPT_FILE:
-      return PyErr_Format(
-          YaraError,
-          "corrupt rules file \"%s\"",
-          extra);
-    case ERROR_SCAN_TIMEOUT:
-      return PyErr_Format(
-          YaraTimeoutError,
-          "scanning timed out");
-    case ERROR_INVALID_EXTERNAL_VARIABLE_TYPE:
-      return PyErr_Format(
-          YaraError,
-          "external variable \"%s\" was already defined with a different type",
-          extra);
-    case ERROR_UNSUPPORTED_FILE_VERSION:
-      return PyErr_Format(
-          YaraError,
-          "rules file \"%s\" is incompatible with this version of YARA",
-          extra);
-    default:
-      return PyErr_Format(
-          YaraError,
-          "internal error: %d",
-          error);
-  }
-}
+  YR_RULE* rule;
+  size_t first_match;
+  size_t num_matches;
+  bool truncated;
 
+} RULE_RECORD;
 
-int process_compile_externals(
-    PyObject* externals,
-    YR_COMPILER* compiler)
+
+typedef struct _SCAN_RESULTS
 {
-  PyObject* key;
-  PyObject* value;
-  Py_ssize_t pos = 0;
+  RULE_RECORD* rules;
+  size_t num_rules;
+  size_t rules_capacity;
 
-  char* identifier = NULL;
-  int result;
+  MATCH_RECORD* matches;
+  size_t num_matches;
+  size_t matches_capacity;
 
-  while (PyDict_Next(externals, &pos, &key, &value))
-  {
-    identifier = PY_STRING_TO_C(key);
+  uint8_t* data;
+  size_t data_length;
+  size_t data_capacity;
 
-    if (PyBool_Check(value))
-    {
-      result = yr_compiler_define_boolean_variable(
-          compiler,
-          identifier,
-          PyObject_IsTrue(value));
-    }
-#if PY_MAJOR_VERSION >= 3
-    else if (PyLong_Check(value))
-#else
-    else if (PyLong_Check(value) || PyInt_Check(value))
-#endif
-    {
-      result = yr_compiler_define_integer_variable(
-          compiler,
-          identifier,
-          PyLong_AsLongLong(value));
-    }
-    else if (PyFloat_Check(value))
-    {
-      result = yr_compiler_define_float_variable(
-          compiler,
-          identifier,
-          PyFloat_AsDouble(value));
-    }
-    else if (PY_STRING_CHECK(value))
-    {
-      char* str = PY_STRING_TO_C(value);
+  const SCAN_LIMITS* limits;
+  size_t result_size;
 
-      if (str == NULL)
-        return ERROR_INVALID_ARGUMENT;
+  int error;
 
-      result = yr_compiler_define_string_variable(
-          compiler, identifier, str);
-    }
-    else
-    {
-      PyErr_Format(
-          PyExc_TypeError,
-          "external values must be of type integer, float, boolean or string");
+} SCAN_RESULTS;
 
-      return ERROR_INVALID_ARGUMENT;
-    }
 
-    if (result != ERROR_SUCCESS)
-    {
-      handle_error(result, identifier);
-      return result;
-    }
-  }
+typedef struct _CALLBACK_DATA
+{
+  YARA_STATE* state;
+  PyThreadState* thread_state;
+  PyObject* matches;
+  PyObject* callback;
+  PyObject* batch_callback;
+  PyObject* modules_data;
+  PyObject* modules_callback;
+  PyObject* warnings_callback;
+  PyObject* console_callback;
+  int which;
+  bool allow_duplicate_metadata;
+  int stop_after;
+  int num_matches;
+  uint8_t* stop_rules;
+  int batch_size;
+  int num_pending;
+  PENDING_RULE* pending;
+  SCAN_RESULTS* results;
 
-  return ERROR_SUCCESS;
+} CALLBACK_DATA;
+
+// Scan callbacks are invoked while the scanning thread doesn't hold the GIL.
+// They take it back with the thread state saved when the scan started, which
+// unlike PyGILState_Ensure() always belongs to the interpreter that started
+// the scan.
+
+static void callback_acquire_gil(
+    CALLBACK_DATA* data)
+{
+  PyEval_RestoreThread(data->thread_state);
 }
 
 
-int process_match_externals(
-    PyObject* externals,
-    YR_SCANNER* scanner)
+static void callback_release_gil(
+    CALLBACK_DATA* data)
 {
-  PyObject* key;
-  PyObject* value;
-  Py_ssize_t pos = 0;
+  data->thread_state = PyEval_SaveThread();
+}
 
-  char* identifier = NULL;
-  int result;
 
-  while (PyDict_Next(externals, &pos, &key, &value))
-  {
-    identifier = PY_STRING_TO_C(key);
+static PyStructSequence_Field RuleString_Fields[] = {
+  {"namespace", "Namespace of the rule"},
+  {"rule", "Identifier of the rule"},
+  {"string", "Identifier of the string"},
+  {NULL}
+};
 
-    if (PyBool_Check(value))
-    {
-      result = yr_scanner_define_boolean_variable(
-          scanner,
-          identifier,
-          PyObject_IsTrue(value));
-    }
-#if PY_MAJOR_VERSION >= 3
-    else if (PyLong_Check(value))
-#else
-    else if (PyLong_Check(value) || PyInt_Check(value))
-#endif
-    {
-      result = yr_scanner_define_integer_variable(
-          scanner,
-          identifier,
-          PyLong_AsLongLong(value));
-    }
-    else if (PyFloat_Check(value))
-    {
-      result = yr_scanner_define_float_variable(
-          scanner,
-          identifier,
-          PyFloat_AsDouble(value));
-    }
-    else if (PY_STRING_CHECK(value))
-    {
-      char* str = PY_STRING_TO_C(value);
+static PyStructSequence_Desc RuleString_Desc = {
+  "yara.RuleString",
+  "Named tuple tying together rule identifier and string identifier",
+  RuleString_Fields,
+  (sizeof(RuleString_Fields) / sizeof(RuleString_Fields[0])) - 1
+};
 
-      if (str == NULL)
-        return ERROR_INVALID_ARGUMENT;
+#if !defined(USE_MODULE_STATE)
+static PyTypeObject RuleString_Type = {0};
+#endif
 
-      result = yr_scanner_define_string_variable(
-          scanner, identifier, str);
-    }
-    else
-    {
-      PyErr_Format(
-          PyExc_TypeError,
-          "external values must be of type integer, float, boolean or string");
+// Forward declarations for handling module data.
+PyObject* convert_structure_to_python(
+    YR_OBJECT_STRUCTURE* structure);
 
-      return ERROR_INVALID_ARGUMENT;
-    }
 
-    // yr_scanner_define_xxx_variable returns ERROR_INVALID_ARGUMENT if the
-    // variable wasn't previously defined in the compilation phase. Ignore
-    // those errors because we don't want the "scan" method being aborted
-    // because of the "externals" dictionary having more keys than those used
-    // during compilation.
+PyObject* convert_array_to_python(
+    YR_OBJECT_ARRAY* array);
 
-    if (result != ERROR_SUCCESS &&
-        result != ERROR_INVALID_ARGUMENT)
-    {
-      handle_error(result, identifier);
-      return result;
-    }
-  }
 
-  return ERROR_SUCCESS;
-}
+PyObject* convert_dictionary_to_python(
+    YR_OBJECT_DICTIONARY* dictionary);
 
 
-static PyObject* Match_NEW(
-    const char* rule,
-    const char* ns,
-    PyObject* tags,
-    PyObject* meta,
-    PyObject* strings)
+PyObject* convert_object_to_python(
+    YR_OBJECT* object)
 {
-  Match* object = PyObject_NEW(Match, &Match_Type);
+  PyObject* result = NULL;
 
-  if (object != NULL)
+  if (object == NULL)
+    return NULL;
+
+  switch(object->type)
   {
-    object->rule = PY_STRING(rule);
-    object->ns = PY_STRING(ns);
-    object->tags = tags;
-    object->meta = meta;
-    object->strings = strings;
+    case OBJECT_TYPE_INTEGER:
+      if (object->value.i != YR_UNDEFINED)
+        result = Py_BuildValue("l", object->value.i);
+      break;
 
-    Py_INCREF(tags);
-    Py_INCREF(meta);
-    Py_INCREF(strings);
-  }
+    case OBJECT_TYPE_STRING:
+      if (object->value.ss != NULL)
+        result = PyBytes_FromStringAndSize(
+            object->value.ss->c_string,
+            object->value.ss->length);
+      break;
 
-  return (PyObject*) object;
-}
+    case OBJECT_TYPE_STRUCTURE:
+      result = convert_structure_to_python(object_as_structure(object));
+      break;
 
+    case OBJECT_TYPE_ARRAY:
+      result = convert_array_to_python(object_as_array(object));
+      break;
 
-static void Match_dealloc(
-    PyObject* self)
-{
-  Match* object = (Match*) self;
+    case OBJECT_TYPE_FUNCTION:
+      // Do nothing with functions...
+      break;
 
-  Py_DECREF(object->rule);
-  Py_DECREF(object->ns);
-  Py_DECREF(object->tags);
-  Py_DECREF(object->meta);
-  Py_DECREF(object->strings);
+    case OBJECT_TYPE_DICTIONARY:
+      result = convert_dictionary_to_python(object_as_dictionary(object));
+      break;
 
-  PyObject_Del(self);
-}
+    case OBJECT_TYPE_FLOAT:
+      if (!isnan(object->value.d))
+        result = Py_BuildValue("d", object->value.d);
+      break;
 
+    default:
+      break;
+  }
 
-static PyObject* Match_repr(
-    PyObject* self)
-{
-  Match* object = (Match*) self;
-  Py_INCREF(object->rule);
-  return object->rule;
+  return result;
 }
 
 
-static PyObject* Match_getattro(
-    PyObject* self,
-    PyObject* name)
+PyObject* convert_structure_to_python(
+    YR_OBJECT_STRUCTURE* structure)
 {
-  return PyObject_GenericGetAttr(self, name);
-}
+  YR_STRUCTURE_MEMBER* member;
 
+  PyObject* py_object;
+  PyObject* py_dict = PyDict_New();
 
-static PyObject* Match_richcompare(
-    PyObject* self,
-    PyObject* other,
-    int op)
-{
-  PyObject* result = NULL;
+  if (py_dict == NULL)
+    return py_dict;
 
-  Match* a = (Match*) self;
-  Match* b = (Match*) other;
+  member = structure->members;
 
-  if(PyObject_TypeCheck(other, &Match_Type))
+  while (member != NULL)
   {
-    switch(op)
+    py_object = convert_object_to_python(member->object);
+
+    if (py_object != NULL)
     {
-    case Py_EQ:
-      if (PyObject_RichCompareBool(a->rule, b->rule, Py_EQ) &&
-          PyObject_RichCompareBool(a->ns, b->ns, Py_EQ))
-        result = Py_True;
-      else
-        result = Py_False;
+      PyDict_SetItemString(py_dict, member->object->identifier, py_object);
+      Py_DECREF(py_object);
+    }
 
-      Py_INCREF(result);
-      break;
+    member =member->next;
+  }
 
-    case Py_NE:
-      if (PyObject_RichCompareBool(a->rule, b->rule, Py_NE) ||
-          PyObject_RichCompareBool(a->ns, b->ns, Py_NE))
-          result = Py_True;
-      else
-          result = Py_False;
+  return py_dict;
+}
 
-      Py_INCREF(result);
-      break;
 
-    case Py_LT:
-    case Py_LE:
-    case Py_GT:
-    case Py_GE:
-      if (PyObject_RichCompareBool(a->rule, b->rule, Py_EQ))
-        result = PyObject_RichCompare(a->ns, b->ns, op);
-      else
-        result = PyObject_RichCompare(a->rule, b->rule, op);
+PyObject* convert_array_to_python(
+    YR_OBJECT_ARRAY* array)
+{
+  PyObject* py_object;
+  PyObject* py_list = PyList_New(0);
 
-      break;
-    }
-  }
-  else
+  if (py_list == NULL)
+    return py_list;
+
+  // If there is nothing in the list, return an empty Python list
+  if (array->items == NULL)
+    return py_list;
+
+  for (int i = 0; i < array->items->length; i++)
   {
-    result = PyErr_Format(
-        PyExc_TypeError,
-        "'Match' objects must be compared with objects of the same class");
+    py_object = convert_object_to_python(array->items->objects[i]);
+
+    if (py_object != NULL)
+    {
+      PyList_Append(py_list, py_object);
+      Py_DECREF(py_object);
+    }
   }
 
-  return result;
+  return py_list;
 }
 
 
-static Py_hash_t Match_hash(
-    PyObject* self)
+PyObject* convert_dictionary_to_python(
+    YR_OBJECT_DICTIONARY* dictionary)
 {
-  Match* match = (Match*) self;
-  return PyObject_Hash(match->rule) + PyObject_Hash(match->ns);
-}
+  PyObject* py_object;
+  PyObject* py_dict = PyDict_New();
 
-////////////////////////////////////////////////////////////////////////////////
+  if (py_dict == NULL)
+    return py_dict;
 
+  // If there is nothing in the YARA dictionary, return an empty Python dict
+  if (dictionary->items == NULL)
+    return py_dict;
 
-static void Rule_dealloc(
-    PyObject* self)
-{
-  Rule* object = (Rule*) self;
-  Py_XDECREF(object->identifier);
-  Py_XDECREF(object->tags);
-  Py_XDECREF(object->meta);
-  Py_XDECREF(object->global);
-  Py_XDECREF(object->private);
-  PyObject_Del(self);
-}
+  for (int i = 0; i < dictionary->items->used; i++)
+  {
+    py_object = convert_object_to_python(dictionary->items->objects[i].obj);
 
-static PyObject* Rule_getattro(
-    PyObject* self,
-    PyObject* name)
-{
-  return PyObject_GenericGetAttr(self, name);
+    if (py_object != NULL)
+    {
+      PyDict_SetItemString(
+          py_dict,
+          dictionary->items->objects[i].key->c_string,
+          py_object);
+
+      Py_DECREF(py_object);
+    }
+  }
+
+  return py_dict;
 }
 
 
-static Rules* Rules_NEW(void)
+static int handle_import_module(
+    YR_MODULE_IMPORT* module_import,
+    CALLBACK_DATA* data)
 {
-  Rules* rules = PyObject_NEW(Rules, &Rules_Type);
+  if (data->modules_data == NULL)
+    return CALLBACK_CONTINUE;
 
-  if (rules != NULL)
-  {
-    rules->rules = NULL;
-    rules->externals = NULL;
-    rules->warnings = NULL;
-  }
+  callback_acquire_gil(data);
 
-  return rules;
-}
+  PyObject* module_data = PyDict_GetItemString(
+      data->modules_data,
+      module_import->module_name);
 
-static void Rules_dealloc(
-    PyObject* self)
-{
-  Rules* object = (Rules*) self;
+  #if PY_MAJOR_VERSION >= 3
+  if (module_data != NULL && PyBytes_Check(module_data))
+  #else
+  if (module_data != NULL && PyString_Check(module_data))
+  #endif
+  {
+    Py_ssize_t data_size;
 
-  Py_XDECREF(object->externals);
-  Py_XDECREF(object->warnings);
+    #if PY_MAJOR_VERSION >= 3
+    PyBytes_AsStringAndSize(
+        module_data,
+        (char**) &module_import->module_data,
+        &data_size);
+    #else
+    PyString_AsStringAndSize(
+        module_data,
+        (char**) &module_import->module_data,
+        &data_size);
+    #endif
 
-  if (object->rules != NULL)
-    yr_rules_destroy(object->rules);
+    module_import->module_data_size = data_size;
+  }
 
-  PyObject_Del(self);
+  callback_release_gil(data);
+
+  return CALLBACK_CONTINUE;
 }
 
-static PyObject* Rules_next(
-    PyObject* self)
-{
-  PyObject* tag_list;
-  PyObject* object;
-  PyObject* meta_list;
 
-  YR_META* meta;
-  const char* tag;
+static int handle_module_imported(
+    void* message_data,
+    CALLBACK_DATA* data)
+{
+  if (data->modules_callback == NULL)
+    return CALLBACK_CONTINUE;
 
-  Rule* rule;
-  Rules* rules = (Rules *) self;
+  callback_acquire_gil(data);
 
-  // Generate new Rule object based upon iter_current_rule and increment
-  // iter_current_rule.
+  PyObject* module_info_dict = convert_structure_to_python(
+      object_as_structure(message_data));
 
-  if (RULE_IS_NULL(rules->iter_current_rule))
+  if (module_info_dict == NULL)
   {
-    rules->iter_current_rule = rules->rules->rules_table;
-    PyErr_SetNone(PyExc_StopIteration);
-    return NULL;
+    callback_release_gil(data);
+    return CALLBACK_CONTINUE;
   }
 
-  rule = PyObject_NEW(Rule, &Rule_Type);
-  tag_list = PyList_New(0);
-  meta_list = PyDict_New();
+  PyObject* object = PY_STRING(object_as_structure(message_data)->identifier);
+  PyDict_SetItemString(module_info_dict, "module", object);
+  Py_DECREF(object);
 
-  if (rule != NULL && tag_list != NULL && meta_list != NULL)
-  {
-    yr_rule_tags_foreach(rules->iter_current_rule, tag)
-    {
-      object = PY_STRING(tag);
-      PyList_Append(tag_list, object);
-      Py_DECREF(object);
-    }
+  Py_INCREF(data->modules_callback);
 
-    yr_rule_metas_foreach(rules->iter_current_rule, meta)
-    {
-      if (meta->type == META_TYPE_INTEGER)
-        object = Py_BuildValue("i", meta->integer);
-      else if (meta->type == META_TYPE_BOOLEAN)
-        object = PyBool_FromLong((long) meta->integer);
-      else
-        object = PY_STRING(meta->string);
+  PyObject* callback_result = PyObject_CallFunctionObjArgs(
+      data->modules_callback,
+      module_info_dict,
+      NULL);
 
-        PyDict_SetItemString(meta_list, meta->identifier, object);
-        Py_DECREF(object);
+  int result = CALLBACK_CONTINUE;
 
+  if (callback_result != NULL)
+  {
+    #if PY_MAJOR_VERSION >= 3
+    if (PyLong_Check(callback_result))
+    #else
+    if (PyLong_Check(callback_result) || PyInt_Check(callback_result))
+    #endif
+    {
+      result = (int) PyLong_AsLong(callback_result);
     }
-
-    rule->global = PyBool_FromLong(rules->iter_current_rule->flags & RULE_FLAGS_GLOBAL);
-    rule->private = PyBool_FromLong(rules->iter_current_rule->flags & RULE_FLAGS_PRIVATE);
-    rule->identifier = PY_STRING(rules->iter_current_rule->identifier);
-    rule->tags = tag_list;
-    rule->meta = meta_list;
-    rules->iter_current_rule++;
-    return (PyObject*) rule;
   }
   else
   {
-    Py_XDECREF(tag_list);
-    Py_XDECREF(meta_list);
-    return PyErr_Format(PyExc_TypeError, "Out of memory");
+    result = CALLBACK_ERROR;
   }
-}
-
-static PyObject* Rules_match(
-    PyObject* self,
-    PyObject* args,
-    PyObject* keywords)
-{
-  static char* kwlist[] = {
-      "filepath", "pid", "data", "externals",
-      "callback", "fast", "timeout", "modules_data",
-      "modules_callback", "which_callbacks", "warnings_callback",
-      "console_callback", "allow_duplicate_metadata", NULL
-      };
-
-  char* filepath = NULL;
-  Py_buffer data = {0};
 
-  int pid = -1;
-  int timeout = 0;
-  int error = ERROR_SUCCESS;
+  Py_XDECREF(callback_result);
+  Py_DECREF(module_info_dict);
+  Py_DECREF(data->modules_callback);
 
-  PyObject* externals = NULL;
-  PyObject* fast = NULL;
+  callback_release_gil(data);
 
-  Rules* object = (Rules*) self;
+  return result;
+}
 
-  YR_SCANNER* scanner;
-  CALLBACK_DATA callback_data;
 
-  callback_data.matches = NULL;
-  callback_data.callback = NULL;
-  callback_data.modules_data = NULL;
-  callback_data.modules_callback = NULL;
-  callback_data.warnings_callback = NULL;
-  callback_data.console_callback = NULL;
-  callback_data.which = CALLBACK_ALL;
-  callback_data.allow_duplicate_metadata = false;
+static int handle_console_log(
+    void* message_data,
+    CALLBACK_DATA* data)
+{
+  callback_acquire_gil(data);
+  int result = CALLBACK_CONTINUE;
 
-  if (PyArg_ParseTupleAndKeywords(
-        args,
-        keywords,
-        "|sis*OOOiOOiOOb",
-        kwlist,
-        &filepath,
-        &pid,
-        &data,
-        &externals,
-        &callback_data.callback,
-        &fast,
-        &timeout,
-        &callback_data.modules_data,
-        &callback_data.modules_callback,
-        &callback_data.which,
-        &callback_data.warnings_callback,
-        &callback_data.console_callback,
-        &callback_data.allow_duplicate_metadata))
+  if (data->console_callback == NULL)
   {
-    if (filepath == NULL && data.buf == NULL && pid == -1)
-    {
-      return PyErr_Format(
-          PyExc_TypeError,
-          "match() takes at least one argument");
-    }
-
-    if (callback_data.callback != NULL)
-    {
-      if (!PyCallable_Check(callback_data.callback))
-      {
-        PyBuffer_Release(&data);
-        return PyErr_Format(
-            PyExc_TypeError,
-            "'callback' must be callable");
-      }
-    }
+    // If the user does not specify a console callback we dump to stdout.
+    // If we want to support 3.2 and newer only we can use
+    // https://docs.python.org/3/c-api/sys.html?highlight=stdout#c.PySys_FormatStdout
+    // instead of this call with the limit.
+    PySys_WriteStdout("%.1000s\n", (char*) message_data);
+  }
+  else
+  {
+    PyObject* log_string = PY_STRING((char*) message_data);
+    Py_INCREF(data->console_callback);
 
-    if (callback_data.modules_callback != NULL)
-    {
-      if (!PyCallable_Check(callback_data.modules_callback))
-      {
-        PyBuffer_Release(&data);
-        return PyErr_Format(
-            PyExc_TypeError,
-            "'modules_callback' must be callable");
-      }
-    }
+    PyObject* callback_result = PyObject_CallFunctionObjArgs(
+        data->console_callback,
+        log_string,
+        NULL);
 
-    if (callback_data.warnings_callback != NULL)
+    if (callback_result != NULL)
     {
-      if (!PyCallable_Check(callback_data.warnings_callback))
+      #if PY_MAJOR_VERSION >= 3
+      if (PyLong_Check(callback_result))
+      #else
+      if (PyLong_Check(callback_result) || PyInt_Check(callback_result))
+      #endif
       {
-        PyBuffer_Release(&data);
-        return PyErr_Format(
-            PyExc_TypeError,
-            "'warnings_callback' must be callable");
+        result = (int) PyLong_AsLong(callback_result);
       }
     }
-
-    if (callback_data.console_callback != NULL)
+    else
     {
-      if (!PyCallable_Check(callback_data.console_callback))
-      {
-        PyBuffer_Release(&data);
-        return PyErr_Format(
-            PyExc_TypeError,
-            "'console_callback' must be callable");
-      }
+      result = CALLBACK_ERROR;
     }
 
-    if (callback_data.modules_data != NULL)
-    {
-      if (!PyDict_Check(callback_data.modules_data))
-      {
-        PyBuffer_Release(&data);
-        return PyErr_Format(
-            PyExc_TypeError,
-            "'modules_data' must be a dictionary");
-      }
-    }
+    Py_DECREF(log_string);
+    Py_XDECREF(callback_result);
+    Py_DECREF(data->console_callback);
+  }
 
-    if (callback_data.allow_duplicate_metadata == NULL)
-      callback_data.allow_duplicate_metadata = false;
+  callback_release_gil(data);
 
-    if (yr_scanner_create(object->rules, &scanner) != 0)
-    {
-      return PyErr_Format(
-          PyExc_Exception,
-          "could not create scanner");
-    }
+  return result;
+}
 
-    if (externals != NULL && externals != Py_None)
-    {
-      if (PyDict_Check(externals))
-      {
-        if (process_match_externals(externals, scanner) != ERROR_SUCCESS)
-        {
-          PyBuffer_Release(&data);
-          yr_scanner_destroy(scanner);
-          return NULL;
-        }
-      }
-      else
-      {
-        PyBuffer_Release(&data);
-        yr_scanner_destroy(scanner);
-        return PyErr_Format(
-            PyExc_TypeError,
-            "'externals' must be a dictionary");
-      }
-    }
 
-    if (fast != NULL && PyObject_IsTrue(fast) == 1)
-    {
-      yr_scanner_set_flags(scanner, SCAN_FLAGS_FAST_MODE);
-    }
+static int handle_too_many_matches(
+    YR_SCAN_CONTEXT* context,
+    YR_STRING* string,
+    CALLBACK_DATA* data)
+{
+  if (metrics_enabled)
+    metrics_add(&metrics.too_many_matches, 1);
 
-    yr_scanner_set_timeout(scanner, timeout);
-    yr_scanner_set_callback(scanner, yara_callback, &callback_data);
+  callback_acquire_gil(data);
 
-    if (filepath != NULL)
-    {
-      callback_data.matches = PyList_New(0);
+  PyObject* warning_type = NULL;
+  PyObject* string_identifier = NULL;
+  PyObject* rule_identifier = NULL;
+  PyObject* namespace_identifier = NULL;
+  PyObject* rule_string = NULL;
+  YR_RULE* rule = NULL;
 
-      Py_BEGIN_ALLOW_THREADS
+  int result = CALLBACK_CONTINUE;
 
-      error = yr_scanner_scan_file(scanner, filepath);
+  if (data->warnings_callback == NULL)
+  {
+    char message[200];
 
-      Py_END_ALLOW_THREADS
-    }
-    else if (data.buf != NULL)
-    {
-      callback_data.matches = PyList_New(0);
+    snprintf(
+        message,
+        sizeof(message),
+        "too many matches for string %s in rule \"%s\"",
+        string->identifier,
+        context->rules->rules_table[string->rule_idx].identifier);
 
-      Py_BEGIN_ALLOW_THREADS
+    if (PyErr_WarnEx(PyExc_RuntimeWarning, message, 1) == -1)
+      result = CALLBACK_ERROR;
+  }
+  else
+  {
+    Py_INCREF(data->warnings_callback);
 
-      error = yr_scanner_scan_mem(
-          scanner,
-          (unsigned char*) data.buf,
-          (size_t) data.len);
+    string_identifier = PY_STRING(string->identifier);
 
-      Py_END_ALLOW_THREADS
-    }
-    else if (pid != -1)
+    if (string_identifier == NULL)
     {
-      callback_data.matches = PyList_New(0);
-
-      Py_BEGIN_ALLOW_THREADS
-
-      error = yr_scanner_scan_proc(scanner, pid);
-
-      Py_END_ALLOW_THREADS
+      result = CALLBACK_ERROR;
+      goto _exit;
     }
 
-    PyBuffer_Release(&data);
-    yr_scanner_destroy(scanner);
+    rule = &context->rules->rules_table[string->rule_idx];
+    rule_identifier = PY_STRING(rule->identifier);
 
-    if (error != ERROR_SUCCESS)
+    if (rule_identifier == NULL)
     {
-      Py_DECREF(callback_data.matches);
+      result = CALLBACK_ERROR;
+      goto _exit;
+    }
 
-      if (error != ERROR_CALLBACK_ERROR)
-      {
-        if (filepath != NULL)
-        {
-          handle_error(error, filepath);
-        }
-        else if (pid != -1)
-        {
-          handle_error(error, "<proc>");
-        }
-        else
-        {
-          handle_error(error, "<data>");
-        }
+    namespace_identifier = PY_STRING(rule->ns->name);
 
-        #ifdef PROFILING_ENABLED
-        PyObject* exception = PyErr_Occurred();
+    if (namespace_identifier == NULL)
+    {
+      result = CALLBACK_ERROR;
+      goto _exit;
+    }
 
-        if (exception != NULL && error == ERROR_SCAN_TIMEOUT)
-        {
-          PyObject_SetAttrString(
-              exception,
-              "profiling_info",
-              Rules_profiling_info(self, NULL));
-        }
-        #endif
-      }
+    rule_string = PyStructSequence_New(data->state->RuleString_Type);
 
-      return NULL;
+    if (rule_string == NULL)
+    {
+      result = CALLBACK_ERROR;
+      goto _exit;
     }
-  }
-
-  return callback_data.matches;
-}
 
+    PyStructSequence_SET_ITEM(rule_string, 0, namespace_identifier);
+    PyStructSequence_SET_ITEM(rule_string, 1, rule_identifier);
+    PyStructSequence_SET_ITEM(rule_string, 2, string_identifier);
 
-static PyObject* Rules_save(
-    PyObject* self,
-    PyObject* args,
-    PyObject* keywords)
+    // PyStructSequenece steals the reference so we NULL these
+    // so that Py_XDECREF() can be used in _exit label
+    namespace_identifier = NULL;
+    rule_identifier = NULL;
+    string_identifier = NULL;
+
+    warning_type = PyLong_FromLong(CALLBACK_MSG_TOO_MANY_MATCHES);
+
+    if (warning_type == NULL)
+    {
+      result = CALLBACK_ERROR;
+      goto _exit;
+    }
+
+    PyObject* callback_result = PyObject_CallFunctionObjArgs(
+        data->warnings_callback,
+        warning_type,
+        rule_string,
+        NULL);
+
+    if (callback_result != NULL)
+    {
+      #if PY_MAJOR_VERSION >= 3
+      if (PyLong_Check(callback_result))
+      #else
+      if (PyLong_Check(callback_result) || PyInt_Check(callback_result))
+      #endif
+      {
+        result = (int) PyLong_AsLong(callback_result);
+      }
+    }
+    else
+    {
+      result = CALLBACK_ERROR;
+    }
+
+    Py_XDECREF(callback_result);
+  }
+
+_exit:
+
+  Py_XDECREF(namespace_identifier);
+  Py_XDECREF(rule_identifier);
+  Py_XDECREF(string_identifier);
+  Py_XDECREF(rule_string);
+  Py_XDECREF(warning_type);
+  Py_XDECREF(data->warnings_callback);
+
+  callback_release_gil(data);
+
+  return result;
+}
+
+
+#define CALLBACK_MATCHES 0x01
+#define CALLBACK_NON_MATCHES 0x02
+#define CALLBACK_ALL CALLBACK_MATCHES | CALLBACK_NON_MATCHES
+
+
+// Creates the tag list and metadata dictionary for a rule, and an empty
+// string list. Must be called with the GIL held.
+
+static bool build_rule_tags_and_meta(
+    YR_RULE* rule,
+    CALLBACK_DATA* data,
+    PyObject** tag_list,
+    PyObject** meta_list,
+    PyObject** string_list)
 {
-  static char* kwlist[] = {
-      "filepath", "file",  NULL
-      };
+  YR_META* meta;
 
-  char* filepath = NULL;
-  PyObject* file = NULL;
-  Rules* rules = (Rules*) self;
+  const char* tag;
 
-  int error;
+  PyObject* object;
 
-  if (!PyArg_ParseTupleAndKeywords(
-      args,
-      keywords,
-      "|sO",
-      kwlist,
-      &filepath,
-      &file))
+  *tag_list = PyList_New(0);
+  *string_list = PyList_New(0);
+  *meta_list = PyDict_New();
+
+  if (*tag_list == NULL || *string_list == NULL || *meta_list == NULL)
   {
-    return NULL;
+    Py_XDECREF(*tag_list);
+    Py_XDECREF(*string_list);
+    Py_XDECREF(*meta_list);
+
+    return false;
   }
 
-  if (filepath != NULL)
+  yr_rule_tags_foreach(rule, tag)
   {
-    Py_BEGIN_ALLOW_THREADS
-    error = yr_rules_save(rules->rules, filepath);
-    Py_END_ALLOW_THREADS
-
-    if (error != ERROR_SUCCESS)
-      return handle_error(error, filepath);
+    object = PY_STRING(tag);
+    PyList_Append(*tag_list, object);
+    Py_DECREF(object);
   }
-  else if (file != NULL && PyObject_HasAttrString(file, "write"))
+
+  yr_rule_metas_foreach(rule, meta)
   {
-    YR_STREAM stream;
+    if (meta->type == META_TYPE_INTEGER)
+      object = Py_BuildValue("i", meta->integer);
+    else if (meta->type == META_TYPE_BOOLEAN)
+      object = PyBool_FromLong((long) meta->integer);
+    else
+      object = PY_STRING(meta->string);
 
-    stream.user_data = file;
-    stream.write = flo_write;
+    if (data->allow_duplicate_metadata){
+      // Check if we already have an array under this key
+      PyObject* existing_item = PyDict_GetItemString(*meta_list, meta->identifier);
+      // Append object to existing list
+      if (existing_item)
+        PyList_Append(existing_item, object);
+      else{
+        //Otherwise, instantiate array and append object as first item
+        PyObject* new_list = PyList_New(0);
+        PyList_Append(new_list, object);
+        PyDict_SetItemString(*meta_list, meta->identifier, new_list);
+        Py_DECREF(new_list);
+      }
+    }
+    else{
+      PyDict_SetItemString(*meta_list, meta->identifier, object);
+      Py_DECREF(object);
+    }
+  }
 
-    Py_BEGIN_ALLOW_THREADS;
-    error = yr_rules_save_stream(rules->rules, &stream);
-    Py_END_ALLOW_THREADS;
+  return true;
+}
 
-    if (error != ERROR_SUCCESS)
-      return handle_error(error, "<file-like-object>");
-  }
-  else
+
+// Creates the tag list, metadata dictionary and string list for a rule. The
+// string list is built from the matches found in the current scan, so this
+// must be called before the scan finishes. Must be called with the GIL held.
+
+static bool build_rule_objects(
+    YR_SCAN_CONTEXT* context,
+    YR_RULE* rule,
+    CALLBACK_DATA* data,
+    PyObject** tag_list,
+    PyObject** meta_list,
+    PyObject** string_list)
+{
+  YR_STRING* string;
+  YR_MATCH* m;
+
+  PyObject* object;
+  PyObject* tuple;
+
+  if (!build_rule_tags_and_meta(rule, data, tag_list, meta_list, string_list))
+    return false;
+
+  yr_rule_strings_foreach(rule, string)
   {
-    return PyErr_Format(
-      PyExc_TypeError,
-      "load() expects either a file path or a file-like object");
+    yr_string_matches_foreach(context, string, m)
+    {
+      object = PyBytes_FromStringAndSize((char*) m->data, m->data_length);
+
+      tuple = Py_BuildValue(
+          "(L,s,O)",
+          m->base + m->offset,
+          string->identifier,
+          object);
+
+      PyList_Append(*string_list, tuple);
+
+      Py_DECREF(object);
+      Py_DECREF(tuple);
+    }
   }
 
-  Py_RETURN_NONE;
+  return true;
 }
 
 
-static PyObject* Rules_profiling_info(
-    PyObject* self,
-    PyObject* args)
-{
+// Creates the dictionary passed to callback functions for a rule.
 
-#ifdef PROFILING_ENABLED
+static PyObject* build_callback_dict(
+    YR_RULE* rule,
+    bool matching,
+    PyObject* tag_list,
+    PyObject* meta_list,
+    PyObject* string_list)
+{
   PyObject* object;
-  PyObject* result;
+  PyObject* callback_dict = PyDict_New();
 
-  YR_RULES* rules = ((Rules*) self)->rules;
-  YR_RULE* rule;
-  YR_STRING* string;
+  if (callback_dict == NULL)
+    return NULL;
 
-  char key[512];
-  uint64_t clock_ticks;
+  object = PyBool_FromLong(matching);
+  PyDict_SetItemString(callback_dict, "matches", object);
+  Py_DECREF(object);
 
-  result = PyDict_New();
+  object = PY_STRING(rule->identifier);
+  PyDict_SetItemString(callback_dict, "rule", object);
+  Py_DECREF(object);
 
-  yr_rules_foreach(rules, rule)
-  {
-    clock_ticks = rule->clock_ticks;
+  object = PY_STRING(rule->ns->name);
+  PyDict_SetItemString(callback_dict, "namespace", object);
+  Py_DECREF(object);
 
-    yr_rule_strings_foreach(rule, string)
-    {
-      clock_ticks += string->clock_ticks;
-    }
+  PyDict_SetItemString(callback_dict, "tags", tag_list);
+  PyDict_SetItemString(callback_dict, "meta", meta_list);
+  PyDict_SetItemString(callback_dict, "strings", string_list);
 
-    snprintf(key, sizeof(key), "%s:%s", rule->ns->name, rule->identifier);
+  return callback_dict;
+}
 
-    object = PyLong_FromLongLong(clock_ticks);
-    PyDict_SetItemString(result, key, object);
-    Py_DECREF(object);
+
+// Makes sure that "array" has room for "needed" items, growing it if
+// required. Doesn't use the Python allocator as it's called without the GIL.
+
+static bool grow_array(
+    void** array,
+    size_t* capacity,
+    size_t needed,
+    size_t item_size)
+{
+  size_t new_capacity = *capacity;
+  void* new_array;
+
+  if (needed <= *capacity)
+    return true;
+
+  while (new_capacity < needed)
+    new_capacity = new_capacity == 0 ? 16 : new_capacity * 2;
+
+  new_array = realloc(*array, new_capacity * item_size);
+
+  if (new_array == NULL)
+    return false;
+
+  *array = new_array;
+  *capacity = new_capacity;
+
+  return true;
+}
+
+
+// Validates the limits passed to match().
+
+static bool scan_limits_check(
+    SCAN_LIMITS* limits)
+{
+  const char* name = NULL;
+
+  if (limits->max_string_matches < -1)
+    name = "max_string_matches";
+  else if (limits->max_matches < -1)
+    name = "max_matches";
+  else if (limits->max_match_data < -1)
+    name = "max_match_data";
+  else if (limits->max_result_size < -1)
+    name = "max_result_size";
+
+  if (name != NULL)
+  {
+    PyErr_Format(PyExc_ValueError, "'%s' must be a positive number", name);
+    return false;
   }
 
-  return result;
-#else
-  return PyErr_Format(YaraError, "libyara compiled without profiling support");
-#endif
+  return true;
 }
 
 
-static PyObject* Rules_getattro(
-    PyObject* self,
-    PyObject* name)
+static bool scan_limits_enabled(
+    SCAN_LIMITS* limits)
 {
-  return PyObject_GenericGetAttr(self, name);
+  return limits->max_string_matches != -1 ||
+      limits->max_matches != -1 ||
+      limits->max_match_data != -1 ||
+      limits->max_result_size != -1;
 }
 
 
-void raise_exception_on_error(
-    int error_level,
-    const char* file_name,
-    int line_number,
-    const YR_RULE* rule,
-    const char* message,
-    void* user_data)
+// Decides whether a match can be kept within the limits of the scan, given
+// the number of matches already kept for its string, and reduces the length
+// of its data if only part of it fits. Matches are considered in the order
+// they are reported, so the same rules and data are always truncated in the
+// same way. Called without the GIL.
+
+static bool scan_results_within_limits(
+    SCAN_RESULTS* results,
+    size_t string_matches,
+    int32_t* data_length)
 {
-  PyGILState_STATE gil_state = PyGILState_Ensure();
+  const SCAN_LIMITS* limits = results->limits;
+  long long available;
 
-  if (error_level == YARA_ERROR_LEVEL_ERROR)
+  if (limits == NULL)
+    return true;
+
+  if (limits->max_string_matches != -1 &&
+      (long long) string_matches >= limits->max_string_matches)
+    return false;
+
+  if (limits->max_matches != -1 &&
+      (long long) results->num_matches >= limits->max_matches)
+    return false;
+
+  if (limits->max_result_size != -1)
   {
-    if (file_name != NULL)
-      PyErr_Format(
-          YaraSyntaxError,
-          "%s(%d): %s",
-          file_name,
-          line_number,
-          message);
-    else
-      PyErr_Format(
-          YaraSyntaxError,
-          "line %d: %s",
-          line_number,
-          message);
+    available = limits->max_result_size -
+        (long long) results->result_size -
+        (long long) sizeof(MATCH_RECORD);
+
+    if (available < 0)
+      return false;
+
+    if (*data_length > available)
+      *data_length = (int32_t) available;
   }
-  else
+
+  if (limits->max_match_data != -1)
   {
-    PyObject* warnings = (PyObject*)user_data;
-    PyObject* warning_msg;
-    if (file_name != NULL)
-      warning_msg = PY_STRING_FORMAT(
-          "%s(%d): %s",
-          file_name,
-          line_number,
-          message);
-    else
-      warning_msg = PY_STRING_FORMAT(
-          "line %d: %s",
-          line_number,
-          message);
-    PyList_Append(warnings, warning_msg);
-    Py_DECREF(warning_msg);
+    available = limits->max_match_data - (long long) results->data_length;
+
+    if (*data_length > available)
+      *data_length = (int32_t) available;
   }
 
-  PyGILState_Release(gil_state);
+  return true;
 }
 
 
-////////////////////////////////////////////////////////////////////////////////
+// Records a matching rule and a copy of its matches, which are released by
+// the scanner when the scan finishes. The rule is always recorded, but its
+// matches may be truncated by the limits of the scan. Called without the GIL.
 
-const char* yara_include_callback(
-    const char* include_name,
-    const char* calling_rule_filename,
-    const char* calling_rule_namespace,
-    void* user_data)
+static int scan_results_add_rule(
+    SCAN_RESULTS* results,
+    YR_SCAN_CONTEXT* context,
+    YR_RULE* rule)
 {
-  PyObject* result;
-  PyObject* callback = (PyObject*) user_data;
-  PyObject* py_incl_name = NULL;
-  PyObject* py_calling_fn = NULL;
-  PyObject* py_calling_ns = NULL;
-  PyObject* type = NULL;
-  PyObject* value = NULL;
-  PyObject* traceback = NULL;
-
-  const char* cstring_result = NULL;
+  YR_STRING* string;
+  YR_MATCH* m;
+  RULE_RECORD* rule_record;
 
-  PyGILState_STATE gil_state = PyGILState_Ensure();
+  if (!grow_array(
+          (void**) &results->rules,
+          &results->rules_capacity,
+          results->num_rules + 1,
+          sizeof(RULE_RECORD)))
+    return ERROR_INSUFFICIENT_MEMORY;
 
-  if (include_name != NULL)
-  {
-    py_incl_name = PY_STRING(include_name);
-  }
-  else //safeguard: should never happen for 'include_name'
-  {
-    py_incl_name = Py_None;
-    Py_INCREF(py_incl_name);
-  }
+  rule_record = &results->rules[results->num_rules++];
+  rule_record->rule = rule;
+  rule_record->first_match = results->num_matches;
+  rule_record->num_matches = 0;
+  rule_record->truncated = false;
 
-  if (calling_rule_filename != NULL)
-  {
-    py_calling_fn = PY_STRING(calling_rule_filename);
-  }
-  else
-  {
-    py_calling_fn = Py_None;
-    Py_INCREF(py_calling_fn);
-  }
+  results->result_size += sizeof(RULE_RECORD);
 
-  if (calling_rule_namespace != NULL)
-  {
-    py_calling_ns = PY_STRING(calling_rule_namespace);
-  }
-  else
+  yr_rule_strings_foreach(rule, string)
   {
-    py_calling_ns = Py_None;
-    Py_INCREF(py_calling_ns);
-  }
-
-  PyErr_Fetch(&type, &value, &traceback);
-
-  result = PyObject_CallFunctionObjArgs(
-      callback,
-      py_incl_name,
-      py_calling_fn,
-      py_calling_ns,
-      NULL);
+    size_t string_matches = 0;
 
-  PyErr_Restore(type, value, traceback);
+    yr_string_matches_foreach(context, string, m)
+    {
+      MATCH_RECORD* match_record;
+      int32_t data_length = m->data_length;
 
-  Py_DECREF(py_incl_name);
-  Py_DECREF(py_calling_fn);
-  Py_DECREF(py_calling_ns);
+      if (!scan_results_within_limits(results, string_matches, &data_length))
+      {
+        rule_record->truncated = true;
+        continue;
+      }
 
-  if (result != NULL && result != Py_None && PY_STRING_CHECK(result))
-  {
-    //transferring string ownership to C code
-    cstring_result = strdup(PY_STRING_TO_C(result));
-  }
-  else
-  {
-    if (PyErr_Occurred() == NULL)
-    {
-      PyErr_Format(PyExc_TypeError,
-          "'include_callback' function must return a yara rules as an ascii "
-          "or unicode string");
+      if (data_length < m->data_length)
+        rule_record->truncated = true;
+
+      if (!grow_array(
+              (void**) &results->matches,
+              &results->matches_capacity,
+              results->num_matches + 1,
+              sizeof(MATCH_RECORD)) ||
+          !grow_array(
+              (void**) &results->data,
+              &results->data_capacity,
+              results->data_length + data_length,
+              1))
+        return ERROR_INSUFFICIENT_MEMORY;
+
+      match_record = &results->matches[results->num_matches++];
+      match_record->string = string;
+      match_record->offset = m->base + m->offset;
+      match_record->length = m->match_length;
+      match_record->data_length = data_length;
+      match_record->data_offset = results->data_length;
+
+      memcpy(results->data + results->data_length, m->data, data_length);
+
+      results->data_length += data_length;
+      results->result_size += sizeof(MATCH_RECORD) + data_length;
+      rule_record->num_matches++;
+      string_matches++;
     }
   }
 
-  Py_XDECREF(result);
-  PyGILState_Release(gil_state);
-
-  return cstring_result;
+  return ERROR_SUCCESS;
 }
 
-void yara_include_free(
-    const char* result_ptr,
-    void* user_data)
+
+static void scan_results_destroy(
+    SCAN_RESULTS* results)
 {
-  if (result_ptr != NULL)
-  {
-    free((void*) result_ptr);
-  }
-}
+  free(results->rules);
+  free(results->matches);
+  free(results->data);
 
-////////////////////////////////////////////////////////////////////////////////
+  memset(results, 0, sizeof(SCAN_RESULTS));
+}
 
-static PyObject* yara_set_config(
-    PyObject* self,
-    PyObject* args,
-    PyObject* keywords)
-{
 
-  /*
-   * It is recommended that this be kept up to date with the config
-   * options present in yara/libyara.c yr_set_configuration(...) - ck
-   */
-  static char *kwlist[] = {
-    "stack_size", "max_strings_per_rule", "max_match_data", NULL};
+// Appends a Match object to "matches" for every rule recorded in "results".
+// Must be called with the GIL held.
 
-  unsigned int stack_size = 0;
-  unsigned int max_strings_per_rule = 0;
-  unsigned int max_match_data = 0;
+static bool scan_results_to_matches(
+    SCAN_RESULTS* results,
+    CALLBACK_DATA* data,
+    PyObject* matches)
+{
+  PyObject* tag_list;
+  PyObject* string_list;
+  PyObject* meta_list;
+  PyObject* match;
+  PyObject* object;
+  PyObject* tuple;
 
-  int error = 0;
+  size_t i, j;
 
-  if (PyArg_ParseTupleAndKeywords(
-        args,
-        keywords,
-        "|III",
-        kwlist,
-        &stack_size,
-        &max_strings_per_rule,
-  	&max_match_data))
+  for (i = 0; i < results->num_rules; i++)
   {
-    if (stack_size != 0)
-    {
-      error = yr_set_configuration(
-          YR_CONFIG_STACK_SIZE,
-          &stack_size);
+    RULE_RECORD* rule_record = &results->rules[i];
 
-      if ( error != ERROR_SUCCESS)
-        return handle_error(error, NULL);
-    }
+    if (!build_rule_tags_and_meta(
+            rule_record->rule, data, &tag_list, &meta_list, &string_list))
+      return false;
 
-    if (max_strings_per_rule != 0)
+    for (j = 0; j < rule_record->num_matches; j++)
     {
-      error = yr_set_configuration(
-          YR_CONFIG_MAX_STRINGS_PER_RULE,
-				  &max_strings_per_rule);
-
-      if (error != ERROR_SUCCESS)
-        return handle_error(error, NULL);
-    }
+      MATCH_RECORD* match_record = &results->matches[
+          rule_record->first_match + j];
 
-    if (max_match_data != 0)
-    {
-      error = yr_set_configuration(
-          YR_CONFIG_MAX_MATCH_DATA,
-				  &max_match_data);
+      object = PyBytes_FromStringAndSize(
+          (char*) results->data + match_record->data_offset,
+          match_record->data_length);
 
-      if (error != ERROR_SUCCESS)
-        return handle_error(error, NULL);
-    }
-  }
+      tuple = Py_BuildValue(
+          "(L,s,O)",
+          match_record->offset,
+          match_record->string->identifier,
+          object);
 
-  Py_RETURN_NONE;
-}
+      PyList_Append(string_list, tuple);
 
-static PyObject* yara_compile(
-    PyObject* self,
-    PyObject* args,
-    PyObject* keywords)
-{
-  static char *kwlist[] = {
-    "filepath", "source", "file", "filepaths", "sources",
-    "includes", "externals", "error_on_warning", "include_callback", NULL};
+      Py_DECREF(object);
+      Py_DECREF(tuple);
+    }
 
-  YR_COMPILER* compiler;
-  YR_RULES* yara_rules;
-  FILE* fh;
+    match = Match_NEW(
+        data->state,
+        rule_record->rule->identifier,
+        rule_record->rule->ns->name,
+        tag_list,
+        meta_list,
+        string_list);
 
-  Rules* rules;
+    Py_DECREF(tag_list);
+    Py_DECREF(string_list);
+    Py_DECREF(meta_list);
 
-  PyObject* key;
-  PyObject* value;
-  PyObject* result = NULL;
-  PyObject* file = NULL;
-  PyObject* sources_dict = NULL;
-  PyObject* filepaths_dict = NULL;
-  PyObject* includes = NULL;
-  PyObject* externals = NULL;
-  PyObject* error_on_warning = NULL;
-  PyObject* include_callback = NULL;
+    if (match == NULL)
+      return false;
 
-  Py_ssize_t pos = 0;
+    ((Match*) match)->truncated = rule_record->truncated;
 
-  int fd;
-  int error = 0;
+    PyList_Append(matches, match);
+    Py_DECREF(match);
+  }
 
-  char* filepath = NULL;
-  char* source = NULL;
-  char* ns = NULL;
-  PyObject* warnings = PyList_New(0);
-  bool warning_error = false;
+  return true;
+}
 
-  if (PyArg_ParseTupleAndKeywords(
-        args,
-        keywords,
-        "|ssOOOOOOO",
-        kwlist,
-        &filepath,
-        &source,
-        &file,
-        &filepaths_dict,
-        &sources_dict,
-        &includes,
-        &externals,
-        &error_on_warning,
-        &include_callback))
-  {
-    char num_args = 0;
 
-    if (filepath != NULL)
-      num_args++;
+// Delivers the pending rules to the batch callback in a single call, and
+// appends a Match object to the matches list for every matching rule. This
+// is the only place where the GIL is acquired for rules in batch mode.
 
-    if (source != NULL)
-      num_args++;
+static int flush_pending_rules(
+    YR_SCAN_CONTEXT* context,
+    CALLBACK_DATA* data)
+{
+  PyObject* batch;
+  PyObject* callback_dict;
+  PyObject* callback_result;
+  PyObject* match;
+  PyObject* tag_list;
+  PyObject* string_list;
+  PyObject* meta_list;
 
-    if (file != NULL)
-      num_args++;
+  int result = CALLBACK_CONTINUE;
+  int i;
 
-    if (filepaths_dict != NULL)
-      num_args++;
+  if (data->num_pending == 0)
+    return CALLBACK_CONTINUE;
 
-    if (sources_dict != NULL)
-      num_args++;
+  callback_acquire_gil(data);
 
-    if (num_args > 1)
-      return PyErr_Format(
-          PyExc_TypeError,
-          "compile is receiving too many arguments");
+  batch = PyList_New(0);
 
-    error = yr_compiler_create(&compiler);
+  if (batch == NULL)
+  {
+    callback_release_gil(data);
+    return CALLBACK_ERROR;
+  }
 
-    if (error != ERROR_SUCCESS)
-      return handle_error(error, NULL);
+  for (i = 0; i < data->num_pending; i++)
+  {
+    YR_RULE* rule = data->pending[i].rule;
+    bool matching = data->pending[i].matching;
 
-    yr_compiler_set_callback(compiler, raise_exception_on_error, warnings);
+    if (!build_rule_objects(
+            context, rule, data, &tag_list, &meta_list, &string_list))
+    {
+      result = CALLBACK_ERROR;
+      break;
+    }
 
-    if (error_on_warning != NULL)
+    if (matching)
     {
-      if (PyBool_Check(error_on_warning))
+      match = Match_NEW(
+          data->state,
+          rule->identifier,
+          rule->ns->name,
+          tag_list,
+          meta_list,
+          string_list);
+
+      if (match != NULL)
       {
-        if (PyObject_IsTrue(error_on_warning) == 1)
-        {
-          warning_error = true;
-        }
+        PyList_Append(data->matches, match);
+        Py_DECREF(match);
       }
       else
       {
-        yr_compiler_destroy(compiler);
-        return PyErr_Format(
-            PyExc_TypeError,
-            "'error_on_warning' param must be of boolean type");
+        result = CALLBACK_ERROR;
       }
     }
 
-    if (includes != NULL)
+    if (result == CALLBACK_CONTINUE &&
+        ((matching && (data->which & CALLBACK_MATCHES)) ||
+         (!matching && (data->which & CALLBACK_NON_MATCHES))))
     {
-      if (PyBool_Check(includes))
+      callback_dict = build_callback_dict(
+          rule, matching, tag_list, meta_list, string_list);
+
+      if (callback_dict != NULL)
       {
-        // PyObject_IsTrue can return -1 in case of error
-        if (PyObject_IsTrue(includes) == 0)
-          yr_compiler_set_include_callback(compiler, NULL, NULL, NULL);
+        PyList_Append(batch, callback_dict);
+        Py_DECREF(callback_dict);
       }
       else
       {
-        yr_compiler_destroy(compiler);
-        return PyErr_Format(
-            PyExc_TypeError,
-            "'includes' param must be of boolean type");
+        result = CALLBACK_ERROR;
       }
     }
 
-    if (include_callback != NULL)
-    {
-      if (!PyCallable_Check(include_callback))
-      {
-        yr_compiler_destroy(compiler);
-        return PyErr_Format(
-            PyExc_TypeError,
-            "'include_callback' must be callable");
-      }
+    Py_DECREF(tag_list);
+    Py_DECREF(string_list);
+    Py_DECREF(meta_list);
 
-      yr_compiler_set_include_callback(
-          compiler,
-          yara_include_callback,
-          yara_include_free,
-          include_callback);
-    }
+    if (result != CALLBACK_CONTINUE)
+      break;
+  }
 
-    if (externals != NULL && externals != Py_None)
+  data->num_pending = 0;
+
+  if (result == CALLBACK_CONTINUE && PyList_Size(batch) > 0)
+  {
+    Py_INCREF(data->batch_callback);
+
+    callback_result = PyObject_CallFunctionObjArgs(
+        data->batch_callback,
+        batch,
+        NULL);
+
+    if (callback_result != NULL)
     {
-      if (PyDict_Check(externals))
-      {
-        if (process_compile_externals(externals, compiler) != ERROR_SUCCESS)
-        {
-          yr_compiler_destroy(compiler);
-          return NULL;
-        }
-      }
-      else
+      #if PY_MAJOR_VERSION >= 3
+      if (PyLong_Check(callback_result))
+      #else
+      if (PyLong_Check(callback_result) || PyInt_Check(callback_result))
+      #endif
       {
-        yr_compiler_destroy(compiler);
-        return PyErr_Format(
-            PyExc_TypeError,
-            "'externals' must be a dictionary");
+        result = (int) PyLong_AsLong(callback_result);
       }
+
+      Py_DECREF(callback_result);
+    }
+    else
+    {
+      result = CALLBACK_ERROR;
     }
 
-    Py_XINCREF(include_callback);
+    Py_DECREF(data->batch_callback);
+  }
 
-    if (filepath != NULL)
-    {
-      fh = fopen(filepath, "r");
+  Py_DECREF(batch);
+  callback_release_gil(data);
 
-      if (fh != NULL)
-      {
-        Py_BEGIN_ALLOW_THREADS
-        error = yr_compiler_add_file(compiler, fh, NULL, filepath);
-        fclose(fh);
-        Py_END_ALLOW_THREADS
-      }
-      else
-      {
-        result = PyErr_SetFromErrno(YaraError);
-      }
-    }
-    else if (source != NULL)
+  return result;
+}
+
+
+int yara_callback(
+    YR_SCAN_CONTEXT* context,
+    int message,
+    void* message_data,
+    void* user_data)
+{
+  YR_RULE* rule;
+
+  PyObject* tag_list = NULL;
+  PyObject* string_list = NULL;
+  PyObject* meta_list = NULL;
+  PyObject* match;
+  PyObject* callback_dict;
+  PyObject* matches = ((CALLBACK_DATA*) user_data)->matches;
+  PyObject* callback = ((CALLBACK_DATA*) user_data)->callback;
+  PyObject* batch_callback = ((CALLBACK_DATA*) user_data)->batch_callback;
+  PyObject* callback_result;
+
+  int which = ((CALLBACK_DATA*) user_data)->which;
+
+  switch(message)
+  {
+  case CALLBACK_MSG_IMPORT_MODULE:
+    return handle_import_module(message_data, user_data);
+
+  case CALLBACK_MSG_MODULE_IMPORTED:
+    return handle_module_imported(message_data, user_data);
+
+  case CALLBACK_MSG_TOO_MANY_MATCHES:
+    return handle_too_many_matches(context, message_data, user_data);
+
+  case CALLBACK_MSG_SCAN_FINISHED:
+    // The scanner ignores the value returned here, if delivering the last
+    // batch fails the exception is detected by the caller after the scan.
+    return flush_pending_rules(context, user_data);
+
+  case CALLBACK_MSG_RULE_NOT_MATCHING:
+    // In cases where the rule doesn't match and the user didn't provided a
+    // callback function or is not interested in getting notified about
+    // non-matches, there's nothing more do to here, keep executing the function
+    // if otherwise. Rules excluded by select() are not part of the scan, so
+    // they are not reported either.
+
+    if ((callback == NULL && batch_callback == NULL) ||
+        (which & CALLBACK_NON_MATCHES) != CALLBACK_NON_MATCHES ||
+        RULE_IS_DISABLED((YR_RULE*) message_data))
+      return CALLBACK_CONTINUE;
+    break;
+
+  case CALLBACK_MSG_CONSOLE_LOG:
+    return handle_console_log(message_data, user_data);
+  }
+
+  // At this point we have handled all the other cases of when this callback
+  // can be called. The only things left are:
+  //
+  // 1. A matching rule.
+  //
+  // 2 A non-matching rule and the user has requested to see non-matching rules.
+  //
+  // In both cases, we need to create the data that will be either passed back
+  // to the python callback or stored in the matches list.
+
+  int result = CALLBACK_CONTINUE;
+  bool stop = false;
+
+  rule = (YR_RULE*) message_data;
+
+  // Stop conditions are decided here, without the GIL. The rule that triggers
+  // the condition is still reported, but the scan is aborted right after.
+
+  if (message == CALLBACK_MSG_RULE_MATCHING)
+  {
+    CALLBACK_DATA* data = (CALLBACK_DATA*) user_data;
+
+    data->num_matches++;
+
+    if (metrics_enabled)
+      metrics_count_rule(rule);
+
+    if (data->stop_after > 0 && data->num_matches >= data->stop_after)
+      stop = true;
+
+    if (data->stop_rules != NULL &&
+        data->stop_rules[rule - context->rules->rules_table])
+      stop = true;
+  }
+
+  // When there are no callbacks the matches are only recorded here, without
+  // the GIL, and Match objects are created by the caller after the scan.
+
+  if (((CALLBACK_DATA*) user_data)->results != NULL)
+  {
+    SCAN_RESULTS* results = ((CALLBACK_DATA*) user_data)->results;
+
+    results->error = scan_results_add_rule(results, context, rule);
+
+    if (results->error != ERROR_SUCCESS)
+      return CALLBACK_ERROR;
+
+    return stop ? CALLBACK_ABORT : CALLBACK_CONTINUE;
+  }
+
+  // In batch mode the rule is only queued, the GIL is acquired once per batch
+  // when the batch is full, when a stop condition is met (as the scanner
+  // won't report anything else after aborting) or when the scan finishes.
+
+  if (batch_callback != NULL)
+  {
+    CALLBACK_DATA* data = (CALLBACK_DATA*) user_data;
+
+    data->pending[data->num_pending].rule = rule;
+    data->pending[data->num_pending].matching =
+        (message == CALLBACK_MSG_RULE_MATCHING);
+
+    data->num_pending++;
+
+    if (data->num_pending == data->batch_size || stop)
+      result = flush_pending_rules(context, data);
+
+    if (stop && result == CALLBACK_CONTINUE)
+      result = CALLBACK_ABORT;
+
+    return result;
+  }
+
+  callback_acquire_gil((CALLBACK_DATA*) user_data);
+
+  if (!build_rule_objects(
+          context,
+          rule,
+          (CALLBACK_DATA*) user_data,
+          &tag_list,
+          &meta_list,
+          &string_list))
+  {
+    callback_release_gil((CALLBACK_DATA*) user_data);
+
+    return CALLBACK_ERROR;
+  }
+
+  if (message == CALLBACK_MSG_RULE_MATCHING)
+  {
+    match = Match_NEW(
+        ((CALLBACK_DATA*) user_data)->state,
+        rule->identifier,
+        rule->ns->name,
+        tag_list,
+        meta_list,
+        string_list);
+
+    if (match != NULL)
     {
-      Py_BEGIN_ALLOW_THREADS
-      error = yr_compiler_add_string(compiler, source, NULL);
-      Py_END_ALLOW_THREADS
+      PyList_Append(matches, match);
+      Py_DECREF(match);
     }
-    else if (file != NULL)
+    else
     {
-      fd = dup(PyObject_AsFileDescriptor(file));
+      Py_DECREF(tag_list);
+      Py_DECREF(string_list);
+      Py_DECREF(meta_list);
+      callback_release_gil((CALLBACK_DATA*) user_data);
 
-      if (fd != -1)
-      {
-        Py_BEGIN_ALLOW_THREADS
-        fh = fdopen(fd, "r");
-        error = yr_compiler_add_file(compiler, fh, NULL, NULL);
-        fclose(fh);
-        Py_END_ALLOW_THREADS
-      }
-      else
-      {
-        result = PyErr_Format(
-            PyExc_TypeError,
-            "'file' is not a file object");
-      }
+      return CALLBACK_ERROR;
     }
-    else if (sources_dict != NULL)
+  }
+
+  if (callback != NULL &&
+      ((message == CALLBACK_MSG_RULE_MATCHING && (which & CALLBACK_MATCHES)) ||
+       (message == CALLBACK_MSG_RULE_NOT_MATCHING && (which & CALLBACK_NON_MATCHES))))
+  {
+    Py_INCREF(callback);
+
+    callback_dict = build_callback_dict(
+        rule,
+        message == CALLBACK_MSG_RULE_MATCHING,
+        tag_list,
+        meta_list,
+        string_list);
+
+    if (callback_dict != NULL)
     {
-      if (PyDict_Check(sources_dict))
-      {
-        while (PyDict_Next(sources_dict, &pos, &key, &value))
-        {
-          source = PY_STRING_TO_C(value);
-          ns = PY_STRING_TO_C(key);
+      callback_result = PyObject_CallFunctionObjArgs(
+          callback,
+          callback_dict,
+          NULL);
 
-          if (source != NULL && ns != NULL)
-          {
-            Py_BEGIN_ALLOW_THREADS
-            error = yr_compiler_add_string(compiler, source, ns);
-            Py_END_ALLOW_THREADS
+      Py_DECREF(callback_dict);
+    }
+    else
+    {
+      callback_result = NULL;
+    }
 
-            if (error > 0)
-              break;
-          }
-          else
-          {
-            result = PyErr_Format(
-                PyExc_TypeError,
-                "keys and values of the 'sources' dictionary must be "
-                "of string type");
-            break;
-          }
-        }
-      }
-      else
+    if (callback_result != NULL)
+    {
+      #if PY_MAJOR_VERSION >= 3
+      if (PyLong_Check(callback_result))
+      #else
+      if (PyLong_Check(callback_result) || PyInt_Check(callback_result))
+      #endif
       {
-        result = PyErr_Format(
-            PyExc_TypeError,
-            "'sources' must be a dictionary");
+        result = (int) PyLong_AsLong(callback_result);
       }
+
+      Py_DECREF(callback_result);
     }
-    else if (filepaths_dict != NULL)
+    else
     {
-      if (PyDict_Check(filepaths_dict))
-      {
-        while (PyDict_Next(filepaths_dict, &pos, &key, &value))
-        {
-          filepath = PY_STRING_TO_C(value);
-          ns = PY_STRING_TO_C(key);
+      result = CALLBACK_ERROR;
+    }
 
-          if (filepath != NULL && ns != NULL)
-          {
-            fh = fopen(filepath, "r");
+    Py_DECREF(callback);
+  }
 
-            if (fh != NULL)
-            {
-              Py_BEGIN_ALLOW_THREADS
-              error = yr_compiler_add_file(compiler, fh, ns, filepath);
-              fclose(fh);
-              Py_END_ALLOW_THREADS
+  Py_DECREF(tag_list);
+  Py_DECREF(string_list);
+  Py_DECREF(meta_list);
+  callback_release_gil((CALLBACK_DATA*) user_data);
 
-              if (error > 0)
-                break;
+  if (stop && result == CALLBACK_CONTINUE)
+    result = CALLBACK_ABORT;
+
+  return result;
+}
+
+
+// Data passed to flo_read and flo_write. Streams are read and written while
+// the GIL is released, the thread state saved at that point is used for
+// calling the file-like object.
+
+typedef struct _STREAM_DATA
+{
+  PyObject* file;
+  PyThreadState* thread_state;
+
+} STREAM_DATA;
+
+
+/* YR_STREAM read method for "file-like objects" */
+
+static size_t flo_read(
+    void* ptr,
+    size_t size,
+    size_t count,
+    void* user_data)
+{
+  STREAM_DATA* stream_data = (STREAM_DATA*) user_data;
+  size_t i;
+
+  // Objects returned by the file-like object must be released while holding
+  // the GIL, so it's held until we are done with each chunk.
+  PyEval_RestoreThread(stream_data->thread_state);
+
+  for (i = 0; i < count; i++)
+  {
+    Py_ssize_t len;
+    char* buffer;
+    int result;
+
+    PyObject* bytes = PyObject_CallMethod(
+        stream_data->file, "read", "n", (Py_ssize_t) size);
+
+    if (bytes == NULL)
+      break;
+
+    result = PyBytes_AsStringAndSize(bytes, &buffer, &len);
+
+    if (result != -1 && (size_t) len >= size)
+      memcpy((char*) ptr + i * size, buffer, size);
+
+    Py_DECREF(bytes);
+
+    if (result == -1 || (size_t) len < size)
+      break;
+  }
+
+  stream_data->thread_state = PyEval_SaveThread();
+
+  return i;
+}
+
+
+/* YR_STREAM write method for "file-like objects" */
+
+static size_t flo_write(
+    const void* ptr,
+    size_t size,
+    size_t count,
+    void* user_data)
+{
+  STREAM_DATA* stream_data = (STREAM_DATA*) user_data;
+  size_t i;
+
+  PyEval_RestoreThread(stream_data->thread_state);
+
+  for (i = 0; i < count; i++)
+  {
+    PyObject* result = PyObject_CallMethod(
+    #if PY_MAJOR_VERSION >= 3
+        stream_data->file, "write", "y#", (char*) ptr + i * size, size);
+    #else
+        stream_data->file, "write", "s#", (char*) ptr + i * size, size);
+    #endif
+
+    if (result == NULL)
+      break;
+
+    Py_DECREF(result);
+  }
+
+  stream_data->thread_state = PyEval_SaveThread();
+
+  return i;
+}
+
+
+PyObject* handle_error(
+    YARA_STATE* state,
+    int error,
+    char* extra)
+{
+  if (metrics_enabled && error >= 0 && error < METRICS_MAX_ERROR)
+    metrics_add(&metrics.errors[error], 1);
+
+  switch(error)
+  {
+    case ERROR_COULD_NOT_ATTACH_TO_PROCESS:
+      return PyErr_Format(
+          state->YaraError,
+          "access denied");
+    case ERROR_INSUFFICIENT_MEMORY:
+      return PyErr_NoMemory();
+    case ERROR_COULD_NOT_OPEN_FILE:
+      return PyErr_Format(
+          state->YaraError,
+          "could not open file \"%s\"",
+          extra);
+    case ERROR_COULD_NOT_MAP_FILE:
+      return PyErr_Format(
+          state->YaraError,
+          "could not map file \"%s\" into memory",
+          extra);
+    case ERROR_INVALID_FILE:
+      return PyErr_Format(
+          state->YaraError,
+          "invalid rules file \"%s\"",
+          extra);
+    case ERROR_CORRUPT_FILE:
+      return PyErr_Format(
+          state->YaraError,
+          "corrupt rules file \"%s\"",
+          extra);
+    case ERROR_SCAN_TIMEOUT:
+      return PyErr_Format(
+          state->YaraTimeoutError,
+          "scanning timed out");
+    case ERROR_INVALID_EXTERNAL_VARIABLE_TYPE:
+      return PyErr_Format(
+          state->YaraError,
+          "external variable \"%s\" was already defined with a different type",
+          extra);
+    case ERROR_UNSUPPORTED_FILE_VERSION:
+      return PyErr_Format(
+          state->YaraError,
+          "rules file \"%s\" is incompatible with this version of YARA",
+          extra);
+    default:
+      return PyErr_Format(
+          state->YaraError,
+          "internal error: %d",
+          error);
+  }
+}
+
+
+int process_compile_externals(
+    YARA_STATE* state,
+    PyObject* externals,
+    YR_COMPILER* compiler)
+{
+  PyObject* key;
+  PyObject* value;
+  Py_ssize_t pos = 0;
+
+  char* identifier = NULL;
+  int result;
+
+  while (PyDict_Next(externals, &pos, &key, &value))
+  {
+    identifier = PY_STRING_TO_C(key);
+
+    if (PyBool_Check(value))
+    {
+      result = yr_compiler_define_boolean_variable(
+          compiler,
+          identifier,
+          PyObject_IsTrue(value));
+    }
+#if PY_MAJOR_VERSION >= 3
+    else if (PyLong_Check(value))
+#else
+    else if (PyLong_Check(value) || PyInt_Check(value))
+#endif
+    {
+      result = yr_compiler_define_integer_variable(
+          compiler,
+          identifier,
+          PyLong_AsLongLong(value));
+    }
+    else if (PyFloat_Check(value))
+    {
+      result = yr_compiler_define_float_variable(
+          compiler,
+          identifier,
+          PyFloat_AsDouble(value));
+    }
+    else if (PY_STRING_CHECK(value))
+    {
+      char* str = PY_STRING_TO_C(value);
+
+      if (str == NULL)
+        return ERROR_INVALID_ARGUMENT;
+
+      result = yr_compiler_define_string_variable(
+          compiler, identifier, str);
+    }
+    else
+    {
+      PyErr_Format(
+          PyExc_TypeError,
+          "external values must be of type integer, float, boolean or string");
+
+      return ERROR_INVALID_ARGUMENT;
+    }
+
+    if (result != ERROR_SUCCESS)
+    {
+      handle_error(state, result, identifier);
+      return result;
+    }
+  }
+
+  return ERROR_SUCCESS;
+}
+
+
+static int define_scanner_variable(
+    YR_SCANNER* scanner,
+    const char* identifier,
+    PyObject* value)
+{
+  if (PyBool_Check(value))
+  {
+    return yr_scanner_define_boolean_variable(
+        scanner,
+        identifier,
+        PyObject_IsTrue(value));
+  }
+#if PY_MAJOR_VERSION >= 3
+  else if (PyLong_Check(value))
+#else
+  else if (PyLong_Check(value) || PyInt_Check(value))
+#endif
+  {
+    return yr_scanner_define_integer_variable(
+        scanner,
+        identifier,
+        PyLong_AsLongLong(value));
+  }
+  else if (PyFloat_Check(value))
+  {
+    return yr_scanner_define_float_variable(
+        scanner,
+        identifier,
+        PyFloat_AsDouble(value));
+  }
+  else if (PY_STRING_CHECK(value))
+  {
+    char* str = PY_STRING_TO_C(value);
+
+    if (str == NULL)
+      return ERROR_INVALID_ARGUMENT;
+
+    return yr_scanner_define_string_variable(
+        scanner, identifier, str);
+  }
+
+  PyErr_Format(
+      PyExc_TypeError,
+      "external values must be of type integer, float, boolean or string");
+
+  return ERROR_INVALID_ARGUMENT;
+}
+
+
+int process_match_externals(
+    YARA_STATE* state,
+    PyObject* externals,
+    YR_SCANNER* scanner)
+{
+  PyObject* key;
+  PyObject* value;
+  Py_ssize_t pos = 0;
+
+  char* identifier = NULL;
+  int result;
+
+  while (PyDict_Next(externals, &pos, &key, &value))
+  {
+    identifier = PY_STRING_TO_C(key);
+    result = define_scanner_variable(scanner, identifier, value);
+
+    if (PyErr_Occurred() != NULL)
+      return ERROR_INVALID_ARGUMENT;
+
+    // yr_scanner_define_xxx_variable returns ERROR_INVALID_ARGUMENT if the
+    // variable wasn't previously defined in the compilation phase. Ignore
+    // those errors because we don't want the "scan" method being aborted
+    // because of the "externals" dictionary having more keys than those used
+    // during compilation.
+
+    if (result != ERROR_SUCCESS &&
+        result != ERROR_INVALID_ARGUMENT)
+    {
+      handle_error(state, result, identifier);
+      return result;
+    }
+  }
+
+  return ERROR_SUCCESS;
+}
+
+
+static void acquire_lock(
+    PyThread_type_lock lock)
+{
+  if (!PyThread_acquire_lock(lock, NOWAIT_LOCK))
+  {
+    Py_BEGIN_ALLOW_THREADS
+    PyThread_acquire_lock(lock, WAIT_LOCK);
+    Py_END_ALLOW_THREADS
+  }
+}
+
+
+static PyObject* Match_NEW(
+    YARA_STATE* state,
+    const char* rule,
+    const char* ns,
+    PyObject* tags,
+    PyObject* meta,
+    PyObject* strings)
+{
+  Match* object = PyObject_NEW(Match, state->Match_Type);
+
+  if (object != NULL)
+  {
+    object->rule = PY_STRING(rule);
+    object->ns = PY_STRING(ns);
+    object->tags = tags;
+    object->meta = meta;
+    object->strings = strings;
+    object->truncated = false;
+
+    Py_INCREF(tags);
+    Py_INCREF(meta);
+    Py_INCREF(strings);
+  }
+
+  return (PyObject*) object;
+}
+
+
+static void Match_dealloc(
+    PyObject* self)
+{
+  PyTypeObject* type = Py_TYPE(self);
+  Match* object = (Match*) self;
+
+  Py_DECREF(object->rule);
+  Py_DECREF(object->ns);
+  Py_DECREF(object->tags);
+  Py_DECREF(object->meta);
+  Py_DECREF(object->strings);
+
+  PyObject_Del(self);
+  release_type(type);
+}
+
+
+static PyObject* Match_repr(
+    PyObject* self)
+{
+  Match* object = (Match*) self;
+  Py_INCREF(object->rule);
+  return object->rule;
+}
+
+
+static PyObject* Match_getattro(
+    PyObject* self,
+    PyObject* name)
+{
+  return PyObject_GenericGetAttr(self, name);
+}
+
+
+static PyObject* Match_richcompare(
+    PyObject* self,
+    PyObject* other,
+    int op)
+{
+  PyObject* result = NULL;
+
+  Match* a = (Match*) self;
+  Match* b = (Match*) other;
+
+  if(PyObject_TypeCheck(other, get_type_state(Py_TYPE(self))->Match_Type))
+  {
+    switch(op)
+    {
+    case Py_EQ:
+      if (PyObject_RichCompareBool(a->rule, b->rule, Py_EQ) &&
+          PyObject_RichCompareBool(a->ns, b->ns, Py_EQ))
+        result = Py_True;
+      else
+        result = Py_False;
+
+      Py_INCREF(result);
+      break;
+
+    case Py_NE:
+      if (PyObject_RichCompareBool(a->rule, b->rule, Py_NE) ||
+          PyObject_RichCompareBool(a->ns, b->ns, Py_NE))
+          result = Py_True;
+      else
+          result = Py_False;
+
+      Py_INCREF(result);
+      break;
+
+    case Py_LT:
+    case Py_LE:
+    case Py_GT:
+    case Py_GE:
+      if (PyObject_RichCompareBool(a->rule, b->rule, Py_EQ))
+        result = PyObject_RichCompare(a->ns, b->ns, op);
+      else
+        result = PyObject_RichCompare(a->rule, b->rule, op);
+
+      break;
+    }
+  }
+  else
+  {
+    result = PyErr_Format(
+        PyExc_TypeError,
+        "'Match' objects must be compared with objects of the same class");
+  }
+
+  return result;
+}
+
+
+static Py_hash_t Match_hash(
+    PyObject* self)
+{
+  Match* match = (Match*) self;
+  return PyObject_Hash(match->rule) + PyObject_Hash(match->ns);
+}
+
+
+// Match objects can't be created from Python, they are pickled as a call to
+// yara._match() with their values, so that ScanPool workers can send them.
+
+static PyObject* Match_reduce(
+    PyObject* self,
+    PyObject* args)
+{
+  Match* match = (Match*) self;
+  PyObject* module;
+  PyObject* function;
+
+  module = PyImport_ImportModule("yara");
+
+  if (module == NULL)
+    return NULL;
+
+  function = PyObject_GetAttrString(module, "_match");
+  Py_DECREF(module);
+
+  if (function == NULL)
+    return NULL;
+
+  return Py_BuildValue(
+      "(N(OOOOOO))",
+      function,
+      match->rule,
+      match->ns,
+      match->tags,
+      match->meta,
+      match->strings,
+      match->truncated ? Py_True : Py_False);
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+
+static void Rule_dealloc(
+    PyObject* self)
+{
+  PyTypeObject* type = Py_TYPE(self);
+  Rule* object = (Rule*) self;
+  Py_XDECREF(object->identifier);
+  Py_XDECREF(object->ns);
+  Py_XDECREF(object->tags);
+  Py_XDECREF(object->meta);
+  Py_XDECREF(object->global);
+  Py_XDECREF(object->private);
+  PyObject_Del(self);
+  release_type(type);
+}
+
+static PyObject* Rule_getattro(
+    PyObject* self,
+    PyObject* name)
+{
+  return PyObject_GenericGetAttr(self, name);
+}
+
+
+static Rules* Rules_NEW(
+    YARA_STATE* state)
+{
+  Rules* rules = PyObject_NEW(Rules, state->Rules_Type);
+
+  if (rules != NULL)
+  {
+    rules->rules = NULL;
+    rules->externals = NULL;
+    rules->warnings = NULL;
+    rules->parent = NULL;
+    rules->rule_names = NULL;
+    rules->string_names = NULL;
+    rules->fingerprint = NULL;
+    rules->lock = PyThread_allocate_lock();
+
+    if (rules->lock == NULL)
+    {
+      Py_DECREF(rules);
+      return NULL;
+    }
+  }
+
+  return rules;
+}
+
+// Creates a shallow copy of a YR_RULES structure with a private copy of the
+// rules table, everything else (strings, Aho-Corasick automaton, code) is
+// shared with the original. This allows enabling and disabling rules in the
+// copy without affecting scans that use the original or other copies.
+//
+// When libyara is built with YR_PARANOID_EXEC (the default) rule pointers are
+// checked to be within the rules arena during the scan, so the copy also gets
+// a shadow YR_ARENA that describes the same buffers as the original except
+// for the rules table, which is replaced with the private one. The shadow
+// arena doesn't own any of the original buffers.
+
+static YR_RULES* create_rules_view(
+    YR_RULES* rules)
+{
+  YR_ARENA_BUFFER* buffer = &rules->arena->buffers[YR_RULES_TABLE];
+  YR_RULES* view = (YR_RULES*) PyMem_Malloc(sizeof(YR_RULES));
+  uint8_t* table = (uint8_t*) PyMem_Malloc(buffer->used);
+  YR_ARENA* arena = (YR_ARENA*) PyMem_Malloc(sizeof(YR_ARENA));
+
+  if (view == NULL || table == NULL || arena == NULL)
+  {
+    PyMem_Free(view);
+    PyMem_Free(table);
+    PyMem_Free(arena);
+    return NULL;
+  }
+
+  memcpy(view, rules, sizeof(YR_RULES));
+  memcpy(arena, rules->arena, sizeof(YR_ARENA));
+  memcpy(table, buffer->data, buffer->used);
+
+  arena->buffers[YR_RULES_TABLE].data = table;
+  arena->buffers[YR_RULES_TABLE].size = buffer->used;
+
+  view->arena = arena;
+  view->rules_table = (YR_RULE*) (
+      table + ((uint8_t*) rules->rules_table - buffer->data));
+
+  return view;
+}
+
+
+static void destroy_rules_view(
+    YR_RULES* view)
+{
+  if (view == NULL)
+    return;
+
+  PyMem_Free(view->arena->buffers[YR_RULES_TABLE].data);
+  PyMem_Free(view->arena);
+  PyMem_Free(view);
+}
+
+
+static void Rules_dealloc(
+    PyObject* self)
+{
+  PyTypeObject* type = Py_TYPE(self);
+  Rules* object = (Rules*) self;
+
+  Py_XDECREF(object->externals);
+  Py_XDECREF(object->warnings);
+  Py_XDECREF(object->rule_names);
+  Py_XDECREF(object->string_names);
+  Py_XDECREF(object->fingerprint);
+
+  if (object->parent != NULL)
+  {
+    // Rules created by select() only own their copy of the YR_RULES
+    // structure and rules table, the rest belongs to the parent.
+    destroy_rules_view(object->rules);
+    Py_DECREF(object->parent);
+  }
+  else if (object->rules != NULL)
+  {
+    yr_rules_destroy(object->rules);
+  }
+
+  if (object->lock != NULL)
+    PyThread_free_lock(object->lock);
+
+  PyObject_Del(self);
+  release_type(type);
+}
+
+static PyObject* Rules_iter(
+    PyObject* self)
+{
+  RulesIterator* iterator = PyObject_NEW(
+      RulesIterator, get_type_state(Py_TYPE(self))->RulesIterator_Type);
+
+  if (iterator == NULL)
+    return NULL;
+
+  Py_INCREF(self);
+  iterator->rules = self;
+  iterator->current_rule = ((Rules*) self)->rules->rules_table;
+
+  return (PyObject*) iterator;
+}
+
+
+static void RulesIterator_dealloc(
+    PyObject* self)
+{
+  PyTypeObject* type = Py_TYPE(self);
+
+  Py_DECREF(((RulesIterator*) self)->rules);
+
+  PyObject_Del(self);
+  release_type(type);
+}
+
+
+static PyObject* RulesIterator_next(
+    PyObject* self)
+{
+  PyObject* tag_list;
+  PyObject* object;
+  PyObject* meta_list;
+
+  YR_META* meta;
+  const char* tag;
+
+  Rule* rule;
+  RulesIterator* iterator = (RulesIterator*) self;
+  YR_RULE* current_rule;
+
+  // Generate new Rule object based upon the iterator's current rule and
+  // advance it. Rules disabled by select(), or only kept because a selected
+  // rule depends on them, are skipped.
+
+  while (!RULE_IS_NULL(iterator->current_rule) &&
+         (RULE_IS_DISABLED(iterator->current_rule) ||
+          RULE_IS_DEPENDENCY(iterator->current_rule)))
+    iterator->current_rule++;
+
+  current_rule = iterator->current_rule;
+
+  if (RULE_IS_NULL(current_rule))
+  {
+    PyErr_SetNone(PyExc_StopIteration);
+    return NULL;
+  }
+
+  iterator->current_rule++;
+
+  rule = PyObject_NEW(Rule, get_type_state(Py_TYPE(self))->Rule_Type);
+  tag_list = PyList_New(0);
+  meta_list = PyDict_New();
+
+  if (rule != NULL && tag_list != NULL && meta_list != NULL)
+  {
+    yr_rule_tags_foreach(current_rule, tag)
+    {
+      object = PY_STRING(tag);
+      PyList_Append(tag_list, object);
+      Py_DECREF(object);
+    }
+
+    yr_rule_metas_foreach(current_rule, meta)
+    {
+      if (meta->type == META_TYPE_INTEGER)
+        object = Py_BuildValue("i", meta->integer);
+      else if (meta->type == META_TYPE_BOOLEAN)
+        object = PyBool_FromLong((long) meta->integer);
+      else
+        object = PY_STRING(meta->string);
+
+        PyDict_SetItemString(meta_list, meta->identifier, object);
+        Py_DECREF(object);
+
+    }
+
+    rule->global = PyBool_FromLong(current_rule->flags & RULE_FLAGS_GLOBAL);
+    rule->private = PyBool_FromLong(current_rule->flags & RULE_FLAGS_PRIVATE);
+    rule->identifier = PY_STRING(current_rule->identifier);
+    rule->ns = PY_STRING(current_rule->ns->name);
+    rule->tags = tag_list;
+    rule->meta = meta_list;
+    return (PyObject*) rule;
+  }
+  else
+  {
+    Py_XDECREF(tag_list);
+    Py_XDECREF(meta_list);
+    return PyErr_Format(PyExc_TypeError, "Out of memory");
+  }
+}
+
+// Returns a table with one entry per rule where entry N is non-zero if rule N
+// must stop the scan when it matches, either because its identifier appears
+// in stop_on_rules (as "rule" or "namespace:rule") or because it has some of
+// the tags in stop_on_tags. Returns NULL and sets an exception on error.
+
+static uint8_t* build_stop_table(
+    YR_RULES* rules,
+    PyObject* stop_on_tags,
+    PyObject* stop_on_rules)
+{
+  PyObject* tags = NULL;
+  PyObject* names = NULL;
+  PyObject* item;
+
+  YR_RULE* rule;
+  uint8_t* table = NULL;
+
+  const char* tag;
+  char qualified_name[1024];
+
+  Py_ssize_t i;
+
+  if (stop_on_tags != NULL && stop_on_tags != Py_None)
+  {
+    tags = PySequence_Fast(stop_on_tags, "'stop_on_tags' must be iterable");
+
+    if (tags == NULL)
+      goto _exit;
+  }
+
+  if (stop_on_rules != NULL && stop_on_rules != Py_None)
+  {
+    names = PySequence_Fast(stop_on_rules, "'stop_on_rules' must be iterable");
+
+    if (names == NULL)
+      goto _exit;
+  }
+
+  for (i = 0; tags != NULL && i < PySequence_Fast_GET_SIZE(tags); i++)
+  {
+    if (!PY_STRING_CHECK(PySequence_Fast_GET_ITEM(tags, i)))
+    {
+      PyErr_Format(PyExc_TypeError, "'stop_on_tags' items must be strings");
+      goto _exit;
+    }
+  }
+
+  for (i = 0; names != NULL && i < PySequence_Fast_GET_SIZE(names); i++)
+  {
+    if (!PY_STRING_CHECK(PySequence_Fast_GET_ITEM(names, i)))
+    {
+      PyErr_Format(PyExc_TypeError, "'stop_on_rules' items must be strings");
+      goto _exit;
+    }
+  }
+
+  table = (uint8_t*) PyMem_Malloc(rules->num_rules + 1);
+
+  if (table == NULL)
+  {
+    PyErr_NoMemory();
+    goto _exit;
+  }
+
+  memset(table, 0, rules->num_rules + 1);
+
+  yr_rules_foreach(rules, rule)
+  {
+    uint8_t* entry = &table[rule - rules->rules_table];
+
+    yr_rule_tags_foreach(rule, tag)
+    {
+      for (i = 0; tags != NULL && i < PySequence_Fast_GET_SIZE(tags); i++)
+      {
+        item = PySequence_Fast_GET_ITEM(tags, i);
+
+        if (strcmp(tag, PY_STRING_TO_C(item)) == 0)
+          *entry = 1;
+      }
+    }
+
+    snprintf(
+        qualified_name,
+        sizeof(qualified_name),
+        "%s:%s",
+        rule->ns->name,
+        rule->identifier);
+
+    for (i = 0; names != NULL && i < PySequence_Fast_GET_SIZE(names); i++)
+    {
+      const char* name = PY_STRING_TO_C(PySequence_Fast_GET_ITEM(names, i));
+
+      if (strcmp(name, rule->identifier) == 0 ||
+          strcmp(name, qualified_name) == 0)
+        *entry = 1;
+    }
+  }
+
+_exit:
+
+  Py_XDECREF(tags);
+  Py_XDECREF(names);
+
+  return table;
+}
+
+
+// Creates the tuples that map the rule and string indexes used in columnar
+// results to "namespace:identifier" and string identifiers. They are built
+// the first time they are needed and shared by all subsequent results. If
+// several threads build them at the same time the first one to finish wins.
+
+static bool Rules_build_names(
+    Rules* object)
+{
+  YR_RULES* rules = object->rules;
+  YR_RULE* rule;
+  YR_STRING* string;
+
+  PyObject* rule_names;
+  PyObject* string_names;
+
+  uint32_t i;
+
+  acquire_lock(object->lock);
+  rule_names = object->rule_names;
+  PyThread_release_lock(object->lock);
+
+  if (rule_names != NULL)
+    return true;
+
+  rule_names = PyTuple_New(rules->num_rules);
+  string_names = PyTuple_New(rules->num_strings);
+
+  if (rule_names == NULL || string_names == NULL)
+  {
+    Py_XDECREF(rule_names);
+    Py_XDECREF(string_names);
+    return false;
+  }
+
+  for (i = 0; i < rules->num_rules; i++)
+  {
+    rule = &rules->rules_table[i];
+
+    PyTuple_SET_ITEM(
+        rule_names,
+        i,
+        PyUnicode_FromFormat("%s:%s", rule->ns->name, rule->identifier));
+  }
+
+  for (i = 0; i < rules->num_strings; i++)
+  {
+    string = &rules->strings_table[i];
+
+    PyTuple_SET_ITEM(
+        string_names, i, PY_STRING(string->identifier));
+  }
+
+  acquire_lock(object->lock);
+
+  if (object->rule_names == NULL)
+  {
+    object->rule_names = rule_names;
+    object->string_names = string_names;
+    rule_names = NULL;
+    string_names = NULL;
+  }
+
+  PyThread_release_lock(object->lock);
+
+  Py_XDECREF(rule_names);
+  Py_XDECREF(string_names);
+
+  return true;
+}
+
+
+// Wraps a bytes object holding an array of fixed-size items into a
+// memoryview with the given struct format, so that it can be consumed
+// through the buffer protocol, by NumPy or Arrow for example, without
+// copying. Steals the reference to "bytes".
+
+static PyObject* make_column(
+    PyObject* bytes,
+    const char* format)
+{
+  PyObject* view;
+  PyObject* column;
+
+  if (bytes == NULL)
+    return NULL;
+
+  view = PyMemoryView_FromObject(bytes);
+  Py_DECREF(bytes);
+
+  if (view == NULL)
+    return NULL;
+
+  column = PyObject_CallMethod(view, "cast", "s", format);
+  Py_DECREF(view);
+
+  return column;
+}
+
+
+// Builds the dictionary returned by match() when result="columnar". Every
+// string match is a row in the rule_index, string_index, offset and length
+// columns, its data is found in data[data_offset[i]:data_offset[i + 1]].
+
+static PyObject* scan_results_to_columns(
+    SCAN_RESULTS* results,
+    Rules* object)
+{
+  PyObject* columns[8] = {NULL};
+  PyObject* result = NULL;
+
+  int64_t* rules;
+  int64_t* rule_index;
+  int64_t* string_index;
+  int64_t* offset;
+  int32_t* length;
+  int64_t* data_offset;
+  uint8_t* truncated;
+
+  size_t i, j, row = 0;
+
+  if (!Rules_build_names(object))
+    return NULL;
+
+  columns[0] = PyBytes_FromStringAndSize(
+      NULL, results->num_rules * sizeof(int64_t));
+  columns[1] = PyBytes_FromStringAndSize(
+      NULL, results->num_matches * sizeof(int64_t));
+  columns[2] = PyBytes_FromStringAndSize(
+      NULL, results->num_matches * sizeof(int64_t));
+  columns[3] = PyBytes_FromStringAndSize(
+      NULL, results->num_matches * sizeof(int64_t));
+  columns[4] = PyBytes_FromStringAndSize(
+      NULL, results->num_matches * sizeof(int32_t));
+  columns[5] = PyBytes_FromStringAndSize(
+      (char*) results->data, results->data_length);
+  columns[6] = PyBytes_FromStringAndSize(
+      NULL, (results->num_matches + 1) * sizeof(int64_t));
+  columns[7] = PyBytes_FromStringAndSize(
+      NULL, results->num_rules * sizeof(uint8_t));
+
+  for (i = 0; i < 8; i++)
+  {
+    if (columns[i] == NULL)
+      goto _exit;
+  }
+
+  rules = (int64_t*) PyBytes_AS_STRING(columns[0]);
+  rule_index = (int64_t*) PyBytes_AS_STRING(columns[1]);
+  string_index = (int64_t*) PyBytes_AS_STRING(columns[2]);
+  offset = (int64_t*) PyBytes_AS_STRING(columns[3]);
+  length = (int32_t*) PyBytes_AS_STRING(columns[4]);
+  data_offset = (int64_t*) PyBytes_AS_STRING(columns[6]);
+  truncated = (uint8_t*) PyBytes_AS_STRING(columns[7]);
+
+  for (i = 0; i < results->num_rules; i++)
+  {
+    RULE_RECORD* rule_record = &results->rules[i];
+
+    rules[i] = rule_record->rule - object->rules->rules_table;
+    truncated[i] = rule_record->truncated;
+
+    for (j = 0; j < rule_record->num_matches; j++, row++)
+    {
+      MATCH_RECORD* match_record = &results->matches[
+          rule_record->first_match + j];
+
+      rule_index[row] = rules[i];
+      string_index[row] =
+          match_record->string - object->rules->strings_table;
+      offset[row] = match_record->offset;
+      length[row] = match_record->length;
+      data_offset[row] = match_record->data_offset;
+    }
+  }
+
+  data_offset[row] = results->data_length;
+
+  result = Py_BuildValue(
+      "{s:N,s:N,s:N,s:N,s:N,s:N,s:N,s:N,s:O,s:O}",
+      "rules", make_column(columns[0], "q"),
+      "rule_index", make_column(columns[1], "q"),
+      "string_index", make_column(columns[2], "q"),
+      "offset", make_column(columns[3], "q"),
+      "length", make_column(columns[4], "i"),
+      "data", make_column(columns[5], "B"),
+      "data_offset", make_column(columns[6], "q"),
+      "truncated", make_column(columns[7], "?"),
+      "rule_names", object->rule_names,
+      "string_names", object->string_names);
+
+  // make_column() has stolen the references, even if it failed.
+
+  return result;
+
+_exit:
+
+  for (i = 0; i < 8; i++)
+    Py_XDECREF(columns[i]);
+
+  return NULL;
+}
+
+
+// Encoder for the output="json" and output="msgpack" modes of match() and
+// for dumps_matches(). Matches are written straight to a byte buffer, either
+// from the records collected in C during a scan or from Match objects. Both
+// produce a list with an object per matching rule, having the rule, namespace,
+// tags, meta and strings keys, where each string match is an array with the
+// offset, the string identifier, and optionally the data. Rules whose matches
+// were truncated by the scan limits also have "truncated" set to true.
+
+#define OUTPUT_JSON     1
+#define OUTPUT_MSGPACK  2
+
+#define OUTPUT_DATA_NONE    0
+#define OUTPUT_DATA_BASE64  1
+#define OUTPUT_DATA_HEX     2
+#define OUTPUT_DATA_RAW     3
+
+#define ENCODER_MAX_DEPTH   8
+
+typedef struct _ENCODER
+{
+  int format;
+  int data_encoding;
+
+  uint8_t* buffer;
+  size_t length;
+  size_t capacity;
+
+  // Items written at each nesting level, used for placing JSON separators.
+  int depth;
+  size_t items[ENCODER_MAX_DEPTH];
+  bool after_key;
+
+  bool failed;
+
+} ENCODER;
+
+
+static void encoder_write(
+    ENCODER* encoder,
+    const void* data,
+    size_t length)
+{
+  if (encoder->failed)
+    return;
+
+  if (!grow_array(
+          (void**) &encoder->buffer,
+          &encoder->capacity,
+          encoder->length + length,
+          1))
+  {
+    encoder->failed = true;
+    return;
+  }
+
+  memcpy(encoder->buffer + encoder->length, data, length);
+  encoder->length += length;
+}
+
+
+static void encoder_write_byte(
+    ENCODER* encoder,
+    uint8_t byte)
+{
+  encoder_write(encoder, &byte, 1);
+}
+
+
+// Writes "value" as a big-endian integer of "size" bytes, as msgpack does.
+
+static void encoder_write_be(
+    ENCODER* encoder,
+    uint64_t value,
+    int size)
+{
+  uint8_t bytes[8];
+  int i;
+
+  for (i = 0; i < size; i++)
+    bytes[i] = (uint8_t) (value >> (8 * (size - i - 1)));
+
+  encoder_write(encoder, bytes, size);
+}
+
+
+// Writes the separator that precedes a JSON value, if any.
+
+static void encoder_begin_value(
+    ENCODER* encoder)
+{
+  if (encoder->format != OUTPUT_JSON)
+    return;
+
+  if (encoder->after_key)
+    encoder->after_key = false;
+  else if (encoder->items[encoder->depth]++ > 0)
+    encoder_write_byte(encoder, ',');
+}
+
+
+static void encoder_begin_container(
+    ENCODER* encoder,
+    bool map,
+    size_t count)
+{
+  encoder_begin_value(encoder);
+
+  if (encoder->depth + 1 >= ENCODER_MAX_DEPTH)
+  {
+    encoder->failed = true;
+    return;
+  }
+
+  encoder->items[++encoder->depth] = 0;
+
+  if (encoder->format == OUTPUT_JSON)
+  {
+    encoder_write_byte(encoder, map ? '{' : '[');
+  }
+  else if (count < 16)
+  {
+    encoder_write_byte(encoder, (map ? 0x80 : 0x90) | (uint8_t) count);
+  }
+  else if (count <= 0xFFFF)
+  {
+    encoder_write_byte(encoder, map ? 0xde : 0xdc);
+    encoder_write_be(encoder, count, 2);
+  }
+  else
+  {
+    encoder_write_byte(encoder, map ? 0xdf : 0xdd);
+    encoder_write_be(encoder, count, 4);
+  }
+}
+
+
+static void encoder_end_container(
+    ENCODER* encoder,
+    bool map)
+{
+  encoder->depth--;
+
+  if (encoder->format == OUTPUT_JSON)
+    encoder_write_byte(encoder, map ? '}' : ']');
+}
+
+
+// Returns the length of the valid UTF-8 sequence starting at "s", or 0 if
+// the sequence is invalid.
+
+static size_t utf8_sequence_length(
+    const uint8_t* s,
+    size_t length)
+{
+  size_t needed, i;
+
+  if (s[0] < 0x80)
+    return 1;
+  else if (s[0] >= 0xC2 && s[0] <= 0xDF)
+    needed = 2;
+  else if (s[0] >= 0xE0 && s[0] <= 0xEF)
+    needed = 3;
+  else if (s[0] >= 0xF0 && s[0] <= 0xF4)
+    needed = 4;
+  else
+    return 0;
+
+  if (needed > length)
+    return 0;
+
+  for (i = 1; i < needed; i++)
+  {
+    if ((s[i] & 0xC0) != 0x80)
+      return 0;
+  }
+
+  return needed;
+}
+
+
+// Writes a text string. Invalid UTF-8 sequences are dropped, the same way
+// they are ignored when strings from the rules are converted to Python.
+
+static void encoder_text(
+    ENCODER* encoder,
+    const char* text,
+    size_t length)
+{
+  const uint8_t* s = (const uint8_t*) text;
+  size_t valid_length = 0;
+  size_t i, n;
+
+  encoder_begin_value(encoder);
+
+  for (i = 0; i < length; i += n ? n : 1)
+  {
+    n = utf8_sequence_length(s + i, length - i);
+    valid_length += n;
+  }
+
+  if (encoder->format == OUTPUT_MSGPACK)
+  {
+    if (valid_length < 32)
+    {
+      encoder_write_byte(encoder, 0xa0 | (uint8_t) valid_length);
+    }
+    else if (valid_length <= 0xFF)
+    {
+      encoder_write_byte(encoder, 0xd9);
+      encoder_write_be(encoder, valid_length, 1);
+    }
+    else if (valid_length <= 0xFFFF)
+    {
+      encoder_write_byte(encoder, 0xda);
+      encoder_write_be(encoder, valid_length, 2);
+    }
+    else
+    {
+      encoder_write_byte(encoder, 0xdb);
+      encoder_write_be(encoder, valid_length, 4);
+    }
+  }
+  else
+  {
+    encoder_write_byte(encoder, '"');
+  }
+
+  for (i = 0; i < length; i += n ? n : 1)
+  {
+    n = utf8_sequence_length(s + i, length - i);
+
+    if (n == 0)
+      continue;
+
+    if (encoder->format == OUTPUT_JSON &&
+        (s[i] == '"' || s[i] == '\\' || s[i] < 0x20))
+    {
+      char escape[8];
+
+      if (s[i] == '"' || s[i] == '\\')
+        snprintf(escape, sizeof(escape), "\\%c", s[i]);
+      else
+        snprintf(escape, sizeof(escape), "\\u%04x", s[i]);
+
+      encoder_write(encoder, escape, strlen(escape));
+    }
+    else
+    {
+      encoder_write(encoder, s + i, n);
+    }
+  }
+
+  if (encoder->format == OUTPUT_JSON)
+    encoder_write_byte(encoder, '"');
+}
+
+
+// Ends a map key, the next value written is its value.
+
+static void encoder_end_key(
+    ENCODER* encoder)
+{
+  if (encoder->format == OUTPUT_JSON)
+  {
+    encoder_write_byte(encoder, ':');
+    encoder->after_key = true;
+  }
+}
+
+
+static void encoder_key(
+    ENCODER* encoder,
+    const char* key)
+{
+  encoder_text(encoder, key, strlen(key));
+  encoder_end_key(encoder);
+}
+
+
+static void encoder_integer(
+    ENCODER* encoder,
+    int64_t value)
+{
+  encoder_begin_value(encoder);
+
+  if (encoder->format == OUTPUT_JSON)
+  {
+    char number[32];
+    snprintf(number, sizeof(number), "%lld", (long long) value);
+    encoder_write(encoder, number, strlen(number));
+  }
+  else if (value >= 0 && value <= 0x7F)
+  {
+    encoder_write_byte(encoder, (uint8_t) value);
+  }
+  else if (value < 0 && value >= -32)
+  {
+    encoder_write_byte(encoder, (uint8_t) (0xe0 | (value + 32)));
+  }
+  else if (value >= INT32_MIN && value <= INT32_MAX)
+  {
+    encoder_write_byte(encoder, 0xd2);
+    encoder_write_be(encoder, (uint64_t) value, 4);
+  }
+  else
+  {
+    encoder_write_byte(encoder, 0xd3);
+    encoder_write_be(encoder, (uint64_t) value, 8);
+  }
+}
+
+
+static void encoder_boolean(
+    ENCODER* encoder,
+    bool value)
+{
+  encoder_begin_value(encoder);
+
+  if (encoder->format == OUTPUT_JSON)
+    encoder_write(encoder, value ? "true" : "false", value ? 4 : 5);
+  else
+    encoder_write_byte(encoder, value ? 0xc3 : 0xc2);
+}
+
+
+// Writes matched data as base64 or hexadecimal text, or as msgpack binary
+// data for OUTPUT_DATA_RAW.
+
+static void encoder_data(
+    ENCODER* encoder,
+    const uint8_t* data,
+    size_t length)
+{
+  static const char base64[] =
+      "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+  static const char hex[] = "0123456789abcdef";
+
+  size_t encoded_length;
+  size_t i;
+  char* p;
+
+  if (encoder->data_encoding == OUTPUT_DATA_RAW)
+  {
+    encoder_begin_value(encoder);
+
+    if (length <= 0xFF)
+    {
+      encoder_write_byte(encoder, 0xc4);
+      encoder_write_be(encoder, length, 1);
+    }
+    else if (length <= 0xFFFF)
+    {
+      encoder_write_byte(encoder, 0xc5);
+      encoder_write_be(encoder, length, 2);
+    }
+    else
+    {
+      encoder_write_byte(encoder, 0xc6);
+      encoder_write_be(encoder, length, 4);
+    }
+
+    encoder_write(encoder, data, length);
+    return;
+  }
+
+  if (encoder->data_encoding == OUTPUT_DATA_HEX)
+    encoded_length = 2 * length;
+  else
+    encoded_length = 4 * ((length + 2) / 3);
+
+  p = (char*) malloc(encoded_length + 1);
+
+  if (p == NULL)
+  {
+    encoder->failed = true;
+    return;
+  }
+
+  if (encoder->data_encoding == OUTPUT_DATA_HEX)
+  {
+    for (i = 0; i < length; i++)
+    {
+      p[2 * i] = hex[data[i] >> 4];
+      p[2 * i + 1] = hex[data[i] & 0x0F];
+    }
+  }
+  else
+  {
+    char* q = p;
+
+    for (i = 0; i + 2 < length; i += 3)
+    {
+      *q++ = base64[data[i] >> 2];
+      *q++ = base64[((data[i] & 0x03) << 4) | (data[i + 1] >> 4)];
+      *q++ = base64[((data[i + 1] & 0x0F) << 2) | (data[i + 2] >> 6)];
+      *q++ = base64[data[i + 2] & 0x3F];
+    }
+
+    if (i < length)
+    {
+      *q++ = base64[data[i] >> 2];
+
+      if (i + 1 < length)
+      {
+        *q++ = base64[((data[i] & 0x03) << 4) | (data[i + 1] >> 4)];
+        *q++ = base64[(data[i + 1] & 0x0F) << 2];
+      }
+      else
+      {
+        *q++ = base64[(data[i] & 0x03) << 4];
+        *q++ = '=';
+      }
+
+      *q++ = '=';
+    }
+  }
+
+  encoder_text(encoder, p, encoded_length);
+  free(p);
+}
+
+
+static void encoder_string_match(
+    ENCODER* encoder,
+    int64_t offset,
+    const char* identifier,
+    const uint8_t* data,
+    size_t data_length)
+{
+  bool with_data = encoder->data_encoding != OUTPUT_DATA_NONE;
+
+  encoder_begin_container(encoder, false, with_data ? 3 : 2);
+  encoder_integer(encoder, offset);
+  encoder_text(encoder, identifier, strlen(identifier));
+
+  if (with_data)
+    encoder_data(encoder, data, data_length);
+
+  encoder_end_container(encoder, false);
+}
+
+
+static void encoder_meta_value(
+    ENCODER* encoder,
+    YR_META* meta)
+{
+  if (meta->type == META_TYPE_INTEGER)
+    encoder_integer(encoder, meta->integer);
+  else if (meta->type == META_TYPE_BOOLEAN)
+    encoder_boolean(encoder, meta->integer != 0);
+  else
+    encoder_text(encoder, meta->string, strlen(meta->string));
+}
+
+
+// Writes the metadata of "rule" as a map, with the same contents as the
+// dictionary built by build_rule_tags_and_meta(): every identifier appears
+// once, with the last value or, if "allow_duplicate_metadata" is true, a list
+// with all its values.
+
+static void encoder_rule_meta(
+    ENCODER* encoder,
+    YR_RULE* rule,
+    bool allow_duplicate_metadata)
+{
+  YR_META* meta;
+  YR_META* other;
+  YR_META* last;
+  size_t count = 0;
+
+  yr_rule_metas_foreach(rule, meta)
+  {
+    for (other = rule->metas; other != meta; other++)
+    {
+      if (strcmp(other->identifier, meta->identifier) == 0)
+        break;
+    }
+
+    if (other == meta)
+      count++;
+  }
+
+  encoder_begin_container(encoder, true, count);
+
+  yr_rule_metas_foreach(rule, meta)
+  {
+    size_t values = 0;
+
+    for (other = rule->metas; other != meta; other++)
+    {
+      if (strcmp(other->identifier, meta->identifier) == 0)
+        break;
+    }
+
+    // Only the first occurrence of each identifier is written.
+
+    if (other != meta)
+      continue;
+
+    encoder_key(encoder, meta->identifier);
+
+    last = meta;
+
+    yr_rule_metas_foreach(rule, other)
+    {
+      if (strcmp(other->identifier, meta->identifier) == 0)
+      {
+        last = other;
+        values++;
+      }
+    }
+
+    if (allow_duplicate_metadata)
+    {
+      encoder_begin_container(encoder, false, values);
+
+      yr_rule_metas_foreach(rule, other)
+      {
+        if (strcmp(other->identifier, meta->identifier) == 0)
+          encoder_meta_value(encoder, other);
+      }
+
+      encoder_end_container(encoder, false);
+    }
+    else
+    {
+      encoder_meta_value(encoder, last);
+    }
+  }
+
+  encoder_end_container(encoder, true);
+}
+
+
+// Encodes the matches recorded during a scan. Doesn't need the GIL.
+
+static void encoder_scan_results(
+    ENCODER* encoder,
+    SCAN_RESULTS* results,
+    bool allow_duplicate_metadata)
+{
+  const char* tag;
+  size_t num_tags;
+  size_t i, j;
+
+  encoder_begin_container(encoder, false, results->num_rules);
+
+  for (i = 0; i < results->num_rules; i++)
+  {
+    RULE_RECORD* rule_record = &results->rules[i];
+    YR_RULE* rule = rule_record->rule;
+
+    encoder_begin_container(encoder, true, rule_record->truncated ? 6 : 5);
+
+    encoder_key(encoder, "rule");
+    encoder_text(encoder, rule->identifier, strlen(rule->identifier));
+    encoder_key(encoder, "namespace");
+    encoder_text(encoder, rule->ns->name, strlen(rule->ns->name));
+
+    num_tags = 0;
+
+    yr_rule_tags_foreach(rule, tag)
+    {
+      num_tags++;
+    }
+
+    encoder_key(encoder, "tags");
+    encoder_begin_container(encoder, false, num_tags);
+
+    yr_rule_tags_foreach(rule, tag)
+    {
+      encoder_text(encoder, tag, strlen(tag));
+    }
+
+    encoder_end_container(encoder, false);
+
+    encoder_key(encoder, "meta");
+    encoder_rule_meta(encoder, rule, allow_duplicate_metadata);
+
+    encoder_key(encoder, "strings");
+    encoder_begin_container(encoder, false, rule_record->num_matches);
+
+    for (j = 0; j < rule_record->num_matches; j++)
+    {
+      MATCH_RECORD* match_record = &results->matches[
+          rule_record->first_match + j];
+
+      encoder_string_match(
+          encoder,
+          match_record->offset,
+          match_record->string->identifier,
+          results->data + match_record->data_offset,
+          match_record->data_length);
+    }
+
+    encoder_end_container(encoder, false);
+
+    if (rule_record->truncated)
+    {
+      encoder_key(encoder, "truncated");
+      encoder_boolean(encoder, true);
+    }
+
+    encoder_end_container(encoder, true);
+  }
+
+  encoder_end_container(encoder, false);
+}
+
+
+// Writes a str object, or a bool, int, str or list as found in the metadata of
+// Match objects. Returns false with an exception set for other types. Must be
+// called with the GIL held.
+
+static bool encoder_object(
+    ENCODER* encoder,
+    PyObject* object)
+{
+  Py_ssize_t i;
+
+  if (PyBool_Check(object))
+  {
+    encoder_boolean(encoder, object == Py_True);
+  }
+  #if PY_MAJOR_VERSION < 3
+  else if (PyInt_Check(object))
+  {
+    encoder_integer(encoder, PyInt_AsLong(object));
+  }
+  #endif
+  else if (PyLong_Check(object))
+  {
+    long long value = PyLong_AsLongLong(object);
+
+    if (value == -1 && PyErr_Occurred())
+      return false;
+
+    encoder_integer(encoder, value);
+  }
+  else if (PY_STRING_CHECK(object))
+  {
+    PyObject* utf8 = PyUnicode_Check(object) ?
+        PyUnicode_AsUTF8String(object) : object;
+
+    if (utf8 == NULL)
+      return false;
+
+    encoder_text(encoder, PyBytes_AsString(utf8), PyBytes_Size(utf8));
+
+    if (utf8 != object)
+      Py_DECREF(utf8);
+  }
+  else if (PyList_Check(object))
+  {
+    encoder_begin_container(encoder, false, PyList_Size(object));
+
+    for (i = 0; i < PyList_Size(object); i++)
+    {
+      if (!encoder_object(encoder, PyList_GetItem(object, i)))
+        return false;
+    }
+
+    encoder_end_container(encoder, false);
+  }
+  else
+  {
+    PyErr_Format(
+        PyExc_TypeError,
+        "can't serialize object of type %s",
+        Py_TYPE(object)->tp_name);
+
+    return false;
+  }
+
+  return true;
+}
+
+
+// Encodes a Match object. Must be called with the GIL held.
+
+static bool encoder_match(
+    ENCODER* encoder,
+    Match* match)
+{
+  PyObject* key;
+  PyObject* value;
+  PyObject* data;
+
+  Py_ssize_t pos = 0;
+  Py_ssize_t i;
+
+  long long offset;
+  char* identifier;
+
+  encoder_begin_container(encoder, true, match->truncated ? 6 : 5);
+
+  encoder_key(encoder, "rule");
+
+  if (!encoder_object(encoder, match->rule))
+    return false;
+
+  encoder_key(encoder, "namespace");
+
+  if (!encoder_object(encoder, match->ns))
+    return false;
+
+  encoder_key(encoder, "tags");
+
+  if (!encoder_object(encoder, match->tags))
+    return false;
+
+  encoder_key(encoder, "meta");
+  encoder_begin_container(encoder, true, PyDict_Size(match->meta));
+
+  while (PyDict_Next(match->meta, &pos, &key, &value))
+  {
+    if (!PY_STRING_CHECK(key))
+    {
+      PyErr_Format(PyExc_TypeError, "meta keys must be strings");
+      return false;
+    }
+
+    if (!encoder_object(encoder, key))
+      return false;
+
+    encoder_end_key(encoder);
+
+    if (!encoder_object(encoder, value))
+      return false;
+  }
+
+  encoder_end_container(encoder, true);
+
+  encoder_key(encoder, "strings");
+  encoder_begin_container(encoder, false, PyList_Size(match->strings));
+
+  for (i = 0; i < PyList_Size(match->strings); i++)
+  {
+    if (!PyArg_ParseTuple(
+          PyList_GetItem(match->strings, i),
+          "LsS",
+          &offset,
+          &identifier,
+          &data))
+      return false;
+
+    encoder_string_match(
+        encoder,
+        offset,
+        identifier,
+        (uint8_t*) PyBytes_AsString(data),
+        PyBytes_Size(data));
+  }
+
+  encoder_end_container(encoder, false);
+
+  if (match->truncated)
+  {
+    encoder_key(encoder, "truncated");
+    encoder_boolean(encoder, true);
+  }
+
+  encoder_end_container(encoder, true);
+
+  return true;
+}
+
+
+// Parses the names of output formats and data encodings.
+
+static bool parse_output_options(
+    const char* format,
+    const char* data_encoding,
+    ENCODER* encoder)
+{
+  memset(encoder, 0, sizeof(ENCODER));
+
+  if (strcmp(format, "json") == 0)
+  {
+    encoder->format = OUTPUT_JSON;
+  }
+  else if (strcmp(format, "msgpack") == 0)
+  {
+    encoder->format = OUTPUT_MSGPACK;
+  }
+  else
+  {
+    PyErr_Format(
+        PyExc_ValueError,
+        "output format must be \"json\" or \"msgpack\"");
+    return false;
+  }
+
+  if (data_encoding == NULL)
+    encoder->data_encoding = OUTPUT_DATA_NONE;
+  else if (strcmp(data_encoding, "base64") == 0)
+    encoder->data_encoding = OUTPUT_DATA_BASE64;
+  else if (strcmp(data_encoding, "hex") == 0)
+    encoder->data_encoding = OUTPUT_DATA_HEX;
+  else if (strcmp(data_encoding, "raw") == 0 &&
+           encoder->format == OUTPUT_MSGPACK)
+    encoder->data_encoding = OUTPUT_DATA_RAW;
+  else
+  {
+    PyErr_Format(
+        PyExc_ValueError,
+        "data encoding must be \"base64\", \"hex\", None, or \"raw\" for "
+        "msgpack");
+    return false;
+  }
+
+  return true;
+}
+
+
+// Returns the encoded output as a bytes object and releases the encoder's
+// buffer.
+
+static PyObject* encoder_finish(
+    ENCODER* encoder)
+{
+  PyObject* result = NULL;
+
+  if (encoder->failed)
+    PyErr_NoMemory();
+  else
+    result = PyBytes_FromStringAndSize(
+        (char*) encoder->buffer, encoder->length);
+
+  free(encoder->buffer);
+  encoder->buffer = NULL;
+
+  return result;
+}
+
+
+// Saves the rules into a stream. yr_rules_save_stream can't be used while
+// other threads scan with the same rules, it temporarily replaces the
+// pointers in the arena with references while it writes them. Instead, the
+// arena's buffers are copied and the copy is the one saved. Pointers in the
+// copy are adjusted for pointing to the copied buffers first, as saving
+// translates them to references by looking up the buffer they point to.
+
+static int save_rules_stream(
+    YR_RULES* rules,
+    YR_STREAM* stream)
+{
+  YR_ARENA* arena = rules->arena;
+  YR_ARENA snapshot;
+  YR_RELOC* reloc;
+
+  int error = ERROR_SUCCESS;
+  uint32_t i;
+
+  memcpy(&snapshot, arena, sizeof(YR_ARENA));
+
+  for (i = 0; i < arena->num_buffers; i++)
+  {
+    snapshot.buffers[i].data = NULL;
+    snapshot.buffers[i].size = arena->buffers[i].used;
+  }
+
+  for (i = 0; i < arena->num_buffers && error == ERROR_SUCCESS; i++)
+  {
+    if (arena->buffers[i].used == 0)
+      continue;
+
+    snapshot.buffers[i].data = (uint8_t*) malloc(arena->buffers[i].used);
+
+    if (snapshot.buffers[i].data == NULL)
+      error = ERROR_INSUFFICIENT_MEMORY;
+    else
+      memcpy(
+          snapshot.buffers[i].data,
+          arena->buffers[i].data,
+          arena->buffers[i].used);
+  }
+
+  for (reloc = arena->reloc_list_head;
+       reloc != NULL && error == ERROR_SUCCESS;
+       reloc = reloc->next)
+  {
+    uint8_t** reloc_ptr = (uint8_t**) (
+        snapshot.buffers[reloc->buffer_id].data + reloc->offset);
+
+    for (i = 0; i < arena->num_buffers; i++)
+    {
+      if (*reloc_ptr >= arena->buffers[i].data &&
+          *reloc_ptr < arena->buffers[i].data + arena->buffers[i].used)
+      {
+        *reloc_ptr = snapshot.buffers[i].data +
+                     (*reloc_ptr - arena->buffers[i].data);
+        break;
+      }
+    }
+  }
+
+  if (error == ERROR_SUCCESS)
+    error = yr_arena_save_stream(&snapshot, stream);
+
+  for (i = 0; i < arena->num_buffers; i++)
+    free(snapshot.buffers[i].data);
+
+  return error;
+}
+
+
+// Growable buffer used as a YR_STREAM for saving rules into memory.
+
+typedef struct _MEMORY_STREAM
+{
+  uint8_t* data;
+  size_t length;
+  size_t capacity;
+
+} MEMORY_STREAM;
+
+
+static size_t memory_stream_write(
+    const void* ptr,
+    size_t size,
+    size_t count,
+    void* user_data)
+{
+  MEMORY_STREAM* stream = (MEMORY_STREAM*) user_data;
+
+  if (!grow_array(
+          (void**) &stream->data,
+          &stream->capacity,
+          stream->length + size * count,
+          1))
+    return 0;
+
+  memcpy(stream->data + stream->length, ptr, size * count);
+  stream->length += size * count;
+
+  return count;
+}
+
+
+// Returns a new reference to the SHA-256 digest of the hashed objects. Every
+// object must be bytes or support the buffer protocol. The list is NULL
+// terminated.
+
+static PyObject* sha256_digest(
+    PyObject* object,
+    ...)
+{
+  PyObject* hashlib;
+  PyObject* hasher;
+  PyObject* result;
+  va_list objects;
+
+  hashlib = PyImport_ImportModule("hashlib");
+
+  if (hashlib == NULL)
+    return NULL;
+
+  hasher = PyObject_CallMethod(hashlib, "sha256", NULL);
+  Py_DECREF(hashlib);
+
+  if (hasher == NULL)
+    return NULL;
+
+  va_start(objects, object);
+
+  while (object != NULL)
+  {
+    result = PyObject_CallMethod(hasher, "update", "O", object);
+
+    if (result == NULL)
+    {
+      va_end(objects);
+      Py_DECREF(hasher);
+      return NULL;
+    }
+
+    Py_DECREF(result);
+    object = va_arg(objects, PyObject*);
+  }
+
+  va_end(objects);
+
+  result = PyObject_CallMethod(hasher, "digest", NULL);
+  Py_DECREF(hasher);
+
+  return result;
+}
+
+
+// Returns a new reference to a digest that identifies the compiled rules,
+// computed from their serialized form. Rules compiled from the same sources
+// with the same version of libyara have the same fingerprint. For rules
+// created by select() the rules table, and therefore the fingerprint,
+// reflects which rules are enabled.
+
+static PyObject* Rules_fingerprint(
+    Rules* object)
+{
+  PyObject* fingerprint;
+  PyObject* bytes;
+
+  MEMORY_STREAM memory_stream;
+  YR_STREAM stream;
+
+  int error;
+
+  acquire_lock(object->lock);
+  fingerprint = object->fingerprint;
+  Py_XINCREF(fingerprint);
+  PyThread_release_lock(object->lock);
+
+  if (fingerprint != NULL)
+    return fingerprint;
+
+  memset(&memory_stream, 0, sizeof(MEMORY_STREAM));
+
+  stream.user_data = &memory_stream;
+  stream.write = memory_stream_write;
+
+  Py_BEGIN_ALLOW_THREADS
+  error = save_rules_stream(object->rules, &stream);
+  Py_END_ALLOW_THREADS
+
+  if (error != ERROR_SUCCESS)
+  {
+    free(memory_stream.data);
+    return handle_error(
+        get_type_state(Py_TYPE(object)), error, "<fingerprint>");
+  }
+
+  bytes = PyBytes_FromStringAndSize(
+      (char*) memory_stream.data, memory_stream.length);
+
+  free(memory_stream.data);
+
+  if (bytes == NULL)
+    return NULL;
+
+  fingerprint = sha256_digest(bytes, NULL);
+  Py_DECREF(bytes);
+
+  if (fingerprint == NULL)
+    return NULL;
+
+  acquire_lock(object->lock);
+
+  if (object->fingerprint == NULL)
+  {
+    object->fingerprint = fingerprint;
+    Py_INCREF(fingerprint);
+  }
+
+  PyThread_release_lock(object->lock);
+
+  return fingerprint;
+}
+
+
+// Returns a new list with the items of "iterable" sorted, or None if
+// "iterable" is NULL or None.
+
+static PyObject* sorted_list(
+    PyObject* iterable)
+{
+  PyObject* list;
+
+  if (iterable == NULL || iterable == Py_None)
+    Py_RETURN_NONE;
+
+  if (PyDict_Check(iterable))
+    list = PyDict_Items(iterable);
+  else
+    list = PySequence_List(iterable);
+
+  if (list != NULL && PyList_Sort(list) != 0)
+  {
+    Py_DECREF(list);
+    return NULL;
+  }
+
+  return list;
+}
+
+
+// XXH64, the 64-bit variant of the xxHash non-cryptographic hash function.
+// The scanned data is hashed with it for computing cache keys, which can be
+// done without the GIL. Data is hashed incrementally, as the windows of a
+// file are not contiguous.
+
+#define XXH64_PRIME_1 0x9E3779B185EBCA87ULL
+#define XXH64_PRIME_2 0xC2B2AE3D27D4EB4FULL
+#define XXH64_PRIME_3 0x165667B19E3779F9ULL
+#define XXH64_PRIME_4 0x85EBCA77C2B2AE63ULL
+#define XXH64_PRIME_5 0x27D4EB2F165667C5ULL
+
+#define XXH64_ROTL(x, r) (((x) << (r)) | ((x) >> (64 - (r))))
+
+typedef struct _XXH64_STATE
+{
+  uint64_t acc[4];
+  uint64_t total_length;
+  uint8_t buffer[32];
+  size_t buffered;
+
+} XXH64_STATE;
+
+
+static uint64_t read_le64(
+    const uint8_t* p)
+{
+  return (uint64_t) p[0] | (uint64_t) p[1] << 8 |
+         (uint64_t) p[2] << 16 | (uint64_t) p[3] << 24 |
+         (uint64_t) p[4] << 32 | (uint64_t) p[5] << 40 |
+         (uint64_t) p[6] << 48 | (uint64_t) p[7] << 56;
+}
+
+
+static void write_le64(
+    uint8_t* p,
+    uint64_t value)
+{
+  int i;
+
+  for (i = 0; i < 8; i++)
+    p[i] = (uint8_t) (value >> (8 * i));
+}
+
+
+static uint64_t xxh64_round(
+    uint64_t acc,
+    uint64_t input)
+{
+  acc += input * XXH64_PRIME_2;
+  acc = XXH64_ROTL(acc, 31);
+  return acc * XXH64_PRIME_1;
+}
+
+
+static uint64_t xxh64_merge_round(
+    uint64_t acc,
+    uint64_t value)
+{
+  acc ^= xxh64_round(0, value);
+  return acc * XXH64_PRIME_1 + XXH64_PRIME_4;
+}
+
+
+static void xxh64_stripe(
+    XXH64_STATE* state,
+    const uint8_t* p)
+{
+  int i;
+
+  for (i = 0; i < 4; i++)
+    state->acc[i] = xxh64_round(state->acc[i], read_le64(p + 8 * i));
+}
+
+
+static void xxh64_reset(
+    XXH64_STATE* state,
+    uint64_t seed)
+{
+  memset(state, 0, sizeof(XXH64_STATE));
+
+  state->acc[0] = seed + XXH64_PRIME_1 + XXH64_PRIME_2;
+  state->acc[1] = seed + XXH64_PRIME_2;
+  state->acc[2] = seed;
+  state->acc[3] = seed - XXH64_PRIME_1;
+}
+
+
+static void xxh64_update(
+    XXH64_STATE* state,
+    const uint8_t* data,
+    size_t length)
+{
+  const uint8_t* end = data + length;
+
+  if (length == 0)
+    return;
+
+  state->total_length += length;
+
+  if (state->buffered + length < 32)
+  {
+    memcpy(state->buffer + state->buffered, data, length);
+    state->buffered += length;
+    return;
+  }
+
+  if (state->buffered > 0)
+  {
+    memcpy(state->buffer + state->buffered, data, 32 - state->buffered);
+    data += 32 - state->buffered;
+    state->buffered = 0;
+    xxh64_stripe(state, state->buffer);
+  }
+
+  for (; data + 32 <= end; data += 32)
+    xxh64_stripe(state, data);
+
+  memcpy(state->buffer, data, end - data);
+  state->buffered = end - data;
+}
+
+
+static uint64_t xxh64_digest(
+    XXH64_STATE* state)
+{
+  const uint8_t* p = state->buffer;
+  const uint8_t* end = state->buffer + state->buffered;
+
+  uint64_t h;
+  int i;
+
+  if (state->total_length >= 32)
+  {
+    h = XXH64_ROTL(state->acc[0], 1) + XXH64_ROTL(state->acc[1], 7) +
+        XXH64_ROTL(state->acc[2], 12) + XXH64_ROTL(state->acc[3], 18);
+
+    for (i = 0; i < 4; i++)
+      h = xxh64_merge_round(h, state->acc[i]);
+  }
+  else
+  {
+    // The seed, when no stripe has been processed.
+    h = state->acc[2] + XXH64_PRIME_5;
+  }
+
+  h += state->total_length;
+
+  for (; p + 8 <= end; p += 8)
+  {
+    h ^= xxh64_round(0, read_le64(p));
+    h = XXH64_ROTL(h, 27) * XXH64_PRIME_1 + XXH64_PRIME_4;
+  }
+
+  if (p + 4 <= end)
+  {
+    h ^= (read_le64(p) & 0xFFFFFFFFULL) * XXH64_PRIME_1;
+    h = XXH64_ROTL(h, 23) * XXH64_PRIME_2 + XXH64_PRIME_3;
+    p += 4;
+  }
+
+  for (; p < end; p++)
+  {
+    h ^= (*p) * XXH64_PRIME_5;
+    h = XXH64_ROTL(h, 11) * XXH64_PRIME_1;
+  }
+
+  h ^= h >> 33;
+  h *= XXH64_PRIME_2;
+  h ^= h >> 29;
+  h *= XXH64_PRIME_3;
+  h ^= h >> 32;
+
+  return h;
+}
+
+
+// Computes the key under which the results of a scan are cached. The key is
+// a digest of the rules fingerprint, the arguments of match() that change
+// which rules match and the XXH64 digest of the scanned data, computed by
+// the caller. "params" is marshaled, so it must be a tuple of basic types.
+
+static PyObject* result_cache_key(
+    Rules* rules,
+    PyObject* params,
+    uint64_t data_digest)
+{
+  PyObject* fingerprint;
+  PyObject* marshaled;
+  PyObject* digest;
+  PyObject* key = NULL;
+
+  uint8_t digest_bytes[8];
+
+  fingerprint = Rules_fingerprint(rules);
+
+  if (fingerprint == NULL)
+    return NULL;
+
+  write_le64(digest_bytes, data_digest);
+
+  marshaled = PyMarshal_WriteObjectToString(params, Py_MARSHAL_VERSION);
+  digest = PyBytes_FromStringAndSize(
+      (const char*) digest_bytes, sizeof(digest_bytes));
+
+  if (marshaled != NULL && digest != NULL)
+    key = sha256_digest(fingerprint, marshaled, digest, NULL);
+
+  Py_DECREF(fingerprint);
+  Py_XDECREF(marshaled);
+  Py_XDECREF(digest);
+
+  return key;
+}
+
+
+// Converts a list of Match objects into the marshaled form stored in the
+// result cache, and back.
+
+static PyObject* matches_to_blob(
+    PyObject* matches)
+{
+  PyObject* entries;
+  PyObject* entry;
+  PyObject* blob;
+
+  Match* match;
+  Py_ssize_t i;
+
+  entries = PyList_New(PyList_Size(matches));
+
+  if (entries == NULL)
+    return NULL;
+
+  for (i = 0; i < PyList_Size(matches); i++)
+  {
+    match = (Match*) PyList_GetItem(matches, i);
+
+    entry = Py_BuildValue(
+        "(OOOOOO)",
+        match->rule,
+        match->ns,
+        match->tags,
+        match->meta,
+        match->strings,
+        match->truncated ? Py_True : Py_False);
+
+    if (entry == NULL)
+    {
+      Py_DECREF(entries);
+      return NULL;
+    }
+
+    PyList_SET_ITEM(entries, i, entry);
+  }
+
+  blob = PyMarshal_WriteObjectToString(entries, Py_MARSHAL_VERSION);
+  Py_DECREF(entries);
+
+  return blob;
+}
+
+
+static PyObject* matches_from_blob(
+    YARA_STATE* state,
+    PyObject* blob)
+{
+  PyObject* entries;
+  PyObject* entry;
+  PyObject* matches;
+
+  Match* match;
+  Py_ssize_t i;
+
+  entries = PyMarshal_ReadObjectFromString(
+      PyBytes_AsString(blob), PyBytes_Size(blob));
+
+  if (entries == NULL)
+    return NULL;
+
+  if (!PyList_Check(entries))
+  {
+    Py_DECREF(entries);
+    return PyErr_Format(PyExc_ValueError, "invalid cache entry");
+  }
+
+  matches = PyList_New(PyList_Size(entries));
+
+  for (i = 0; matches != NULL && i < PyList_Size(entries); i++)
+  {
+    entry = PyList_GetItem(entries, i);
+
+    // Entries are (rule, namespace, tags, meta, strings) tuples, optionally
+    // followed by the truncated flag, which is false when missing.
+
+    if (!PyTuple_Check(entry) ||
+        PyTuple_Size(entry) < 5 || PyTuple_Size(entry) > 6)
+    {
+      PyErr_Format(PyExc_ValueError, "invalid cache entry");
+      Py_CLEAR(matches);
+      break;
+    }
+
+    match = PyObject_NEW(Match, state->Match_Type);
+
+    if (match == NULL)
+    {
+      Py_CLEAR(matches);
+      break;
+    }
+
+    match->rule = PyTuple_GetItem(entry, 0);
+    match->ns = PyTuple_GetItem(entry, 1);
+    match->tags = PyTuple_GetItem(entry, 2);
+    match->meta = PyTuple_GetItem(entry, 3);
+    match->strings = PyTuple_GetItem(entry, 4);
+    match->truncated = PyTuple_Size(entry) == 6 &&
+        PyObject_IsTrue(PyTuple_GetItem(entry, 5)) == 1;
+
+    Py_INCREF(match->rule);
+    Py_INCREF(match->ns);
+    Py_INCREF(match->tags);
+    Py_INCREF(match->meta);
+    Py_INCREF(match->strings);
+
+    PyList_SET_ITEM(matches, i, (PyObject*) match);
+  }
+
+  Py_DECREF(entries);
+
+  return matches;
+}
+
+
+// Windows of a file scanned by match(filepath=..., ranges=..., max_bytes=...).
+// Each window is exposed to the scanner as a memory block whose base is the
+// window's offset in the file, and is mapped into memory only when its data
+// is needed. The scanner may ask again for data from a block it has already
+// scanned, uint32(offset) does that for instance, so the block being fetched
+// is not necessarily the one currently mapped.
+
+typedef struct _FILE_WINDOWS
+{
+  const char* filepath;
+  uint64_t file_size;
+
+  YR_MEMORY_BLOCK* blocks;
+  size_t num_blocks;
+  size_t next_block;
+
+  YR_MAPPED_FILE mapped_file;
+  YR_MEMORY_BLOCK* mapped_block;
+
+} FILE_WINDOWS;
+
+
+static int compare_file_windows(
+    const void* a,
+    const void* b)
+{
+  const YR_MEMORY_BLOCK* block_a = (const YR_MEMORY_BLOCK*) a;
+  const YR_MEMORY_BLOCK* block_b = (const YR_MEMORY_BLOCK*) b;
+
+  if (block_a->base < block_b->base)
+    return -1;
+
+  if (block_a->base > block_b->base)
+    return 1;
+
+  return 0;
+}
+
+
+static const uint8_t* file_window_fetch_data(
+    YR_MEMORY_BLOCK* block)
+{
+  FILE_WINDOWS* windows = (FILE_WINDOWS*) block->context;
+
+  // Mappings must start at offsets that are multiples of 1MB.
+  uint64_t aligned_base = block->base >> 20 << 20;
+
+  if (windows->mapped_block == block)
+    return windows->mapped_file.data + (block->base - aligned_base);
+
+  if (windows->mapped_block != NULL)
+  {
+    yr_filemap_unmap(&windows->mapped_file);
+    windows->mapped_block = NULL;
+  }
+
+  if (yr_filemap_map_ex(
+          windows->filepath,
+          aligned_base,
+          (size_t) (block->base - aligned_base + block->size),
+          &windows->mapped_file) != ERROR_SUCCESS)
+    return NULL;
+
+  if (windows->mapped_file.size < block->base - aligned_base + block->size)
+  {
+    // The file was truncated after the windows were computed.
+    yr_filemap_unmap(&windows->mapped_file);
+    return NULL;
+  }
+
+  windows->mapped_block = block;
+
+  return windows->mapped_file.data + (block->base - aligned_base);
+}
+
+
+static YR_MEMORY_BLOCK* file_windows_first_block(
+    YR_MEMORY_BLOCK_ITERATOR* iterator)
+{
+  FILE_WINDOWS* windows = (FILE_WINDOWS*) iterator->context;
+
+  windows->next_block = 0;
+  iterator->last_error = ERROR_SUCCESS;
+
+  if (windows->num_blocks == 0)
+    return NULL;
+
+  return &windows->blocks[windows->next_block++];
+}
+
+
+static YR_MEMORY_BLOCK* file_windows_next_block(
+    YR_MEMORY_BLOCK_ITERATOR* iterator)
+{
+  FILE_WINDOWS* windows = (FILE_WINDOWS*) iterator->context;
+
+  iterator->last_error = ERROR_SUCCESS;
+
+  if (windows->next_block >= windows->num_blocks)
+    return NULL;
+
+  return &windows->blocks[windows->next_block++];
+}
+
+
+static uint64_t file_windows_file_size(
+    YR_MEMORY_BLOCK_ITERATOR* iterator)
+{
+  return ((FILE_WINDOWS*) iterator->context)->file_size;
+}
+
+
+// Hashes what a scan of the windows sees: the offset, size and data of every
+// window, and the size of the whole file. Called without the GIL. Returns
+// false if some window can't be read.
+
+static bool file_windows_hash(
+    FILE_WINDOWS* windows,
+    XXH64_STATE* state)
+{
+  uint8_t header[16];
+  size_t i;
+
+  for (i = 0; i < windows->num_blocks; i++)
+  {
+    YR_MEMORY_BLOCK* block = &windows->blocks[i];
+    const uint8_t* data = file_window_fetch_data(block);
+
+    if (data == NULL)
+      return false;
+
+    write_le64(header, block->base);
+    write_le64(header + 8, block->size);
+
+    xxh64_update(state, header, sizeof(header));
+    xxh64_update(state, data, block->size);
+  }
+
+  write_le64(header, windows->file_size);
+  xxh64_update(state, header, 8);
+
+  return true;
+}
+
+
+// Converts the "ranges" argument of match() into windows of the file. Each
+// range is a (start, end) tuple where negative values are relative to the
+// end of the file and None as end means the end of the file. Overlapping
+// ranges are merged and windows beyond the first max_bytes bytes of selected
+// data are dropped (max_bytes < 0 means no limit). Without ranges the window
+// is the whole file. Returns false with an exception set on error.
+
+static bool file_windows_create(
+    YARA_STATE* state,
+    FILE_WINDOWS* windows,
+    const char* filepath,
+    PyObject* ranges,
+    long long max_bytes)
+{
+  PyObject* sequence = NULL;
+  PyObject* item;
+
+  Py_ssize_t num_ranges = 1;
+  Py_ssize_t i;
+
+  size_t num_blocks = 0;
+  uint64_t remaining = (uint64_t) max_bytes;
+
+  #if defined(_WIN32)
+  struct _stati64 st;
+
+  if (_stati64(filepath, &st) != 0)
+  #else
+  struct stat st;
+
+  if (stat(filepath, &st) != 0)
+  #endif
+  {
+    handle_error(state, ERROR_COULD_NOT_OPEN_FILE, (char*) filepath);
+    return false;
+  }
+
+  memset(windows, 0, sizeof(FILE_WINDOWS));
+
+  windows->filepath = filepath;
+  windows->file_size = (uint64_t) st.st_size;
+
+  if (ranges != NULL && ranges != Py_None)
+  {
+    sequence = PySequence_Fast(
+        ranges, "'ranges' must be a sequence of (start, end) tuples");
+
+    if (sequence == NULL)
+      return false;
+
+    num_ranges = PySequence_Fast_GET_SIZE(sequence);
+  }
+
+  windows->blocks = (YR_MEMORY_BLOCK*) PyMem_Malloc(
+      (num_ranges + 1) * sizeof(YR_MEMORY_BLOCK));
+
+  if (windows->blocks == NULL)
+  {
+    Py_XDECREF(sequence);
+    PyErr_NoMemory();
+    return false;
+  }
+
+  for (i = 0; i < num_ranges; i++)
+  {
+    long long start = 0;
+    long long end = (long long) windows->file_size;
+    long long size = (long long) windows->file_size;
+
+    PyObject* start_object;
+    PyObject* end_object;
+
+    if (sequence != NULL)
+    {
+      item = PySequence_Fast_GET_ITEM(sequence, i);
+
+      if (!PyTuple_Check(item) && !PyList_Check(item))
+        goto _type_error;
+
+      if (PySequence_Fast_GET_SIZE(item) != 2)
+        goto _type_error;
+
+      start_object = PySequence_Fast_GET_ITEM(item, 0);
+      end_object = PySequence_Fast_GET_ITEM(item, 1);
+
+      if (!PyIndex_Check(start_object))
+        goto _type_error;
+
+      start = PyLong_AsLongLong(start_object);
+
+      if (start == -1 && PyErr_Occurred())
+        goto _error;
+
+      if (start < 0)
+        start += size;
+
+      if (end_object != Py_None)
+      {
+        if (!PyIndex_Check(end_object))
+          goto _type_error;
+
+        end = PyLong_AsLongLong(end_object);
+
+        if (end == -1 && PyErr_Occurred())
+          goto _error;
+
+        if (end < 0)
+          end += size;
+      }
+    }
+
+    start = start < 0 ? 0 : (start > size ? size : start);
+    end = end < 0 ? 0 : (end > size ? size : end);
+
+    if (end > start)
+    {
+      windows->blocks[num_blocks].base = (uint64_t) start;
+      windows->blocks[num_blocks].size = (size_t) (end - start);
+      num_blocks++;
+    }
+  }
+
+  Py_XDECREF(sequence);
+  sequence = NULL;
+
+  qsort(
+      windows->blocks,
+      num_blocks,
+      sizeof(YR_MEMORY_BLOCK),
+      compare_file_windows);
+
+  windows->num_blocks = 0;
+
+  for (i = 0; i < (Py_ssize_t) num_blocks; i++)
+  {
+    YR_MEMORY_BLOCK* block = &windows->blocks[i];
+    YR_MEMORY_BLOCK* last = windows->num_blocks > 0 ?
+        &windows->blocks[windows->num_blocks - 1] : NULL;
+
+    if (last != NULL && block->base <= last->base + last->size)
+    {
+      if (block->base + block->size > last->base + last->size)
+        last->size = (size_t) (block->base + block->size - last->base);
+    }
+    else
+    {
+      windows->blocks[windows->num_blocks++] = *block;
+    }
+  }
+
+  for (i = 0; i < (Py_ssize_t) windows->num_blocks; i++)
+  {
+    YR_MEMORY_BLOCK* block = &windows->blocks[i];
+
+    if (max_bytes >= 0)
+    {
+      if (remaining == 0)
+      {
+        windows->num_blocks = i;
+        break;
+      }
+
+      if (block->size > remaining)
+        block->size = (size_t) remaining;
+
+      remaining -= block->size;
+    }
+
+    block->context = windows;
+    block->fetch_data = file_window_fetch_data;
+  }
+
+  return true;
+
+_type_error:
+
+  PyErr_Format(
+      PyExc_TypeError,
+      "'ranges' must be a sequence of (start, end) tuples");
+
+_error:
+
+  Py_XDECREF(sequence);
+  PyMem_Free(windows->blocks);
+  windows->blocks = NULL;
+
+  return false;
+}
+
+
+static void file_windows_destroy(
+    FILE_WINDOWS* windows)
+{
+  if (windows->mapped_block != NULL)
+    yr_filemap_unmap(&windows->mapped_file);
+
+  PyMem_Free(windows->blocks);
+}
+
+
+// Validates the callbacks and related arguments passed to match().
+
+static bool check_match_callbacks(
+    CALLBACK_DATA* callback_data)
+{
+  if (callback_data->callback != NULL &&
+      !PyCallable_Check(callback_data->callback))
+  {
+    PyErr_Format(PyExc_TypeError, "'callback' must be callable");
+    return false;
+  }
+
+  if (callback_data->batch_callback == Py_None)
+    callback_data->batch_callback = NULL;
+
+  if (callback_data->batch_callback != NULL)
+  {
+    if (!PyCallable_Check(callback_data->batch_callback))
+    {
+      PyErr_Format(PyExc_TypeError, "'batch_callback' must be callable");
+      return false;
+    }
+
+    if (callback_data->callback != NULL)
+    {
+      PyErr_Format(
+          PyExc_TypeError,
+          "'callback' and 'batch_callback' can't be used together");
+      return false;
+    }
+  }
+
+  if (callback_data->batch_size < 0)
+  {
+    PyErr_Format(PyExc_ValueError, "'batch_size' must be a positive number");
+    return false;
+  }
+
+  if (callback_data->modules_callback != NULL &&
+      !PyCallable_Check(callback_data->modules_callback))
+  {
+    PyErr_Format(PyExc_TypeError, "'modules_callback' must be callable");
+    return false;
+  }
+
+  if (callback_data->warnings_callback != NULL &&
+      !PyCallable_Check(callback_data->warnings_callback))
+  {
+    PyErr_Format(PyExc_TypeError, "'warnings_callback' must be callable");
+    return false;
+  }
+
+  if (callback_data->console_callback != NULL &&
+      !PyCallable_Check(callback_data->console_callback))
+  {
+    PyErr_Format(PyExc_TypeError, "'console_callback' must be callable");
+    return false;
+  }
+
+  if (callback_data->modules_data != NULL &&
+      !PyDict_Check(callback_data->modules_data))
+  {
+    PyErr_Format(PyExc_TypeError, "'modules_data' must be a dictionary");
+    return false;
+  }
+
+  if (callback_data->stop_after < 0)
+  {
+    PyErr_Format(PyExc_ValueError, "'stop_after' must be a positive number");
+    return false;
+  }
+
+  return true;
+}
+
+
+// Parses the "result", "output" and "output_data" arguments of match().
+// Columnar results and encoded output are built straight from the matches
+// collected in C, which only happens when there are no callbacks. Match data
+// is included in encoded output as base64 unless output_data says otherwise.
+
+static bool parse_match_result(
+    CALLBACK_DATA* callback_data,
+    const char* result_type,
+    const char* output,
+    PyObject* output_data,
+    bool* columnar,
+    ENCODER* encoder)
+{
+  bool callbacks = (
+      callback_data->callback != NULL ||
+      callback_data->batch_callback != NULL);
+
+  *columnar = false;
+
+  if (result_type != NULL && strcmp(result_type, "columnar") == 0)
+  {
+    *columnar = true;
+  }
+  else if (result_type != NULL && strcmp(result_type, "matches") != 0)
+  {
+    PyErr_Format(
+        PyExc_ValueError,
+        "'result' must be \"matches\" or \"columnar\"");
+    return false;
+  }
+
+  #if PY_MAJOR_VERSION < 3
+  // Columns are memoryviews cast to the column's type, which Python 2
+  // doesn't support.
+  if (*columnar)
+  {
+    PyErr_Format(
+        PyExc_ValueError,
+        "'result=\"columnar\"' requires Python 3");
+    return false;
+  }
+  #endif
+
+  if (*columnar && callbacks)
+  {
+    PyErr_Format(
+        PyExc_TypeError,
+        "'result=\"columnar\"' can't be used with callbacks");
+    return false;
+  }
+
+  if (output != NULL)
+  {
+    const char* data_encoding = "base64";
+
+    if (output_data == Py_None)
+      data_encoding = NULL;
+    else if (output_data != NULL && PY_STRING_CHECK(output_data))
+      data_encoding = PY_STRING_TO_C(output_data);
+    else if (output_data != NULL)
+      data_encoding = "";
+
+    if (!parse_output_options(output, data_encoding, encoder))
+      return false;
+
+    if (*columnar || callbacks)
+    {
+      PyErr_Format(
+          PyExc_TypeError,
+          "'output' can't be used with callbacks or columnar results");
+      return false;
+    }
+  }
+
+  return true;
+}
+
+
+// Validates the per-scan limits passed to match(). Limits are enforced while
+// recording the matches in C, callbacks receive the matches straight from the
+// scanner.
+
+static bool check_match_limits(
+    CALLBACK_DATA* callback_data,
+    SCAN_LIMITS* limits)
+{
+  if (!scan_limits_check(limits))
+    return false;
+
+  if (scan_limits_enabled(limits) &&
+      (callback_data->callback != NULL ||
+       callback_data->batch_callback != NULL))
+  {
+    PyErr_Format(PyExc_TypeError, "scan limits can't be used with callbacks");
+    return false;
+  }
+
+  return true;
+}
+
+
+// Validates the "ranges" and "max_bytes" arguments of match(), which select
+// the windows of a file that are scanned.
+
+static bool check_match_windows(
+    const char* filepath,
+    PyObject* ranges,
+    long long max_bytes)
+{
+  if ((ranges != NULL || max_bytes != -1) && filepath == NULL)
+  {
+    PyErr_Format(
+        PyExc_TypeError,
+        "'ranges' and 'max_bytes' can only be used with 'filepath'");
+    return false;
+  }
+
+  if (max_bytes < -1)
+  {
+    PyErr_Format(PyExc_ValueError, "'max_bytes' must be a positive number");
+    return false;
+  }
+
+  return true;
+}
+
+
+// Computes the cache key of a scan and returns the matches cached under it,
+// or NULL if there are none. "params" are the arguments of match() included
+// in the key. Only the scanned data is hashed: the selected windows of a file
+// when "windows" is not NULL, otherwise the whole file or "data". Files are
+// mapped for hashing them, the mapping is returned in "mapped_file" so that
+// the scan uses the same data, and it must be unmapped by the caller if
+// "file_mapped" is true. "cache_key" receives a new reference to the key, or
+// NULL if the data couldn't be read, in which case the scan doesn't use the
+// cache and reports the error itself. Returns NULL with an exception set on
+// any other error.
+
+static PyObject* match_cache_lookup(
+    Rules* object,
+    ResultCache* cache,
+    PyObject* params,
+    const char* filepath,
+    FILE_WINDOWS* windows,
+    Py_buffer* data,
+    YR_MAPPED_FILE* mapped_file,
+    bool* file_mapped,
+    PyObject** cache_key)
+{
+  PyObject* cached;
+  PyObject* matches;
+
+  XXH64_STATE state;
+  bool hashed = true;
+
+  if (params == NULL)
+    return NULL;
+
+  xxh64_reset(&state, 0);
+
+  Py_BEGIN_ALLOW_THREADS
+
+  if (windows != NULL)
+  {
+    hashed = file_windows_hash(windows, &state);
+  }
+  else if (filepath != NULL)
+  {
+    *file_mapped = yr_filemap_map(filepath, mapped_file) == ERROR_SUCCESS;
+    hashed = *file_mapped;
+
+    if (hashed)
+      xxh64_update(&state, mapped_file->data, mapped_file->size);
+  }
+  else
+  {
+    xxh64_update(&state, (const uint8_t*) data->buf, (size_t) data->len);
+  }
+
+  Py_END_ALLOW_THREADS
+
+  if (!hashed)
+    return NULL;
+
+  *cache_key = result_cache_key(object, params, xxh64_digest(&state));
+
+  if (*cache_key == NULL)
+    return NULL;
+
+  cached = ResultCache_lookup(cache, *cache_key);
+
+  if (cached == NULL)
+    return NULL;
+
+  matches = matches_from_blob(get_type_state(Py_TYPE(object)), cached);
+  Py_DECREF(cached);
+
+  return matches;
+}
+
+
+// Scans a file, a file's windows, a memory buffer or a process with the GIL
+// released. "mapped_file" is used instead of "filepath" when not NULL.
+
+static int match_scan(
+    YR_SCANNER* scanner,
+    CALLBACK_DATA* callback_data,
+    const char* filepath,
+    FILE_WINDOWS* windows,
+    YR_MAPPED_FILE* mapped_file,
+    Py_buffer* data,
+    int pid)
+{
+  YR_MEMORY_BLOCK_ITERATOR iterator;
+
+  int error = ERROR_SUCCESS;
+
+  if (windows != NULL)
+  {
+    iterator.context = windows;
+    iterator.first = file_windows_first_block;
+    iterator.next = file_windows_next_block;
+    iterator.file_size = file_windows_file_size;
+    iterator.last_error = ERROR_SUCCESS;
+  }
+
+  callback_data->thread_state = PyEval_SaveThread();
+
+  if (windows != NULL)
+    error = yr_scanner_scan_mem_blocks(scanner, &iterator);
+  else if (mapped_file != NULL)
+    error = yr_scanner_scan_mem(scanner, mapped_file->data, mapped_file->size);
+  else if (filepath != NULL)
+    error = yr_scanner_scan_file(scanner, filepath);
+  else if (data->buf != NULL)
+    error = yr_scanner_scan_mem(
+        scanner, (unsigned char*) data->buf, (size_t) data->len);
+  else if (pid != -1)
+    error = yr_scanner_scan_proc(scanner, pid);
+
+  PyEval_RestoreThread(callback_data->thread_state);
+
+  return error;
+}
+
+
+static PyObject* Rules_match(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  static char* kwlist[] = {
+      "filepath", "pid", "data", "externals",
+      "callback", "fast", "timeout", "modules_data",
+      "modules_callback", "which_callbacks", "warnings_callback",
+      "console_callback", "allow_duplicate_metadata", "stop_after",
+      "stop_on_tags", "stop_on_rules", "batch_callback", "batch_size",
+      "result", "ranges", "max_bytes", "cache", "output", "output_data",
+      "max_string_matches", "max_matches", "max_match_data",
+      "max_result_size", NULL
+      };
+
+  char* filepath = NULL;
+  char* result_type = NULL;
+  char* output = NULL;
+  Py_buffer data = {0};
+
+  bool columnar = false;
+
+  int pid = -1;
+  int timeout = 0;
+  int error = ERROR_SUCCESS;
+
+  PyObject* result = NULL;
+  PyObject* externals = NULL;
+  PyObject* fast = NULL;
+  PyObject* stop_on_tags = NULL;
+  PyObject* stop_on_rules = NULL;
+
+  Rules* object = (Rules*) self;
+  Externals* bound = NULL;
+  EXTERNALS_SCANNER bound_scanner = {NULL, NULL, 0};
+  PyObject* bound_values = NULL;
+
+  YARA_STATE* state = get_type_state(Py_TYPE(self));
+
+  YR_SCANNER* scanner = NULL;
+  CALLBACK_DATA callback_data;
+  SCAN_RESULTS results;
+
+  PyObject* ranges = NULL;
+  long long max_bytes = -1;
+
+  PyObject* cache = NULL;
+  PyObject* cache_key = NULL;
+
+  PyObject* output_data = NULL;
+  ENCODER encoder;
+
+  SCAN_LIMITS limits = {-1, -1, -1, -1};
+
+  YR_MAPPED_FILE mapped_file;
+  bool file_mapped = false;
+
+  FILE_WINDOWS windows;
+  bool use_windows = false;
+
+  bool measured = false;
+  double scan_started = 0;
+
+  int flags = 0;
+
+  memset(&results, 0, sizeof(SCAN_RESULTS));
+  memset(&windows, 0, sizeof(FILE_WINDOWS));
+
+  callback_data.state = state;
+  callback_data.thread_state = NULL;
+  callback_data.matches = NULL;
+  callback_data.callback = NULL;
+  callback_data.modules_data = NULL;
+  callback_data.modules_callback = NULL;
+  callback_data.warnings_callback = NULL;
+  callback_data.console_callback = NULL;
+  callback_data.which = CALLBACK_ALL;
+  callback_data.allow_duplicate_metadata = false;
+  callback_data.stop_after = 0;
+  callback_data.num_matches = 0;
+  callback_data.stop_rules = NULL;
+  callback_data.batch_callback = NULL;
+  callback_data.batch_size = 0;
+  callback_data.num_pending = 0;
+  callback_data.pending = NULL;
+  callback_data.results = NULL;
+
+  if (!PyArg_ParseTupleAndKeywords(
+        args,
+        keywords,
+        "|sis*OOOiOOiOObiOOOizOLOzOLLLL",
+        kwlist,
+        &filepath,
+        &pid,
+        &data,
+        &externals,
+        &callback_data.callback,
+        &fast,
+        &timeout,
+        &callback_data.modules_data,
+        &callback_data.modules_callback,
+        &callback_data.which,
+        &callback_data.warnings_callback,
+        &callback_data.console_callback,
+        &callback_data.allow_duplicate_metadata,
+        &callback_data.stop_after,
+        &stop_on_tags,
+        &stop_on_rules,
+        &callback_data.batch_callback,
+        &callback_data.batch_size,
+        &result_type,
+        &ranges,
+        &max_bytes,
+        &cache,
+        &output,
+        &output_data,
+        &limits.max_string_matches,
+        &limits.max_matches,
+        &limits.max_match_data,
+        &limits.max_result_size))
+  {
+    return NULL;
+  }
+
+  if (filepath == NULL && data.buf == NULL && pid == -1)
+  {
+    PyErr_Format(PyExc_TypeError, "match() takes at least one argument");
+    goto _exit;
+  }
+
+  if (ranges == Py_None)
+    ranges = NULL;
+
+  if (cache == Py_None)
+    cache = NULL;
+
+  if (!check_match_callbacks(&callback_data) ||
+      !parse_match_result(
+          &callback_data,
+          result_type,
+          output,
+          output_data,
+          &columnar,
+          &encoder) ||
+      !check_match_limits(&callback_data, &limits) ||
+      !check_match_windows(filepath, ranges, max_bytes))
+    goto _exit;
+
+  if (cache != NULL && !PyObject_TypeCheck(cache, state->ResultCache_Type))
+  {
+    PyErr_Format(PyExc_TypeError, "'cache' must be a ResultCache object");
+    goto _exit;
+  }
+
+  if (externals != NULL &&
+      PyObject_TypeCheck(externals, state->Externals_Type))
+  {
+    bound = (Externals*) externals;
+
+    if (bound->rules != self)
+    {
+      PyErr_Format(
+          PyExc_TypeError,
+          "'externals' is bound to a different Rules object");
+      goto _exit;
+    }
+  }
+  else if (externals != NULL && externals != Py_None &&
+           !PyDict_Check(externals))
+  {
+    PyErr_Format(PyExc_TypeError, "'externals' must be a dictionary");
+    goto _exit;
+  }
+
+  if ((stop_on_tags != NULL && stop_on_tags != Py_None) ||
+      (stop_on_rules != NULL && stop_on_rules != Py_None))
+  {
+    callback_data.stop_rules = build_stop_table(
+        object->rules, stop_on_tags, stop_on_rules);
+
+    if (callback_data.stop_rules == NULL)
+      goto _exit;
+  }
+
+  if (callback_data.batch_callback != NULL)
+  {
+    // Rules are queued in this array while scanning, it must be able to
+    // hold a whole batch, or all the rules if the batch size is unlimited.
+
+    if (callback_data.batch_size == 0 ||
+        callback_data.batch_size > (int) object->rules->num_rules)
+      callback_data.batch_size = (int) object->rules->num_rules;
+
+    callback_data.pending = (PENDING_RULE*) PyMem_Malloc(
+        (callback_data.batch_size + 1) * sizeof(PENDING_RULE));
+
+    if (callback_data.pending == NULL)
+    {
+      PyErr_NoMemory();
+      goto _exit;
+    }
+  }
+
+  if (bound != NULL)
+  {
+    // The binding hands out a scanner that already has the external
+    // variables defined, and that no other thread uses until this scan
+    // gives it back.
+    scanner = Externals_acquire_scanner(bound, &bound_scanner, &bound_values);
+
+    if (scanner == NULL)
+      goto _exit;
+  }
+  else if (yr_scanner_create(object->rules, &scanner) != 0)
+  {
+    scanner = NULL;
+    PyErr_Format(PyExc_Exception, "could not create scanner");
+    goto _exit;
+  }
+
+  if (bound == NULL && externals != NULL && externals != Py_None &&
+      process_match_externals(state, externals, scanner) != ERROR_SUCCESS)
+    goto _exit;
+
+  if (fast != NULL && PyObject_IsTrue(fast) == 1)
+    flags |= SCAN_FLAGS_FAST_MODE;
+
+  // Without callbacks only matching rules are of interest, and they are
+  // collected in C while the GIL is released.
+
+  if (callback_data.callback == NULL && callback_data.batch_callback == NULL)
+  {
+    flags |= SCAN_FLAGS_REPORT_RULES_MATCHING;
+    callback_data.results = &results;
+
+    if (scan_limits_enabled(&limits))
+      results.limits = &limits;
+  }
+
+  // Only the selected windows of the file are scanned, but filesize is still
+  // the size of the whole file. When the file was mapped for computing the
+  // cache key, the mapping is scanned so that the results match the key.
+
+  if (filepath != NULL && (ranges != NULL || max_bytes != -1))
+  {
+    if (!file_windows_create(state, &windows, filepath, ranges, max_bytes))
+      goto _exit;
+
+    use_windows = true;
+  }
+
+  // Cached results are used only when they depend exclusively on the rules,
+  // the scanned data and the arguments included in the key. Callbacks must
+  // be invoked and modules data may change between scans, so they disable
+  // the cache, which is also not used for processes.
+
+  if (cache != NULL &&
+      callback_data.callback == NULL &&
+      callback_data.batch_callback == NULL &&
+      callback_data.modules_callback == NULL &&
+      callback_data.warnings_callback == NULL &&
+      callback_data.console_callback == NULL &&
+      callback_data.modules_data == NULL &&
+      !columnar &&
+      output == NULL &&
+      pid == -1)
+  {
+    PyObject* params = Py_BuildValue(
+        "(iiNNiOLN(LLLL))",
+        fast != NULL && PyObject_IsTrue(fast) == 1,
+        callback_data.stop_after,
+        sorted_list(stop_on_tags),
+        sorted_list(stop_on_rules),
+        (int) callback_data.allow_duplicate_metadata,
+        ranges != NULL ? ranges : Py_None,
+        max_bytes,
+        sorted_list(bound != NULL ? bound_values : externals),
+        limits.max_string_matches,
+        limits.max_matches,
+        limits.max_match_data,
+        limits.max_result_size);
+
+    result = match_cache_lookup(
+        object,
+        (ResultCache*) cache,
+        params,
+        filepath,
+        use_windows ? &windows : NULL,
+        &data,
+        &mapped_file,
+        &file_mapped,
+        &cache_key);
+
+    Py_XDECREF(params);
+
+    // Results served from the cache are not counted as scans.
+
+    if (result != NULL || PyErr_Occurred() != NULL)
+      goto _exit;
+  }
+
+  yr_scanner_set_flags(scanner, flags);
+  yr_scanner_set_timeout(scanner, timeout);
+  yr_scanner_set_callback(scanner, yara_callback, &callback_data);
+
+  callback_data.matches = PyList_New(0);
+
+  if (callback_data.matches == NULL)
+    goto _exit;
+
+  if (metrics_enabled)
+  {
+    measured = true;
+    scan_started = monotonic_time();
+  }
+
+  error = match_scan(
+      scanner,
+      &callback_data,
+      filepath,
+      use_windows ? &windows : NULL,
+      file_mapped ? &mapped_file : NULL,
+      &data,
+      pid);
+
+  // The size of a process is unknown, it doesn't count as scanned bytes.
+  if (measured)
+    metrics_record_scan(
+        pid == -1 ? scanner->file_size : 0,
+        monotonic_time() - scan_started,
+        error);
+
+  // An error delivering the last batch doesn't make the scan fail, the
+  // scanner ignores what is returned for CALLBACK_MSG_SCAN_FINISHED.
+
+  if (error == ERROR_SUCCESS && PyErr_Occurred() != NULL)
+    error = ERROR_CALLBACK_ERROR;
+
+  if (error == ERROR_CALLBACK_ERROR && results.error != ERROR_SUCCESS)
+    error = results.error;
+
+  if (error == ERROR_SUCCESS && columnar)
+  {
+    result = scan_results_to_columns(&results, object);
+  }
+  else if (error == ERROR_SUCCESS && output != NULL)
+  {
+    Py_BEGIN_ALLOW_THREADS
+    encoder_scan_results(
+        &encoder, &results, callback_data.allow_duplicate_metadata);
+    Py_END_ALLOW_THREADS
+
+    result = encoder_finish(&encoder);
+  }
+  else if (error == ERROR_SUCCESS &&
+      scan_results_to_matches(&results, &callback_data, callback_data.matches))
+  {
+    result = callback_data.matches;
+    callback_data.matches = NULL;
+
+    if (cache_key != NULL)
+    {
+      PyObject* blob = matches_to_blob(result);
+
+      if (blob != NULL)
+      {
+        ResultCache_store((ResultCache*) cache, cache_key, blob);
+        Py_DECREF(blob);
+      }
+
+      PyErr_Clear();
+    }
+  }
+  else if (error != ERROR_SUCCESS && error != ERROR_CALLBACK_ERROR)
+  {
+    if (filepath != NULL)
+      handle_error(state, error, filepath);
+    else if (pid != -1)
+      handle_error(state, error, "<proc>");
+    else
+      handle_error(state, error, "<data>");
+
+    #ifdef PROFILING_ENABLED
+    PyObject* exception = PyErr_Occurred();
+
+    if (exception != NULL && error == ERROR_SCAN_TIMEOUT)
+    {
+      PyObject_SetAttrString(
+          exception,
+          "profiling_info",
+          Rules_profiling_info(self, NULL));
+    }
+    #endif
+  }
+
+_exit:
+
+  PyBuffer_Release(&data);
+  PyMem_Free(callback_data.stop_rules);
+  PyMem_Free(callback_data.pending);
+  Py_XDECREF(callback_data.matches);
+  Py_XDECREF(cache_key);
+  Py_XDECREF(bound_values);
+
+  if (scanner != NULL && bound != NULL)
+    Externals_release_scanner(bound, &bound_scanner);
+  else if (scanner != NULL)
+    yr_scanner_destroy(scanner);
+
+  file_windows_destroy(&windows);
+  scan_results_destroy(&results);
+
+  if (file_mapped)
+    yr_filemap_unmap(&mapped_file);
+
+  return result;
+}
+
+
+#if defined(USE_LINUX_PROC)
+
+// Memory regions of a process, as listed in /proc/<pid>/maps, that passed the
+// user-provided region filter. Regions are sorted by base address.
+
+typedef struct _PROCESS_REGION
+{
+  uint64_t base;
+  uint64_t size;
+
+} PROCESS_REGION;
+
+
+typedef struct _PROCESS_SCAN_JOB
+{
+  int pid;
+  int error;
+
+  PROCESS_REGION* regions;
+  size_t num_regions;
+
+  CALLBACK_DATA callback_data;
+  SCAN_RESULTS results;
+
+} PROCESS_SCAN_JOB;
+
+
+typedef struct _PROCESS_SCAN
+{
+  PROCESS_SCAN_JOB* jobs;
+  size_t num_jobs;
+  size_t next_job;
+
+  int running_workers;
+
+  PyThread_type_lock lock;
+  PyThread_type_lock done;
+
+  PyInterpreterState* interpreter;
+
+} PROCESS_SCAN;
+
+
+typedef struct _PROCESS_SCAN_WORKER
+{
+  PROCESS_SCAN* scan;
+  YR_SCANNER* scanner;
+
+} PROCESS_SCAN_WORKER;
+
+
+typedef struct _FILTERED_ITERATOR_CTX
+{
+  YR_MEMORY_BLOCK_ITERATOR* process_iterator;
+  PROCESS_SCAN_JOB* job;
+
+} FILTERED_ITERATOR_CTX;
+
+
+static PROCESS_REGION* find_process_region(
+    PROCESS_REGION* regions,
+    size_t num_regions,
+    uint64_t address)
+{
+  size_t lo = 0;
+  size_t hi = num_regions;
+
+  while (lo < hi)
+  {
+    size_t mid = lo + (hi - lo) / 2;
+
+    if (address < regions[mid].base)
+      hi = mid;
+    else if (address >= regions[mid].base + regions[mid].size)
+      lo = mid + 1;
+    else
+      return &regions[mid];
+  }
+
+  return NULL;
+}
+
+
+static YR_MEMORY_BLOCK* filtered_skip_blocks(
+    YR_MEMORY_BLOCK_ITERATOR* iterator,
+    YR_MEMORY_BLOCK* block)
+{
+  FILTERED_ITERATOR_CTX* context = (FILTERED_ITERATOR_CTX*) iterator->context;
+  YR_MEMORY_BLOCK_ITERATOR* process_iterator = context->process_iterator;
+
+  while (block != NULL && find_process_region(
+      context->job->regions,
+      context->job->num_regions,
+      block->base) == NULL)
+  {
+    block = process_iterator->next(process_iterator);
+  }
+
+  iterator->last_error = process_iterator->last_error;
+
+  return block;
+}
+
+
+static YR_MEMORY_BLOCK* filtered_first_block(
+    YR_MEMORY_BLOCK_ITERATOR* iterator)
+{
+  FILTERED_ITERATOR_CTX* context = (FILTERED_ITERATOR_CTX*) iterator->context;
+  YR_MEMORY_BLOCK_ITERATOR* process_iterator = context->process_iterator;
+
+  return filtered_skip_blocks(
+      iterator, process_iterator->first(process_iterator));
+}
+
+
+static YR_MEMORY_BLOCK* filtered_next_block(
+    YR_MEMORY_BLOCK_ITERATOR* iterator)
+{
+  FILTERED_ITERATOR_CTX* context = (FILTERED_ITERATOR_CTX*) iterator->context;
+  YR_MEMORY_BLOCK_ITERATOR* process_iterator = context->process_iterator;
+
+  return filtered_skip_blocks(
+      iterator, process_iterator->next(process_iterator));
+}
+
+
+// Reads /proc/<pid>/maps and fills the job's region table with the regions
+// accepted by region_filter (all of them if region_filter is NULL). A Python
+// dictionary describing each accepted region is appended to region_list.
+// Must be called with the GIL held.
+
+static int read_process_regions(
+    PROCESS_SCAN_JOB* job,
+    PyObject* region_filter,
+    PyObject* region_list)
+{
+  char buffer[PATH_MAX + 128];
+  char perms[5];
+
+  uint64_t begin, end, offset, inode;
+  unsigned int dev_major, dev_minor;
+  int path_start;
+
+  size_t capacity = 0;
+  FILE* maps;
+
+  snprintf(buffer, sizeof(buffer), "/proc/%d/maps", job->pid);
+  maps = fopen(buffer, "r");
+
+  if (maps == NULL)
+    return ERROR_COULD_NOT_ATTACH_TO_PROCESS;
+
+  while (fgets(buffer, sizeof(buffer), maps) != NULL)
+  {
+    PyObject* region;
+    char* path;
+    char* p = strrchr(buffer, '\n');
+    int keep = 1;
+
+    if (p != NULL)
+      *p = '\0';
+
+    if (sscanf(
+            buffer,
+            "%" SCNx64 "-%" SCNx64 " %4s %" SCNx64 " %x:%x %" SCNu64 " %n",
+            &begin,
+            &end,
+            perms,
+            &offset,
+            &dev_major,
+            &dev_minor,
+            &inode,
+            &path_start) != 7)
+      continue;
+
+    path = buffer + path_start;
+
+    region = Py_BuildValue(
+        "{s:K,s:K,s:s,s:s}",
+        "base", (unsigned PY_LONG_LONG) begin,
+        "size", (unsigned PY_LONG_LONG) (end - begin),
+        "perms", perms,
+        "path", path);
+
+    if (region == NULL)
+    {
+      fclose(maps);
+      return ERROR_INSUFFICIENT_MEMORY;
+    }
+
+    if (region_filter != NULL && region_filter != Py_None)
+    {
+      PyObject* result = PyObject_CallFunctionObjArgs(
+          region_filter, region, NULL);
+
+      keep = (result != NULL) ? PyObject_IsTrue(result) : -1;
+      Py_XDECREF(result);
+    }
+
+    if (keep == 1)
+    {
+      if (job->num_regions == capacity)
+      {
+        PROCESS_REGION* regions;
+
+        capacity = (capacity == 0) ? 64 : capacity * 2;
+        regions = (PROCESS_REGION*) PyMem_Realloc(
+            job->regions, capacity * sizeof(PROCESS_REGION));
+
+        if (regions == NULL)
+        {
+          Py_DECREF(region);
+          fclose(maps);
+          return ERROR_INSUFFICIENT_MEMORY;
+        }
+
+        job->regions = regions;
+      }
+
+      job->regions[job->num_regions].base = begin;
+      job->regions[job->num_regions].size = end - begin;
+      job->num_regions++;
+
+      if (PyList_Append(region_list, region) != 0)
+        keep = -1;
+    }
+
+    Py_DECREF(region);
+
+    if (keep == -1)
+    {
+      fclose(maps);
+      return ERROR_CALLBACK_ERROR;
+    }
+  }
+
+  fclose(maps);
+
+  return ERROR_SUCCESS;
+}
+
+
+static void process_scan_worker(
+    void* arg)
+{
+  PROCESS_SCAN_WORKER* worker = (PROCESS_SCAN_WORKER*) arg;
+  PROCESS_SCAN* scan = worker->scan;
+  PROCESS_SCAN_JOB* job;
+
+  YR_MEMORY_BLOCK_ITERATOR process_iterator;
+  YR_MEMORY_BLOCK_ITERATOR iterator;
+  FILTERED_ITERATOR_CTX context;
+
+  // Callbacks that need the GIL, like the ones for warnings, use a thread
+  // state of the interpreter that called match_processes().
+  PyThreadState* thread_state = PyThreadState_New(scan->interpreter);
+
+  bool measured;
+  double scan_started;
+
+  int last_worker;
+
+  while (1)
+  {
+    PyThread_acquire_lock(scan->lock, WAIT_LOCK);
+
+    if (scan->next_job < scan->num_jobs)
+      job = &scan->jobs[scan->next_job++];
+    else
+      job = NULL;
+
+    PyThread_release_lock(scan->lock);
+
+    if (job == NULL)
+      break;
+
+    if (job->error != ERROR_SUCCESS)
+      continue;
+
+    if (thread_state == NULL)
+    {
+      job->error = ERROR_INSUFFICIENT_MEMORY;
+      continue;
+    }
+
+    job->error = yr_process_open_iterator(job->pid, &process_iterator);
+
+    if (job->error != ERROR_SUCCESS)
+      continue;
+
+    context.process_iterator = &process_iterator;
+    context.job = job;
+
+    iterator.context = &context;
+    iterator.first = filtered_first_block;
+    iterator.next = filtered_next_block;
+    iterator.file_size = NULL;
+    iterator.last_error = ERROR_SUCCESS;
+
+    job->callback_data.thread_state = thread_state;
+
+    yr_scanner_set_callback(worker->scanner, yara_callback, &job->callback_data);
+
+    measured = metrics_enabled != 0;
+    scan_started = measured ? monotonic_time() : 0;
+
+    job->error = yr_scanner_scan_mem_blocks(worker->scanner, &iterator);
+
+    // The size of a process is unknown, it doesn't count as scanned bytes.
+    if (measured)
+      metrics_record_scan(0, monotonic_time() - scan_started, job->error);
+
+    if (job->error == ERROR_CALLBACK_ERROR &&
+        job->results.error != ERROR_SUCCESS)
+      job->error = job->results.error;
+
+    yr_process_close_iterator(&process_iterator);
+  }
+
+  if (thread_state != NULL)
+  {
+    PyEval_RestoreThread(thread_state);
+    PyThreadState_Clear(thread_state);
+    PyThreadState_DeleteCurrent();
+  }
+
+  PyThread_acquire_lock(scan->lock, WAIT_LOCK);
+  last_worker = (--scan->running_workers == 0);
+  PyThread_release_lock(scan->lock);
+
+  // Once "done" is released the thread waiting for the workers may free the
+  // PROCESS_SCAN structure, so it must be the very last thing we touch.
+
+  if (last_worker)
+    PyThread_release_lock(scan->done);
+}
+
+
+// Builds the dictionary returned for a single process by match_processes(),
+// attributing every string match to the memory region it was found in.
+
+static PyObject* process_scan_result(
+    YARA_STATE* state,
+    PROCESS_SCAN_JOB* job,
+    PyObject* region_list)
+{
+  PyObject* result;
+  PyObject* regions;
+  PyObject* error = Py_None;
+  PyObject* type = NULL;
+  PyObject* traceback = NULL;
+
+  Py_ssize_t i, j;
+
+  regions = PyList_New(0);
+
+  if (regions == NULL)
+    return NULL;
+
+  Py_INCREF(error);
+
+  if (job->error != ERROR_SUCCESS)
+  {
+    Py_DECREF(error);
+    handle_error(state, job->error, "<proc>");
+    PyErr_Fetch(&type, &error, &traceback);
+    PyErr_NormalizeException(&type, &error, &traceback);
+    Py_XDECREF(type);
+    Py_XDECREF(traceback);
+  }
+  else
+  {
+    for (i = 0; i < PyList_Size(job->callback_data.matches); i++)
+    {
+      Match* match = (Match*) PyList_GetItem(job->callback_data.matches, i);
+
+      for (j = 0; j < PyList_Size(match->strings); j++)
+      {
+        PyObject* string = PyList_GetItem(match->strings, j);
+        PyObject* region_strings;
+        PyObject* hit;
+        PROCESS_REGION* region = find_process_region(
+            job->regions,
+            job->num_regions,
+            PyLong_AsUnsignedLongLongMask(PyTuple_GetItem(string, 0)));
+
+        if (region == NULL)
+          continue;
+
+        PyObject* region_dict = PyList_GetItem(
+            region_list, region - job->regions);
+
+        region_strings = PyDict_GetItemString(region_dict, "strings");
+
+        if (region_strings == NULL)
+        {
+          region_strings = PyList_New(0);
+          PyDict_SetItemString(region_dict, "strings", region_strings);
+          PyList_Append(regions, region_dict);
+          Py_DECREF(region_strings);
+        }
+
+        hit = Py_BuildValue(
+            "(OOO)",
+            PyTuple_GetItem(string, 0),
+            match->rule,
+            PyTuple_GetItem(string, 1));
+
+        PyList_Append(region_strings, hit);
+        Py_DECREF(hit);
+      }
+    }
+  }
+
+  result = Py_BuildValue(
+      "{s:i,s:O,s:O,s:O}",
+      "pid", job->pid,
+      "matches", job->callback_data.matches,
+      "regions", regions,
+      "error", error);
+
+  Py_DECREF(regions);
+  Py_XDECREF(error);
+
+  return result;
+}
+
+#endif
+
+
+static PyObject* Rules_match_processes(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+#if defined(USE_LINUX_PROC)
+  static char* kwlist[] = {
+      "pids", "workers", "region_filter", "externals", "fast", "timeout", NULL
+      };
+
+  PyObject* pids = NULL;
+  PyObject* pid_list = NULL;
+  PyObject* region_filter = NULL;
+  PyObject* region_lists = NULL;
+  PyObject* externals = NULL;
+  PyObject* fast = NULL;
+  PyObject* results = NULL;
+
+  PROCESS_SCAN scan = {0};
+  PROCESS_SCAN_WORKER* workers = NULL;
+
+  Rules* object = (Rules*) self;
+
+  YARA_STATE* state = get_type_state(Py_TYPE(self));
+
+  Py_ssize_t i;
+
+  int num_workers = 1;
+  int started = 0;
+  int timeout = 0;
+  int flags = SCAN_FLAGS_PROCESS_MEMORY;
+
+  if (!PyArg_ParseTupleAndKeywords(
+        args,
+        keywords,
+        "O|iOOOi",
+        kwlist,
+        &pids,
+        &num_workers,
+        &region_filter,
+        &externals,
+        &fast,
+        &timeout))
+  {
+    return NULL;
+  }
+
+  if (num_workers < 1)
+    return PyErr_Format(
+        PyExc_ValueError,
+        "'workers' must be greater than zero");
+
+  if (region_filter != NULL &&
+      region_filter != Py_None &&
+      !PyCallable_Check(region_filter))
+    return PyErr_Format(
+        PyExc_TypeError,
+        "'region_filter' must be callable");
+
+  if (externals != NULL && externals != Py_None && !PyDict_Check(externals))
+    return PyErr_Format(
+        PyExc_TypeError,
+        "'externals' must be a dictionary");
+
+  if (fast != NULL && PyObject_IsTrue(fast) == 1)
+    flags |= SCAN_FLAGS_FAST_MODE;
+
+  flags |= SCAN_FLAGS_REPORT_RULES_MATCHING;
+
+  pid_list = PySequence_List(pids);
+
+  if (pid_list == NULL)
+    return NULL;
+
+  scan.num_jobs = (size_t) PyList_Size(pid_list);
+  scan.jobs = (PROCESS_SCAN_JOB*) PyMem_Malloc(
+      (scan.num_jobs + 1) * sizeof(PROCESS_SCAN_JOB));
+
+  region_lists = PyList_New(0);
+
+  if (scan.jobs == NULL || region_lists == NULL)
+  {
+    PyErr_NoMemory();
+    goto _exit;
+  }
+
+  memset(scan.jobs, 0, (scan.num_jobs + 1) * sizeof(PROCESS_SCAN_JOB));
+
+  // Region filtering, and everything else involving Python objects, happens
+  // here while holding the GIL. Worker threads only touch C structures.
+
+  for (i = 0; i < (Py_ssize_t) scan.num_jobs; i++)
+  {
+    PROCESS_SCAN_JOB* job = &scan.jobs[i];
+    PyObject* region_list = PyList_New(0);
+
+    job->callback_data.state = state;
+    job->callback_data.matches = PyList_New(0);
+    job->callback_data.which = CALLBACK_ALL;
+    job->callback_data.results = &job->results;
+
+    if (region_list == NULL || job->callback_data.matches == NULL)
+    {
+      Py_XDECREF(region_list);
+      PyErr_NoMemory();
+      goto _exit;
+    }
+
+    PyList_Append(region_lists, region_list);
+    Py_DECREF(region_list);
+
+    job->pid = (int) PyLong_AsLong(PyList_GetItem(pid_list, i));
+
+    if (job->pid == -1 && PyErr_Occurred())
+      goto _exit;
+
+    job->error = read_process_regions(job, region_filter, region_list);
+
+    if (job->error == ERROR_CALLBACK_ERROR ||
+        job->error == ERROR_INSUFFICIENT_MEMORY)
+    {
+      if (!PyErr_Occurred())
+        PyErr_NoMemory();
+
+      goto _exit;
+    }
+  }
+
+  if ((size_t) num_workers > scan.num_jobs)
+    num_workers = (int) scan.num_jobs;
+
+  workers = (PROCESS_SCAN_WORKER*) PyMem_Malloc(
+      (num_workers + 1) * sizeof(PROCESS_SCAN_WORKER));
+
+  if (workers == NULL)
+  {
+    PyErr_NoMemory();
+    goto _exit;
+  }
+
+  memset(workers, 0, (num_workers + 1) * sizeof(PROCESS_SCAN_WORKER));
+
+  for (i = 0; i < num_workers; i++)
+  {
+    workers[i].scan = &scan;
+
+    if (yr_scanner_create(object->rules, &workers[i].scanner) != 0)
+    {
+      PyErr_Format(PyExc_Exception, "could not create scanner");
+      goto _exit;
+    }
+
+    if (externals != NULL && externals != Py_None &&
+        process_match_externals(state, externals, workers[i].scanner) != ERROR_SUCCESS)
+      goto _exit;
+
+    yr_scanner_set_flags(workers[i].scanner, flags);
+    yr_scanner_set_timeout(workers[i].scanner, timeout);
+  }
+
+  scan.lock = PyThread_allocate_lock();
+  scan.done = PyThread_allocate_lock();
+  scan.interpreter = PyThreadState_Get()->interp;
+
+  // Before Python 3.7 the GIL isn't created until some thread is started
+  // from Python, and worker threads need it for their thread states.
+  #if PY_VERSION_HEX < 0x03070000
+  PyEval_InitThreads();
+  #endif
+
+  if (scan.lock == NULL || scan.done == NULL)
+  {
+    PyErr_NoMemory();
+    goto _exit;
+  }
+
+  if (num_workers > 0)
+  {
+    PyThread_acquire_lock(scan.done, WAIT_LOCK);
+
+    scan.running_workers = num_workers;
+
+    for (started = 0; started < num_workers; started++)
+    {
+      if (PyThread_start_new_thread(
+            process_scan_worker, &workers[started]) == PYTHREAD_INVALID_THREAD_ID)
+        break;
+    }
+
+    // If some thread couldn't be started, account for it as if it had already
+    // finished. Threads already running will take care of the pending jobs.
+
+    PyThread_acquire_lock(scan.lock, WAIT_LOCK);
+    scan.running_workers -= num_workers - started;
+
+    if (scan.running_workers == 0)
+      PyThread_release_lock(scan.done);
+
+    PyThread_release_lock(scan.lock);
+
+    if (started == 0)
+    {
+      PyErr_Format(state->YaraError, "could not start scanning threads");
+      goto _exit;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    PyThread_acquire_lock(scan.done, WAIT_LOCK);
+    Py_END_ALLOW_THREADS
+
+    PyThread_release_lock(scan.done);
+  }
+
+  results = PyList_New(0);
+
+  if (results == NULL)
+    goto _exit;
+
+  for (i = 0; i < (Py_ssize_t) scan.num_jobs; i++)
+  {
+    PyObject* result = NULL;
+
+    if (scan.jobs[i].error != ERROR_SUCCESS ||
+        scan_results_to_matches(
+            &scan.jobs[i].results,
+            &scan.jobs[i].callback_data,
+            scan.jobs[i].callback_data.matches))
+      result = process_scan_result(
+          state,
+          &scan.jobs[i], PyList_GetItem(region_lists, i));
+
+    if (result == NULL || PyList_Append(results, result) != 0)
+    {
+      Py_XDECREF(result);
+      Py_CLEAR(results);
+      goto _exit;
+    }
+
+    Py_DECREF(result);
+  }
+
+_exit:
+
+  if (workers != NULL)
+  {
+    for (i = 0; i < num_workers; i++)
+    {
+      if (workers[i].scanner != NULL)
+        yr_scanner_destroy(workers[i].scanner);
+    }
+
+    PyMem_Free(workers);
+  }
+
+  if (scan.jobs != NULL)
+  {
+    for (i = 0; i < (Py_ssize_t) scan.num_jobs; i++)
+    {
+      Py_XDECREF(scan.jobs[i].callback_data.matches);
+      PyMem_Free(scan.jobs[i].regions);
+      scan_results_destroy(&scan.jobs[i].results);
+    }
+
+    PyMem_Free(scan.jobs);
+  }
+
+  if (scan.lock != NULL)
+    PyThread_free_lock(scan.lock);
+
+  if (scan.done != NULL)
+    PyThread_free_lock(scan.done);
+
+  Py_XDECREF(region_lists);
+  Py_XDECREF(pid_list);
+
+  return results;
+#else
+  return PyErr_Format(
+      get_type_state(Py_TYPE(self))->YaraError,
+      "match_processes() is only supported on Linux");
+#endif
+}
+
+
+// Calls function_name() in the Python module module_name with the Rules object
+// as first argument followed by "args". Used by the methods implemented in
+// the Python modules distributed with yara-python.
+
+static PyObject* call_python_method(
+    const char* module_name,
+    const char* function_name,
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  PyObject* module;
+  PyObject* function;
+  PyObject* self_tuple;
+  PyObject* function_args;
+  PyObject* result;
+
+  module = PyImport_ImportModule(module_name);
+
+  if (module == NULL)
+    return NULL;
+
+  function = PyObject_GetAttrString(module, function_name);
+  Py_DECREF(module);
+
+  if (function == NULL)
+    return NULL;
+
+  self_tuple = PyTuple_Pack(1, self);
+  function_args = self_tuple != NULL ?
+      PySequence_Concat(self_tuple, args) : NULL;
+
+  result = function_args != NULL ?
+      PyObject_Call(function, function_args, keywords) : NULL;
+
+  Py_XDECREF(self_tuple);
+  Py_XDECREF(function_args);
+  Py_DECREF(function);
+
+  return result;
+}
+
+
+// Scans the members of an archive. Reading archives relies on the zipfile,
+// tarfile, gzip, bz2 and lzma modules, so it's implemented in Python by
+// match_archive() in yara_archive.py.
+
+static PyObject* Rules_match_archive(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  return call_python_method(
+      "yara_archive", "match_archive", self, args, keywords);
+}
+
+
+// Returns a yara_follow.Follower that scans the data appended to a file since
+// the previous scan, implemented in yara_follow.py on top of match(ranges=).
+
+static PyObject* Rules_follow(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  return call_python_method("yara_follow", "Follower", self, args, keywords);
+}
+
+
+// Edge in the graph of rules referenced from other rules' conditions.
+
+typedef struct _RULE_DEPENDENCY
+{
+  uint32_t rule_idx;
+  uint32_t dependency_idx;
+
+} RULE_DEPENDENCY;
+
+
+// Returns the size of the operands that follow "opcode" in the code emitted
+// by the compiler, or -1 if the opcode is unknown.
+
+static int opcode_operands_size(
+    uint8_t opcode)
+{
+  switch (opcode)
+  {
+  case OP_PUSH_8:
+    return sizeof(uint8_t);
+
+  case OP_PUSH_16:
+    return sizeof(uint16_t);
+
+  case OP_PUSH_32:
+  case OP_JUNDEF:
+  case OP_JUNDEF_P:
+  case OP_JNUNDEF:
+  case OP_JNUNDEF_P:
+  case OP_JFALSE:
+  case OP_JFALSE_P:
+  case OP_JTRUE:
+  case OP_JTRUE_P:
+  case OP_JL_P:
+  case OP_JLE_P:
+  case OP_JZ:
+  case OP_JZ_P:
+    return sizeof(int32_t);
+
+  case OP_INIT_RULE:
+    return sizeof(int32_t) + sizeof(uint32_t);
+
+  case OP_PUSH:
+  case OP_CALL:
+  case OP_OBJ_LOAD:
+  case OP_OBJ_FIELD:
+  case OP_OF:
+  case OP_OF_PERCENT:
+  case OP_PUSH_RULE:
+  case OP_MATCH_RULE:
+  case OP_INCR_M:
+  case OP_CLEAR_M:
+  case OP_ADD_M:
+  case OP_POP_M:
+  case OP_PUSH_M:
+  case OP_SET_M:
+  case OP_SWAPUNDEF:
+  case OP_IMPORT:
+  case OP_INT_TO_DBL:
+    return sizeof(uint64_t);
+
+  case OP_AND:
+  case OP_OR:
+  case OP_NOT:
+  case OP_BITWISE_NOT:
+  case OP_BITWISE_AND:
+  case OP_BITWISE_OR:
+  case OP_BITWISE_XOR:
+  case OP_SHL:
+  case OP_SHR:
+  case OP_MOD:
+  case OP_STR_TO_BOOL:
+  case OP_POP:
+  case OP_OBJ_VALUE:
+  case OP_INDEX_ARRAY:
+  case OP_COUNT:
+  case OP_COUNT_IN:
+  case OP_LENGTH:
+  case OP_FOUND:
+  case OP_FOUND_AT:
+  case OP_FOUND_IN:
+  case OP_OFFSET:
+  case OP_OF_FOUND_IN:
+  case OP_FILESIZE:
+  case OP_ENTRYPOINT:
+  case OP_MATCHES:
+  case OP_LOOKUP_DICT:
+  case OP_ITER_NEXT:
+  case OP_ITER_START_ARRAY:
+  case OP_ITER_START_DICT:
+  case OP_ITER_START_INT_RANGE:
+  case OP_ITER_START_INT_ENUM:
+  case OP_PUSH_U:
+  case OP_CONTAINS:
+  case OP_STARTSWITH:
+  case OP_ENDSWITH:
+  case OP_ICONTAINS:
+  case OP_ISTARTSWITH:
+  case OP_IENDSWITH:
+  case OP_IEQUALS:
+  case OP_DEFINED:
+  case OP_NOP:
+    return 0;
+  }
+
+  if ((opcode >= OP_INT_BEGIN && opcode <= OP_INT_END) ||
+      (opcode >= OP_DBL_BEGIN && opcode <= OP_DBL_END) ||
+      (opcode >= OP_STR_BEGIN && opcode <= OP_STR_END) ||
+      (opcode >= OP_READ_INT && opcode <= OP_UINT32BE))
+    return 0;
+
+  return -1;
+}
+
+
+// Walks the code of every rule looking for OP_PUSH_RULE instructions, which
+// are emitted when a condition references another rule. Returns false if the
+// code contains something this function doesn't understand, in that case
+// "dependencies" is left empty.
+
+static bool find_rule_dependencies(
+    YR_RULES* rules,
+    RULE_DEPENDENCY** dependencies,
+    size_t* count)
+{
+  const uint8_t* ip = rules->code_start;
+  const uint8_t* end = ip + rules->arena->buffers[YR_CODE_SECTION].used;
+
+  size_t capacity = 0;
+  uint32_t rule_idx = UINT32_MAX;
+
+  *dependencies = NULL;
+  *count = 0;
+
+  while (ip < end && *ip != OP_HALT)
+  {
+    uint8_t opcode = *ip++;
+    int operands_size = opcode_operands_size(opcode);
+
+    if (operands_size < 0 || ip + operands_size > end)
+      goto _fail;
+
+    if (opcode == OP_INIT_RULE)
+    {
+      memcpy(&rule_idx, ip + sizeof(int32_t), sizeof(uint32_t));
+    }
+    else if (opcode == OP_PUSH_RULE)
+    {
+      uint64_t dependency_idx;
+
+      memcpy(&dependency_idx, ip, sizeof(uint64_t));
+
+      if (rule_idx >= rules->num_rules || dependency_idx >= rules->num_rules)
+        goto _fail;
+
+      if (!grow_array(
+              (void**) dependencies,
+              &capacity,
+              *count + 1,
+              sizeof(RULE_DEPENDENCY)))
+        goto _fail;
+
+      (*dependencies)[*count].rule_idx = rule_idx;
+      (*dependencies)[*count].dependency_idx = (uint32_t) dependency_idx;
+      (*count)++;
+    }
+
+    ip += operands_size;
+  }
+
+  if (ip < end)
+    return true;
+
+_fail:
+
+  free(*dependencies);
+
+  *dependencies = NULL;
+  *count = 0;
+
+  return false;
+}
+
+
+// Re-enables the disabled rules that some enabled rule depends on, directly
+// or indirectly, flagging them as dependencies so that they are evaluated but
+// not reported. If the dependencies can't be determined every disabled rule
+// is kept that way, which is slower but still correct.
+
+static void keep_rule_dependencies(
+    YR_RULES* rules)
+{
+  RULE_DEPENDENCY* dependencies;
+  YR_RULE* rule;
+
+  size_t count;
+  size_t i;
+  bool changed = true;
+
+  if (!find_rule_dependencies(rules, &dependencies, &count))
+  {
+    yr_rules_foreach(rules, rule)
+    {
+      if (RULE_IS_DISABLED(rule))
+      {
+        rule->flags &= ~RULE_FLAGS_DISABLED;
+
+        if (!RULE_IS_PRIVATE(rule))
+          rule->flags |= RULE_FLAGS_PRIVATE | RULE_FLAGS_DEPENDENCY;
+      }
+    }
+
+    return;
+  }
+
+  while (changed)
+  {
+    changed = false;
+
+    for (i = 0; i < count; i++)
+    {
+      YR_RULE* dependent = &rules->rules_table[dependencies[i].rule_idx];
+
+      rule = &rules->rules_table[dependencies[i].dependency_idx];
+
+      if (!RULE_IS_DISABLED(dependent) && RULE_IS_DISABLED(rule))
+      {
+        rule->flags &= ~RULE_FLAGS_DISABLED;
+
+        if (!RULE_IS_PRIVATE(rule))
+          rule->flags |= RULE_FLAGS_PRIVATE | RULE_FLAGS_DEPENDENCY;
+
+        changed = true;
+      }
+    }
+  }
+
+  free(dependencies);
+}
+
+
+// Returns true if the string obtained from PY_STRING_TO_C matches some of the
+// items in "sequence", which must be the result of PySequence_Fast.
+
+static bool sequence_contains_string(
+    PyObject* sequence,
+    const char* string)
+{
+  Py_ssize_t i;
+
+  for (i = 0; i < PySequence_Fast_GET_SIZE(sequence); i++)
+  {
+    const char* item = PY_STRING_TO_C(PySequence_Fast_GET_ITEM(sequence, i));
+
+    if (item != NULL && strcmp(item, string) == 0)
+      return true;
+  }
+
+  return false;
+}
+
+
+static PyObject* Rules_select(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  static char* kwlist[] = {
+      "tags", "namespaces", "identifiers", NULL
+      };
+
+  PyObject* arguments[3] = {NULL, NULL, NULL};
+  PyObject* sequences[3] = {NULL, NULL, NULL};
+
+  Rules* object = (Rules*) self;
+  Rules* view = NULL;
+
+  YR_RULES* rules = object->rules;
+  YR_RULE* rule;
+
+  uint8_t* selected_namespaces = NULL;
+  const char* tag;
+  char qualified_name[1024];
+
+  int i;
+  Py_ssize_t j;
+
+  if (!PyArg_ParseTupleAndKeywords(
+        args,
+        keywords,
+        "|OOO",
+        kwlist,
+        &arguments[0],
+        &arguments[1],
+        &arguments[2]))
+  {
+    return NULL;
+  }
+
+  for (i = 0; i < 3; i++)
+  {
+    if (arguments[i] == NULL || arguments[i] == Py_None)
+      continue;
+
+    sequences[i] = PySequence_Fast(
+        arguments[i], "select() arguments must be iterables of strings");
+
+    if (sequences[i] == NULL)
+      goto _exit;
+
+    for (j = 0; j < PySequence_Fast_GET_SIZE(sequences[i]); j++)
+    {
+      if (!PY_STRING_CHECK(PySequence_Fast_GET_ITEM(sequences[i], j)))
+      {
+        PyErr_Format(
+            PyExc_TypeError,
+            "select() arguments must be iterables of strings");
+        goto _exit;
+      }
+    }
+  }
+
+  view = Rules_NEW(get_type_state(Py_TYPE(self)));
+
+  if (view == NULL)
+    goto _exit;
+
+  // The parent is kept alive as long as the view exists.
+
+  view->parent = self;
+  Py_INCREF(self);
+
+  view->warnings = object->warnings;
+  Py_XINCREF(view->warnings);
+
+  view->rules = create_rules_view(rules);
+  selected_namespaces = (uint8_t*) PyMem_Malloc(rules->num_namespaces + 1);
+
+  if (view->rules == NULL || selected_namespaces == NULL)
+  {
+    PyErr_NoMemory();
+    goto _exit;
+  }
+
+  memset(selected_namespaces, 0, rules->num_namespaces + 1);
+
+  // Rules are disabled by setting RULE_FLAGS_DISABLED in the private table,
+  // just like yr_rule_disable does. yr_rule_disable itself can't be used
+  // because it also flags the rule's strings, which are shared with the
+  // parent and any other view.
+
+  yr_rules_foreach(view->rules, rule)
+  {
+    bool selected = true;
+
+    // When selecting from a view the rules it only keeps as dependencies are
+    // not part of its selection, they are enabled again below if needed.
+
+    if (RULE_IS_DEPENDENCY(rule))
+    {
+      rule->flags &= ~(RULE_FLAGS_PRIVATE | RULE_FLAGS_DEPENDENCY);
+      rule->flags |= RULE_FLAGS_DISABLED;
+      continue;
+    }
+
+    if (RULE_IS_DISABLED(rule) || RULE_IS_PRIVATE(rule) || RULE_IS_GLOBAL(rule))
+      continue;
+
+    if (sequences[0] != NULL)
+    {
+      bool has_tag = false;
+
+      yr_rule_tags_foreach(rule, tag)
+      {
+        if (sequence_contains_string(sequences[0], tag))
+          has_tag = true;
+      }
+
+      selected = has_tag;
+    }
+
+    if (sequences[1] != NULL &&
+        !sequence_contains_string(sequences[1], rule->ns->name))
+      selected = false;
+
+    if (sequences[2] != NULL)
+    {
+      snprintf(
+          qualified_name,
+          sizeof(qualified_name),
+          "%s:%s",
+          rule->ns->name,
+          rule->identifier);
+
+      if (!sequence_contains_string(sequences[2], rule->identifier) &&
+          !sequence_contains_string(sequences[2], qualified_name))
+        selected = false;
+    }
+
+    if (selected)
+      selected_namespaces[rule->ns->idx] = 1;
+    else
+      rule->flags |= RULE_FLAGS_DISABLED;
+  }
+
+  // Private rules may be referenced from the conditions of selected rules and
+  // global rules constrain every rule in their namespace, so they are kept
+  // unless their namespace doesn't have any selected rule.
+
+  yr_rules_foreach(view->rules, rule)
+  {
+    if ((RULE_IS_PRIVATE(rule) || RULE_IS_GLOBAL(rule)) &&
+        !selected_namespaces[rule->ns->idx])
+      rule->flags |= RULE_FLAGS_DISABLED;
+  }
+
+  // Rules referenced from the condition of a kept rule must still be
+  // evaluated, otherwise the condition would see them as undefined.
+
+  keep_rule_dependencies(view->rules);
+
+_exit:
+
+  for (i = 0; i < 3; i++)
+    Py_XDECREF(sequences[i]);
+
+  PyMem_Free(selected_namespaces);
+
+  if (PyErr_Occurred() != NULL)
+  {
+    Py_XDECREF(view);
+    return NULL;
+  }
+
+  return (PyObject*) view;
+}
+
+
+static PyObject* Rules_save(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  static char* kwlist[] = {
+      "filepath", "file",  NULL
+      };
+
+  char* filepath = NULL;
+  PyObject* file = NULL;
+  Rules* rules = (Rules*) self;
+
+  YARA_STATE* state = get_type_state(Py_TYPE(self));
+
+  int error;
+
+  if (!PyArg_ParseTupleAndKeywords(
+      args,
+      keywords,
+      "|sO",
+      kwlist,
+      &filepath,
+      &file))
+  {
+    return NULL;
+  }
+
+  if (rules->parent != NULL)
+  {
+    return PyErr_Format(
+      state->YaraError,
+      "rules returned by select() can't be saved");
+  }
+
+  if (filepath != NULL)
+  {
+    YR_STREAM stream;
+
+    Py_BEGIN_ALLOW_THREADS
+
+    FILE* fh = fopen(filepath, "wb");
+
+    if (fh != NULL)
+    {
+      stream.user_data = fh;
+      stream.write = (YR_STREAM_WRITE_FUNC) fwrite;
+
+      error = save_rules_stream(rules->rules, &stream);
+      fclose(fh);
+    }
+    else
+    {
+      error = ERROR_COULD_NOT_OPEN_FILE;
+    }
+
+    Py_END_ALLOW_THREADS
+
+    if (error != ERROR_SUCCESS)
+      return handle_error(state, error, filepath);
+  }
+  else if (file != NULL && PyObject_HasAttrString(file, "write"))
+  {
+    YR_STREAM stream;
+    STREAM_DATA stream_data;
+
+    stream_data.file = file;
+    stream.user_data = &stream_data;
+    stream.write = flo_write;
+
+    stream_data.thread_state = PyEval_SaveThread();
+    error = save_rules_stream(rules->rules, &stream);
+    PyEval_RestoreThread(stream_data.thread_state);
+
+    if (error != ERROR_SUCCESS)
+      return handle_error(state, error, "<file-like-object>");
+  }
+  else
+  {
+    return PyErr_Format(
+      PyExc_TypeError,
+      "load() expects either a file path or a file-like object");
+  }
+
+  Py_RETURN_NONE;
+}
+
+
+static PyObject* Rules_profiling_info(
+    PyObject* self,
+    PyObject* args)
+{
+
+#ifdef PROFILING_ENABLED
+  PyObject* object;
+  PyObject* result;
+
+  YR_RULES* rules = ((Rules*) self)->rules;
+  YR_RULE* rule;
+  YR_STRING* string;
+
+  char key[512];
+  uint64_t clock_ticks;
+
+  result = PyDict_New();
+
+  yr_rules_foreach(rules, rule)
+  {
+    clock_ticks = rule->clock_ticks;
+
+    yr_rule_strings_foreach(rule, string)
+    {
+      clock_ticks += string->clock_ticks;
+    }
+
+    snprintf(key, sizeof(key), "%s:%s", rule->ns->name, rule->identifier);
+
+    object = PyLong_FromLongLong(clock_ticks);
+    PyDict_SetItemString(result, key, object);
+    Py_DECREF(object);
+  }
+
+  return result;
+#else
+  return PyErr_Format(
+      get_type_state(Py_TYPE(self))->YaraError,
+      "libyara compiled without profiling support");
+#endif
+}
+
+
+// An atom found in the Aho-Corasick automaton, together with the string it
+// belongs to and how many bytes before the atom the string starts.
+
+typedef struct
+{
+  uint32_t string_idx;
+  uint16_t backtrack;
+  YR_ATOM atom;
+
+} ATOM_ENTRY;
+
+
+typedef struct
+{
+  ATOM_ENTRY* entries;
+  size_t count;
+  size_t capacity;
+
+} ATOM_ENTRIES;
+
+
+static int compare_atom_entries(
+    const void* a,
+    const void* b)
+{
+  const ATOM_ENTRY* entry_a = (const ATOM_ENTRY*) a;
+  const ATOM_ENTRY* entry_b = (const ATOM_ENTRY*) b;
+  int result;
+
+  if (entry_a->string_idx != entry_b->string_idx)
+    return entry_a->string_idx < entry_b->string_idx ? -1 : 1;
+
+  if (entry_a->backtrack != entry_b->backtrack)
+    return entry_a->backtrack < entry_b->backtrack ? -1 : 1;
+
+  if (entry_a->atom.length != entry_b->atom.length)
+    return entry_a->atom.length < entry_b->atom.length ? -1 : 1;
+
+  result = memcmp(entry_a->atom.bytes, entry_b->atom.bytes, YR_MAX_ATOM_LENGTH);
+
+  if (result != 0)
+    return result;
+
+  return memcmp(entry_a->atom.mask, entry_b->atom.mask, YR_MAX_ATOM_LENGTH);
+}
+
+
+// Walks the Aho-Corasick automaton depth-first starting at "state", which is
+// reached with the bytes in "atom", and records every atom found along with
+// the string it belongs to. Parts of chained strings are attributed to the
+// first string in the chain. Strings without atoms are attached to the root
+// state and get a zero-length atom.
+
+static bool collect_atoms(
+    YR_RULES* rules,
+    uint32_t table_size,
+    uint32_t state,
+    YR_ATOM* atom,
+    ATOM_ENTRIES* entries)
+{
+  YR_AC_TRANSITION transition;
+  YR_AC_MATCH* match;
+  YR_STRING* string;
+  ATOM_ENTRY* entry;
+
+  uint32_t match_index = rules->ac_match_table[state];
+  uint32_t index;
+
+  if (match_index != 0)
+  {
+    match = &rules->ac_match_pool[match_index - 1];
+
+    while (match != NULL)
+    {
+      string = match->string;
+
+      while (string->chained_to != NULL)
+        string = string->chained_to;
+
+      if (!grow_array(
+            (void**) &entries->entries,
+            &entries->capacity,
+            entries->count + 1,
+            sizeof(ATOM_ENTRY)))
+        return false;
+
+      entry = &entries->entries[entries->count++];
+      entry->string_idx = string->idx;
+      entry->backtrack = match->backtrack;
+      entry->atom = *atom;
+
+      match = match->next;
+    }
+  }
+
+  if (atom->length == YR_MAX_ATOM_LENGTH)
+    return true;
+
+  for (index = 1; index <= 256; index++)
+  {
+    if (state + index >= table_size)
+      break;
+
+    transition = rules->ac_transition_table[state + index];
+
+    if (YR_AC_INVALID_TRANSITION(transition, index))
+      continue;
+
+    atom->bytes[atom->length] = (uint8_t) (index - 1);
+    atom->mask[atom->length] = 0xFF;
+    atom->length++;
+
+    if (!collect_atoms(
+          rules, table_size, YR_AC_NEXT_STATE(transition), atom, entries))
+      return false;
+
+    atom->length--;
+  }
+
+  return true;
+}
+
+
+// The compiler replaces atoms with wildcards, like { 01 ?? 03 }, with every
+// concrete atom they can match before adding them to the automaton, so the
+// atoms in the automaton look better than the ones actually chosen. This
+// function receives the atoms for a string with the same length and
+// backtrack and turns them back into wildcards: a byte that takes all of its
+// 256 possible values, while the rest of the atom stays the same, is a ??
+// wildcard, and one that takes the 16 values of a nibble is a X? or ?X
+// wildcard. The atoms that become equal are merged and "count" is updated.
+
+static bool find_atom_wildcards(
+    ATOM_ENTRY* group,
+    size_t* count)
+{
+  const uint8_t keep_bits[] = {0x00, 0xF0, 0x0F};
+  const long expected[] = {256, 16, 16};
+
+  PyObject* counters;
+  PyObject* key;
+  PyObject* value;
+
+  uint8_t bytes[YR_MAX_ATOM_LENGTH];
+  size_t i;
+  size_t j;
+  int position;
+  int k;
+
+  for (position = 0; position < group[0].atom.length; position++)
+  {
+    if (*count < 16)
+      return true;
+
+    for (k = 0; k < 3; k++)
+    {
+      counters = PyDict_New();
+
+      if (counters == NULL)
+        return false;
+
+      // The first pass counts how many atoms are equal once the bits that
+      // may vary are cleared, the second one marks the bytes that take every
+      // possible value. Bytes marked as wildcards in previous rounds are
+      // left alone.
+      for (i = 0; i < *count * 2; i++)
+      {
+        ATOM_ENTRY* entry = &group[i % *count];
+
+        if (entry->atom.mask[position] != 0xFF)
+          continue;
+
+        memcpy(bytes, entry->atom.bytes, YR_MAX_ATOM_LENGTH);
+        bytes[position] &= keep_bits[k];
+
+        key = PyBytes_FromStringAndSize(
+            (const char*) bytes, entry->atom.length);
+
+        if (key == NULL)
+        {
+          Py_DECREF(counters);
+          return false;
+        }
+
+        value = PyDict_GetItem(counters, key);
+
+        if (i < *count)
+        {
+          value = PyLong_FromLong(value == NULL ? 1 : PyLong_AsLong(value) + 1);
+
+          if (value == NULL || PyDict_SetItem(counters, key, value) != 0)
+          {
+            Py_XDECREF(value);
+            Py_DECREF(key);
+            Py_DECREF(counters);
+            return false;
+          }
+
+          Py_DECREF(value);
+        }
+        else if (PyLong_AsLong(value) == expected[k])
+        {
+          entry->atom.mask[position] = keep_bits[k];
+        }
+
+        Py_DECREF(key);
+      }
+
+      Py_DECREF(counters);
+    }
+
+    for (i = 0; i < *count; i++)
+      group[i].atom.bytes[position] &= group[i].atom.mask[position];
+
+    qsort(group, *count, sizeof(ATOM_ENTRY), compare_atom_entries);
+
+    for (i = 1, j = 0; i < *count; i++)
+    {
+      if (compare_atom_entries(&group[i], &group[j]) != 0)
+        group[++j] = group[i];
+    }
+
+    *count = j + 1;
+  }
+
+  return true;
+}
+
+
+// Builds the report returned by Rules.analyze(), a list with a dictionary per
+// enabled rule. A string is considered slow when the best quality among its
+// atoms is below "threshold", and a rule is slow if any of its strings is.
+// If "slow_strings" is not NULL a message is appended to it for every slow
+// string, compile() uses them for failing when min_atom_quality is given.
+
+static PyObject* analyze_rules(
+    YR_RULES* rules,
+    int threshold,
+    PyObject* slow_strings)
+{
+  YR_ATOMS_CONFIG config;
+  YR_ATOM atom;
+  YR_RULE* rule;
+  YR_STRING* string;
+
+  ATOM_ENTRIES entries = {NULL, 0, 0};
+  ATOM_ENTRY* entry;
+
+  PyObject* result = NULL;
+  PyObject* rule_dict;
+  PyObject* string_dict;
+  PyObject* string_list;
+  PyObject* object;
+  PyObject** atoms;
+
+  int* min_quality;
+  int rule_min_quality;
+  int quality;
+  size_t group_count;
+  size_t num_entries;
+  size_t i;
+  bool rule_slow;
+  bool slow;
+
+  atoms = (PyObject**) PyMem_Malloc(
+      (rules->num_strings + 1) * sizeof(PyObject*));
+  min_quality = (int*) PyMem_Malloc((rules->num_strings + 1) * sizeof(int));
+
+  if (atoms == NULL || min_quality == NULL)
+  {
+    PyMem_Free(atoms);
+    PyMem_Free(min_quality);
+    return PyErr_NoMemory();
+  }
+
+  for (i = 0; i < rules->num_strings; i++)
+  {
+    atoms[i] = NULL;
+    min_quality[i] = YR_MAX_ATOM_QUALITY + 1;
+  }
+
+  memset(&config, 0, sizeof(config));
+  memset(&atom, 0, sizeof(atom));
+
+  config.get_atom_quality = yr_atoms_heuristic_quality;
+  config.quality_warning_threshold = threshold;
+
+  if (!collect_atoms(
+        rules,
+        (uint32_t) (rules->arena->buffers[YR_AC_TRANSITION_TABLE].used /
+            sizeof(YR_AC_TRANSITION)),
+        YR_AC_ROOT_STATE,
+        &atom,
+        &entries))
+  {
+    PyErr_NoMemory();
+    goto _exit;
+  }
+
+  qsort(entries.entries, entries.count, sizeof(ATOM_ENTRY), compare_atom_entries);
+
+  // Atoms with the same string, backtrack and length come from the same
+  // atom chosen by the compiler, restore its wildcards and keep only one
+  // copy of it.
+  num_entries = 0;
+  i = 0;
+
+  while (i < entries.count)
+  {
+    group_count = 1;
+
+    while (i + group_count < entries.count &&
+           entries.entries[i].string_idx ==
+               entries.entries[i + group_count].string_idx &&
+           entries.entries[i].backtrack ==
+               entries.entries[i + group_count].backtrack &&
+           entries.entries[i].atom.length ==
+               entries.entries[i + group_count].atom.length)
+      group_count++;
+
+    memmove(
+        &entries.entries[num_entries],
+        &entries.entries[i],
+        group_count * sizeof(ATOM_ENTRY));
+
+    i += group_count;
+
+    if (!find_atom_wildcards(&entries.entries[num_entries], &group_count))
+      goto _exit;
+
+    num_entries += group_count;
+  }
+
+  for (i = 0; i < num_entries; i++)
+  {
+    entry = &entries.entries[i];
+    quality = yr_atoms_heuristic_quality(&config, &entry->atom);
+
+    if (atoms[entry->string_idx] == NULL)
+      atoms[entry->string_idx] = PyList_New(0);
+
+    object = Py_BuildValue(
+        "(NNi)",
+        PyBytes_FromStringAndSize(
+            (const char*) entry->atom.bytes, entry->atom.length),
+        PyBytes_FromStringAndSize(
+            (const char*) entry->atom.mask, entry->atom.length),
+        quality);
+
+    if (atoms[entry->string_idx] == NULL || object == NULL ||
+        PyList_Append(atoms[entry->string_idx], object) != 0)
+    {
+      Py_XDECREF(object);
+      goto _exit;
+    }
+
+    Py_DECREF(object);
+
+    if (quality < min_quality[entry->string_idx])
+      min_quality[entry->string_idx] = quality;
+  }
+
+  result = PyList_New(0);
+
+  if (result == NULL)
+    goto _exit;
+
+  yr_rules_foreach(rules, rule)
+  {
+    if (RULE_IS_DISABLED(rule))
+      continue;
+
+    string_list = PyList_New(0);
+    rule_min_quality = YR_MAX_ATOM_QUALITY + 1;
+    rule_slow = false;
+
+    yr_rule_strings_foreach(rule, string)
+    {
+      if (string->chained_to != NULL)
+        continue;
+
+      slow = min_quality[string->idx] < threshold;
+
+      if (atoms[string->idx] == NULL)
+        atoms[string->idx] = PyList_New(0);
+
+      if (min_quality[string->idx] < rule_min_quality)
+        rule_min_quality = min_quality[string->idx];
+
+      if (slow)
+        rule_slow = true;
+
+      if (slow && slow_strings != NULL)
+      {
+        object = PY_STRING_FORMAT(
+            "rule \"%s:%s\": string \"%s\" has atom quality %d, below %d",
+            rule->ns->name,
+            rule->identifier,
+            string->identifier,
+            min_quality[string->idx],
+            threshold);
+
+        if (object != NULL)
+        {
+          PyList_Append(slow_strings, object);
+          Py_DECREF(object);
+        }
+      }
+
+      if (min_quality[string->idx] > YR_MAX_ATOM_QUALITY)
+      {
+        Py_INCREF(Py_None);
+        object = Py_None;
+      }
+      else
+      {
+        object = PyLong_FromLong(min_quality[string->idx]);
+      }
+
+      string_dict = Py_BuildValue(
+          "{s:N,s:O,s:N,s:O}",
+          "identifier", PY_STRING(string->identifier),
+          "atoms", atoms[string->idx],
+          "min_atom_quality", object,
+          "slow", slow ? Py_True : Py_False);
+
+      if (string_dict != NULL)
+      {
+        PyList_Append(string_list, string_dict);
+        Py_DECREF(string_dict);
+      }
+    }
+
+    if (rule_min_quality > YR_MAX_ATOM_QUALITY)
+    {
+      Py_INCREF(Py_None);
+      object = Py_None;
+    }
+    else
+    {
+      object = PyLong_FromLong(rule_min_quality);
+    }
+
+    rule_dict = Py_BuildValue(
+        "{s:N,s:N,s:N,s:O,s:N}",
+        "identifier", PY_STRING(rule->identifier),
+        "namespace", PY_STRING(rule->ns->name),
+        "min_atom_quality", object,
+        "slow", rule_slow ? Py_True : Py_False,
+        "strings", string_list);
+
+    if (rule_dict != NULL)
+    {
+      PyList_Append(result, rule_dict);
+      Py_DECREF(rule_dict);
+    }
+
+    if (PyErr_Occurred() != NULL)
+    {
+      Py_CLEAR(result);
+      break;
+    }
+  }
+
+_exit:
+
+  for (i = 0; i < rules->num_strings; i++)
+    Py_XDECREF(atoms[i]);
+
+  free(entries.entries);
+  PyMem_Free(atoms);
+  PyMem_Free(min_quality);
+
+  return result;
+}
+
+
+static PyObject* Rules_analyze(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  static char* kwlist[] = {"threshold", NULL};
+
+  int threshold = YR_ATOM_QUALITY_WARNING_THRESHOLD;
+
+  if (!PyArg_ParseTupleAndKeywords(
+        args,
+        keywords,
+        "|i",
+        kwlist,
+        &threshold))
+  {
+    return NULL;
+  }
+
+  return analyze_rules(((Rules*) self)->rules, threshold, NULL);
+}
+
+
+// Returns a dictionary describing the memory used by the compiled rules:
+// the size of the arena and each of its sections, the Aho-Corasick tables,
+// the number of rules, strings and atoms, and the "top" rules that take the
+// most memory. The size of a rule accounts for the rule itself, its strings,
+// metadata and entries in the Aho-Corasick match pool, the code for its
+// condition is not included because it can't be attributed to a rule.
+
+static PyObject* Rules_memory_usage(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  static char* kwlist[] = {"top", NULL};
+
+  static const char* section_names[YR_NUM_SECTIONS] = {
+      "namespaces",
+      "rules",
+      "metas",
+      "strings",
+      "externals",
+      "sz_pool",
+      "code",
+      "re_code",
+      "ac_transition_table",
+      "ac_match_table",
+      "ac_match_pool",
+      "summary"};
+
+  YR_RULES* rules = ((Rules*) self)->rules;
+  YR_ARENA* arena = rules->arena;
+  YR_RULE* rule;
+  YR_STRING* string;
+  YR_META* meta;
+  YR_RELOC* reloc;
+
+  const char* tag;
+
+  PyObject* result = NULL;
+  PyObject* sections = NULL;
+  PyObject* largest = NULL;
+  PyObject* object;
+
+  uint64_t* rule_sizes;
+  uint64_t arena_size = 0;
+  uint64_t arena_used = 0;
+  uint64_t relocations = 0;
+  uint64_t num_atoms = 0;
+  uint32_t num_matches;
+  uint32_t i;
+
+  int top = 10;
+
+  if (!PyArg_ParseTupleAndKeywords(
+        args,
+        keywords,
+        "|i",
+        kwlist,
+        &top))
+  {
+    return NULL;
+  }
+
+  if (top < 0)
+    return PyErr_Format(
+        PyExc_ValueError,
+        "'top' must be greater than or equal to zero");
+
+  rule_sizes = (uint64_t*) PyMem_Malloc(
+      (rules->num_rules + 1) * sizeof(uint64_t));
+
+  if (rule_sizes == NULL)
+    return PyErr_NoMemory();
+
+  sections = PyDict_New();
+
+  if (sections == NULL)
+    goto _exit;
+
+  for (i = 0; i < arena->num_buffers && i < YR_NUM_SECTIONS; i++)
+  {
+    arena_size += arena->buffers[i].size;
+    arena_used += arena->buffers[i].used;
+
+    object = PyLong_FromUnsignedLongLong(arena->buffers[i].used);
+
+    if (object == NULL ||
+        PyDict_SetItemString(sections, section_names[i], object) != 0)
+    {
+      Py_XDECREF(object);
+      goto _exit;
+    }
+
+    Py_DECREF(object);
+  }
+
+  for (reloc = arena->reloc_list_head; reloc != NULL; reloc = reloc->next)
+    relocations += sizeof(YR_RELOC);
+
+  for (i = 0; i < rules->num_rules; i++)
+  {
+    rule = &rules->rules_table[i];
+    rule_sizes[i] = sizeof(YR_RULE) + strlen(rule->identifier) + 1;
+    num_atoms += rule->num_atoms;
+
+    yr_rule_tags_foreach(rule, tag)
+    {
+      rule_sizes[i] += strlen(tag) + 1;
+    }
+
+    yr_rule_strings_foreach(rule, string)
+    {
+      rule_sizes[i] += sizeof(YR_STRING) + string->length + 1;
+      rule_sizes[i] += strlen(string->identifier) + 1;
+    }
+
+    yr_rule_metas_foreach(rule, meta)
+    {
+      rule_sizes[i] += sizeof(YR_META) + strlen(meta->identifier) + 1;
+
+      if (meta->type == META_TYPE_STRING)
+        rule_sizes[i] += strlen(meta->string) + 1;
+    }
+  }
+
+  // Every entry in the match pool belongs to the string that gets matched
+  // when the automaton reaches the entry's state.
+  num_matches = (uint32_t) (
+      arena->buffers[YR_AC_STATE_MATCHES_POOL].used / sizeof(YR_AC_MATCH));
+
+  for (i = 0; i < num_matches; i++)
+  {
+    string = rules->ac_match_pool[i].string;
+
+    if (string != NULL && string->rule_idx < rules->num_rules)
+      rule_sizes[string->rule_idx] += sizeof(YR_AC_MATCH);
+  }
+
+  largest = PyList_New(0);
+
+  if (largest == NULL)
+    goto _exit;
+
+  for (i = 0; i < rules->num_rules; i++)
+  {
+    rule = &rules->rules_table[i];
+
+    if (RULE_IS_DISABLED(rule))
+      continue;
+
+    object = Py_BuildValue(
+        "(KNNi)",
+        (unsigned long long) rule_sizes[i],
+        PY_STRING(rule->ns->name),
+        PY_STRING(rule->identifier),
+        rule->num_atoms);
+
+    if (object == NULL || PyList_Append(largest, object) != 0)
+    {
+      Py_XDECREF(object);
+      goto _exit;
+    }
+
+    Py_DECREF(object);
+  }
+
+  if (PyList_Sort(largest) != 0 || PyList_Reverse(largest) != 0)
+    goto _exit;
+
+  if (PyList_SetSlice(largest, top, PyList_Size(largest), NULL) != 0)
+    goto _exit;
+
+  for (i = 0; i < (uint32_t) PyList_Size(largest); i++)
+  {
+    PyObject* item = PyList_GetItem(largest, i);
+
+    object = Py_BuildValue(
+        "{s:O,s:O,s:O,s:O}",
+        "namespace", PyTuple_GetItem(item, 1),
+        "identifier", PyTuple_GetItem(item, 2),
+        "size", PyTuple_GetItem(item, 0),
+        "atoms", PyTuple_GetItem(item, 3));
+
+    if (object == NULL || PyList_SetItem(largest, i, object) != 0)
+      goto _exit;
+  }
+
+  result = Py_BuildValue(
+      "{s:K,s:K,s:K,s:O,s:K,s:K,s:I,s:I,s:K,s:O}",
+      "arena_size", (unsigned long long) arena_size,
+      "arena_used", (unsigned long long) arena_used,
+      "relocations", (unsigned long long) relocations,
+      "sections", sections,
+      "ac_transition_table", (unsigned long long)
+          arena->buffers[YR_AC_TRANSITION_TABLE].used,
+      "ac_match_table", (unsigned long long)
+          arena->buffers[YR_AC_STATE_MATCHES_TABLE].used,
+      "num_rules", rules->num_rules,
+      "num_strings", rules->num_strings,
+      "num_atoms", (unsigned long long) num_atoms,
+      "largest_rules", largest);
+
+_exit:
+
+  Py_XDECREF(sections);
+  Py_XDECREF(largest);
+  PyMem_Free(rule_sizes);
+
+  return result;
+}
+
+
+static PyObject* Rules_getattro(
+    PyObject* self,
+    PyObject* name)
+{
+  return PyObject_GenericGetAttr(self, name);
+}
+
+
+// Checks that "value" can be assigned to the external variable "key" of the
+// rules bound to "externals", without changing anything. Unlike match(), which
+// silently ignores unknown keys in the "externals" dictionary, a binding is
+// validated against the rules so that typos are caught when the binding is
+// created instead of producing wrong results.
+
+static int Externals_check(
+    Externals* externals,
+    PyObject* key,
+    PyObject* value)
+{
+  YARA_STATE* state = get_type_state(Py_TYPE(externals));
+  YR_EXTERNAL_VARIABLE* external;
+  PyObject* index;
+
+  char* identifier = PY_STRING_TO_C(key);
+  bool compatible;
+
+  if (identifier == NULL)
+    return -1;
+
+#if PY_MAJOR_VERSION >= 3
+  if (!PyBool_Check(value) && !PyLong_Check(value) &&
+#else
+  if (!PyBool_Check(value) && !PyLong_Check(value) && !PyInt_Check(value) &&
+#endif
+      !PyFloat_Check(value) && !PY_STRING_CHECK(value))
+  {
+    PyErr_Format(
+        PyExc_TypeError,
+        "external values must be of type integer, float, boolean or string");
+
+    return -1;
+  }
+
+  if (PY_STRING_CHECK(value) && PY_STRING_TO_C(value) == NULL)
+    return -1;
+
+  index = PyDict_GetItem(externals->indexes, key);
+
+  if (index == NULL)
+  {
+    PyErr_Format(
+        state->YaraError,
+        "external variable \"%s\" is not defined in the rules",
+        identifier);
+
+    return -1;
+  }
+
+  external = externals->variables[PyLong_AsSsize_t(index)].external;
+
+  switch (external->type)
+  {
+  case EXTERNAL_VARIABLE_TYPE_FLOAT:
+    compatible = PyFloat_Check(value);
+    break;
+
+  case EXTERNAL_VARIABLE_TYPE_STRING:
+  case EXTERNAL_VARIABLE_TYPE_MALLOC_STRING:
+    compatible = PY_STRING_CHECK(value);
+    break;
+
+  default:
+    compatible = !PyFloat_Check(value) && !PY_STRING_CHECK(value);
+  }
+
+  if (!compatible)
+  {
+    handle_error(state, ERROR_INVALID_EXTERNAL_VARIABLE_TYPE, identifier);
+    return -1;
+  }
+
+  return 0;
+}
+
+
+// Defines in "acquired" the values that changed since the generation it has
+// defined. Values are set directly in the scanner's objects for the external
+// variables, which were already validated with Externals_check.
+
+static int Externals_apply(
+    Externals* externals,
+    EXTERNALS_SCANNER* acquired)
+{
+  Py_ssize_t i;
+
+  int result = ERROR_SUCCESS;
+
+  for (i = 0; result == ERROR_SUCCESS && i < externals->num_variables; i++)
+  {
+    EXTERNALS_VARIABLE* variable = &externals->variables[i];
+    YR_OBJECT* object = acquired->objects[i];
+
+    if (variable->value == NULL || variable->generation <= acquired->generation)
+      continue;
+
+    if (object->type == OBJECT_TYPE_FLOAT)
+    {
+      result = yr_object_set_float(
+          PyFloat_AsDouble(variable->value), object, NULL);
+    }
+    else if (object->type == OBJECT_TYPE_STRING)
+    {
+      char* str = PY_STRING_TO_C(variable->value);
+
+      result = str != NULL ?
+          yr_object_set_string(str, strlen(str), object, NULL) :
+          ERROR_INVALID_ARGUMENT;
+    }
+    else
+    {
+      result = yr_object_set_integer(
+          PyLong_AsLongLong(variable->value), object, NULL);
+    }
+  }
+
+  acquired->generation = externals->generation;
+
+  return result;
+}
+
+
+// Creates a scanner for the rules bound to "externals" and looks up its
+// objects for the external variables, once for the scanner's lifetime.
+
+static int Externals_create_scanner(
+    Externals* externals,
+    EXTERNALS_SCANNER* created)
+{
+  Py_ssize_t i;
+
+  int result = yr_scanner_create(
+      ((Rules*) externals->rules)->rules, &created->scanner);
+
+  if (result != ERROR_SUCCESS)
+    return result;
+
+  created->generation = 0;
+  created->objects = (YR_OBJECT**) malloc(
+      (externals->num_variables + 1) * sizeof(YR_OBJECT*));
+
+  if (created->objects == NULL)
+    return ERROR_INSUFFICIENT_MEMORY;
+
+  for (i = 0; i < externals->num_variables; i++)
+  {
+    created->objects[i] = (YR_OBJECT*) yr_hash_table_lookup(
+        created->scanner->objects_table,
+        externals->variables[i].external->identifier,
+        NULL);
+
+    if (created->objects[i] == NULL)
+      return ERROR_INVALID_ARGUMENT;
+  }
+
+  return ERROR_SUCCESS;
+}
+
+
+static void Externals_destroy_scanner(
+    EXTERNALS_SCANNER* scanner)
+{
+  if (scanner->scanner != NULL)
+    yr_scanner_destroy(scanner->scanner);
+
+  free(scanner->objects);
+
+  scanner->scanner = NULL;
+  scanner->objects = NULL;
+}
+
+
+// Returns a scanner with the current values defined, which is used by a
+// single scan and then given back with Externals_release_scanner. "values"
+// receives a new reference to the dictionary of values defined. Scanners
+// are reused, and only the values updated after their last scan are defined
+// again. The lock is not held during the scan, so threads sharing the
+// binding scan in parallel.
+
+static YR_SCANNER* Externals_acquire_scanner(
+    Externals* externals,
+    EXTERNALS_SCANNER* acquired,
+    PyObject** values)
+{
+  int result = ERROR_SUCCESS;
+
+  acquire_lock(externals->lock);
+
+  if (externals->num_idle > 0)
+    *acquired = externals->idle[--externals->num_idle];
+  else
+    result = Externals_create_scanner(externals, acquired);
+
+  if (result == ERROR_SUCCESS && acquired->generation != externals->generation)
+    result = Externals_apply(externals, acquired);
+
+  *values = externals->values;
+
+  Py_INCREF(*values);
+
+  PyThread_release_lock(externals->lock);
+
+  if (result != ERROR_SUCCESS)
+  {
+    Externals_destroy_scanner(acquired);
+
+    handle_error(
+        get_type_state(Py_TYPE(externals)), result, "<externals>");
+
+    Py_CLEAR(*values);
+
+    return NULL;
+  }
+
+  return acquired->scanner;
+}
+
+
+static void Externals_release_scanner(
+    Externals* externals,
+    EXTERNALS_SCANNER* acquired)
+{
+  bool kept = false;
+
+  acquire_lock(externals->lock);
+
+  if (grow_array(
+          (void**) &externals->idle,
+          &externals->idle_capacity,
+          externals->num_idle + 1,
+          sizeof(EXTERNALS_SCANNER)))
+  {
+    externals->idle[externals->num_idle++] = *acquired;
+    kept = true;
+  }
+
+  PyThread_release_lock(externals->lock);
+
+  if (!kept)
+    Externals_destroy_scanner(acquired);
+}
+
+
+// Validates all the changes in "dicts" before applying any of them, so that
+// the values are left untouched if some of them is wrong. Later dictionaries
+// override earlier ones, just like dict.update() does. Only the variables
+// whose value actually changes get the new generation.
+
+static int Externals_set(
+    Externals* externals,
+    PyObject** dicts,
+    int num_dicts)
+{
+  PyObject* values;
+  PyObject* previous;
+  PyObject* key;
+  PyObject* value;
+  Py_ssize_t pos;
+
+  bool changed = false;
+  int i;
+
+  for (i = 0; i < num_dicts; i++)
+  {
+    pos = 0;
+
+    while (dicts[i] != NULL && PyDict_Next(dicts[i], &pos, &key, &value))
+    {
+      if (Externals_check(externals, key, value) != 0)
+        return -1;
+    }
+  }
+
+  values = PyDict_Copy(externals->values);
+
+  if (values == NULL)
+    return -1;
+
+  for (i = 0; i < num_dicts; i++)
+  {
+    if (dicts[i] != NULL && PyDict_Update(values, dicts[i]) != 0)
+    {
+      Py_DECREF(values);
+      return -1;
+    }
+  }
+
+  // Idle scanners define the new values the next time they are used, and
+  // scans in progress keep the values they started with.
+
+  acquire_lock(externals->lock);
+
+  pos = 0;
+
+  while (PyDict_Next(values, &pos, &key, &value))
+  {
+    EXTERNALS_VARIABLE* variable = &externals->variables[
+        PyLong_AsSsize_t(PyDict_GetItem(externals->indexes, key))];
+
+    if (variable->value != NULL &&
+        Py_TYPE(variable->value) == Py_TYPE(value) &&
+        PyObject_RichCompareBool(variable->value, value, Py_EQ) == 1)
+      continue;
+
+    Py_INCREF(value);
+    Py_XDECREF(variable->value);
+
+    variable->value = value;
+    variable->generation = externals->generation + 1;
+    changed = true;
+  }
+
+  if (changed)
+    externals->generation++;
+
+  previous = externals->values;
+  externals->values = values;
+
+  PyThread_release_lock(externals->lock);
+
+  Py_DECREF(previous);
+
+  return 0;
+}
+
+
+// Maps the name of each external variable of "rules" to its index in the
+// table of variables of the binding.
+
+static int Externals_resolve(
+    Externals* externals,
+    YR_RULES* rules)
+{
+  YR_EXTERNAL_VARIABLE* external = rules->ext_vars_table;
+  Py_ssize_t i;
+
+  while (!EXTERNAL_VARIABLE_IS_NULL(external + externals->num_variables))
+    externals->num_variables++;
+
+  externals->variables = (EXTERNALS_VARIABLE*) PyMem_Malloc(
+      (externals->num_variables + 1) * sizeof(EXTERNALS_VARIABLE));
+
+  if (externals->variables == NULL)
+  {
+    PyErr_NoMemory();
+    return -1;
+  }
+
+  for (i = 0; i < externals->num_variables; i++)
+  {
+    externals->variables[i].external = &external[i];
+    externals->variables[i].value = NULL;
+    externals->variables[i].generation = 0;
+  }
+
+  for (i = 0; i < externals->num_variables; i++)
+  {
+    PyObject* name = PY_STRING(external[i].identifier);
+    PyObject* index = PyLong_FromSsize_t(i);
+
+    if (name == NULL || index == NULL ||
+        PyDict_SetItem(externals->indexes, name, index) != 0)
+    {
+      Py_XDECREF(name);
+      Py_XDECREF(index);
+      return -1;
+    }
+
+    Py_DECREF(name);
+    Py_DECREF(index);
+  }
+
+  return 0;
+}
+
+
+static PyObject* Externals_new(
+    PyTypeObject* type,
+    PyObject* args,
+    PyObject* keywords)
+{
+  PyObject* rules = NULL;
+
+  Externals* object;
+
+  YARA_STATE* state = get_type_state(type);
+
+  if (!PyArg_ParseTuple(args, "O!", state->Rules_Type, &rules))
+    return NULL;
+
+  object = PyObject_NEW(Externals, state->Externals_Type);
+
+  if (object == NULL)
+    return NULL;
+
+  object->rules = rules;
+  object->values = PyDict_New();
+  object->indexes = PyDict_New();
+  object->variables = NULL;
+  object->num_variables = 0;
+  object->generation = 0;
+  object->idle = NULL;
+  object->num_idle = 0;
+  object->idle_capacity = 0;
+  object->lock = PyThread_allocate_lock();
+
+  Py_INCREF(rules);
+
+  if (object->values == NULL || object->indexes == NULL ||
+      object->lock == NULL)
+  {
+    Py_DECREF(object);
+    return PyErr_NoMemory();
+  }
+
+  if (Externals_resolve(object, ((Rules*) rules)->rules) != 0 ||
+      Externals_set(object, &keywords, 1) != 0)
+  {
+    Py_DECREF(object);
+    return NULL;
+  }
+
+  return (PyObject*) object;
+}
+
+
+static void Externals_dealloc(
+    PyObject* self)
+{
+  PyTypeObject* type = Py_TYPE(self);
+  Externals* object = (Externals*) self;
+
+  Py_ssize_t i;
+  size_t j;
+
+  for (j = 0; j < object->num_idle; j++)
+    Externals_destroy_scanner(&object->idle[j]);
+
+  free(object->idle);
+
+  for (i = 0; object->variables != NULL && i < object->num_variables; i++)
+    Py_XDECREF(object->variables[i].value);
+
+  PyMem_Free(object->variables);
+
+  if (object->lock != NULL)
+    PyThread_free_lock(object->lock);
+
+  Py_XDECREF(object->values);
+  Py_XDECREF(object->indexes);
+  Py_XDECREF(object->rules);
+
+  PyObject_Del(self);
+  release_type(type);
+}
+
+
+static PyObject* Externals_update(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  PyObject* dicts[2] = {NULL, NULL};
+
+  if (!PyArg_ParseTuple(args, "|O!", &PyDict_Type, &dicts[0]))
+    return NULL;
+
+  // Positional dictionary first, keyword arguments override it.
+
+  dicts[1] = keywords;
+
+  if (Externals_set((Externals*) self, dicts, 2) != 0)
+    return NULL;
+
+  Py_RETURN_NONE;
+}
+
+
+static PyObject* ResultCache_new(
+    PyTypeObject* type,
+    PyObject* args,
+    PyObject* keywords)
+{
+  static char* kwlist[] = {
+      "max_entries", "max_bytes", "directory", NULL
+      };
+
+  Py_ssize_t max_entries = 1024;
+  Py_ssize_t max_bytes = 64 * 1024 * 1024;
+  PyObject* directory = Py_None;
+  PyObject* collections;
+
+  ResultCache* object;
+
+  YARA_STATE* state = get_type_state(type);
+
+  if (!PyArg_ParseTupleAndKeywords(
+        args,
+        keywords,
+        "|nnO",
+        kwlist,
+        &max_entries,
+        &max_bytes,
+        &directory))
+  {
+    return NULL;
+  }
+
+  if (max_entries < 0 || max_bytes < 0)
+    return PyErr_Format(
+        PyExc_ValueError,
+        "'max_entries' and 'max_bytes' must be positive numbers");
+
+  if (directory != Py_None && !PY_STRING_CHECK(directory))
+    return PyErr_Format(
+        PyExc_TypeError,
+        "'directory' must be a string");
+
+  object = PyObject_NEW(ResultCache, state->ResultCache_Type);
+
+  if (object == NULL)
+    return NULL;
+
+  object->directory = directory;
+  object->max_entries = max_entries;
+  object->max_bytes = max_bytes;
+  object->size = 0;
+  object->hits = 0;
+  object->misses = 0;
+  object->evictions = 0;
+  object->entries = NULL;
+  object->lock = PyThread_allocate_lock();
+
+  Py_INCREF(directory);
+
+  // An OrderedDict keeps the entries in least recently used order.
+
+  collections = PyImport_ImportModule("collections");
+
+  if (collections != NULL)
+  {
+    object->entries = PyObject_CallMethod(collections, "OrderedDict", NULL);
+    Py_DECREF(collections);
+  }
+
+  if (object->entries == NULL || object->lock == NULL)
+  {
+    Py_DECREF(object);
+    return PyErr_Occurred() ? NULL : PyErr_NoMemory();
+  }
+
+  return (PyObject*) object;
+}
+
+
+static void ResultCache_dealloc(
+    PyObject* self)
+{
+  PyTypeObject* type = Py_TYPE(self);
+  ResultCache* object = (ResultCache*) self;
+
+  if (object->lock != NULL)
+    PyThread_free_lock(object->lock);
+
+  Py_XDECREF(object->entries);
+  Py_XDECREF(object->directory);
+
+  PyObject_Del(self);
+  release_type(type);
+}
+
+
+static PyObject* ResultCache_clear(
+    PyObject* self,
+    PyObject* args)
+{
+  ResultCache* object = (ResultCache*) self;
+  PyObject* result;
+
+  acquire_lock(object->lock);
+
+  result = PyObject_CallMethod(object->entries, "clear", NULL);
+  object->size = 0;
+
+  PyThread_release_lock(object->lock);
+
+  if (result == NULL)
+    return NULL;
+
+  Py_DECREF(result);
+  Py_RETURN_NONE;
+}
+
+
+static Py_ssize_t ResultCache_length(
+    PyObject* self)
+{
+  ResultCache* object = (ResultCache*) self;
+  Py_ssize_t length;
+
+  acquire_lock(object->lock);
+  length = PyObject_Size(object->entries);
+  PyThread_release_lock(object->lock);
+
+  return length;
+}
+
+
+static PyObject* ResultCache_hit_rate(
+    PyObject* self,
+    void* closure)
+{
+  ResultCache* object = (ResultCache*) self;
+  unsigned long long hits;
+  unsigned long long total;
+
+  acquire_lock(object->lock);
+  hits = object->hits;
+  total = object->hits + object->misses;
+  PyThread_release_lock(object->lock);
+
+  return PyFloat_FromDouble(
+      total == 0 ? 0.0 : (double) hits / (double) total);
+}
+
+
+// Returns the path of the file where the entry for "key" is persisted in
+// the cache's directory, which must be freed with PyMem_Free. The file name
+// is the key in hex.
+
+static char* ResultCache_path(
+    ResultCache* cache,
+    PyObject* key,
+    const char* suffix)
+{
+  const char* directory = PY_STRING_TO_C(cache->directory);
+  const unsigned char* digest = (const unsigned char*) PyBytes_AsString(key);
+  Py_ssize_t digest_length = PyBytes_Size(key);
+
+  char* path;
+  size_t length;
+  Py_ssize_t i;
+
+  if (directory == NULL || digest == NULL)
+    return NULL;
+
+  length = strlen(directory) + 2 * digest_length + strlen(suffix) + 2;
+  path = (char*) PyMem_Malloc(length);
+
+  if (path == NULL)
+    return NULL;
+
+  length = sprintf(path, "%s/", directory);
+
+  for (i = 0; i < digest_length; i++)
+    length += sprintf(path + length, "%02x", digest[i]);
+
+  strcpy(path + length, suffix);
+
+  return path;
+}
+
+
+static PyObject* ResultCache_read_file(
+    ResultCache* cache,
+    PyObject* key)
+{
+  PyObject* blob = NULL;
+
+  char* path = ResultCache_path(cache, key, "");
+  char* data = NULL;
+  long length = -1;
+
+  FILE* fh;
+
+  if (path == NULL)
+    return NULL;
+
+  Py_BEGIN_ALLOW_THREADS
+
+  fh = fopen(path, "rb");
+
+  if (fh != NULL)
+  {
+    if (fseek(fh, 0, SEEK_END) == 0)
+      length = ftell(fh);
+
+    if (length >= 0 && fseek(fh, 0, SEEK_SET) == 0)
+      data = (char*) malloc(length > 0 ? length : 1);
+
+    if (data != NULL && fread(data, 1, length, fh) != (size_t) length)
+    {
+      free(data);
+      data = NULL;
+    }
+
+    fclose(fh);
+  }
+
+  Py_END_ALLOW_THREADS
+
+  if (data != NULL)
+  {
+    blob = PyBytes_FromStringAndSize(data, length);
+    free(data);
+  }
+
+  PyMem_Free(path);
+
+  return blob;
+}
+
+
+// Entries are written to a temporary file that is then renamed, so that
+// other processes sharing the directory never see partially written ones.
+// The temporary file is named after the process and thread writing it, and
+// it is created exclusively, so if two writers still pick the same name one
+// of them simply doesn't write the entry.
+
+static void ResultCache_write_file(
+    ResultCache* cache,
+    PyObject* key,
+    PyObject* blob)
+{
+  char suffix[64];
+  char* path = ResultCache_path(cache, key, "");
+  char* temp_path;
+
+  const char* data = PyBytes_AsString(blob);
+  size_t length = (size_t) PyBytes_Size(blob);
+
+  FILE* fh = NULL;
+  bool created = false;
+  bool written = false;
+
+  snprintf(
+      suffix,
+      sizeof(suffix),
+      ".%lu.%lu.tmp",
+      #if defined(_WIN32)
+      (unsigned long) _getpid(),
+      #else
+      (unsigned long) getpid(),
+      #endif
+      (unsigned long) PyThread_get_thread_ident());
+
+  temp_path = ResultCache_path(cache, key, suffix);
+
+  if (path != NULL && temp_path != NULL && data != NULL)
+  {
+    Py_BEGIN_ALLOW_THREADS
+
+    #if defined(_WIN32)
+    fh = fopen(temp_path, "wbx");
+    created = (fh != NULL);
+    #else
+    int fd = open(temp_path, O_WRONLY | O_CREAT | O_EXCL, 0666);
+
+    if (fd >= 0)
+    {
+      created = true;
+      fh = fdopen(fd, "wb");
+
+      if (fh == NULL)
+        close(fd);
+    }
+    #endif
+
+    if (fh != NULL)
+    {
+      written = fwrite(data, 1, length, fh) == length;
+      written = fclose(fh) == 0 && written;
+    }
+
+    if (created && (!written || rename(temp_path, path) != 0))
+      remove(temp_path);
+
+    Py_END_ALLOW_THREADS
+  }
+
+  PyMem_Free(path);
+  PyMem_Free(temp_path);
+}
+
+
+// Adds an entry to the in-memory cache, evicting the least recently used
+// entries if the limits are exceeded. Must be called with the lock held.
+
+static void ResultCache_insert(
+    ResultCache* cache,
+    PyObject* key,
+    PyObject* blob)
+{
+  PyObject* item;
+  Py_ssize_t size = PyBytes_Size(blob);
+
+  if (cache->max_entries == 0 || size > cache->max_bytes)
+    return;
+
+  if (PyMapping_HasKey(cache->entries, key))
+    return;
+
+  if (PyObject_SetItem(cache->entries, key, blob) != 0)
+    return;
+
+  cache->size += size;
+
+  while (PyObject_Size(cache->entries) > cache->max_entries ||
+         cache->size > cache->max_bytes)
+  {
+    item = PyObject_CallMethod(cache->entries, "popitem", "O", Py_False);
+
+    if (item == NULL)
+      break;
+
+    cache->size -= PyBytes_Size(PyTuple_GetItem(item, 1));
+    cache->evictions++;
+
+    Py_DECREF(item);
+  }
+}
+
+
+// Returns a new reference to the marshaled matches cached under "key", or
+// NULL if there are none. Never raises, the cache is only an optimization.
+
+static PyObject* ResultCache_lookup(
+    ResultCache* cache,
+    PyObject* key)
+{
+  PyObject* blob;
+
+  acquire_lock(cache->lock);
+
+  blob = PyObject_GetItem(cache->entries, key);
+
+  if (blob != NULL)
+  {
+    // Move the entry to the end, as the most recently used.
+    PyObject_DelItem(cache->entries, key);
+    PyObject_SetItem(cache->entries, key, blob);
+  }
+
+  PyThread_release_lock(cache->lock);
+
+  PyErr_Clear();
+
+  if (blob == NULL && cache->directory != Py_None)
+  {
+    blob = ResultCache_read_file(cache, key);
+
+    acquire_lock(cache->lock);
+
+    if (blob != NULL)
+      ResultCache_insert(cache, key, blob);
+
+    PyThread_release_lock(cache->lock);
+
+    PyErr_Clear();
+  }
+
+  acquire_lock(cache->lock);
+
+  if (blob != NULL)
+    cache->hits++;
+  else
+    cache->misses++;
+
+  PyThread_release_lock(cache->lock);
+
+  return blob;
+}
+
+
+static void ResultCache_store(
+    ResultCache* cache,
+    PyObject* key,
+    PyObject* blob)
+{
+  acquire_lock(cache->lock);
+  ResultCache_insert(cache, key, blob);
+  PyThread_release_lock(cache->lock);
+
+  if (cache->directory != Py_None)
+    ResultCache_write_file(cache, key, blob);
+
+  PyErr_Clear();
+}
+
+
+// Returns the time in seconds of a clock that isn't affected by changes of
+// the system time.
+
+static double monotonic_time(void)
+{
+#if defined(_WIN32)
+  return GetTickCount64() / 1e3;
+#else
+  struct timespec ts;
+
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+
+  return ts.tv_sec + ts.tv_nsec / 1e9;
+#endif
+}
+
+
+// Data passed to raise_exception_on_error and yara_include_callback through
+// the compiler. Rules are compiled while the GIL is released, thread_state is
+// the thread state saved at that point.
+
+typedef struct _COMPILER_DATA
+{
+  YARA_STATE* state;
+  PyThreadState* thread_state;
+  PyObject* warnings;
+  PyObject* include_callback;
+
+} COMPILER_DATA;
+
+
+void raise_exception_on_error(
+    int error_level,
+    const char* file_name,
+    int line_number,
+    const YR_RULE* rule,
+    const char* message,
+    void* user_data)
+{
+  COMPILER_DATA* compiler_data = (COMPILER_DATA*) user_data;
+
+  PyEval_RestoreThread(compiler_data->thread_state);
+
+  if (error_level == YARA_ERROR_LEVEL_ERROR)
+  {
+    if (file_name != NULL)
+      PyErr_Format(
+          compiler_data->state->YaraSyntaxError,
+          "%s(%d): %s",
+          file_name,
+          line_number,
+          message);
+    else
+      PyErr_Format(
+          compiler_data->state->YaraSyntaxError,
+          "line %d: %s",
+          line_number,
+          message);
+  }
+  else
+  {
+    PyObject* warnings = compiler_data->warnings;
+    PyObject* warning_msg;
+    if (file_name != NULL)
+      warning_msg = PY_STRING_FORMAT(
+          "%s(%d): %s",
+          file_name,
+          line_number,
+          message);
+    else
+      warning_msg = PY_STRING_FORMAT(
+          "line %d: %s",
+          line_number,
+          message);
+    PyList_Append(warnings, warning_msg);
+    Py_DECREF(warning_msg);
+  }
+
+  compiler_data->thread_state = PyEval_SaveThread();
+}
+
+
+////////////////////////////////////////////////////////////////////////////////
+
+const char* yara_include_callback(
+    const char* include_name,
+    const char* calling_rule_filename,
+    const char* calling_rule_namespace,
+    void* user_data)
+{
+  COMPILER_DATA* compiler_data = (COMPILER_DATA*) user_data;
+  PyObject* result;
+  PyObject* callback = compiler_data->include_callback;
+  PyObject* py_incl_name = NULL;
+  PyObject* py_calling_fn = NULL;
+  PyObject* py_calling_ns = NULL;
+  PyObject* type = NULL;
+  PyObject* value = NULL;
+  PyObject* traceback = NULL;
+
+  const char* cstring_result = NULL;
+
+  PyEval_RestoreThread(compiler_data->thread_state);
+
+  if (include_name != NULL)
+  {
+    py_incl_name = PY_STRING(include_name);
+  }
+  else //safeguard: should never happen for 'include_name'
+  {
+    py_incl_name = Py_None;
+    Py_INCREF(py_incl_name);
+  }
+
+  if (calling_rule_filename != NULL)
+  {
+    py_calling_fn = PY_STRING(calling_rule_filename);
+  }
+  else
+  {
+    py_calling_fn = Py_None;
+    Py_INCREF(py_calling_fn);
+  }
+
+  if (calling_rule_namespace != NULL)
+  {
+    py_calling_ns = PY_STRING(calling_rule_namespace);
+  }
+  else
+  {
+    py_calling_ns = Py_None;
+    Py_INCREF(py_calling_ns);
+  }
+
+  PyErr_Fetch(&type, &value, &traceback);
+
+  result = PyObject_CallFunctionObjArgs(
+      callback,
+      py_incl_name,
+      py_calling_fn,
+      py_calling_ns,
+      NULL);
+
+  PyErr_Restore(type, value, traceback);
+
+  Py_DECREF(py_incl_name);
+  Py_DECREF(py_calling_fn);
+  Py_DECREF(py_calling_ns);
+
+  if (result != NULL && result != Py_None && PY_STRING_CHECK(result))
+  {
+    //transferring string ownership to C code
+    cstring_result = strdup(PY_STRING_TO_C(result));
+  }
+  else
+  {
+    if (PyErr_Occurred() == NULL)
+    {
+      PyErr_Format(PyExc_TypeError,
+          "'include_callback' function must return a yara rules as an ascii "
+          "or unicode string");
+    }
+  }
+
+  Py_XDECREF(result);
+  compiler_data->thread_state = PyEval_SaveThread();
+
+  return cstring_result;
+}
+
+void yara_include_free(
+    const char* result_ptr,
+    void* user_data)
+{
+  if (result_ptr != NULL)
+  {
+    free((void*) result_ptr);
+  }
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+static PyObject* yara_set_config(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+
+  /*
+   * It is recommended that this be kept up to date with the config
+   * options present in yara/libyara.c yr_set_configuration(...) - ck
+   */
+  static char *kwlist[] = {
+    "stack_size", "max_strings_per_rule", "max_match_data", NULL};
+
+  unsigned int stack_size = 0;
+  unsigned int max_strings_per_rule = 0;
+  unsigned int max_match_data = 0;
+
+  int error = 0;
+
+  if (PyArg_ParseTupleAndKeywords(
+        args,
+        keywords,
+        "|III",
+        kwlist,
+        &stack_size,
+        &max_strings_per_rule,
+  	&max_match_data))
+  {
+    if (stack_size != 0)
+    {
+      error = yr_set_configuration(
+          YR_CONFIG_STACK_SIZE,
+          &stack_size);
+
+      if ( error != ERROR_SUCCESS)
+        return handle_error(get_module_state(self), error, NULL);
+    }
+
+    if (max_strings_per_rule != 0)
+    {
+      error = yr_set_configuration(
+          YR_CONFIG_MAX_STRINGS_PER_RULE,
+				  &max_strings_per_rule);
+
+      if (error != ERROR_SUCCESS)
+        return handle_error(get_module_state(self), error, NULL);
+    }
+
+    if (max_match_data != 0)
+    {
+      error = yr_set_configuration(
+          YR_CONFIG_MAX_MATCH_DATA,
+				  &max_match_data);
+
+      if (error != ERROR_SUCCESS)
+        return handle_error(get_module_state(self), error, NULL);
+    }
+  }
+
+  Py_RETURN_NONE;
+}
+
+static PyObject* yara_compile(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  static char *kwlist[] = {
+    "filepath", "source", "file", "filepaths", "sources",
+    "includes", "externals", "error_on_warning", "include_callback",
+    "min_atom_quality", NULL};
+
+  YR_COMPILER* compiler;
+  YR_RULES* yara_rules;
+  FILE* fh;
+
+  Rules* rules;
+
+  PyObject* key;
+  PyObject* value;
+  PyObject* result = NULL;
+  PyObject* file = NULL;
+  PyObject* sources_dict = NULL;
+  PyObject* filepaths_dict = NULL;
+  PyObject* includes = NULL;
+  PyObject* externals = NULL;
+  PyObject* error_on_warning = NULL;
+  PyObject* include_callback = NULL;
+  PyObject* min_atom_quality = NULL;
+
+  Py_ssize_t pos = 0;
+
+  int fd;
+  int error = 0;
+  int threshold = YR_ATOM_QUALITY_WARNING_THRESHOLD;
+
+  char* filepath = NULL;
+  char* source = NULL;
+  char* ns = NULL;
+  PyObject* warnings = PyList_New(0);
+  bool warning_error = false;
+
+  YARA_STATE* state = get_module_state(self);
+  COMPILER_DATA compiler_data;
+
+  if (PyArg_ParseTupleAndKeywords(
+        args,
+        keywords,
+        "|ssOOOOOOOO",
+        kwlist,
+        &filepath,
+        &source,
+        &file,
+        &filepaths_dict,
+        &sources_dict,
+        &includes,
+        &externals,
+        &error_on_warning,
+        &include_callback,
+        &min_atom_quality))
+  {
+    char num_args = 0;
+
+    if (filepath != NULL)
+      num_args++;
+
+    if (source != NULL)
+      num_args++;
+
+    if (file != NULL)
+      num_args++;
+
+    if (filepaths_dict != NULL)
+      num_args++;
+
+    if (sources_dict != NULL)
+      num_args++;
+
+    if (num_args > 1)
+      return PyErr_Format(
+          PyExc_TypeError,
+          "compile is receiving too many arguments");
+
+    if (min_atom_quality == Py_None)
+    {
+      min_atom_quality = NULL;
+    }
+    else if (min_atom_quality != NULL)
+    {
+      if (!PyIndex_Check(min_atom_quality))
+        return PyErr_Format(
+            PyExc_TypeError,
+            "'min_atom_quality' must be an integer");
+
+      threshold = (int) PyLong_AsLong(min_atom_quality);
+
+      if (threshold == -1 && PyErr_Occurred())
+        return NULL;
+    }
+
+    error = yr_compiler_create(&compiler);
+
+    if (error != ERROR_SUCCESS)
+      return handle_error(state, error, NULL);
+
+    compiler_data.state = state;
+    compiler_data.warnings = warnings;
+    compiler_data.include_callback = include_callback;
+
+    yr_compiler_set_callback(
+        compiler, raise_exception_on_error, &compiler_data);
+
+    // Strings below the threshold are reported with the usual "may slow
+    // down scanning" warning, and fail the compilation later.
+    if (min_atom_quality != NULL)
+      compiler->atoms_config.quality_warning_threshold = threshold;
+
+    if (error_on_warning != NULL)
+    {
+      if (PyBool_Check(error_on_warning))
+      {
+        if (PyObject_IsTrue(error_on_warning) == 1)
+        {
+          warning_error = true;
+        }
+      }
+      else
+      {
+        yr_compiler_destroy(compiler);
+        return PyErr_Format(
+            PyExc_TypeError,
+            "'error_on_warning' param must be of boolean type");
+      }
+    }
+
+    if (includes != NULL)
+    {
+      if (PyBool_Check(includes))
+      {
+        // PyObject_IsTrue can return -1 in case of error
+        if (PyObject_IsTrue(includes) == 0)
+          yr_compiler_set_include_callback(compiler, NULL, NULL, NULL);
+      }
+      else
+      {
+        yr_compiler_destroy(compiler);
+        return PyErr_Format(
+            PyExc_TypeError,
+            "'includes' param must be of boolean type");
+      }
+    }
+
+    if (include_callback != NULL)
+    {
+      if (!PyCallable_Check(include_callback))
+      {
+        yr_compiler_destroy(compiler);
+        return PyErr_Format(
+            PyExc_TypeError,
+            "'include_callback' must be callable");
+      }
+
+      yr_compiler_set_include_callback(
+          compiler,
+          yara_include_callback,
+          yara_include_free,
+          &compiler_data);
+    }
+
+    if (externals != NULL && externals != Py_None)
+    {
+      if (PyDict_Check(externals))
+      {
+        if (process_compile_externals(state, externals, compiler) != ERROR_SUCCESS)
+        {
+          yr_compiler_destroy(compiler);
+          return NULL;
+        }
+      }
+      else
+      {
+        yr_compiler_destroy(compiler);
+        return PyErr_Format(
+            PyExc_TypeError,
+            "'externals' must be a dictionary");
+      }
+    }
+
+    Py_XINCREF(include_callback);
+
+    if (filepath != NULL)
+    {
+      fh = fopen(filepath, "r");
+
+      if (fh != NULL)
+      {
+        compiler_data.thread_state = PyEval_SaveThread();
+        error = yr_compiler_add_file(compiler, fh, NULL, filepath);
+        fclose(fh);
+        PyEval_RestoreThread(compiler_data.thread_state);
+      }
+      else
+      {
+        result = PyErr_SetFromErrno(state->YaraError);
+      }
+    }
+    else if (source != NULL)
+    {
+      compiler_data.thread_state = PyEval_SaveThread();
+      error = yr_compiler_add_string(compiler, source, NULL);
+      PyEval_RestoreThread(compiler_data.thread_state);
+    }
+    else if (file != NULL)
+    {
+      fd = dup(PyObject_AsFileDescriptor(file));
+
+      if (fd != -1)
+      {
+        compiler_data.thread_state = PyEval_SaveThread();
+        fh = fdopen(fd, "r");
+        error = yr_compiler_add_file(compiler, fh, NULL, NULL);
+        fclose(fh);
+        PyEval_RestoreThread(compiler_data.thread_state);
+      }
+      else
+      {
+        result = PyErr_Format(
+            PyExc_TypeError,
+            "'file' is not a file object");
+      }
+    }
+    else if (sources_dict != NULL)
+    {
+      if (PyDict_Check(sources_dict))
+      {
+        while (PyDict_Next(sources_dict, &pos, &key, &value))
+        {
+          source = PY_STRING_TO_C(value);
+          ns = PY_STRING_TO_C(key);
+
+          if (source != NULL && ns != NULL)
+          {
+            compiler_data.thread_state = PyEval_SaveThread();
+            error = yr_compiler_add_string(compiler, source, ns);
+            PyEval_RestoreThread(compiler_data.thread_state);
+
+            if (error > 0)
+              break;
+          }
+          else
+          {
+            result = PyErr_Format(
+                PyExc_TypeError,
+                "keys and values of the 'sources' dictionary must be "
+                "of string type");
+            break;
+          }
+        }
+      }
+      else
+      {
+        result = PyErr_Format(
+            PyExc_TypeError,
+            "'sources' must be a dictionary");
+      }
+    }
+    else if (filepaths_dict != NULL)
+    {
+      if (PyDict_Check(filepaths_dict))
+      {
+        while (PyDict_Next(filepaths_dict, &pos, &key, &value))
+        {
+          filepath = PY_STRING_TO_C(value);
+          ns = PY_STRING_TO_C(key);
+
+          if (filepath != NULL && ns != NULL)
+          {
+            fh = fopen(filepath, "r");
+
+            if (fh != NULL)
+            {
+              compiler_data.thread_state = PyEval_SaveThread();
+              error = yr_compiler_add_file(compiler, fh, ns, filepath);
+              fclose(fh);
+              PyEval_RestoreThread(compiler_data.thread_state);
+
+              if (error > 0)
+                break;
             }
             else
             {
-              result = PyErr_SetFromErrno(YaraError);
+              result = PyErr_SetFromErrno(state->YaraError);
               break;
             }
           }
@@ -2454,184 +10117,1310 @@ static PyObject* yara_compile(
       }
       else
       {
-        result = PyErr_Format(
-            PyExc_TypeError,
-            "filepaths must be a dictionary");
+        result = PyErr_Format(
+            PyExc_TypeError,
+            "filepaths must be a dictionary");
+      }
+    }
+    else
+    {
+      result = PyErr_Format(
+          PyExc_TypeError,
+          "compile() takes 1 argument");
+    }
+
+    if (warning_error && PyList_Size(warnings) > 0)
+    {
+      PyErr_SetObject(state->YaraWarningError, warnings);
+    }
+
+    if (PyErr_Occurred() == NULL)
+    {
+      rules = Rules_NEW(state);
+
+      if (rules != NULL)
+      {
+        Py_BEGIN_ALLOW_THREADS
+        error = yr_compiler_get_rules(compiler, &yara_rules);
+        Py_END_ALLOW_THREADS
+
+        if (error == ERROR_SUCCESS)
+        {
+          rules->rules = yara_rules;
+          rules->warnings = warnings;
+
+          if (externals != NULL && externals != Py_None)
+            rules->externals = PyDict_Copy(externals);
+
+          result = (PyObject*) rules;
+
+          if (min_atom_quality != NULL)
+          {
+            PyObject* slow_strings = PyList_New(0);
+            PyObject* report = NULL;
+
+            if (slow_strings != NULL)
+              report = analyze_rules(yara_rules, threshold, slow_strings);
+
+            if (report == NULL)
+            {
+              Py_CLEAR(result);
+            }
+            else if (PyList_Size(slow_strings) > 0)
+            {
+              PyErr_SetObject(state->YaraWarningError, slow_strings);
+              Py_CLEAR(result);
+            }
+
+            Py_XDECREF(slow_strings);
+            Py_XDECREF(report);
+          }
+        }
+        else
+        {
+          Py_DECREF(rules);
+          result = handle_error(state, error, NULL);
+        }
+      }
+      else
+      {
+        result = handle_error(state, ERROR_INSUFFICIENT_MEMORY, NULL);
+      }
+    }
+
+    yr_compiler_destroy(compiler);
+    Py_XDECREF(include_callback);
+  }
+
+  return result;
+}
+
+
+static PyObject* yara_load(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  static char* kwlist[] = {
+      "filepath", "file",  NULL
+      };
+
+  YR_EXTERNAL_VARIABLE* external;
+
+  Rules* rules = NULL;
+  PyObject* file = NULL;
+  char* filepath = NULL;
+
+  int error;
+
+  YARA_STATE* state = get_module_state(self);
+
+  if (!PyArg_ParseTupleAndKeywords(
+      args,
+      keywords,
+      "|sO",
+      kwlist,
+      &filepath,
+      &file))
+  {
+    return NULL;
+  }
+
+  if (filepath != NULL)
+  {
+    rules = Rules_NEW(state);
+
+    if (rules == NULL)
+      return PyErr_NoMemory();
+
+    Py_BEGIN_ALLOW_THREADS;
+    error = yr_rules_load(filepath, &rules->rules);
+    Py_END_ALLOW_THREADS;
+
+    if (error != ERROR_SUCCESS)
+    {
+      Py_DECREF(rules);
+      return handle_error(state, error, filepath);
+    }
+  }
+  else if (file != NULL && PyObject_HasAttrString(file, "read"))
+  {
+    YR_STREAM stream;
+    STREAM_DATA stream_data;
+
+    stream_data.file = file;
+    stream.user_data = &stream_data;
+    stream.read = flo_read;
+
+    rules = Rules_NEW(state);
+
+    if (rules == NULL)
+      return PyErr_NoMemory();
+
+    stream_data.thread_state = PyEval_SaveThread();
+    error = yr_rules_load_stream(&stream, &rules->rules);
+    PyEval_RestoreThread(stream_data.thread_state);
+
+    if (error != ERROR_SUCCESS)
+    {
+      Py_DECREF(rules);
+      return handle_error(state, error, "<file-like-object>");
+    }
+  }
+  else
+  {
+    return PyErr_Format(
+      PyExc_TypeError,
+      "load() expects either a file path or a file-like object");
+  }
+
+  external = rules->rules->ext_vars_table;
+
+  if (!EXTERNAL_VARIABLE_IS_NULL(external))
+    rules->externals = PyDict_New();
+
+  while (!EXTERNAL_VARIABLE_IS_NULL(external))
+  {
+    switch(external->type)
+    {
+      case EXTERNAL_VARIABLE_TYPE_BOOLEAN:
+        PyDict_SetItemString(
+            rules->externals,
+            external->identifier,
+            PyBool_FromLong((long) external->value.i));
+        break;
+      case EXTERNAL_VARIABLE_TYPE_INTEGER:
+        PyDict_SetItemString(
+            rules->externals,
+            external->identifier,
+            PyLong_FromLong((long) external->value.i));
+        break;
+      case EXTERNAL_VARIABLE_TYPE_FLOAT:
+        PyDict_SetItemString(
+            rules->externals,
+            external->identifier,
+            PyFloat_FromDouble(external->value.f));
+        break;
+      case EXTERNAL_VARIABLE_TYPE_STRING:
+        PyDict_SetItemString(
+            rules->externals,
+            external->identifier,
+            PY_STRING(external->value.s));
+        break;
+    }
+
+    external++;
+  }
+
+  return (PyObject*) rules;
+}
+
+
+// Allocates the pool. yara.ScanPool itself is replaced by yara_pool.ScanPool,
+// whose __init__() is then called by the type machinery, as the object is an
+// instance of yara.ScanPool. Subclasses are allocated as usual.
+
+static PyObject* ScanPool_new(
+    PyTypeObject* type,
+    PyObject* args,
+    PyObject* keywords)
+{
+  PyObject* module;
+  PyObject* pool_type;
+  PyObject* result;
+
+  if (type != get_type_state(type)->ScanPool_Type)
+    return type->tp_alloc(type, 0);
+
+  module = PyImport_ImportModule("yara_pool");
+
+  if (module == NULL)
+    return NULL;
+
+  pool_type = PyObject_GetAttrString(module, "ScanPool");
+  Py_DECREF(module);
+
+  if (pool_type == NULL)
+    return NULL;
+
+  if (!PyType_Check(pool_type) ||
+      !PyType_IsSubtype((PyTypeObject*) pool_type, type))
+  {
+    Py_DECREF(pool_type);
+
+    return PyErr_Format(
+        PyExc_TypeError, "yara_pool.ScanPool must derive from yara.ScanPool");
+  }
+
+  result = ((PyTypeObject*) pool_type)->tp_alloc((PyTypeObject*) pool_type, 0);
+  Py_DECREF(pool_type);
+
+  return result;
+}
+
+
+// Rebuilds a Match object from the values returned by Match.__reduce__().
+
+static PyObject* yara_match(
+    PyObject* self,
+    PyObject* args)
+{
+  YARA_STATE* state = get_module_state(self);
+  Match* match;
+
+  PyObject* rule;
+  PyObject* ns;
+  PyObject* tags;
+  PyObject* meta;
+  PyObject* strings;
+  PyObject* truncated = NULL;
+
+  if (!PyArg_ParseTuple(
+        args, "OOOOO|O", &rule, &ns, &tags, &meta, &strings, &truncated))
+    return NULL;
+
+  match = PyObject_NEW(Match, state->Match_Type);
+
+  if (match == NULL)
+    return NULL;
+
+  match->rule = rule;
+  match->ns = ns;
+  match->tags = tags;
+  match->meta = meta;
+  match->strings = strings;
+  match->truncated = truncated != NULL && PyObject_IsTrue(truncated) == 1;
+
+  Py_INCREF(match->rule);
+  Py_INCREF(match->ns);
+  Py_INCREF(match->tags);
+  Py_INCREF(match->meta);
+  Py_INCREF(match->strings);
+
+  return (PyObject*) match;
+}
+
+
+static PyObject* yara_dumps_matches(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  static char* kwlist[] = {"matches", "format", "data", NULL};
+
+  PyObject* matches;
+  PyObject* sequence;
+  PyObject* output_data = NULL;
+  PyObject* item;
+
+  const char* format = "json";
+  const char* data_encoding = "base64";
+
+  Py_ssize_t i;
+
+  ENCODER encoder;
+
+  YARA_STATE* state = get_module_state(self);
+
+  if (!PyArg_ParseTupleAndKeywords(
+        args,
+        keywords,
+        "O|sO",
+        kwlist,
+        &matches,
+        &format,
+        &output_data))
+  {
+    return NULL;
+  }
+
+  if (output_data == Py_None)
+    data_encoding = NULL;
+  else if (output_data != NULL && PY_STRING_CHECK(output_data))
+    data_encoding = PY_STRING_TO_C(output_data);
+  else if (output_data != NULL)
+    data_encoding = "";
+
+  if (!parse_output_options(format, data_encoding, &encoder))
+    return NULL;
+
+  sequence = PySequence_Fast(matches, "'matches' must be a sequence");
+
+  if (sequence == NULL)
+    return NULL;
+
+  encoder_begin_container(&encoder, false, PySequence_Fast_GET_SIZE(sequence));
+
+  for (i = 0; i < PySequence_Fast_GET_SIZE(sequence); i++)
+  {
+    item = PySequence_Fast_GET_ITEM(sequence, i);
+
+    if (!PyObject_TypeCheck(item, state->Match_Type))
+    {
+      PyErr_Format(
+          PyExc_TypeError,
+          "'matches' must contain Match objects");
+      break;
+    }
+
+    if (!encoder_match(&encoder, (Match*) item))
+      break;
+  }
+
+  Py_DECREF(sequence);
+
+  if (PyErr_Occurred())
+  {
+    free(encoder.buffer);
+    return NULL;
+  }
+
+  encoder_end_container(&encoder, false);
+
+  return encoder_finish(&encoder);
+}
+
+
+static PyObject* RuleStore_new(
+    PyTypeObject* type,
+    PyObject* args,
+    PyObject* keywords)
+{
+  static char* kwlist[] = {"rules", NULL};
+
+  PyObject* rules;
+  RuleStore* object;
+
+  if (!PyArg_ParseTupleAndKeywords(args, keywords, "O", kwlist, &rules))
+    return NULL;
+
+  if (!PyObject_TypeCheck(rules, get_type_state(type)->Rules_Type))
+    return PyErr_Format(
+        PyExc_TypeError,
+        "'rules' must be a Rules object");
+
+  object = PyObject_NEW(RuleStore, type);
+
+  if (object == NULL)
+    return NULL;
+
+  Py_INCREF(rules);
+
+  object->rules = rules;
+  object->history = PyDict_New();
+  object->loader = NULL;
+  object->loader_args = NULL;
+  object->loader_keywords = NULL;
+  object->reload_error = NULL;
+  object->version = 1;
+  object->scans = 0;
+  object->reload_started = 0;
+  object->reload_latency = -1;
+  object->reloading = false;
+  object->interpreter = NULL;
+  object->lock = PyThread_allocate_lock();
+  object->done = PyThread_allocate_lock();
+
+  if (object->history == NULL)
+  {
+    Py_DECREF(object);
+    return NULL;
+  }
+
+  if (object->lock == NULL || object->done == NULL)
+  {
+    Py_DECREF(object);
+    return PyErr_NoMemory();
+  }
+
+  return (PyObject*) object;
+}
+
+
+static void RuleStore_dealloc(
+    PyObject* self)
+{
+  PyTypeObject* type = Py_TYPE(self);
+  RuleStore* object = (RuleStore*) self;
+
+  Py_XDECREF(object->rules);
+  Py_XDECREF(object->history);
+  Py_XDECREF(object->loader_args);
+  Py_XDECREF(object->loader_keywords);
+  Py_XDECREF(object->reload_error);
+
+  if (object->lock != NULL)
+    PyThread_free_lock(object->lock);
+
+  if (object->done != NULL)
+    PyThread_free_lock(object->done);
+
+  PyObject_Del(self);
+  release_type(type);
+}
+
+
+// Returns a new reference to the current version of the rules and counts a
+// scan for that version.
+
+static PyObject* rule_store_acquire(
+    RuleStore* store,
+    bool scan)
+{
+  PyObject* rules;
+
+  acquire_lock(store->lock);
+
+  rules = store->rules;
+  Py_INCREF(rules);
+
+  if (scan)
+    store->scans++;
+
+  PyThread_release_lock(store->lock);
+
+  return rules;
+}
+
+
+static PyObject* RuleStore_match(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  PyObject* rules = rule_store_acquire((RuleStore*) self, true);
+  PyObject* result = Rules_match(rules, args, keywords);
+
+  // If a new version was published during the scan this may be the last
+  // reference to the previous one, which is destroyed right here.
+
+  Py_DECREF(rules);
+
+  return result;
+}
+
+
+// Compiles or loads a new version of the rules in a background thread and
+// publishes it, replacing the current one. If that fails the current version
+// remains and the exception is saved for wait() to raise it.
+
+static void rule_store_reload_worker(
+    void* arg)
+{
+  RuleStore* store = (RuleStore*) arg;
+  PyThreadState* thread_state = PyThreadState_New(store->interpreter);
+
+  PyObject* module = NULL;
+  PyObject* rules;
+  PyObject* fingerprint;
+  PyObject* previous = NULL;
+  PyObject* error = NULL;
+  PyObject* loader_args;
+  PyObject* loader_keywords;
+  PyObject* version;
+  PyObject* scans;
+  PyObject* type;
+  PyObject* value;
+  PyObject* traceback;
+
+  // Without a thread state the GIL can't be acquired, the reload is simply
+  // abandoned, at the cost of leaking the references owned by this thread.
+
+  if (thread_state == NULL)
+  {
+    PyThread_acquire_lock(store->lock, WAIT_LOCK);
+    store->reloading = false;
+    PyThread_release_lock(store->lock);
+    PyThread_release_lock(store->done);
+    return;
+  }
+
+  PyEval_RestoreThread(thread_state);
+
+#if defined(USE_MODULE_STATE)
+  module = PyType_GetModuleByDef(Py_TYPE(store), &yara_module);
+#endif
+
+  rules = store->loader(module, store->loader_args, store->loader_keywords);
+
+  // The fingerprint is cached by the Rules object, computing it here makes
+  // reading the fingerprint of the new version cheap.
+
+  if (rules != NULL)
+  {
+    fingerprint = Rules_fingerprint((Rules*) rules);
+
+    if (fingerprint == NULL)
+      Py_CLEAR(rules);
+
+    Py_XDECREF(fingerprint);
+  }
+
+  if (rules == NULL)
+  {
+    PyErr_Fetch(&type, &value, &traceback);
+    PyErr_NormalizeException(&type, &value, &traceback);
+
+    error = Py_BuildValue(
+        "(OOO)",
+        type,
+        value != NULL ? value : Py_None,
+        traceback != NULL ? traceback : Py_None);
+
+    Py_XDECREF(type);
+    Py_XDECREF(value);
+    Py_XDECREF(traceback);
+    PyErr_Clear();
+  }
+
+  acquire_lock(store->lock);
+
+  if (rules != NULL)
+  {
+    version = PyLong_FromUnsignedLongLong(store->version);
+    scans = PyLong_FromUnsignedLongLong(store->scans);
+
+    if (version == NULL || scans == NULL ||
+        PyDict_SetItem(store->history, version, scans) != 0)
+      PyErr_Clear();
+
+    Py_XDECREF(version);
+    Py_XDECREF(scans);
+
+    previous = store->rules;
+
+    store->rules = rules;
+    store->version++;
+    store->scans = 0;
+    store->reload_latency = monotonic_time() - store->reload_started;
+  }
+  else
+  {
+    store->reload_error = error;
+  }
+
+  loader_args = store->loader_args;
+  loader_keywords = store->loader_keywords;
+
+  store->loader_args = NULL;
+  store->loader_keywords = NULL;
+  store->reloading = false;
+
+  PyThread_release_lock(store->lock);
+
+  Py_XDECREF(loader_args);
+  Py_XDECREF(loader_keywords);
+
+  // Scans that started with the previous version own references to it, it's
+  // destroyed here if there are none, or when the last of them finishes.
+
+  Py_XDECREF(previous);
+
+  PyThread_release_lock(store->done);
+  Py_DECREF(store);
+
+  PyThreadState_Clear(thread_state);
+  PyThreadState_DeleteCurrent();
+}
+
+
+static PyObject* RuleStore_reload(
+    PyObject* self,
+    PyObject* args,
+    PyObject* keywords)
+{
+  RuleStore* store = (RuleStore*) self;
+
+  PyObject* loader_keywords = NULL;
+  PyObject* compiled;
+  PyObject* error;
+
+  int is_compiled = 0;
+
+  // Arguments are those of yara.compile(), or of yara.load() with
+  // compiled=True.
+
+  if (keywords != NULL)
+  {
+    loader_keywords = PyDict_Copy(keywords);
+
+    if (loader_keywords == NULL)
+      return NULL;
+
+    compiled = PyDict_GetItemString(loader_keywords, "compiled");
+
+    if (compiled != NULL)
+    {
+      is_compiled = PyObject_IsTrue(compiled);
+
+      if (is_compiled == -1 ||
+          PyDict_DelItemString(loader_keywords, "compiled") != 0)
+      {
+        Py_DECREF(loader_keywords);
+        return NULL;
       }
     }
+  }
+
+  acquire_lock(store->lock);
+
+  if (store->reloading)
+  {
+    PyThread_release_lock(store->lock);
+    Py_XDECREF(loader_keywords);
+
+    return PyErr_Format(
+        PyExc_RuntimeError,
+        "RuleStore is already reloading");
+  }
+
+  // "done" is held while the reload runs, wait() blocks on it.
+
+  acquire_lock(store->done);
+
+  Py_INCREF(args);
+
+  error = store->reload_error;
+
+  store->loader = is_compiled ? yara_load : yara_compile;
+  store->loader_args = args;
+  store->loader_keywords = loader_keywords;
+  store->reload_error = NULL;
+  store->reload_started = monotonic_time();
+  store->reloading = true;
+  store->interpreter = PyThreadState_Get()->interp;
+
+  PyThread_release_lock(store->lock);
+
+  Py_XDECREF(error);
+
+  // Before Python 3.7 the GIL isn't created until some thread is started
+  // from Python, and the reloading thread needs it for its thread state.
+  #if PY_VERSION_HEX < 0x03070000
+  PyEval_InitThreads();
+  #endif
+
+  Py_INCREF(store);
+
+  if (PyThread_start_new_thread(
+        rule_store_reload_worker, store) == PYTHREAD_INVALID_THREAD_ID)
+  {
+    acquire_lock(store->lock);
+
+    store->loader_args = NULL;
+    store->loader_keywords = NULL;
+    store->reloading = false;
+
+    PyThread_release_lock(store->lock);
+    PyThread_release_lock(store->done);
+
+    Py_DECREF(args);
+    Py_XDECREF(loader_keywords);
+    Py_DECREF(store);
+
+    return PyErr_Format(
+        get_type_state(Py_TYPE(self))->YaraError,
+        "could not start reloading thread");
+  }
+
+  Py_RETURN_NONE;
+}
+
+
+static PyObject* RuleStore_wait(
+    PyObject* self,
+    PyObject* args)
+{
+  RuleStore* store = (RuleStore*) self;
+  PyObject* error;
+
+  Py_BEGIN_ALLOW_THREADS
+  PyThread_acquire_lock(store->done, WAIT_LOCK);
+  PyThread_release_lock(store->done);
+  Py_END_ALLOW_THREADS
+
+  acquire_lock(store->lock);
+  error = store->reload_error;
+  store->reload_error = NULL;
+  PyThread_release_lock(store->lock);
+
+  if (error != NULL)
+  {
+    PyObject* type = PyTuple_GET_ITEM(error, 0);
+    PyObject* value = PyTuple_GET_ITEM(error, 1);
+    PyObject* traceback = PyTuple_GET_ITEM(error, 2);
+
+    Py_INCREF(type);
+    Py_INCREF(value);
+
+    if (traceback != Py_None)
+      Py_INCREF(traceback);
     else
+      traceback = NULL;
+
+    PyErr_Restore(type, value, traceback);
+    Py_DECREF(error);
+
+    return NULL;
+  }
+
+  Py_RETURN_NONE;
+}
+
+
+static PyObject* RuleStore_rules(
+    PyObject* self,
+    void* closure)
+{
+  return rule_store_acquire((RuleStore*) self, false);
+}
+
+
+static PyObject* RuleStore_fingerprint(
+    PyObject* self,
+    void* closure)
+{
+  PyObject* rules = rule_store_acquire((RuleStore*) self, false);
+  PyObject* digest = Rules_fingerprint((Rules*) rules);
+  PyObject* result;
+
+  char hex[2 * 64 + 1];
+  char* data;
+  Py_ssize_t length;
+  Py_ssize_t i;
+
+  Py_DECREF(rules);
+
+  if (digest == NULL)
+    return NULL;
+
+  data = PyBytes_AsString(digest);
+  length = PyBytes_Size(digest);
+
+  for (i = 0; i < length && i < 64; i++)
+    sprintf(hex + 2 * i, "%02x", (uint8_t) data[i]);
+
+  hex[2 * i] = '\0';
+
+  result = PY_STRING(hex);
+  Py_DECREF(digest);
+
+  return result;
+}
+
+
+static PyObject* RuleStore_reload_latency(
+    PyObject* self,
+    void* closure)
+{
+  RuleStore* store = (RuleStore*) self;
+  double latency;
+
+  acquire_lock(store->lock);
+  latency = store->reload_latency;
+  PyThread_release_lock(store->lock);
+
+  if (latency < 0)
+    Py_RETURN_NONE;
+
+  return PyFloat_FromDouble(latency);
+}
+
+
+static PyObject* RuleStore_scans(
+    PyObject* self,
+    void* closure)
+{
+  RuleStore* store = (RuleStore*) self;
+
+  PyObject* result;
+  PyObject* version;
+  PyObject* scans;
+
+  acquire_lock(store->lock);
+
+  result = PyDict_Copy(store->history);
+  version = PyLong_FromUnsignedLongLong(store->version);
+  scans = PyLong_FromUnsignedLongLong(store->scans);
+
+  PyThread_release_lock(store->lock);
+
+  if (result != NULL && (version == NULL || scans == NULL ||
+      PyDict_SetItem(result, version, scans) != 0))
+    Py_CLEAR(result);
+
+  Py_XDECREF(version);
+  Py_XDECREF(scans);
+
+  return result;
+}
+
+
+static PyObject* RuleStore_reloading(
+    PyObject* self,
+    void* closure)
+{
+  RuleStore* store = (RuleStore*) self;
+  bool reloading;
+
+  acquire_lock(store->lock);
+  reloading = store->reloading;
+  PyThread_release_lock(store->lock);
+
+  return PyBool_FromLong(reloading);
+}
+
+
+static void Metrics_dealloc(
+    PyObject* self)
+{
+  PyTypeObject* type = Py_TYPE(self);
+
+  PyObject_Del(self);
+  release_type(type);
+}
+
+
+static PyObject* Metrics_enable(
+    PyObject* self,
+    PyObject* args)
+{
+  metrics_enabled = 1;
+
+  Py_RETURN_NONE;
+}
+
+
+static PyObject* Metrics_disable(
+    PyObject* self,
+    PyObject* args)
+{
+  metrics_enabled = 0;
+
+  Py_RETURN_NONE;
+}
+
+
+static PyObject* Metrics_enabled(
+    PyObject* self,
+    void* closure)
+{
+  return PyBool_FromLong(metrics_enabled);
+}
+
+
+static PyObject* Metrics_reset(
+    PyObject* self,
+    PyObject* args)
+{
+  volatile uint64_t* counters = (volatile uint64_t*) &metrics;
+  size_t i;
+
+  for (i = 0; i < sizeof(METRICS) / sizeof(uint64_t); i++)
+    metrics_clear(&counters[i]);
+
+  spin_lock(&metrics_rules_lock);
+
+  for (i = 0; i < METRICS_MAX_RULES; i++)
+  {
+    free(metrics_rules[i].ns);
+    free(metrics_rules[i].identifier);
+  }
+
+  memset(metrics_rules, 0, sizeof(metrics_rules));
+
+  spin_unlock(&metrics_rules_lock);
+
+  Py_RETURN_NONE;
+}
+
+
+// Copies the rules that have hits, so that Python objects are not created
+// while holding the spin lock. Returns the number of rules copied, or -1 if
+// there is not enough memory.
+
+static Py_ssize_t metrics_copy_rules(
+    METRICS_RULE** copy)
+{
+  Py_ssize_t count = 0;
+  size_t i;
+
+  *copy = (METRICS_RULE*) calloc(METRICS_MAX_RULES, sizeof(METRICS_RULE));
+
+  if (*copy == NULL)
+    return -1;
+
+  spin_lock(&metrics_rules_lock);
+
+  for (i = 0; i < METRICS_MAX_RULES; i++)
+  {
+    if (metrics_rules[i].identifier == NULL)
+      continue;
+
+    (*copy)[count].ns = strdup(metrics_rules[i].ns);
+    (*copy)[count].identifier = strdup(metrics_rules[i].identifier);
+    (*copy)[count].hits = metrics_rules[i].hits;
+
+    if ((*copy)[count].ns == NULL || (*copy)[count].identifier == NULL)
     {
-      result = PyErr_Format(
-          PyExc_TypeError,
-          "compile() takes 1 argument");
+      count = -1;
+      break;
     }
 
-    if (warning_error && PyList_Size(warnings) > 0)
-    {
-      PyErr_SetObject(YaraWarningError, warnings);
-    }
+    count++;
+  }
+
+  spin_unlock(&metrics_rules_lock);
+
+  return count;
+}
+
+
+static void metrics_free_rules(
+    METRICS_RULE* copy)
+{
+  size_t i;
+
+  for (i = 0; i < METRICS_MAX_RULES; i++)
+  {
+    free(copy[i].ns);
+    free(copy[i].identifier);
+  }
+
+  free(copy);
+}
+
+
+static PyObject* Metrics_as_dict(
+    PyObject* self,
+    PyObject* args)
+{
+  PyObject* result;
+  PyObject* errors;
+  PyObject* rule_hits;
+  PyObject* buckets;
+  PyObject* object;
+
+  METRICS_RULE* rules;
+  Py_ssize_t num_rules;
+  Py_ssize_t i;
+
+  uint64_t count = 0;
+  uint64_t value;
+
+  num_rules = metrics_copy_rules(&rules);
+
+  if (num_rules == -1)
+  {
+    if (rules != NULL)
+      metrics_free_rules(rules);
+
+    return PyErr_NoMemory();
+  }
+
+  errors = PyDict_New();
+  rule_hits = PyDict_New();
+  buckets = PyList_New(0);
+
+  for (i = 0; errors != NULL && i < METRICS_MAX_ERROR; i++)
+  {
+    value = metrics_add(&metrics.errors[i], 0);
+
+    if (value == 0)
+      continue;
+
+    object = Py_BuildValue("K", (unsigned long long) value);
+
+    if (object == NULL || PyDict_SetItem(errors, PyLong_FromLong((long) i), object) != 0)
+      Py_CLEAR(errors);
+
+    Py_XDECREF(object);
+  }
+
+  for (i = 0; rule_hits != NULL && i < num_rules; i++)
+  {
+    PyObject* key = Py_BuildValue("(ss)", rules[i].ns, rules[i].identifier);
+
+    object = Py_BuildValue("K", (unsigned long long) rules[i].hits);
+
+    if (key == NULL || object == NULL ||
+        PyDict_SetItem(rule_hits, key, object) != 0)
+      Py_CLEAR(rule_hits);
+
+    Py_XDECREF(key);
+    Py_XDECREF(object);
+  }
+
+  metrics_free_rules(rules);
 
-    if (PyErr_Occurred() == NULL)
-    {
-      rules = Rules_NEW();
+  // Histogram buckets are cumulative, as in Prometheus.
 
-      if (rules != NULL)
-      {
-        Py_BEGIN_ALLOW_THREADS
-        error = yr_compiler_get_rules(compiler, &yara_rules);
-        Py_END_ALLOW_THREADS
+  for (i = 0; buckets != NULL && i <= METRICS_LATENCY_BUCKETS; i++)
+  {
+    count += metrics_add(&metrics.latency[i], 0);
 
-        if (error == ERROR_SUCCESS)
-        {
-          rules->rules = yara_rules;
-          rules->iter_current_rule = rules->rules->rules_table;
-          rules->warnings = warnings;
+    object = Py_BuildValue(
+        "(dK)",
+        i < METRICS_LATENCY_BUCKETS ? metrics_latency_bounds[i] : Py_HUGE_VAL,
+        (unsigned long long) count);
 
-          if (externals != NULL && externals != Py_None)
-            rules->externals = PyDict_Copy(externals);
+    if (object == NULL || PyList_Append(buckets, object) != 0)
+      Py_CLEAR(buckets);
 
-          result = (PyObject*) rules;
-        }
-        else
-        {
-          Py_DECREF(rules);
-          result = handle_error(error, NULL);
-        }
-      }
-      else
-      {
-        result = handle_error(ERROR_INSUFFICIENT_MEMORY, NULL);
-      }
-    }
+    Py_XDECREF(object);
+  }
 
-    yr_compiler_destroy(compiler);
-    Py_XDECREF(include_callback);
+  if (errors == NULL || rule_hits == NULL || buckets == NULL)
+  {
+    Py_XDECREF(errors);
+    Py_XDECREF(rule_hits);
+    Py_XDECREF(buckets);
+    return NULL;
   }
 
+  result = Py_BuildValue(
+      "{s:K,s:K,s:K,s:K,s:N,s:N,s:K,s:{s:N,s:K,s:d}}",
+      "scans", (unsigned long long) metrics_add(&metrics.scans, 0),
+      "scanned_bytes", (unsigned long long) metrics_add(&metrics.scanned_bytes, 0),
+      "timeouts", (unsigned long long) metrics_add(&metrics.timeouts, 0),
+      "too_many_matches",
+      (unsigned long long) metrics_add(&metrics.too_many_matches, 0),
+      "errors", errors,
+      "rule_hits", rule_hits,
+      "dropped_rule_hits",
+      (unsigned long long) metrics_add(&metrics.dropped_rule_hits, 0),
+      "scan_latency",
+      "buckets", buckets,
+      "count", (unsigned long long) count,
+      "sum", metrics_add(&metrics.latency_sum, 0) / 1e6);
+
   return result;
 }
 
 
-static PyObject* yara_load(
-    PyObject* self,
-    PyObject* args,
-    PyObject* keywords)
+// Writes formatted text into "text". Lines written with this function are
+// short, longer strings like namespaces are written with metrics_write_label.
+
+static void metrics_write(
+    ENCODER* text,
+    const char* format,
+    ...)
 {
-  static char* kwlist[] = {
-      "filepath", "file",  NULL
-      };
+  char line[256];
+  va_list args;
+  int length;
 
-  YR_EXTERNAL_VARIABLE* external;
+  va_start(args, format);
+  length = vsnprintf(line, sizeof(line), format, args);
+  va_end(args);
 
-  Rules* rules = NULL;
-  PyObject* file = NULL;
-  char* filepath = NULL;
+  if (length >= (int) sizeof(line))
+    length = sizeof(line) - 1;
 
-  int error;
+  if (length > 0)
+    encoder_write(text, line, length);
+}
 
-  if (!PyArg_ParseTupleAndKeywords(
-      args,
-      keywords,
-      "|sO",
-      kwlist,
-      &filepath,
-      &file))
+
+// Writes a label value escaped as required by OpenMetrics.
+
+static void metrics_write_label(
+    ENCODER* text,
+    const char* value)
+{
+  for (; *value != '\0'; value++)
   {
-    return NULL;
+    if (*value == '\\' || *value == '"')
+    {
+      encoder_write_byte(text, '\\');
+      encoder_write_byte(text, *value);
+    }
+    else if (*value == '\n')
+    {
+      encoder_write(text, "\\n", 2);
+    }
+    else
+    {
+      encoder_write_byte(text, *value);
+    }
   }
+}
 
-  if (filepath != NULL)
+
+static void metrics_write_counter(
+    ENCODER* text,
+    const char* name,
+    const char* help,
+    uint64_t value)
+{
+  metrics_write(text, "# TYPE %s counter\n", name);
+  metrics_write(text, "# HELP %s %s\n", name, help);
+  metrics_write(text, "%s_total %llu\n", name, (unsigned long long) value);
+}
+
+
+static PyObject* Metrics_openmetrics(
+    PyObject* self,
+    PyObject* args)
+{
+  PyObject* result = NULL;
+  ENCODER text;
+
+  METRICS_RULE* rules;
+  Py_ssize_t num_rules;
+  Py_ssize_t i;
+
+  uint64_t count = 0;
+  uint64_t value;
+
+  num_rules = metrics_copy_rules(&rules);
+
+  if (num_rules == -1)
   {
-    rules = Rules_NEW();
+    if (rules != NULL)
+      metrics_free_rules(rules);
 
-    if (rules == NULL)
-      return PyErr_NoMemory();
+    return PyErr_NoMemory();
+  }
 
-    Py_BEGIN_ALLOW_THREADS;
-    error = yr_rules_load(filepath, &rules->rules);
-    Py_END_ALLOW_THREADS;
+  memset(&text, 0, sizeof(text));
 
-    if (error != ERROR_SUCCESS)
-    {
-      Py_DECREF(rules);
-      return handle_error(error, filepath);
-    }
+  metrics_write_counter(
+      &text,
+      "yara_scans",
+      "Scans started by Rules.match() and Rules.match_processes().",
+      metrics_add(&metrics.scans, 0));
+
+  metrics_write_counter(
+      &text,
+      "yara_scanned_bytes",
+      "Bytes of files and data scanned successfully.",
+      metrics_add(&metrics.scanned_bytes, 0));
+
+  metrics_write_counter(
+      &text,
+      "yara_scan_timeouts",
+      "Scans that timed out.",
+      metrics_add(&metrics.timeouts, 0));
+
+  metrics_write_counter(
+      &text,
+      "yara_too_many_matches",
+      "Strings that reached the maximum number of matches in a scan.",
+      metrics_add(&metrics.too_many_matches, 0));
+
+  metrics_write(&text, "# TYPE yara_errors counter\n");
+  metrics_write(&text, "# HELP yara_errors Errors by libyara error code.\n");
+
+  for (i = 0; i < METRICS_MAX_ERROR; i++)
+  {
+    value = metrics_add(&metrics.errors[i], 0);
+
+    if (value > 0)
+      metrics_write(
+          &text,
+          "yara_errors_total{code=\"%d\"} %llu\n",
+          (int) i,
+          (unsigned long long) value);
   }
-  else if (file != NULL && PyObject_HasAttrString(file, "read"))
+
+  metrics_write(&text, "# TYPE yara_rule_hits counter\n");
+  metrics_write(&text, "# HELP yara_rule_hits Scans matching each rule.\n");
+
+  for (i = 0; i < num_rules; i++)
   {
-    YR_STREAM stream;
+    metrics_write(&text, "yara_rule_hits_total{namespace=\"");
+    metrics_write_label(&text, rules[i].ns);
+    metrics_write(&text, "\",rule=\"");
+    metrics_write_label(&text, rules[i].identifier);
+    metrics_write(&text, "\"} %llu\n", (unsigned long long) rules[i].hits);
+  }
 
-    stream.user_data = file;
-    stream.read = flo_read;
+  metrics_free_rules(rules);
 
-    rules = Rules_NEW();
+  metrics_write_counter(
+      &text,
+      "yara_dropped_rule_hits",
+      "Rule hits not counted because too many rules have hits.",
+      metrics_add(&metrics.dropped_rule_hits, 0));
 
-    if (rules == NULL)
-      return PyErr_NoMemory();
+  metrics_write(&text, "# TYPE yara_scan_duration_seconds histogram\n");
+  metrics_write(
+      &text, "# HELP yara_scan_duration_seconds Duration of scans.\n");
 
-    Py_BEGIN_ALLOW_THREADS;
-    error = yr_rules_load_stream(&stream, &rules->rules);
-    Py_END_ALLOW_THREADS;
+  for (i = 0; i <= METRICS_LATENCY_BUCKETS; i++)
+  {
+    count += metrics_add(&metrics.latency[i], 0);
 
-    if (error != ERROR_SUCCESS)
-    {
-      Py_DECREF(rules);
-      return handle_error(error, "<file-like-object>");
-    }
+    metrics_write(
+        &text,
+        "yara_scan_duration_seconds_bucket{le=\"%s\"} %llu\n",
+        i < METRICS_LATENCY_BUCKETS ? metrics_latency_labels[i] : "+Inf",
+        (unsigned long long) count);
+  }
+
+  metrics_write(
+      &text,
+      "yara_scan_duration_seconds_count %llu\n",
+      (unsigned long long) count);
+  metrics_write(
+      &text,
+      "yara_scan_duration_seconds_sum %.6f\n",
+      metrics_add(&metrics.latency_sum, 0) / 1e6);
+  metrics_write(&text, "# EOF\n");
+
+  if (text.failed)
+  {
+    PyErr_NoMemory();
   }
   else
   {
-    return PyErr_Format(
-      PyExc_TypeError,
-      "load() expects either a file path or a file-like object");
+    #if PY_MAJOR_VERSION >= 3
+    result = PyUnicode_DecodeUTF8(
+        (char*) text.buffer, text.length, "replace");
+    #else
+    result = PyString_FromStringAndSize((char*) text.buffer, text.length);
+    #endif
   }
 
-  external = rules->rules->ext_vars_table;
-  rules->iter_current_rule = rules->rules->rules_table;
+  free(text.buffer);
 
-  if (!EXTERNAL_VARIABLE_IS_NULL(external))
-    rules->externals = PyDict_New();
+  return result;
+}
 
-  while (!EXTERNAL_VARIABLE_IS_NULL(external))
-  {
-    switch(external->type)
-    {
-      case EXTERNAL_VARIABLE_TYPE_BOOLEAN:
-        PyDict_SetItemString(
-            rules->externals,
-            external->identifier,
-            PyBool_FromLong((long) external->value.i));
-        break;
-      case EXTERNAL_VARIABLE_TYPE_INTEGER:
-        PyDict_SetItemString(
-            rules->externals,
-            external->identifier,
-            PyLong_FromLong((long) external->value.i));
-        break;
-      case EXTERNAL_VARIABLE_TYPE_FLOAT:
-        PyDict_SetItemString(
-            rules->externals,
-            external->identifier,
-            PyFloat_FromDouble(external->value.f));
-        break;
-      case EXTERNAL_VARIABLE_TYPE_STRING:
-        PyDict_SetItemString(
-            rules->externals,
-            external->identifier,
-            PY_STRING(external->value.s));
-        break;
-    }
 
-    external++;
-  }
+#if defined(USE_MODULE_STATE)
 
-  return (PyObject*) rules;
+// libyara's initialization is reference counted but not thread-safe, and
+// interpreters with their own GIL can import or release the module at the
+// same time, so a spin lock serializes it.
+
+static volatile long yara_init_lock = 0;
+
+static void lock_yara_init(void)
+{
+  spin_lock(&yara_init_lock);
+}
+
+
+static void unlock_yara_init(void)
+{
+  spin_unlock(&yara_init_lock);
 }
 
+#else
+
+static void lock_yara_init(void) {}
+static void unlock_yara_init(void) {}
+
+#endif
+
 
 void finalize(void)
 {
+  lock_yara_init();
   yr_finalize();
+  unlock_yara_init();
 }
 
 
@@ -2654,6 +11443,18 @@ static PyMethodDef yara_methods[] = {
     METH_VARARGS | METH_KEYWORDS,
     "Set a yara configuration variable (stack_size, max_strings_per_rule, or max_match_data)"
   },
+  {
+    "dumps_matches",
+    (PyCFunction) yara_dumps_matches,
+    METH_VARARGS | METH_KEYWORDS,
+    "Serializes a list of Match objects to JSON or msgpack"
+  },
+  {
+    "_match",
+    (PyCFunction) yara_match,
+    METH_VARARGS,
+    "Rebuilds a pickled Match object"
+  },
   { NULL, NULL }
 };
 
@@ -2692,14 +11493,16 @@ static PyGetSetDef YaraWarningError_getsetters[] = {
 };
 
 
-MOD_INIT(yara)
-{
-  PyObject* m;
-
-  MOD_DEF(m, "yara", YARA_DOC, yara_methods)
+// Creates the module's exceptions and types and initializes libyara. With
+// multi-phase initialization this happens for every module object, there is
+// one per interpreter importing the module.
 
-  if (m == NULL)
-    return MOD_ERROR_VAL;
+static int yara_exec(
+    PyObject* m)
+{
+  YARA_STATE* state = get_module_state(m);
+  PyObject* metrics_object;
+  int error;
 
   /* initialize module variables/constants */
 
@@ -2709,60 +11512,284 @@ MOD_INIT(yara)
   PyModule_AddIntConstant(m, "CALLBACK_NON_MATCHES", CALLBACK_NON_MATCHES);
   PyModule_AddIntConstant(m, "CALLBACK_ALL", CALLBACK_ALL);
   PyModule_AddIntConstant(m, "CALLBACK_TOO_MANY_MATCHES", CALLBACK_MSG_TOO_MANY_MATCHES);
+  PyModule_AddIntConstant(
+      m, "ATOM_QUALITY_WARNING_THRESHOLD", YR_ATOM_QUALITY_WARNING_THRESHOLD);
   PyModule_AddStringConstant(m, "__version__", YR_VERSION);
   PyModule_AddStringConstant(m, "YARA_VERSION", YR_VERSION);
   PyModule_AddIntConstant(m, "YARA_VERSION_HEX", YR_VERSION_HEX);
 
 #if PYTHON_API_VERSION >= 1007
-  YaraError = PyErr_NewException("yara.Error", PyExc_Exception, NULL);
-  YaraSyntaxError = PyErr_NewException("yara.SyntaxError", YaraError, NULL);
-  YaraTimeoutError = PyErr_NewException("yara.TimeoutError", YaraError, NULL);
-  YaraWarningError = PyErr_NewException("yara.WarningError", YaraError, NULL);
-
-  PyTypeObject *YaraWarningError_type = (PyTypeObject *) YaraWarningError;
+  state->YaraError = PyErr_NewException("yara.Error", PyExc_Exception, NULL);
+  state->YaraSyntaxError = PyErr_NewException("yara.SyntaxError", state->YaraError, NULL);
+  state->YaraTimeoutError = PyErr_NewException("yara.TimeoutError", state->YaraError, NULL);
+  state->YaraWarningError = PyErr_NewException("yara.WarningError", state->YaraError, NULL);
+
+  if (state->YaraError == NULL ||
+      state->YaraSyntaxError == NULL ||
+      state->YaraTimeoutError == NULL ||
+      state->YaraWarningError == NULL)
+    return -1;
+
+  PyTypeObject *YaraWarningError_type = (PyTypeObject *) state->YaraWarningError;
   PyObject* descr = PyDescr_NewGetSet(YaraWarningError_type, YaraWarningError_getsetters);
 
   if (PyDict_SetItem(YaraWarningError_type->tp_dict, PyDescr_NAME(descr), descr) < 0)
   {
-    Py_DECREF(m);
     Py_DECREF(descr);
+    return -1;
   }
 
   Py_DECREF(descr);
 #else
-  YaraError = Py_BuildValue("s", "yara.Error");
-  YaraSyntaxError = Py_BuildValue("s", "yara.SyntaxError");
-  YaraTimeoutError = Py_BuildValue("s", "yara.TimeoutError");
-  YaraWarningError = Py_BuildValue("s", "yara.WarningError");
+  state->YaraError = Py_BuildValue("s", "yara.Error");
+  state->YaraSyntaxError = Py_BuildValue("s", "yara.SyntaxError");
+  state->YaraTimeoutError = Py_BuildValue("s", "yara.TimeoutError");
+  state->YaraWarningError = Py_BuildValue("s", "yara.WarningError");
 #endif
 
+#if defined(USE_MODULE_STATE)
+  state->Rule_Type = (PyTypeObject*) PyType_FromModuleAndSpec(
+      m, &Rule_Type_spec, NULL);
+  state->Rules_Type = (PyTypeObject*) PyType_FromModuleAndSpec(
+      m, &Rules_Type_spec, NULL);
+  state->RulesIterator_Type = (PyTypeObject*) PyType_FromModuleAndSpec(
+      m, &RulesIterator_Type_spec, NULL);
+  state->Match_Type = (PyTypeObject*) PyType_FromModuleAndSpec(
+      m, &Match_Type_spec, NULL);
+  state->Externals_Type = (PyTypeObject*) PyType_FromModuleAndSpec(
+      m, &Externals_Type_spec, NULL);
+  state->ScanPool_Type = (PyTypeObject*) PyType_FromModuleAndSpec(
+      m, &ScanPool_Type_spec, NULL);
+  state->ResultCache_Type = (PyTypeObject*) PyType_FromModuleAndSpec(
+      m, &ResultCache_Type_spec, NULL);
+  state->RuleStore_Type = (PyTypeObject*) PyType_FromModuleAndSpec(
+      m, &RuleStore_Type_spec, NULL);
+  state->Metrics_Type = (PyTypeObject*) PyType_FromModuleAndSpec(
+      m, &Metrics_Type_spec, NULL);
+  state->RuleString_Type = PyStructSequence_NewType(&RuleString_Desc);
+
+  if (state->Rule_Type == NULL ||
+      state->Rules_Type == NULL ||
+      state->RulesIterator_Type == NULL ||
+      state->Match_Type == NULL ||
+      state->Externals_Type == NULL ||
+      state->ScanPool_Type == NULL ||
+      state->ResultCache_Type == NULL ||
+      state->RuleStore_Type == NULL ||
+      state->Metrics_Type == NULL ||
+      state->RuleString_Type == NULL)
+    return -1;
+#else
   if (PyType_Ready(&Rule_Type) < 0)
-    return MOD_ERROR_VAL;
+    return -1;
 
   if (PyType_Ready(&Rules_Type) < 0)
-    return MOD_ERROR_VAL;
+    return -1;
+
+  if (PyType_Ready(&RulesIterator_Type) < 0)
+    return -1;
 
   if (PyType_Ready(&Match_Type) < 0)
-    return MOD_ERROR_VAL;
+    return -1;
+
+  if (PyType_Ready(&Externals_Type) < 0)
+    return -1;
+
+  if (PyType_Ready(&ScanPool_Type) < 0)
+    return -1;
+
+  if (PyType_Ready(&ResultCache_Type) < 0)
+    return -1;
+
+  if (PyType_Ready(&RuleStore_Type) < 0)
+    return -1;
+
+  if (PyType_Ready(&Metrics_Type) < 0)
+    return -1;
 
   PyStructSequence_InitType(&RuleString_Type, &RuleString_Desc);
 
-  PyModule_AddObject(m, "Rule", (PyObject*) &Rule_Type);
-  PyModule_AddObject(m, "Rules", (PyObject*) &Rules_Type);
-  PyModule_AddObject(m, "Match",  (PyObject*) &Match_Type);
+  state->Rule_Type = &Rule_Type;
+  state->Rules_Type = &Rules_Type;
+  state->RulesIterator_Type = &RulesIterator_Type;
+  state->Match_Type = &Match_Type;
+  state->Externals_Type = &Externals_Type;
+  state->ScanPool_Type = &ScanPool_Type;
+  state->ResultCache_Type = &ResultCache_Type;
+  state->RuleStore_Type = &RuleStore_Type;
+  state->Metrics_Type = &Metrics_Type;
+  state->RuleString_Type = &RuleString_Type;
+#endif
+
+  // PyModule_AddObject steals a reference, the state keeps its own.
+
+  Py_INCREF(state->Rule_Type);
+  Py_INCREF(state->Rules_Type);
+  Py_INCREF(state->Match_Type);
+  Py_INCREF(state->Externals_Type);
+  Py_INCREF(state->ScanPool_Type);
+  Py_INCREF(state->ResultCache_Type);
+  Py_INCREF(state->RuleStore_Type);
 
-  PyModule_AddObject(m, "Error", YaraError);
-  PyModule_AddObject(m, "SyntaxError", YaraSyntaxError);
-  PyModule_AddObject(m, "TimeoutError", YaraTimeoutError);
-  PyModule_AddObject(m, "WarningError", YaraWarningError);
+  PyModule_AddObject(m, "Rule", (PyObject*) state->Rule_Type);
+  PyModule_AddObject(m, "Rules", (PyObject*) state->Rules_Type);
+  PyModule_AddObject(m, "Match",  (PyObject*) state->Match_Type);
+  PyModule_AddObject(m, "Externals", (PyObject*) state->Externals_Type);
+  PyModule_AddObject(m, "ScanPool", (PyObject*) state->ScanPool_Type);
+  PyModule_AddObject(m, "ResultCache", (PyObject*) state->ResultCache_Type);
+  PyModule_AddObject(m, "RuleStore", (PyObject*) state->RuleStore_Type);
 
-  if (yr_initialize() != ERROR_SUCCESS)
+  // The metrics are process-wide, yara.metrics is their only instance.
+
+  metrics_object = (PyObject*) PyObject_New(Metrics, state->Metrics_Type);
+
+  if (metrics_object == NULL)
+    return -1;
+
+  PyModule_AddObject(m, "metrics", metrics_object);
+
+  Py_INCREF(state->YaraError);
+  Py_INCREF(state->YaraSyntaxError);
+  Py_INCREF(state->YaraTimeoutError);
+  Py_INCREF(state->YaraWarningError);
+
+  PyModule_AddObject(m, "Error", state->YaraError);
+  PyModule_AddObject(m, "SyntaxError", state->YaraSyntaxError);
+  PyModule_AddObject(m, "TimeoutError", state->YaraTimeoutError);
+  PyModule_AddObject(m, "WarningError", state->YaraWarningError);
+
+  lock_yara_init();
+  error = yr_initialize();
+  unlock_yara_init();
+
+  if (error != ERROR_SUCCESS)
   {
-    PyErr_SetString(YaraError, "initialization error");
-    return MOD_ERROR_VAL;
+    PyErr_SetString(state->YaraError, "initialization error");
+    return -1;
   }
 
+  state->initialized = true;
+
+#if !defined(USE_MODULE_STATE)
   Py_AtExit(finalize);
+#endif
+
+  return 0;
+}
+
+
+#if defined(USE_MODULE_STATE)
+
+static int yara_traverse(
+    PyObject* m,
+    visitproc visit,
+    void* arg)
+{
+  YARA_STATE* state = get_module_state(m);
+
+  Py_VISIT(state->YaraError);
+  Py_VISIT(state->YaraSyntaxError);
+  Py_VISIT(state->YaraTimeoutError);
+  Py_VISIT(state->YaraWarningError);
+  Py_VISIT(state->Rule_Type);
+  Py_VISIT(state->Rules_Type);
+  Py_VISIT(state->RulesIterator_Type);
+  Py_VISIT(state->Match_Type);
+  Py_VISIT(state->Externals_Type);
+  Py_VISIT(state->ScanPool_Type);
+  Py_VISIT(state->ResultCache_Type);
+  Py_VISIT(state->RuleStore_Type);
+  Py_VISIT(state->Metrics_Type);
+  Py_VISIT(state->RuleString_Type);
+
+  return 0;
+}
+
+
+static int yara_clear(
+    PyObject* m)
+{
+  YARA_STATE* state = get_module_state(m);
+
+  Py_CLEAR(state->YaraError);
+  Py_CLEAR(state->YaraSyntaxError);
+  Py_CLEAR(state->YaraTimeoutError);
+  Py_CLEAR(state->YaraWarningError);
+  Py_CLEAR(state->Rule_Type);
+  Py_CLEAR(state->Rules_Type);
+  Py_CLEAR(state->RulesIterator_Type);
+  Py_CLEAR(state->Match_Type);
+  Py_CLEAR(state->Externals_Type);
+  Py_CLEAR(state->ScanPool_Type);
+  Py_CLEAR(state->ResultCache_Type);
+  Py_CLEAR(state->RuleStore_Type);
+  Py_CLEAR(state->Metrics_Type);
+  Py_CLEAR(state->RuleString_Type);
+
+  return 0;
+}
+
+
+static void yara_free(
+    void* m)
+{
+  YARA_STATE* state = get_module_state((PyObject*) m);
+
+  yara_clear((PyObject*) m);
+
+  if (state->initialized)
+  {
+    finalize();
+    state->initialized = false;
+  }
+}
+
+
+static PyModuleDef_Slot yara_slots[] = {
+  {Py_mod_exec, yara_exec},
+#if PY_VERSION_HEX >= 0x030C0000
+  {Py_mod_multiple_interpreters, Py_MOD_PER_INTERPRETER_GIL_SUPPORTED},
+#endif
+#if PY_VERSION_HEX >= 0x030D0000
+  {Py_mod_gil, Py_MOD_GIL_NOT_USED},
+#endif
+  {0, NULL}
+};
+
+
+static struct PyModuleDef yara_module = {
+  PyModuleDef_HEAD_INIT,
+  "yara",
+  YARA_DOC,
+  sizeof(YARA_STATE),
+  yara_methods,
+  yara_slots,
+  yara_traverse,
+  yara_clear,
+  yara_free
+};
+
+
+PyMODINIT_FUNC PyInit_yara(void)
+{
+  return PyModuleDef_Init(&yara_module);
+}
+
+#else
+
+MOD_INIT(yara)
+{
+  PyObject* m;
+
+  MOD_DEF(m, "yara", YARA_DOC, yara_methods)
+
+  if (m == NULL)
+    return MOD_ERROR_VAL;
+
+  if (yara_exec(m) != 0)
+    return MOD_ERROR_VAL;
 
   return MOD_SUCCESS_VAL(m);
 }
+
+#endif
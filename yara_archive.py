@@ -0,0 +1,399 @@
+#
+# Copyright (c) 2007-2013. The YARA Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Archive scanning for yara-python.
+
+Implements Rules.match_archive(), which scans the members of zip, tar, gzip,
+bzip2 and xz archives without extracting them to disk:
+
+  for member in rules.match_archive('samples.tar.gz', max_depth=2):
+    print(member.path, member.matches)
+
+Members are decompressed in the calling thread while the members read before
+them are scanned by worker threads, and results are yielded in the order in
+which members appear in the archive. Members that are archives themselves are
+scanned as a whole, and their own members are scanned too as long as they are
+less than "max_depth" levels deep.
+
+The size of each member, the total size of the decompressed data and the
+compression ratio of each member are limited, so that a small malicious
+archive can't make the scan use huge amounts of memory or time.
+"""
+
+import bz2
+import collections
+import gzip
+import io
+import os
+import sys
+import tarfile
+import threading
+import zipfile
+import zlib
+
+try:
+  import lzma
+except ImportError:
+  lzma = None
+
+try:
+  from os import cpu_count
+except ImportError:
+  from multiprocessing import cpu_count
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import yara
+
+
+class ArchiveMember(collections.namedtuple(
+    'ArchiveMember', ['path', 'depth', 'size', 'matches', 'error'])):
+  """A scanned member of an archive.
+
+  "path" is the path of the member in the archive, members of nested archives
+  have the path of the nested archive as prefix. "depth" is 0 for the members
+  of the scanned archive, 1 for the members of archives contained in it, and
+  so on. "matches" is the list returned by Rules.match(), or None if the
+  member couldn't be read or scanned, in which case "error" is the exception
+  raised.
+  """
+
+  __slots__ = ()
+
+
+class ArchiveError(yara.Error):
+  """A member that couldn't be read, or exceeds the limits of the scan."""
+
+
+class _RatioError(ArchiveError):
+  """A member that exceeds "max_ratio"."""
+
+
+_CHUNK_SIZE = 1 << 20
+
+# Small members compress very well, the ratio is checked only for members
+# larger than this.
+_MIN_RATIO_SIZE = 1 << 20
+
+_ARCHIVE_ERRORS = (
+    EOFError,
+    IOError,
+    OSError,
+    NotImplementedError,
+    RuntimeError,
+    ValueError,
+    tarfile.TarError,
+    zipfile.BadZipfile,
+    zipfile.LargeZipFile,
+    zlib.error) + ((lzma.LZMAError,) if lzma is not None else ())
+
+_SUFFIXES = ('.gz', '.tgz', '.bz2', '.xz', '.txz')
+
+
+def _decompressor(head):
+  """Returns a function that opens a file object decompressing another one, or
+  None if "head" is not the beginning of a gzip, bzip2 or xz stream."""
+  if head[:2] == b'\x1f\x8b':
+    return lambda fileobj: gzip.GzipFile(fileobj=fileobj, mode='rb')
+  if head[:3] == b'BZh' and sys.version_info[0] >= 3:
+    return bz2.BZ2File
+  if head[:6] == b'\xfd7zXZ\x00' and lzma is not None:
+    return lzma.LZMAFile
+  return None
+
+
+def _is_zip(head):
+  return head[:4] in (b'PK\x03\x04', b'PK\x05\x06')
+
+
+def _is_tar(head):
+  return head[257:262] == b'ustar'
+
+
+def _iter_members(fileobj, name, size):
+  """Yields (name, compressed_size, declared_size, file) for each member of
+  the archive in "fileobj", which must be seekable. Sizes are None when not
+  known. The members of a compressed tar file have no compressed size of
+  their own, "compressed_size" is "size" for all of them. Yields nothing if
+  "fileobj" is not an archive. Each file object is valid only until the next
+  member is requested."""
+  start = fileobj.tell()
+  head = fileobj.read(512)
+  fileobj.seek(start)
+
+  if _is_zip(head):
+    archive = zipfile.ZipFile(fileobj)
+    try:
+      for info in archive.infolist():
+        if info.filename.endswith('/'):
+          continue
+        member = archive.open(info)
+        try:
+          yield info.filename, info.compress_size, info.file_size, member
+        finally:
+          member.close()
+    finally:
+      archive.close()
+    return
+
+  decompressor = _decompressor(head)
+
+  if decompressor is not None:
+    stream = decompressor(fileobj)
+    inner_head = stream.read(512)
+    stream.close()
+    fileobj.seek(start)
+    if not _is_tar(inner_head):
+      # A single compressed file, named after the compressed one.
+      for suffix in _SUFFIXES:
+        if name.endswith(suffix):
+          name = name[:-len(suffix)]
+          if suffix in ('.tgz', '.txz'):
+            name += '.tar'
+          break
+      stream = decompressor(fileobj)
+      try:
+        yield name, size, None, stream
+      finally:
+        stream.close()
+      return
+  elif not _is_tar(head):
+    return
+
+  # The tar file, possibly compressed, is read sequentially.
+  compressed_size = size if decompressor is not None else None
+  archive = tarfile.open(fileobj=fileobj, mode='r|*')
+  try:
+    for info in archive:
+      if info.isfile():
+        yield (info.name, compressed_size, info.size,
+               archive.extractfile(info))
+  finally:
+    archive.close()
+
+
+class _Walker(object):
+  """Reads the members of an archive and its nested archives, enforcing the
+  limits on their sizes."""
+
+  def __init__(self, max_depth, max_member_size, max_total_size, max_ratio):
+    self.max_depth = max_depth
+    self.max_member_size = max_member_size
+    self.max_total_size = max_total_size
+    self.max_ratio = max_ratio
+    self.total_size = 0
+    self.exhausted = False
+
+  def walk(self, fileobj, name, size, prefix='', depth=0):
+    """Yields (path, depth, data, error) for each member."""
+    members = _iter_members(fileobj, name, size)
+    # Members whose compressed size is the size of the whole file, like those
+    # of a compressed tar file, share it. The ratio applies to their total.
+    shared_length = 0
+    try:
+      while not self.exhausted:
+        try:
+          member_name, compressed_size, declared_size, member = next(members)
+        except StopIteration:
+          break
+        except _ARCHIVE_ERRORS as e:
+          yield prefix.rstrip('/') or name, depth, None, ArchiveError(str(e))
+          break
+        path = prefix + member_name
+        base_length = shared_length if compressed_size == size else 0
+        try:
+          data = self._read(
+              member, compressed_size, declared_size, base_length)
+        except _RatioError as e:
+          yield path, depth, None, e
+          if compressed_size == size:
+            # The following members would exceed the ratio too.
+            break
+          continue
+        except ArchiveError as e:
+          yield path, depth, None, e
+          continue
+        except _ARCHIVE_ERRORS as e:
+          yield path, depth, None, ArchiveError(str(e))
+          continue
+        if compressed_size == size:
+          shared_length += len(data)
+        yield path, depth, data, None
+        if depth < self.max_depth:
+          nested = self.walk(
+              io.BytesIO(data), member_name, len(data), path + '/', depth + 1)
+          try:
+            for item in nested:
+              yield item
+          finally:
+            nested.close()
+    finally:
+      members.close()
+
+  def _read(self, member, compressed_size, declared_size, base_length=0):
+    if declared_size is not None and declared_size > self.max_member_size:
+      raise ArchiveError('member exceeds max_member_size')
+    chunks = []
+    length = 0
+    while True:
+      chunk = member.read(_CHUNK_SIZE)
+      if not chunk:
+        break
+      length += len(chunk)
+      if length > self.max_member_size:
+        raise ArchiveError('member exceeds max_member_size')
+      if self.total_size + length > self.max_total_size:
+        self.exhausted = True
+        raise ArchiveError('archive exceeds max_total_size')
+      expanded = base_length + length
+      if (compressed_size and expanded > _MIN_RATIO_SIZE and
+          expanded > self.max_ratio * compressed_size):
+        raise _RatioError('member exceeds max_ratio')
+      chunks.append(chunk)
+    self.total_size += length
+    return b''.join(chunks)
+
+
+def _scan_members(rules, pending, done, stopped, match_kwargs):
+  while True:
+    item = pending.get()
+    if item is None:
+      break
+    index, path, depth, data = item
+    if stopped.is_set():
+      continue
+    matches = error = None
+    try:
+      matches = rules.match(data=data, **match_kwargs)
+    except Exception as e:
+      error = e
+    done.put((index, ArchiveMember(path, depth, len(data), matches, error)))
+
+
+def match_archive(rules, source, workers=None, max_depth=0,
+                  max_member_size=256 << 20, max_total_size=1 << 30,
+                  max_ratio=100, **match_kwargs):
+  """Scans the members of the archive in "source", a path or a seekable file
+  object, with "rules". Yields an ArchiveMember for each member. Other
+  keyword arguments are passed to Rules.match().
+
+  Members larger than "max_member_size" bytes, or larger than 1MB and
+  "max_ratio" times their compressed size, are reported with an ArchiveError
+  and not scanned. For the members of a compressed tar file the ratio applies
+  to their total size and the size of the compressed file, and the rest of
+  the tar file is skipped once it is exceeded. Once "max_total_size" bytes
+  have been decompressed, the member being read is reported with an
+  ArchiveError and the scan stops.
+  Raises ArchiveError if "source" is not a supported archive.
+  """
+  if max_depth < 0:
+    raise ValueError("'max_depth' must be a positive number")
+
+  if isinstance(source, str) or (
+      sys.version_info[0] < 3 and isinstance(source, unicode)):
+    fileobj = open(source, 'rb')
+    name = os.path.basename(source)
+  else:
+    fileobj = source
+    name = os.path.basename(getattr(source, 'name', '') or '')
+    if not isinstance(name, str):
+      name = ''
+
+  try:
+    start = fileobj.tell()
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell() - start
+    fileobj.seek(start)
+
+    head = fileobj.read(512)
+    fileobj.seek(start)
+
+    if not (_is_zip(head) or _is_tar(head) or _decompressor(head)):
+      raise ArchiveError('not a supported archive')
+
+    walker = _Walker(max_depth, max_member_size, max_total_size, max_ratio)
+
+    for member in _pipeline(
+        rules,
+        walker.walk(fileobj, name, size),
+        workers or cpu_count() or 1,
+        match_kwargs):
+      yield member
+  finally:
+    if fileobj is not source:
+      fileobj.close()
+
+
+def _pipeline(rules, items, workers, match_kwargs):
+  """Scans the data of the (path, depth, data, error) tuples in "items" in
+  "workers" threads, and yields an ArchiveMember for each of them in the
+  same order."""
+  pending = queue.Queue(workers * 2)
+  done = queue.Queue()
+  stopped = threading.Event()
+  threads = []
+  results = {}
+  submitted = 0
+  next_index = 0
+
+  try:
+    for _ in range(workers):
+      thread = threading.Thread(
+          target=_scan_members,
+          args=(rules, pending, done, stopped, match_kwargs))
+      thread.start()
+      threads.append(thread)
+
+    for path, depth, data, error in items:
+      if error is not None:
+        results[submitted] = ArchiveMember(path, depth, None, None, error)
+      else:
+        pending.put((submitted, path, depth, data))
+      submitted += 1
+      while True:
+        try:
+          index, member = done.get_nowait()
+        except queue.Empty:
+          break
+        results[index] = member
+      while next_index in results:
+        yield _result(results.pop(next_index))
+        next_index += 1
+
+    while next_index < submitted:
+      if next_index not in results:
+        index, member = done.get()
+        results[index] = member
+        continue
+      yield _result(results.pop(next_index))
+      next_index += 1
+  finally:
+    stopped.set()
+    for _ in threads:
+      pending.put(None)
+    for thread in threads:
+      thread.join()
+
+
+def _result(member):
+  # Scan errors are reported for the member, other errors are caused by the
+  # arguments passed to Rules.match() and affect all members.
+  if member.error is not None and not isinstance(member.error, yara.Error):
+    raise member.error
+  return member
@@ -0,0 +1,127 @@
+#
+# Copyright (c) 2007-2013. The YARA Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Incremental scanning of growing files for yara-python.
+
+Implements Rules.follow(), which scans the data appended to a file since the
+previous scan instead of the whole file, like "tail -f" does:
+
+  for match in rules.follow('/var/log/app.log'):
+    print(match.rule, match.strings)
+
+Each scan covers the new data plus the last "overlap" bytes scanned before,
+so that strings crossing the boundary between two scans are found too. The
+scans use match(ranges=...), which reads only the scanned window of the file
+and reports matches at their offsets in the file. String matches already
+reported by a previous scan are removed, and rules are reported again only
+when they have new string matches.
+
+Conditions are evaluated on the window scanned, except "filesize", which is
+the size of the whole file. Conditions like "#a > 10" or "$a at 0" should be
+avoided with rules used for following files.
+"""
+
+import os
+import time
+
+
+class Follower(object):
+  """Scans the data appended to "filepath" with "rules". Other keyword
+  arguments are passed to Rules.match().
+
+  If the file is replaced or truncated, as when logs are rotated, it's
+  scanned again from the beginning.
+  """
+
+  def __init__(self, rules, filepath, overlap=4096, **match_kwargs):
+    if overlap < 0:
+      raise ValueError("'overlap' must be a positive number")
+    for name in ('data', 'pid', 'ranges'):
+      if name in match_kwargs:
+        raise TypeError("'%s' can't be used with follow()" % name)
+    self.rules = rules
+    self.filepath = filepath
+    self.overlap = overlap
+    self.match_kwargs = match_kwargs
+    self.offset = 0
+    self._file_id = None
+    self._windows = []
+    self._reported = set()
+
+  def reset(self):
+    """Forgets the data scanned, the next scan starts at the beginning of
+    the file."""
+    self.offset = 0
+    self._windows = []
+    self._reported = set()
+
+  def scan(self):
+    """Scans the data appended to the file since the previous scan and
+    returns the list of matching rules, with the new string matches only."""
+    stat = os.stat(self.filepath)
+    file_id = (stat.st_dev, stat.st_ino)
+
+    if file_id != self._file_id or stat.st_size < self.offset:
+      self.reset()
+      self._file_id = file_id
+
+    if stat.st_size == self.offset:
+      return []
+
+    start = max(0, self.offset - self.overlap)
+    end = stat.st_size
+
+    matches = self.rules.match(
+        self.filepath, ranges=[(start, end)], **self.match_kwargs)
+
+    # Only windows overlapping the current one can contain duplicates.
+    self._windows = [w for w in self._windows if w[1] > start]
+
+    result = []
+    for match in matches:
+      strings = [s for s in match.strings if not self._seen(s)]
+      key = (match.namespace, match.rule)
+      if strings or key not in self._reported:
+        match.strings[:] = strings
+        self._reported.add(key)
+        result.append(match)
+
+    self._windows.append((start, end))
+    self.offset = end
+
+    return result
+
+  def _seen(self, string):
+    offset, _, data = string
+    for start, end in self._windows:
+      if offset >= start and offset + len(data) <= end:
+        return True
+    return False
+
+  def follow(self, interval=1.0, stop=None):
+    """Yields the matching rules as data is appended to the file, checking
+    for new data every "interval" seconds until the threading.Event "stop"
+    is set, if given."""
+    while stop is None or not stop.is_set():
+      for match in self.scan():
+        yield match
+      if stop is not None:
+        stop.wait(interval)
+      else:
+        time.sleep(interval)
+
+  def __iter__(self):
+    return self.follow()
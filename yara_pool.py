@@ -0,0 +1,601 @@
+#
+# Copyright (c) 2007-2013. The YARA Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Pool of worker processes scanning with the same rules for yara-python.
+
+Implements yara.ScanPool, instantiating yara.ScanPool returns an instance of
+the ScanPool class defined here. Workers are forked from the process owning
+the rules, so they share the compiled rules copy-on-write instead of loading
+their own copy:
+
+  with yara.ScanPool(rules, processes=4) as pool:
+    for sample, matches in pool.imap_unordered(paths):
+      print(sample, matches)
+
+Each worker is connected to the pool with a UNIX socket, receives a sample at
+a time and sends back the matches. Paths are sent as they are, file
+descriptors are passed along with the request as SCM_RIGHTS ancillary data,
+and the contents of other objects supporting the buffer protocol are copied
+to an anonymous file that is passed the same way. Workers scan with
+Rules.match(), and send the matches back in a compact form: each rule and
+string identifier is sent once, the first time the worker reports it, and is
+referred to by its index in later results. The pool rebuilds the Match
+objects from that.
+
+Workers are forked with os.fork(), which runs the interpreter's fork hooks,
+so they can run Python code even if the pool is used by several threads.
+"""
+
+import array
+import errno
+import mmap
+import os
+import pickle
+import select
+import signal
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+try:
+  from os import cpu_count
+except ImportError:
+  from multiprocessing import cpu_count
+
+import yara
+
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# Messages are pickled objects preceded by their length.
+_HEADER = struct.Struct('!I')
+
+_LIMITS = (
+    'max_string_matches', 'max_matches', 'max_match_data', 'max_result_size')
+
+
+def _send(sock, obj, fd=None):
+  """Sends "obj" to "sock". If "fd" is not None it's passed along with it,
+  and the peer receives its own copy of the file descriptor."""
+  data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+  message = _HEADER.pack(len(data)) + data
+  if fd is None:
+    sock.sendall(message)
+    return
+  sent = sock.sendmsg(
+      [message],
+      [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))])
+  if sent < len(message):
+    sock.sendall(message[sent:])
+
+
+def _receive_exactly(sock, length):
+  buffer = bytearray(length)
+  view = memoryview(buffer)
+  received = 0
+  while received < length:
+    count = sock.recv_into(view[received:])
+    if count == 0:
+      raise EOFError('connection closed')
+    received += count
+  return bytes(buffer)
+
+
+def _receive(sock):
+  """Returns the next object received from "sock" and the file descriptors
+  passed along with it. Raises EOFError if the peer closed the connection."""
+  fds = []
+  if hasattr(sock, 'recvmsg'):
+    fd_size = array.array('i').itemsize
+    header, ancdata, _, _ = sock.recvmsg(
+        _HEADER.size, socket.CMSG_SPACE(fd_size))
+    for level, type, cmsg_data in ancdata:
+      if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+        received = array.array('i')
+        received.frombytes(
+            cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fd_size)])
+        fds.extend(received)
+  else:
+    header = sock.recv(_HEADER.size)
+  try:
+    if not header:
+      raise EOFError('connection closed')
+    header += _receive_exactly(sock, _HEADER.size - len(header))
+    length, = _HEADER.unpack(header)
+    return pickle.loads(_receive_exactly(sock, length)), fds
+  except BaseException:
+    for fd in fds:
+      os.close(fd)
+    raise
+
+
+def _scan_fd(rules, fd, options):
+  if stat.S_ISREG(os.fstat(fd).st_mode):
+    size = os.fstat(fd).st_size
+    if size == 0:
+      return rules.match(data=b'', **options)
+    data = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+    try:
+      return rules.match(data=data, **options)
+    finally:
+      data.close()
+  chunks = []
+  while True:
+    chunk = os.read(fd, 1 << 20)
+    if not chunk:
+      break
+    chunks.append(chunk)
+  return rules.match(data=b''.join(chunks), **options)
+
+
+def _encode_matches(matches, rule_indexes, string_indexes):
+  """Returns the response for "matches". Rules and string identifiers are
+  replaced by their indexes in "rule_indexes" and "string_indexes". The ones
+  not sent to the pool yet are included in the response, and added to the
+  indexes once the response is complete."""
+  new_rules = {}
+  new_strings = {}
+  response = {'rules': [], 'strings': [], 'matches': []}
+  for match in matches:
+    key = (match.namespace, match.rule)
+    rule_index = rule_indexes.get(key, new_rules.get(key))
+    if rule_index is None:
+      rule_index = new_rules[key] = len(rule_indexes) + len(new_rules)
+      response['rules'].append(
+          (match.rule, match.namespace, match.tags, match.meta))
+    strings = []
+    for offset, identifier, data in match.strings:
+      string_index = string_indexes.get(
+          identifier, new_strings.get(identifier))
+      if string_index is None:
+        string_index = new_strings[identifier] = (
+            len(string_indexes) + len(new_strings))
+        response['strings'].append(identifier)
+      strings.append((offset, string_index, data))
+    response['matches'].append((rule_index, strings, match.truncated))
+  rule_indexes.update(new_rules)
+  string_indexes.update(new_strings)
+  return response
+
+
+def _decode_matches(response, rules, strings):
+  """Returns the Match objects in a response built by _encode_matches().
+  "rules" and "strings" are the tables of the worker that sent it."""
+  rules.extend(response['rules'])
+  strings.extend(response['strings'])
+  matches = []
+  for rule_index, encoded, truncated in response['matches']:
+    rule, namespace, tags, meta = rules[rule_index]
+    matches.append(yara._match(
+        rule, namespace, list(tags), dict(meta),
+        [(offset, strings[i], data) for offset, i, data in encoded],
+        truncated))
+  return matches
+
+
+def _worker_main(rules, sock, options):
+  """Main loop of a worker process, scans the samples received from "sock"
+  until the pool closes its end of the socket."""
+  rule_indexes = {}
+  string_indexes = {}
+  while True:
+    try:
+      request, fds = _receive(sock)
+    except EOFError:
+      return
+    try:
+      if 'path' in request:
+        matches = rules.match(request['path'], **options)
+      elif fds:
+        matches = _scan_fd(rules, fds[0], options)
+      else:
+        raise yara.Error('no file descriptor received')
+      response = _encode_matches(matches, rule_indexes, string_indexes)
+    except Exception as e:
+      response = {'error': e}
+    finally:
+      for fd in fds:
+        os.close(fd)
+    try:
+      _send(sock, response)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+      _send(sock, {'error': yara.Error(str(response.get('error', e)))})
+
+
+def _shared_buffer(sample):
+  """Returns the file descriptor of an anonymous file with a copy of the
+  data in "sample"."""
+  view = memoryview(sample)
+  if view.itemsize != 1 or view.ndim != 1:
+    view = view.cast('B')
+  if hasattr(os, 'memfd_create'):
+    fd = os.memfd_create('yara-scan-pool', os.MFD_CLOEXEC)
+  else:
+    with tempfile.TemporaryFile() as f:
+      fd = os.dup(f.fileno())
+  try:
+    while view:
+      view = view[os.write(fd, view):]
+  except BaseException:
+    os.close(fd)
+    raise
+  return fd
+
+
+class _Worker(object):
+
+  def __init__(self):
+    self.pid = None
+    self.socket = None
+    self.busy = False
+    self.sample = None
+    self.index = None
+    self.deadline = None
+    # Rules and string identifiers sent by the worker, see _encode_matches().
+    self.rules = []
+    self.strings = []
+
+
+class _Iterator(object):
+  """Iterator returned by ScanPool.imap_unordered(). It feeds the samples to
+  the pool's workers and yields results as they arrive."""
+
+  def __init__(self, pool, samples):
+    self.pool = pool
+    self.samples = samples
+    self.next_index = 0
+    self.running = True
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    with self.pool._lock:
+      result = self.pool._next_result(self)
+    if result is None:
+      self.close()
+      raise StopIteration
+    return result[0], result[2]
+
+  next = __next__
+
+  def close(self):
+    """Stops the scans of this iterator. The workers still scanning its
+    samples are replaced, otherwise their responses would be received by the
+    next iterator."""
+    with self.pool._lock:
+      if not self.running:
+        return
+      self.running = False
+      self.pool._running = False
+      for worker in self.pool._workers or ():
+        if worker.busy:
+          self.pool._terminate(worker, True)
+
+  def __del__(self):
+    self.close()
+
+
+class ScanPool(yara.ScanPool):
+  """Pool of "processes" worker processes scanning with "rules", one per CPU
+  by default.
+
+  Samples are paths, file descriptors, or bytes-like objects with the data to
+  scan. In Python 2 str objects are paths, and only paths can be scanned as
+  passing file descriptors requires socket.sendmsg().
+
+  Workers that crash are replaced, and so are workers that haven't answered
+  "timeout" + 1 seconds after they received a sample. The failed sample
+  raises yara.Error or yara.TimeoutError. Other arguments are passed to
+  Rules.match() by the workers.
+  """
+
+  def __init__(self, rules, processes=None, timeout=0, fast=False,
+               externals=None, max_string_matches=-1, max_matches=-1,
+               max_match_data=-1, max_result_size=-1):
+    self._workers = None
+    if not hasattr(os, 'fork'):
+      raise yara.Error('ScanPool is not supported on Windows')
+    if not isinstance(rules, yara.Rules):
+      raise TypeError("'rules' must be a Rules object")
+    if processes is None:
+      processes = cpu_count() or 1
+    elif processes < 1:
+      raise ValueError("'processes' must be greater than zero")
+    if timeout < 0:
+      raise ValueError("'timeout' must be a positive number")
+    if externals is not None and not isinstance(externals, dict):
+      raise TypeError("'externals' must be a dictionary")
+
+    self._options = {'timeout': timeout, 'fast': bool(fast)}
+    if externals is not None:
+      self._options['externals'] = externals
+    limits = (max_string_matches, max_matches, max_match_data, max_result_size)
+    for name, value in zip(_LIMITS, limits):
+      if value < -1:
+        raise ValueError("'%s' must be a positive number" % name)
+      if value != -1:
+        self._options[name] = value
+
+    self.rules = rules
+    self.processes = processes
+    self.timeout = timeout
+    self.replaced = 0
+    self._lock = threading.Lock()
+    self._running = False
+    self._workers = [_Worker() for _ in range(processes)]
+
+    try:
+      with self._lock:
+        for worker in self._workers:
+          self._spawn(worker)
+    except BaseException:
+      self.close()
+      raise
+
+  @property
+  def pids(self):
+    """Process ids of the workers."""
+    return [w.pid for w in self._workers or () if w.pid is not None]
+
+  def map(self, samples):
+    """Scans "samples" and returns the list of matches for each of them, in
+    the same order."""
+    iterator = self._iterator(samples)
+    results = []
+    try:
+      with self._lock:
+        while True:
+          result = self._next_result(iterator)
+          if result is None:
+            break
+          _, index, matches = result
+          # Results arrive in any order, the list grows as needed with None
+          # in the positions of samples still being scanned.
+          results.extend([None] * (index + 1 - len(results)))
+          results[index] = matches
+    finally:
+      iterator.close()
+    return results
+
+  def imap_unordered(self, samples):
+    """Scans "samples" and yields (sample, matches) pairs as the scans
+    finish."""
+    return self._iterator(samples)
+
+  def close(self):
+    """Stops the workers. Idle workers exit when their socket is closed,
+    busy ones are killed."""
+    with self._lock:
+      if self._workers is None:
+        return
+      for worker in self._workers:
+        if worker.socket is not None:
+          try:
+            worker.socket.shutdown(socket.SHUT_WR)
+          except socket.error:
+            pass
+      for worker in self._workers:
+        self._terminate(worker, worker.busy)
+      self._workers = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __del__(self):
+    if getattr(self, '_workers', None) is not None:
+      self.close()
+
+  def _iterator(self, samples):
+    if self._workers is None:
+      raise ValueError('ScanPool is closed')
+    samples = iter(samples)
+    with self._lock:
+      if self._running:
+        raise RuntimeError('ScanPool is already scanning')
+      self._running = True
+    return _Iterator(self, samples)
+
+  def _spawn(self, worker):
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      pid = os.fork()
+    except BaseException:
+      parent.close()
+      child.close()
+      raise
+    if pid == 0:
+      status = 1
+      try:
+        # Workers must not keep other workers' sockets open, or they would
+        # not see the pool closing them.
+        parent.close()
+        for other in self._workers:
+          if other.socket is not None:
+            other.socket.close()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        _worker_main(self.rules, child, self._options)
+        status = 0
+      finally:
+        os._exit(status)
+    child.close()
+    worker.pid = pid
+    worker.socket = parent
+    worker.rules = []
+    worker.strings = []
+
+  def _terminate(self, worker, kill):
+    """Terminates "worker" and returns its wait status. If "kill" is false
+    the worker is expected to exit by itself."""
+    status = 0
+    if worker.socket is not None:
+      worker.socket.close()
+    if worker.pid is not None:
+      if kill:
+        try:
+          os.kill(worker.pid, signal.SIGKILL)
+        except OSError:
+          pass
+      try:
+        _, status = os.waitpid(worker.pid, 0)
+      except OSError:
+        pass
+    worker.pid = None
+    worker.socket = None
+    worker.busy = False
+    worker.sample = None
+    return status
+
+  def _idle_worker(self):
+    """Returns a worker ready to receive a sample, replacing it if it's no
+    longer running, or None if all workers are busy."""
+    for worker in self._workers:
+      if worker.busy:
+        continue
+      if worker.pid is not None:
+        try:
+          exited = os.waitpid(worker.pid, os.WNOHANG)[0] != 0
+        except OSError:
+          exited = True
+        if exited:
+          worker.pid = None
+          self._terminate(worker, False)
+          self.replaced += 1
+      if worker.pid is None:
+        self._spawn(worker)
+      return worker
+    return None
+
+  def _dispatch(self, worker, sample, index):
+    """Sends "sample" to "worker"."""
+    fd = None
+    close_fd = False
+    if isinstance(sample, str) or (
+        sys.version_info[0] < 3 and isinstance(sample, unicode)):
+      request = {'path': sample}
+    else:
+      request = {}
+      if not hasattr(worker.socket, 'sendmsg'):
+        raise TypeError('samples must be paths')
+      if isinstance(sample, int) and not isinstance(sample, bool):
+        fd = sample
+      else:
+        try:
+          fd = _shared_buffer(sample)
+        except TypeError:
+          raise TypeError(
+              'samples must be paths, file descriptors or bytes-like objects')
+        close_fd = True
+    try:
+      _send(worker.socket, request, fd)
+    except socket.error as e:
+      if e.errno == errno.EBADF and not close_fd:
+        raise
+      # The worker is gone, _next_result() will notice it while waiting for
+      # the response.
+      try:
+        worker.socket.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+    finally:
+      if close_fd:
+        os.close(fd)
+    worker.busy = True
+    worker.sample = sample
+    worker.index = index
+    worker.deadline = (
+        _monotonic() + self.timeout + 1 if self.timeout > 0 else None)
+
+  def _next_result(self, iterator):
+    """Waits until some worker finishes its scan and returns (sample, index,
+    matches) for its sample, where "index" is the position of the sample in
+    the sequence of samples. Returns None once all samples have been
+    scanned. Raises the error of the scan if it failed."""
+    if self._workers is None:
+      raise ValueError('ScanPool is closed')
+
+    # Keep all workers busy while there are samples left.
+    while iterator.samples is not None:
+      worker = self._idle_worker()
+      if worker is None:
+        break
+      try:
+        sample = next(iterator.samples)
+      except StopIteration:
+        iterator.samples = None
+        break
+      self._dispatch(worker, sample, iterator.next_index)
+      iterator.next_index += 1
+
+    busy = [w for w in self._workers if w.busy]
+    if not busy:
+      return None
+
+    poller = select.poll()
+    for worker in busy:
+      poller.register(worker.socket, select.POLLIN)
+
+    while True:
+      # Without deadlines wait indefinitely, otherwise until the closest
+      # one, but no longer than a minute at a time.
+      deadlines = [w.deadline for w in busy if w.deadline is not None]
+      if deadlines:
+        wait = min(max(min(deadlines) - _monotonic(), 0), 60) * 1000 + 1
+      else:
+        wait = None
+      try:
+        ready = set(fd for fd, _ in poller.poll(wait))
+      except select.error as e:
+        if e.args[0] != errno.EINTR:
+          raise
+        ready = set()
+      now = _monotonic()
+      for worker in busy:
+        if worker.socket.fileno() in ready:
+          return self._response(worker)
+      for worker in busy:
+        if worker.deadline is not None and worker.deadline <= now:
+          self._terminate(worker, True)
+          self.replaced += 1
+          raise yara.TimeoutError('scanning timed out')
+
+  def _response(self, worker):
+    sample = worker.sample
+    index = worker.index
+    try:
+      response, _ = _receive(worker.socket)
+    except (EOFError, socket.error):
+      pid = worker.pid
+      status = self._terminate(worker, True)
+      self.replaced += 1
+      if os.WIFSIGNALED(status):
+        raise yara.Error(
+            'worker process %d was terminated by signal %d' % (
+                pid, os.WTERMSIG(status)))
+      raise yara.Error('worker process %d exited unexpectedly' % pid)
+    worker.busy = False
+    worker.sample = None
+    if 'error' in response:
+      raise response['error']
+    return sample, index, _decode_matches(
+        response, worker.rules, worker.strings)
@@ -0,0 +1,322 @@
+#
+# Copyright (c) 2007-2013. The YARA Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""File-type routing for yara-python.
+
+Large rule sets usually mix rules for executables of different platforms,
+documents and other kinds of files. A Router scans each sample only with the
+rules meant for its type of file, plus the rules that are not meant for any
+type in particular:
+
+  router = yara_router.compile(filepaths={'pe': 'pe.yar', 'elf': 'elf.yar'})
+  matches = router.match('/bin/ls')
+
+The types of file a rule is meant for are taken from:
+
+  - Its tags, if they are the name of a type, like "rule foo : pe { ... }".
+  - Its "filetype" meta, with one or more comma-separated types. Rules with
+    a type that can't be recognized are scanned for every sample.
+  - The modules used in its condition. A rule using pe.imports() is meant for
+    PE files, for example. This requires the source of the rules.
+
+Samples are classified by their first bytes with sniff(). The rules for each
+type are views created with Rules.select(), so the rules are compiled once.
+Rules referenced from the condition of a rule are evaluated wherever that rule
+is, but they are only reported for samples of their own type.
+
+Routing assumes that rules meant for a type never match other files. With
+verify=True each sample is scanned with all the rules too, and RoutingError is
+raised if the results differ, which allows checking that assumption with a
+corpus before relying on it.
+"""
+
+import io
+import re
+import struct
+import sys
+
+import yara
+
+
+class RoutingError(yara.Error):
+  """The rules matching a sample differ from the rules matching it when
+  scanned with all the rules. "missing" and "unexpected" are lists of
+  (namespace, rule) tuples, and "matches" is the result of the full scan."""
+
+  def __init__(self, file_type, missing, unexpected, matches):
+    yara.Error.__init__(
+        self, 'routing as %s missed %d and added %d matching rules' % (
+            file_type or 'generic', len(missing), len(unexpected)))
+    self.file_type = file_type
+    self.missing = missing
+    self.unexpected = unexpected
+    self.matches = matches
+
+
+# Types recognized by sniff().
+FILE_TYPES = ('pe', 'elf', 'macho', 'dex', 'pdf', 'ole', 'zip', 'rtf')
+
+# Other names used in tags and "filetype" metas for the same types.
+ALIASES = {
+    'exe': 'pe',
+    'dll': 'pe',
+    'sys': 'pe',
+    'pe32': 'pe',
+    'dotnet': 'pe',
+    'mach-o': 'macho',
+    'doc': 'ole',
+    'xls': 'ole',
+    'ppt': 'ole',
+    'msi': 'ole',
+    'docx': 'zip',
+    'xlsx': 'zip',
+    'pptx': 'zip',
+    'jar': 'zip',
+}
+
+# Modules that only make sense for files of a given type.
+MODULE_TYPES = {
+    'pe': 'pe',
+    'dotnet': 'pe',
+    'elf': 'elf',
+    'macho': 'macho',
+    'dex': 'dex',
+}
+
+# Bytes read from the beginning of files for classifying them.
+HEAD_SIZE = 4096
+
+_MACHO_MAGICS = (
+    b'\xfe\xed\xfa\xce', b'\xce\xfa\xed\xfe',
+    b'\xfe\xed\xfa\xcf', b'\xcf\xfa\xed\xfe')
+
+# Keyword arguments of Rules.match() that must not be passed to the full
+# scan made when verifying, as they would see every result twice.
+_CALLBACK_ARGUMENTS = (
+    'callback', 'batch_callback', 'modules_callback', 'warnings_callback',
+    'console_callback', 'cache')
+
+
+def sniff(head):
+  """Returns the type of the file beginning with "head", one of FILE_TYPES,
+  or None if it's not recognized."""
+  head = bytes(head)
+  if head[:2] == b'MZ':
+    return 'pe'
+  if head[:4] == b'\x7fELF':
+    return 'elf'
+  if head[:4] in _MACHO_MAGICS:
+    return 'macho'
+  # Universal binaries share their magic with Java classes, which have a
+  # version number larger than any reasonable number of architectures.
+  if (head[:4] in (b'\xca\xfe\xba\xbe', b'\xca\xfe\xba\xbf') and
+      len(head) >= 8 and struct.unpack('>I', head[4:8])[0] < 45):
+    return 'macho'
+  if head[:4] == b'dex\n':
+    return 'dex'
+  if b'%PDF-' in head[:1024]:
+    return 'pdf'
+  if head[:8] == b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1':
+    return 'ole'
+  if head[:4] in (b'PK\x03\x04', b'PK\x05\x06'):
+    return 'zip'
+  if head[:5] == b'{\\rtf':
+    return 'rtf'
+  return None
+
+
+_IMPORT = re.compile(r'^\s*import\s+"(\w+)"', re.M)
+
+# Comments, text strings and regular expressions, which are removed from the
+# source before looking for rules and the modules they use.
+_LITERALS = re.compile(r'''
+    //[^\n]*
+  | /\*.*?\*/
+  | "(?:\\.|[^"\\\n])*"
+  | (?:=|\bmatches)\s*/(?:\\.|[^/\\\n])+/
+''', re.S | re.X)
+
+_RULE = re.compile(r'\brule\s+([A-Za-z_]\w*)')
+_CONDITION = re.compile(r'\bcondition\s*:')
+_MEMBER = re.compile(r'\b([A-Za-z_]\w*)\s*\.')
+
+
+def rule_modules(source):
+  """Returns a dictionary with the modules used by the condition of each rule
+  in "source". Rules from included files are not found."""
+  imported = set(_IMPORT.findall(source))
+  source = _LITERALS.sub(' ', source)
+  headers = list(_RULE.finditer(source))
+  result = {}
+  for i, header in enumerate(headers):
+    end = headers[i + 1].start() if i + 1 < len(headers) else len(source)
+    body = source[header.end():end]
+    conditions = list(_CONDITION.finditer(body))
+    modules = set()
+    if conditions:
+      condition = body[conditions[-1].end():]
+      modules = set(_MEMBER.findall(condition)) & imported
+    result[header.group(1)] = modules
+  return result
+
+
+def _declared_types(values):
+  """Returns the types named in "values", or None if some of them is not a
+  type that can be recognized."""
+  types = set()
+  for value in values:
+    value = value.strip().lower()
+    value = ALIASES.get(value, value)
+    if value not in FILE_TYPES:
+      return None
+    types.add(value)
+  return types
+
+
+def rule_types(rule, modules=()):
+  """Returns the set of types of file that the yara.Rule "rule" is meant
+  for, which is empty if it's meant for any file. "modules" are the modules
+  used by its condition."""
+  types = set()
+  for tag in rule.tags:
+    tag = tag.lower()
+    tag = ALIASES.get(tag, tag)
+    if tag in FILE_TYPES:
+      types.add(tag)
+  filetype = rule.meta.get('filetype')
+  if isinstance(filetype, str) or (
+      sys.version_info[0] < 3 and isinstance(filetype, unicode)):
+    declared = _declared_types(filetype.split(','))
+    if declared is None:
+      return set()
+    types |= declared
+  for module in modules:
+    if module in MODULE_TYPES:
+      types.add(MODULE_TYPES[module])
+  return types
+
+
+class Router(object):
+  """Scans samples with the subset of "rules" meant for their type of file.
+
+  "sources" maps namespaces to the source of their rules, and is used for
+  finding the modules used by each rule. "classify" is a function returning
+  the type of a sample from its first HEAD_SIZE bytes, sniff() by default.
+  With "verify" every sample is scanned with all the rules too, see
+  RoutingError.
+  """
+
+  def __init__(self, rules, sources=None, verify=False, classify=None):
+    self.rules = rules
+    self.verify = verify
+    self.classify = classify or sniff
+    self.types = {}
+
+    modules = {}
+    for namespace, source in (sources or {}).items():
+      modules[namespace] = rule_modules(source)
+
+    generic = []
+    by_type = dict((file_type, []) for file_type in FILE_TYPES)
+
+    for rule in rules:
+      if rule.is_private or rule.is_global:
+        continue
+      key = (rule.namespace, rule.identifier)
+      types = rule_types(
+          rule, modules.get(rule.namespace, {}).get(rule.identifier, ()))
+      self.types[key] = frozenset(types)
+      if not types:
+        generic.append('%s:%s' % key)
+      for file_type in types:
+        by_type.setdefault(file_type, []).append('%s:%s' % key)
+
+    self.generic = rules.select(identifiers=generic)
+    self.partitions = {}
+    for file_type, identifiers in by_type.items():
+      if identifiers:
+        self.partitions[file_type] = rules.select(
+            identifiers=generic + identifiers)
+
+  def rules_for(self, file_type):
+    """Returns the rules used for samples of "file_type"."""
+    return self.partitions.get(file_type, self.generic)
+
+  def match(self, filepath=None, data=None, **kwargs):
+    """Scans a file or data like Rules.match(), using only the rules for its
+    type. Processes are scanned with all the rules."""
+    if kwargs.get('pid') is not None:
+      return _match(self.rules, filepath, data, kwargs)
+
+    if filepath is not None:
+      with open(filepath, 'rb') as f:
+        head = f.read(HEAD_SIZE)
+    elif data is not None:
+      head = data[:HEAD_SIZE]
+    else:
+      head = b''
+
+    file_type = self.classify(head)
+    matches = _match(self.rules_for(file_type), filepath, data, kwargs)
+
+    if self.verify:
+      self._verify(file_type, matches, filepath, data, kwargs)
+
+    return matches
+
+  def _verify(self, file_type, matches, filepath, data, kwargs):
+    kwargs = dict(
+        (name, value) for name, value in kwargs.items()
+        if name not in _CALLBACK_ARGUMENTS)
+    full = _match(self.rules, filepath, data, kwargs)
+    if not (isinstance(matches, list) and isinstance(full, list)):
+      raise TypeError('verify requires match() to return lists of matches')
+    routed = set((m.namespace, m.rule) for m in matches)
+    expected = set((m.namespace, m.rule) for m in full)
+    if routed != expected:
+      raise RoutingError(
+          file_type,
+          sorted(expected - routed),
+          sorted(routed - expected),
+          full)
+
+
+def _match(rules, filepath, data, kwargs):
+  if filepath is not None:
+    return rules.match(filepath, **kwargs)
+  if data is not None:
+    return rules.match(data=data, **kwargs)
+  return rules.match(**kwargs)
+
+
+def compile(verify=False, classify=None, **kwargs):
+  """Compiles rules like yara.compile() and returns a Router for them. The
+  modules used by each rule are found in "source", "sources", "filepath" or
+  "filepaths"."""
+  sources = {}
+  if 'source' in kwargs:
+    sources['default'] = kwargs['source']
+  if 'sources' in kwargs:
+    sources.update(kwargs['sources'])
+  if 'filepath' in kwargs:
+    with io.open(kwargs['filepath'], encoding='utf-8', errors='replace') as f:
+      sources['default'] = f.read()
+  if 'filepaths' in kwargs:
+    for namespace, filepath in kwargs['filepaths'].items():
+      with io.open(filepath, encoding='utf-8', errors='replace') as f:
+        sources[namespace] = f.read()
+  return Router(
+      yara.compile(**kwargs), sources, verify=verify, classify=classify)
@@ -0,0 +1,257 @@
+#
+# Copyright (c) 2007-2013. The YARA Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Parallel command-line scanner for yara-python.
+
+Scans files and directories with several threads and writes a JSON object per
+line for every file that matches some rule or couldn't be scanned:
+
+  $ python -m yara_scan --recursive --workers 8 rules.yar /data
+
+Each object has the "path" of the file, the "time" taken by the scan, and
+either "matches", in the format used by yara_server, or "error". A summary
+with the throughput and the slowest files is written to stderr at the end,
+which makes this a realistic end-to-end benchmark too.
+"""
+
+import json
+import optparse
+import os
+import sys
+import threading
+import time
+
+try:
+  from os import cpu_count
+except ImportError:
+  from multiprocessing import cpu_count
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import yara
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def parse_size(size):
+  """Converts sizes like "512", "64KB" or "2MB" to a number of bytes."""
+  units = {'KB': 1 << 10, 'MB': 1 << 20, 'GB': 1 << 30}
+  size = size.strip().upper()
+  if size[-2:] in units:
+    return int(size[:-2]) * units[size[-2:]]
+  return int(size)
+
+
+def iter_files(paths, recursive=False, min_size=None, max_size=None):
+  """Yields (path, size) for the regular files in "paths". Directories are
+  scanned only one level deep unless "recursive" is true."""
+  for path in paths:
+    if os.path.isdir(path):
+      if recursive:
+        candidates = (
+            os.path.join(root, name)
+            for root, _, names in os.walk(path)
+            for name in sorted(names))
+      else:
+        candidates = (
+            os.path.join(path, name) for name in sorted(os.listdir(path)))
+    else:
+      candidates = [path]
+    for candidate in candidates:
+      try:
+        if not os.path.isfile(candidate):
+          continue
+        size = os.path.getsize(candidate)
+      except OSError:
+        continue
+      if min_size is not None and size < min_size:
+        continue
+      if max_size is not None and size > max_size:
+        continue
+      yield candidate, size
+
+
+class Scanner(object):
+  """Scans files with "rules" in "workers" threads, writing the results to
+  "output" as JSON lines."""
+
+  def __init__(self, rules, output, workers=None, timeout=0, fast=False,
+               slowest=5):
+    self.rules = rules
+    self.output = output
+    self.workers = workers or cpu_count() or 1
+    self.timeout = timeout
+    self.fast = fast
+    self.slowest = slowest
+    self.files = 0
+    self.bytes = 0
+    self.matches = 0
+    self.errors = 0
+    self.elapsed = 0
+    self.times = []
+    self._lock = threading.Lock()
+
+  def scan(self, files):
+    """Scans (path, size) pairs from "files" until they are exhausted."""
+    pending = queue.Queue(self.workers * 4)
+    threads = [
+        threading.Thread(target=self._scan_files, args=(pending,))
+        for _ in range(self.workers)]
+    start = timer()
+    for thread in threads:
+      thread.start()
+    try:
+      for item in files:
+        pending.put(item)
+    finally:
+      for _ in threads:
+        pending.put(None)
+      for thread in threads:
+        thread.join()
+      self.elapsed += timer() - start
+
+  def _scan_files(self, pending):
+    while True:
+      item = pending.get()
+      if item is None:
+        break
+      path, size = item
+      matches = error = None
+      start = timer()
+      try:
+        # Matches are encoded as JSON in C, straight from the scan results.
+        matches = self.rules.match(
+            path, timeout=self.timeout, fast=self.fast, output='json')
+      except Exception as e:
+        error = str(e)
+      self._record(path, size, timer() - start, matches, error)
+
+  def _record(self, path, size, seconds, matches, error):
+    with self._lock:
+      self.files += 1
+      self.bytes += size
+      self.times.append((seconds, path))
+      if len(self.times) > 4 * self.slowest:
+        self.times.sort(reverse=True)
+        del self.times[self.slowest:]
+      if error is not None:
+        self.errors += 1
+        line = json.dumps({'path': path, 'time': seconds, 'error': error})
+      elif matches != b'[]':
+        self.matches += 1
+        line = '%s, "matches": %s}' % (
+            json.dumps({'path': path, 'time': seconds})[:-1],
+            matches.decode('utf-8'))
+      else:
+        return
+      self.output.write(line + '\n')
+
+  def summary(self):
+    """Returns a dictionary with the statistics of the files scanned."""
+    elapsed = self.elapsed or 1e-9
+    return {
+        'files': self.files,
+        'bytes': self.bytes,
+        'matching': self.matches,
+        'errors': self.errors,
+        'elapsed': self.elapsed,
+        'files_per_second': self.files / elapsed,
+        'mb_per_second': self.bytes / elapsed / (1 << 20),
+        'slowest': [
+            [path, seconds]
+            for seconds, path in sorted(self.times, reverse=True)[:self.slowest]]}
+
+
+def format_summary(summary):
+  lines = [
+      'scanned %d files (%.1f MB) in %.2f s: %.1f files/s, %.1f MB/s' % (
+          summary['files'], summary['bytes'] / float(1 << 20),
+          summary['elapsed'], summary['files_per_second'],
+          summary['mb_per_second']),
+      '%d matching, %d errors' % (summary['matching'], summary['errors'])]
+  if summary['slowest']:
+    lines.append('slowest files:')
+    lines.extend(
+        '  %8.3f s  %s' % (seconds, path)
+        for path, seconds in summary['slowest'])
+  return '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+  parser = optparse.OptionParser(usage='%prog [options] RULES PATH...')
+  parser.add_option(
+      '--compiled', action='store_true',
+      help='RULES is a compiled rules file saved with Rules.save()')
+  parser.add_option(
+      '--workers', type='int', help='number of scanning threads')
+  parser.add_option(
+      '-r', '--recursive', action='store_true',
+      help='scan directories recursively')
+  parser.add_option(
+      '--min-size', help='skip files smaller than this, e.g. 1KB')
+  parser.add_option(
+      '--max-size', help='skip files larger than this, e.g. 10MB')
+  parser.add_option(
+      '--timeout', type='int', default=0, help='timeout for each file')
+  parser.add_option(
+      '--fast', action='store_true', help='scan in fast mode')
+  parser.add_option(
+      '--slowest', type='int', default=5,
+      help='number of slowest files listed in the summary')
+  parser.add_option(
+      '--no-summary', action='store_true', help="don't print the summary")
+  options, args = parser.parse_args(argv)
+
+  if len(args) < 2:
+    parser.error('RULES and at least one PATH are required')
+
+  try:
+    min_size = parse_size(options.min_size) if options.min_size else None
+    max_size = parse_size(options.max_size) if options.max_size else None
+  except ValueError:
+    parser.error('invalid size')
+
+  if options.compiled:
+    rules = yara.load(args[0])
+  else:
+    rules = yara.compile(filepath=args[0])
+
+  scanner = Scanner(
+      rules,
+      sys.stdout,
+      workers=options.workers,
+      timeout=options.timeout,
+      fast=options.fast,
+      slowest=options.slowest)
+
+  scanner.scan(iter_files(
+      args[1:],
+      recursive=options.recursive,
+      min_size=min_size,
+      max_size=max_size))
+
+  if not options.no_summary:
+    sys.stderr.write(format_summary(scanner.summary()))
+
+  return 1 if scanner.errors else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,424 @@
+#
+# Copyright (c) 2007-2013. The YARA Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Local scanning daemon for yara-python.
+
+The daemon keeps compiled rules in memory and scans samples on behalf of
+clients connected to a UNIX domain socket, so that short-lived jobs don't pay
+for compiling or loading the rules every time:
+
+  $ python -m yara_server --socket /tmp/yara.sock rules.yar
+
+Requests and responses are JSON objects, one per line. A request has an "id"
+chosen by the client and one of:
+
+  "path": path of the file to scan.
+  "data": base64-encoded data to scan.
+  "fd": true, the file descriptor to scan is passed along with the request
+        as SCM_RIGHTS ancillary data.
+
+Responses are sent as scans finish, which is not necessarily the order in
+which requests were received. They have the "id" of their request and either
+"matches", with a list of objects describing the matching rules, or "error"
+and "type" describing the exception raised by the scan.
+
+Scans run in worker processes forked by yara.ScanPool. Use Client for
+talking to the daemon from Python:
+
+  with yara_server.Client('/tmp/yara.sock') as client:
+    matches = client.scan('/bin/ls')
+"""
+
+import array
+import base64
+import collections
+import json
+import optparse
+import os
+import socket
+import stat
+import sys
+import threading
+
+try:
+  from os import cpu_count
+except ImportError:
+  from multiprocessing import cpu_count
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import yara
+
+
+def _receive_messages(sock):
+  """Yields the lines received from "sock" and the file descriptors received
+  along with them, until the peer closes the connection."""
+  buffer = b''
+  fds = []
+  while True:
+    if hasattr(sock, 'recvmsg'):
+      fd_size = array.array('i').itemsize
+      data, ancdata, _, _ = sock.recvmsg(
+          65536, socket.CMSG_SPACE(16 * fd_size))
+      for level, type, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+          received = array.array('i')
+          received.frombytes(
+              cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fd_size)])
+          fds.extend(received)
+    else:
+      data = sock.recv(65536)
+    if not data:
+      break
+    buffer += data
+    while b'\n' in buffer:
+      line, buffer = buffer.split(b'\n', 1)
+      yield line, fds
+  for fd in fds:
+    os.close(fd)
+
+
+def match_to_dict(match):
+  """Returns a JSON-serializable dictionary describing a Match object."""
+  result = {
+      'rule': match.rule,
+      'namespace': match.namespace,
+      'tags': match.tags,
+      'meta': match.meta,
+      'strings': [
+          [offset, identifier, base64.b64encode(data).decode('ascii')]
+          for offset, identifier, data in match.strings]}
+  if match.truncated:
+    result['truncated'] = True
+  return result
+
+
+class _Connection(object):
+  """A client connection. Responses are written by the scanning threads, so
+  writes are serialized, and the socket is closed once the client has closed
+  its side and all its requests have been answered."""
+
+  def __init__(self, sock):
+    self.sock = sock
+    self.lock = threading.Lock()
+    self.pending = 0
+    self.reading = True
+
+  def begin(self):
+    with self.lock:
+      self.pending += 1
+
+  def respond(self, response):
+    line = json.dumps(response).encode('utf-8') + b'\n'
+    with self.lock:
+      try:
+        self.sock.sendall(line)
+      except socket.error:
+        pass
+      self.pending -= 1
+      self._close_if_done()
+
+  def finish_reading(self):
+    with self.lock:
+      self.reading = False
+      self._close_if_done()
+
+  def _close_if_done(self):
+    if not self.reading and self.pending == 0:
+      self.sock.close()
+
+
+class Server(object):
+  """Scanning daemon listening on the UNIX socket at "address".
+
+  Each of the "workers" threads scans with its own yara.ScanPool, so a crash
+  while scanning a sample only affects the request for that sample.
+  """
+
+  def __init__(self, rules, address, workers=None, timeout=0, fast=False):
+    self.rules = rules
+    self.address = address
+    self._requests = queue.Queue()
+    self._lock = threading.Lock()
+    self._stopped = threading.Event()
+    self._threads = []
+    self._connections = set()
+    self._pools = [
+        yara.ScanPool(rules, processes=1, timeout=timeout, fast=fast)
+        for _ in range(workers or cpu_count() or 1)]
+
+    if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+      os.unlink(address)
+
+    # The socket is only accessible by the user running the daemon.
+    umask = os.umask(0o077)
+    try:
+      self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self._socket.bind(address)
+    finally:
+      os.umask(umask)
+
+    self._socket.listen(64)
+    self._socket.settimeout(0.5)
+
+  def serve_forever(self):
+    """Accepts connections until shutdown() is called."""
+    for pool in self._pools:
+      self._start_thread('scanner', self._scan_requests, pool)
+    while not self._stopped.is_set():
+      try:
+        sock, _ = self._socket.accept()
+      except socket.timeout:
+        continue
+      except socket.error:
+        if self._stopped.is_set():
+          break
+        raise
+      with self._lock:
+        if self._stopped.is_set():
+          sock.close()
+          break
+        sock.settimeout(None)
+        connection = _Connection(sock)
+        self._connections.add(connection)
+        self._start_thread('reader', self._read_requests, connection)
+
+  def shutdown(self):
+    """Stops accepting connections and scanning, and releases the workers."""
+    with self._lock:
+      self._stopped.set()
+    self._socket.close()
+    # Unblock the threads reading requests from clients that are still
+    # connected, so that they finish before the scanning threads do.
+    with self._lock:
+      connections = list(self._connections)
+    for connection in connections:
+      try:
+        connection.sock.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+    for thread in self._threads:
+      if thread.name == 'reader':
+        thread.join()
+    for _ in self._pools:
+      self._requests.put(None)
+    for thread in self._threads:
+      if thread is not threading.current_thread():
+        thread.join()
+    for pool in self._pools:
+      pool.close()
+    if os.path.exists(self.address):
+      os.unlink(self.address)
+
+  def _start_thread(self, name, target, *args):
+    thread = threading.Thread(name=name, target=target, args=args)
+    thread.start()
+    self._threads = [t for t in self._threads if t.is_alive()]
+    self._threads.append(thread)
+
+  def _read_requests(self, connection):
+    try:
+      for line, fds in _receive_messages(connection.sock):
+        fd = None
+        try:
+          request = json.loads(line.decode('utf-8'))
+          if request.get('fd'):
+            fd = fds.pop(0)
+        except (ValueError, IndexError):
+          request = {'error': 'invalid request'}
+        connection.begin()
+        self._requests.put((connection, request, fd))
+    except socket.error:
+      pass
+    with self._lock:
+      self._connections.discard(connection)
+    connection.finish_reading()
+
+  def _scan_requests(self, pool):
+    while True:
+      item = self._requests.get()
+      if item is None:
+        break
+      connection, request, fd = item
+      connection.respond(self._scan(pool, request, fd))
+
+  def _scan(self, pool, request, fd):
+    response = {'id': request.get('id')}
+    try:
+      if 'error' in request:
+        raise ValueError(request['error'])
+      if fd is not None:
+        sample = fd
+      elif 'path' in request:
+        sample = request['path']
+      elif 'data' in request:
+        sample = bytearray(base64.b64decode(request['data']))
+      else:
+        raise ValueError('nothing to scan')
+      matches = pool.map([sample])[0]
+      response['matches'] = [match_to_dict(m) for m in matches]
+    except Exception as e:
+      response['error'] = str(e)
+      response['type'] = type(e).__name__
+    finally:
+      if fd is not None:
+        os.close(fd)
+    return response
+
+
+class Client(object):
+  """Client for a scanning daemon listening at "address"."""
+
+  def __init__(self, address):
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._socket.connect(address)
+    self._messages = _receive_messages(self._socket)
+    self._responses = collections.OrderedDict()
+    self._next_id = 0
+
+  def close(self):
+    self._socket.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def send(self, sample):
+    """Sends a request for scanning "sample" and returns the request id.
+
+    Samples are paths, file descriptors, or bytes-like objects with the data
+    to scan. As in yara.ScanPool, in Python 2 str objects are paths, data must
+    be passed as a bytearray.
+    """
+    self._next_id += 1
+    request = {'id': self._next_id}
+    fds = []
+    if isinstance(sample, str) or (
+        sys.version_info[0] < 3 and isinstance(sample, unicode)):
+      request['path'] = sample
+    elif isinstance(sample, int):
+      request['fd'] = True
+      fds.append(sample)
+    else:
+      request['data'] = base64.b64encode(bytes(sample)).decode('ascii')
+    line = json.dumps(request).encode('utf-8') + b'\n'
+    if fds:
+      self._socket.sendmsg(
+          [line],
+          [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+    else:
+      self._socket.sendall(line)
+    return self._next_id
+
+  def receive(self):
+    """Returns the next response sent by the daemon, including those received
+    by scan() while waiting for the response to its own request."""
+    if self._responses:
+      return self._responses.popitem(last=False)[1]
+    return self._receive()
+
+  def _receive(self):
+    for line, _ in self._messages:
+      return json.loads(line.decode('utf-8'))
+    raise EOFError('connection closed by the daemon')
+
+  def scan(self, sample):
+    """Scans "sample" and returns the list of matching rules, as
+    dictionaries. Raises yara.Error if the scan fails. Responses to other
+    requests received in the meantime are kept for receive()."""
+    request_id = self.send(sample)
+    while request_id not in self._responses:
+      response = self._receive()
+      self._responses[response['id']] = response
+    response = self._responses.pop(request_id)
+    if 'error' in response:
+      if response.get('type') == 'TimeoutError':
+        raise yara.TimeoutError(response['error'])
+      raise yara.Error(response['error'])
+    return response['matches']
+
+  def scan_many(self, samples):
+    """Scans all "samples" and yields (sample, response) pairs as responses
+    arrive. Requests are sent from a separate thread so that the daemon
+    can work on several of them at once."""
+    requests = {}
+    lock = threading.Lock()
+    sent = threading.Event()
+
+    def send_all():
+      for sample in samples:
+        with lock:
+          requests[self.send(sample)] = sample
+      sent.set()
+
+    sender = threading.Thread(target=send_all)
+    sender.start()
+
+    received = 0
+    while not sent.is_set() or received < len(requests):
+      response = self.receive()
+      with lock:
+        sample = requests[response['id']]
+      received += 1
+      yield sample, response
+    sender.join()
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options] RULES')
+  parser.add_option(
+      '--socket', help='path of the UNIX socket to listen at')
+  parser.add_option(
+      '--compiled', action='store_true',
+      help='RULES is a compiled rules file saved with Rules.save()')
+  parser.add_option(
+      '--workers', type='int', help='number of concurrent scans')
+  parser.add_option(
+      '--timeout', type='int', default=0, help='timeout for each scan')
+  parser.add_option(
+      '--fast', action='store_true', help='scan in fast mode')
+  options, args = parser.parse_args()
+
+  if len(args) != 1 or not options.socket:
+    parser.error('RULES and --socket are required')
+
+  if options.compiled:
+    rules = yara.load(args[0])
+  else:
+    rules = yara.compile(filepath=args[0])
+
+  server = Server(
+      rules,
+      options.socket,
+      workers=options.workers,
+      timeout=options.timeout,
+      fast=options.fast)
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.shutdown()
+
+
+if __name__ == '__main__':
+  main()